@@ -0,0 +1,253 @@
+"""
+Executor for the addon functions.
+
+Synchronous addons (gmail, image generation, the Google APIs, ...) would block the
+event loop, and with it the streaming of every connected user, so they run on a
+bounded thread pool. Every addon has a timeout and a limit on the number of calls
+that run at the same time, and the calls of a user are cancelled when the user
+presses stop. The queue wait and execution time of every call are recorded.
+
+A timed out or cancelled call that already started keeps its worker thread until
+the function returns (threads can't be killed), but the caller gets the error
+response right away. Calls that are still queued are dropped.
+"""
+
+import asyncio
+import contextvars
+import functools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import logs
+from config import (
+    ADDON_CONCURRENCY,
+    ADDON_CONCURRENCY_LIMITS,
+    ADDON_MAX_WORKERS,
+    ADDON_TIMEOUT,
+    ADDON_TIMEOUTS,
+)
+
+logger = logs.Log("addon_executor", "addon_executor.log").get_logger()
+
+
+class AddonCancelledError(Exception):
+    """The addon call was cancelled because the user pressed stop."""
+
+
+class AddonStats:
+    """Queue wait and execution time statistics of one addon."""
+
+    __slots__ = (
+        "calls",
+        "errors",
+        "timeouts",
+        "cancelled",
+        "total_queue_wait",
+        "max_queue_wait",
+        "total_execution_time",
+        "max_execution_time",
+    )
+
+    def __init__(self):
+        for name in self.__slots__:
+            setattr(self, name, 0)
+
+    def record(self, queue_wait, execution_time, outcome):
+        self.calls += 1
+        if outcome == "error":
+            self.errors += 1
+        elif outcome == "timeout":
+            self.timeouts += 1
+        elif outcome == "cancelled":
+            self.cancelled += 1
+        self.total_queue_wait += queue_wait
+        self.max_queue_wait = max(self.max_queue_wait, queue_wait)
+        self.total_execution_time += execution_time
+        self.max_execution_time = max(self.max_execution_time, execution_time)
+
+    def to_dict(self):
+        calls = self.calls or 1
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "timeouts": self.timeouts,
+            "cancelled": self.cancelled,
+            "avg_queue_wait": round(self.total_queue_wait / calls, 4),
+            "max_queue_wait": round(self.max_queue_wait, 4),
+            "avg_execution_time": round(self.total_execution_time / calls, 4),
+            "max_execution_time": round(self.max_execution_time, 4),
+        }
+
+
+class AddonCall:
+    """Timings of a single addon call."""
+
+    __slots__ = ("name", "queue_wait", "execution_time", "outcome")
+
+    def __init__(self, name):
+        self.name = name
+        self.queue_wait = 0.0
+        self.execution_time = 0.0
+        self.outcome = "ok"
+
+
+class AddonExecutor:
+    def __init__(
+        self,
+        max_workers=ADDON_MAX_WORKERS,
+        default_timeout=ADDON_TIMEOUT,
+        timeouts=None,
+        default_concurrency=ADDON_CONCURRENCY,
+        concurrency_limits=None,
+    ):
+        self.max_workers = max_workers
+        self.default_timeout = default_timeout
+        self.timeouts = dict(ADDON_TIMEOUTS if timeouts is None else timeouts)
+        self.default_concurrency = default_concurrency
+        self.concurrency_limits = dict(
+            ADDON_CONCURRENCY_LIMITS
+            if concurrency_limits is None
+            else concurrency_limits
+        )
+        self._pool = None
+        self._semaphores = {}
+        self._tasks = {}
+        self._cancelled = set()
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    @property
+    def pool(self):
+        if self._pool is None:
+            with self._lock:
+                if self._pool is None:
+                    self._pool = ThreadPoolExecutor(
+                        max_workers=self.max_workers, thread_name_prefix="addon"
+                    )
+        return self._pool
+
+    def get_timeout(self, name):
+        return self.timeouts.get(name, self.default_timeout)
+
+    def _get_semaphore(self, name):
+        # asyncio semaphores belong to the event loop they are used in
+        loop = asyncio.get_running_loop()
+        semaphore_loop, semaphore = self._semaphores.get(name, (None, None))
+        if semaphore_loop is not loop:
+            semaphore = asyncio.Semaphore(
+                self.concurrency_limits.get(name, self.default_concurrency)
+            )
+            self._semaphores[name] = (loop, semaphore)
+        return semaphore
+
+    async def run(self, name, function, kwargs, username=None):
+        """Run an addon function and return its result and the AddonCall timings.
+
+        Raises asyncio.TimeoutError when the addon times out and
+        AddonCancelledError when the call was cancelled by cancel().
+        """
+        call = AddonCall(name)
+        task = asyncio.ensure_future(self._execute(call, function, kwargs))
+        self._tasks.setdefault(username, set()).add(task)
+        try:
+            return await task, call
+        except asyncio.TimeoutError:
+            call.outcome = "timeout"
+            raise
+        except asyncio.CancelledError:
+            call.outcome = "cancelled"
+            if task in self._cancelled:
+                raise AddonCancelledError(f"{name} was cancelled") from None
+            task.cancel()
+            raise
+        except Exception:
+            call.outcome = "error"
+            raise
+        finally:
+            self._cancelled.discard(task)
+            user_tasks = self._tasks.get(username)
+            if user_tasks is not None:
+                user_tasks.discard(task)
+                if not user_tasks:
+                    self._tasks.pop(username, None)
+            self._record(call, username)
+
+    async def _execute(self, call, function, kwargs):
+        queued_at = time.perf_counter()
+        timeout = self.get_timeout(call.name)
+        async with self._get_semaphore(call.name):
+            if asyncio.iscoroutinefunction(function):
+                call.queue_wait = time.perf_counter() - queued_at
+                started_at = time.perf_counter()
+                try:
+                    return await asyncio.wait_for(function(**kwargs), timeout)
+                finally:
+                    call.execution_time = time.perf_counter() - started_at
+
+            loop = asyncio.get_running_loop()
+            started = asyncio.Event()
+            times = {}
+
+            def timed():
+                times["started"] = time.perf_counter()
+                try:
+                    loop.call_soon_threadsafe(started.set)
+                except RuntimeError:
+                    # the event loop is already closed
+                    pass
+                try:
+                    return function(**kwargs)
+                finally:
+                    times["finished"] = time.perf_counter()
+
+            context = contextvars.copy_context()
+            future = loop.run_in_executor(
+                self.pool, functools.partial(context.run, timed)
+            )
+            waiter = asyncio.ensure_future(started.wait())
+            try:
+                # the timeout starts when a worker picks the call up
+                await asyncio.wait(
+                    {waiter, future}, return_when=asyncio.FIRST_COMPLETED
+                )
+                return await asyncio.wait_for(asyncio.shield(future), timeout)
+            finally:
+                waiter.cancel()
+                future.cancel()
+                now = time.perf_counter()
+                started_at = times.get("started", now)
+                call.queue_wait = started_at - queued_at
+                call.execution_time = times.get("finished", now) - started_at
+
+    def _record(self, call, username):
+        with self._lock:
+            self._stats.setdefault(call.name, AddonStats()).record(
+                call.queue_wait, call.execution_time, call.outcome
+            )
+        logger.debug(
+            f"Addon {call.name} for {username}: {call.outcome}, queue wait "
+            f"{call.queue_wait:.3f}s, execution time {call.execution_time:.3f}s"
+        )
+
+    def cancel(self, username):
+        """Cancel the running and queued addon calls of a user, returns the number of calls."""
+        tasks = [task for task in self._tasks.get(username, ()) if not task.done()]
+        for task in tasks:
+            self._cancelled.add(task)
+            task.cancel()
+        return len(tasks)
+
+    def get_statistics(self):
+        """Return the statistics of every addon that was called."""
+        with self._lock:
+            return {name: stats.to_dict() for name, stats in self._stats.items()}
+
+    def shutdown(self):
+        """Drop the queued calls and stop the worker threads."""
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+
+addon_executor = AddonExecutor()
@@ -0,0 +1,176 @@
+"""
+Process wide addon registry.
+
+Every addon module in the addons directory is imported once and its tool schemas
+(the OpenAI and the Claude shape) are built once. The directory is scanned for
+modified files at most every ADDON_SCAN_INTERVAL seconds, only the modules whose
+file changed are reloaded. The enabled addons of a user are a filter over the
+shared registry.
+"""
+
+import importlib
+import os
+import sys
+import threading
+import time
+
+import logs
+from config import ADDON_SCAN_INTERVAL
+
+logger = logs.Log("addon_registry", "addon_registry.log").get_logger()
+
+
+def to_claude_tool(tool):
+    """Convert an OpenAI tool (or bare function) schema to Claude's tool format."""
+    function = tool.get("function", {})
+    return {
+        "name": function.get("name") or tool.get("name"),
+        "description": function.get("description") or tool.get("description"),
+        "input_schema": {
+            "type": "object",
+            "properties": function.get("parameters", {}).get("properties")
+            or tool.get("parameters", {}).get("properties", {}),
+            "required": function.get("parameters", {}).get("required")
+            or tool.get("parameters", {}).get("required", []),
+        },
+    }
+
+
+class Addon:
+    """An imported addon module and its tool schemas."""
+
+    def __init__(self, name, path, mtime, module=None, error=None):
+        self.name = name
+        self.path = path
+        self.mtime = mtime
+        self.module = module
+        self.error = error
+        self.openai_tool = None
+        self.claude_tool = None
+        if module is not None and error is None:
+            self.openai_tool = {
+                "type": "function",
+                "function": {
+                    "name": name,
+                    "description": getattr(module, "description", "No description"),
+                    "parameters": getattr(module, "parameters", "No parameters"),
+                },
+            }
+            self.claude_tool = to_claude_tool(self.openai_tool)
+
+    @property
+    def loaded(self):
+        return self.openai_tool is not None
+
+
+class AddonRegistry:
+    """Registry of the addon modules of a directory, shared by all users."""
+
+    def __init__(
+        self, addons_dir="addons", package="addons", scan_interval=ADDON_SCAN_INTERVAL
+    ):
+        self.addons_dir = addons_dir
+        self.package = package
+        self.scan_interval = scan_interval
+        self._addons = {}
+        self._scanned_at = None
+        self._lock = threading.RLock()
+
+    def refresh(self, force=False):
+        """Import new addons, reload the modified ones and drop the deleted ones.
+
+        The directory is only scanned if the last scan is older than the scan
+        interval, unless force is set.
+        """
+        now = time.monotonic()
+        if (
+            not force
+            and self._scanned_at is not None
+            and now - self._scanned_at < self.scan_interval
+        ):
+            return
+        with self._lock:
+            if (
+                not force
+                and self._scanned_at is not None
+                and now - self._scanned_at < self.scan_interval
+            ):
+                return
+            files = {}
+            with os.scandir(self.addons_dir) as entries:
+                for entry in entries:
+                    if (
+                        entry.is_file()
+                        and entry.name.endswith(".py")
+                        and entry.name != "__init__.py"
+                    ):
+                        files[entry.name[:-3]] = (entry.path, entry.stat().st_mtime_ns)
+
+            for name in list(self._addons):
+                if name not in files:
+                    del self._addons[name]
+                    sys.modules.pop(f"{self.package}.{name}", None)
+                    logger.info(f"Addon {name} removed")
+
+            for name, (path, mtime) in sorted(files.items()):
+                addon = self._addons.get(name)
+                if addon is None or addon.mtime != mtime:
+                    self._addons[name] = self._import(name, path, mtime, addon)
+            self._scanned_at = time.monotonic()
+
+    def _import(self, name, path, mtime, previous=None):
+        module_name = f"{self.package}.{name}"
+        try:
+            module = sys.modules.get(module_name)
+            if previous is not None and module is not None:
+                module = importlib.reload(module)
+                logger.info(f"Addon {name} reloaded")
+            else:
+                module = importlib.import_module(module_name)
+        except Exception as e:
+            logger.error(f"Could not import addon {name}: {e}")
+            return Addon(name, path, mtime, error=f"Could not import {name}: {e}")
+        if not callable(getattr(module, name, None)):
+            return Addon(
+                name,
+                path,
+                mtime,
+                module=module,
+                error=f"Module {name} does not have a function with the same name.",
+            )
+        return Addon(name, path, mtime, module=module)
+
+    def get_addons(self, enabled=None):
+        """Return the addons, filtered by a {name: enabled} mapping if given."""
+        self.refresh()
+        with self._lock:
+            addons = list(self._addons.values())
+        if enabled is None:
+            return addons
+        return [addon for addon in addons if enabled.get(addon.name, False)]
+
+    def get_modules(self, enabled=None):
+        """Return {name: module} of the loaded addons."""
+        return {
+            addon.name: addon.module
+            for addon in self.get_addons(enabled)
+            if addon.loaded
+        }
+
+    def get_openai_tools(self, enabled=None):
+        return [addon.openai_tool for addon in self.get_addons(enabled) if addon.loaded]
+
+    def get_claude_tools(self, enabled=None):
+        return [addon.claude_tool for addon in self.get_addons(enabled) if addon.loaded]
+
+    def claude_tool_for(self, tool):
+        """Return the prebuilt Claude schema if the tool is one of the registry's, else convert it."""
+        name = tool.get("function", {}).get("name") or tool.get("name")
+        with self._lock:
+            addon = self._addons.get(name)
+        if addon is not None and addon.openai_tool is tool:
+            return addon.claude_tool
+        return to_claude_tool(tool)
+
+
+addon_registry = AddonRegistry()
@@ -7,6 +7,8 @@ from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from gworkspace.google_auth import onEnable, SCOPES
 from duckduckgo_search import DDGS
+from config import WEB_CACHE_SEARCH_TTL
+from web_cache import record_event, web_cache
 
 description = """
 Used to perform web searches using the Google Custom Search API.
@@ -57,6 +59,14 @@ def search_duckduckgo(
     if not query:
         return "No search query provided."
 
+    key = "duckduckgo:" + json.dumps(
+        [query, region, safesearch, timelimit, max_results], sort_keys=True
+    )
+    cached = web_cache.get(key)
+    if cached is not None and cached.fresh:
+        record_event(f"duckduckgo: {query}", "fresh")
+        return cached.value
+
     try:
         ddgs = DDGS()
         results = ddgs.text(
@@ -71,6 +81,9 @@ def search_duckduckgo(
             result_text += f"Title: {result['title']}\n"
             result_text += f"URL: {result['href']}\n"
             result_text += f"Snippet: {result['body']}\n\n"
+        record_event(f"duckduckgo: {query}", "miss")
+        if result_text:
+            web_cache.put(key, result_text, ttl=WEB_CACHE_SEARCH_TTL)
         return result_text
     except Exception as e:
         print(f"DuckDuckGo search error: {e}")
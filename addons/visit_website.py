@@ -1,10 +1,9 @@
-import requests
-from bs4 import BeautifulSoup
-import json
-import tiktoken
+import asyncio
 
 from config import USERS_DIR
 from utils import SettingsManager
+from web_cache import record_event, web_cache
+from web_fetch import extract_page_async, truncate_to_tokens, web_fetcher
 
 description = """
 Used to visit websites and scrape data from them.
@@ -43,46 +42,61 @@ async def visit_website(urls, include_links=True, include_images=False, username
     settings = await SettingsManager.load_settings(USERS_DIR, username)
     max_tokens = settings.get("memory", {}).get("max_tokens", 4096)
     max_tokens_per_site = max_tokens // len(urls)  # Distribute tokens evenly
+    model = settings.get("active_model", {}).get("active_model", "gpt-4o")
     print(f"DEBUG: Max tokens per site: {max_tokens_per_site}")
+
+    # fetch all urls concurrently, the bodies are capped at WEB_FETCH_MAX_BYTES
+    pages = await asyncio.gather(*(get_page(url) for url in urls))
+
     result = ""
-    enc = tiktoken.encoding_for_model("gpt-3.5-turbo")
-
-    for url in urls:
-        try:
-            response = requests.get(url)
-            response.raise_for_status()
-            soup = BeautifulSoup(response.text, "html.parser")
-            for script in soup(["script", "style"]):
-                script.decompose()
-
-            site_result = f"URL: {url}\n"
-
-            # Process text
-            text = " ".join(soup.stripped_strings)
-            site_result += "Text: " + text + "\n"
-
-            # Process links if included
-            if include_links:
-                links = [
-                    link.get("href") for link in soup.find_all("a") if link.get("href")
-                ]
-                site_result += "Links: " + "\n".join(links) + "\n"
-
-            # Process images if included
-            if include_images:
-                images = [
-                    img.get("src") for img in soup.find_all("img") if img.get("src")
-                ]
-                site_result += "Images: " + "\n".join(images) + "\n"
-
-            # Truncate site_result to max_tokens_per_site
-            tokens = enc.encode(site_result)
-            if len(tokens) > max_tokens_per_site:
-                site_result = enc.decode(tokens[:max_tokens_per_site])
-
-            result += site_result + "\n\n"
-        except Exception as e:
-            print(f"Visit website error: {e}")
-            result += f"Error for URL {url}: {str(e)}\n\n"
+    for url, (page, error) in zip(urls, pages):
+        if error is not None:
+            print(f"Visit website error: {error}")
+            result += f"Error for URL {url}: {error}\n\n"
+            continue
+
+        site_result = f"URL: {url}\n"
+
+        # Process text
+        site_result += "Text: " + page["text"] + "\n"
+
+        # Process links if included
+        if include_links:
+            site_result += "Links: " + "\n".join(page["links"]) + "\n"
+
+        # Process images if included
+        if include_images:
+            site_result += "Images: " + "\n".join(page["images"]) + "\n"
+
+        # Truncate site_result to max_tokens_per_site
+        site_result = truncate_to_tokens(site_result, max_tokens_per_site, model)
+
+        result += site_result + "\n\n"
 
     return result
+
+
+async def get_page(url):
+    """Return the extracted page (text, links and images) and the error, from the web cache if possible."""
+    key = f"page:{url}"
+    cached = await web_cache.get_async(key)
+    if cached is not None and cached.fresh:
+        record_event(url, "fresh")
+        return cached.value, None
+
+    headers = None
+    if cached is not None and cached.revalidatable:
+        headers = cached.conditional_headers()
+    response = await web_fetcher.fetch(url, headers=headers)
+    if not response.ok:
+        return None, response.error
+    if response.status == 304 and cached is not None:
+        await web_cache.revalidated_async(key, response.headers)
+        record_event(url, "revalidated")
+        return cached.value, None
+
+    record_event(url, "miss")
+    page = await extract_page_async(response.body, response.encoding, True, True)
+    if response.status == 200:
+        await web_cache.put_async(key, page, response.headers)
+    return page, None
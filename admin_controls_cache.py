@@ -0,0 +1,211 @@
+"""
+Process-wide cache of the admin controls.
+
+The daily spending limit and the maintenance mode are read on every page load
+but change maybe once a month, so they are kept in memory. AdminControlsDAO
+refreshes the cache when it changes the admin controls and, on postgres, sends
+NOTIFY admin_controls in the same transaction. Every worker runs a thread that
+LISTENs for the notification and reloads the admin controls (and drops the
+cached user contexts, which include the daily limit) when another worker
+changed them. The thread also revalidates the cache every
+ADMIN_CONTROLS_TTL / 2 seconds, so a request only reads the database if the
+thread isn't running.
+
+The same thread LISTENs for the user_sessions notifications of UsersDAO (see
+session_cache) and drops the cached sessions and context of the user, so a
+logout or a revoked access on one worker applies to all of them.
+"""
+
+import json
+import select
+import threading
+import time
+
+import psycopg2
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+from sqlalchemy import text
+from sqlalchemy.engine import make_url
+
+import logs
+from config import ADMIN_CONTROLS_TTL, new_database_url
+from session_cache import NOTIFY_CHANNEL as SESSIONS_CHANNEL, session_cache
+from user_context import DEFAULT_DAILY_LIMIT, user_context_cache
+from user_management.models import AdminControls
+from user_management.session import session_factory
+
+logger = logs.Log("admin_controls_cache", "admin_controls_cache.log").get_logger()
+
+NOTIFY_CHANNEL = "admin_controls"
+# seconds to wait before listening again after the connection was lost
+LISTEN_RETRY_DELAY = 5
+
+
+class AdminControlsSnapshot:
+    """The columns of the AdminControls row, detached from the database session."""
+
+    def __init__(self, row=None):
+        for column in AdminControls.__table__.columns:
+            setattr(self, column.name, getattr(row, column.name, None))
+        if row is None:
+            # like AdminControlsDAO when there are no admin controls yet
+            self.id = 1
+            self.daily_spending_limit = DEFAULT_DAILY_LIMIT
+            self.maintenance = False
+
+    def __repr__(self):
+        return (
+            f"<AdminControlsSnapshot(daily_spending_limit={self.daily_spending_limit}, "
+            f"maintenance={self.maintenance})>"
+        )
+
+
+def load_admin_controls(session):
+    return AdminControlsSnapshot(
+        session.query(AdminControls).order_by(AdminControls.id).first()
+    )
+
+
+def notify_admin_controls_changed(session):
+    """Tell the other workers the admin controls change when the session commits."""
+    if session.get_bind().dialect.name == "postgresql":
+        session.execute(text(f"NOTIFY {NOTIFY_CHANNEL}"))
+
+
+def listen_dsn():
+    """The libpq connection string of NEW_DATABASE_URL, None if it isn't postgres."""
+    url = make_url(new_database_url())
+    if url.get_backend_name() != "postgresql":
+        return None
+    return url.set(drivername="postgresql").render_as_string(hide_password=False)
+
+
+class AdminControlsCache:
+    def __init__(self, ttl=ADMIN_CONTROLS_TTL, loader=load_admin_controls):
+        self.ttl = ttl
+        self.loader = loader
+        self._controls = None
+        self._loaded = None
+        self._generation = 0
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def get(self) -> AdminControlsSnapshot:
+        """Return the admin controls, from the cache when they are fresh."""
+        with self._lock:
+            if (
+                self._controls is not None
+                and time.monotonic() - self._loaded < self.ttl
+            ):
+                return self._controls
+        return self.refresh()
+
+    @property
+    def daily_limit(self):
+        return self.get().daily_spending_limit
+
+    @property
+    def maintenance(self):
+        return bool(self.get().maintenance)
+
+    def refresh(self) -> AdminControlsSnapshot:
+        """Load the admin controls from the database."""
+        with self._lock:
+            generation = self._generation
+        session = session_factory.get_session().session
+        try:
+            controls = self.loader(session)
+        finally:
+            session.close()
+        with self._lock:
+            # don't cache what an invalidation in the meantime may have changed
+            if self._generation == generation:
+                self._controls = controls
+                self._loaded = time.monotonic()
+        return controls
+
+    def invalidate(self):
+        with self._lock:
+            self._generation += 1
+            self._controls = None
+
+    def _revalidate(self):
+        try:
+            self.refresh()
+        except Exception as e:
+            logger.error(f"Could not load the admin controls: {e}")
+
+    @staticmethod
+    def _sessions_changed(payload):
+        try:
+            user = json.loads(payload)
+            user = {"username": user.get("username"), "user_id": user.get("user_id")}
+        except (ValueError, AttributeError):
+            logger.error(f"Invalid {SESSIONS_CHANNEL} notification: {payload}")
+            # drop all sessions rather than keep one that was invalidated
+            user = {}
+        session_cache.invalidate(**user)
+        user_context_cache.invalidate(**user)
+
+    def _listen(self, dsn):
+        connection = psycopg2.connect(dsn)
+        try:
+            connection.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+            with connection.cursor() as cursor:
+                cursor.execute(f"LISTEN {NOTIFY_CHANNEL}")
+                cursor.execute(f"LISTEN {SESSIONS_CHANNEL}")
+            # a change before LISTEN wasn't notified
+            self._revalidate()
+            while not self._stopped.is_set():
+                readable, _, _ = select.select([connection], [], [], self.ttl / 2)
+                if not readable:
+                    self._revalidate()
+                    continue
+                connection.poll()
+                notifies = list(connection.notifies)
+                connection.notifies.clear()
+                for notify in notifies:
+                    if notify.channel == SESSIONS_CHANNEL:
+                        self._sessions_changed(notify.payload)
+                if any(notify.channel == NOTIFY_CHANNEL for notify in notifies):
+                    logger.debug("The admin controls changed")
+                    user_context_cache.invalidate()
+                    self._revalidate()
+        finally:
+            connection.close()
+
+    def start(self):
+        """Listen for changes and revalidate the cache on a background thread."""
+        if self._thread is not None:
+            return
+        dsn = listen_dsn()
+
+        def run():
+            if dsn is None:
+                self._revalidate()
+                while not self._stopped.wait(self.ttl / 2):
+                    self._revalidate()
+                return
+            while not self._stopped.is_set():
+                try:
+                    self._listen(dsn)
+                except Exception as e:
+                    logger.error(f"Listening for admin control changes failed: {e}")
+                    # notifications may have been missed while not listening
+                    self.invalidate()
+                    user_context_cache.invalidate()
+                    session_cache.invalidate()
+                    self._stopped.wait(LISTEN_RETRY_DELAY)
+
+        self._stopped.clear()
+        self._thread = threading.Thread(
+            target=run, name="admin-controls-cache", daemon=True
+        )
+        self._thread.start()
+
+    def shutdown(self):
+        self._stopped.set()
+        self._thread = None
+
+
+admin_controls_cache = AdminControlsCache()
@@ -0,0 +1,285 @@
+"""
+Keyword index of the memories, next to the vector store.
+
+Every user gets a SQLite FTS5 index (users/<name>/keyword_index.db) of the
+documents of all categories. create_memory, update_memory and delete_memory
+keep it up to date. Operations that can't tell which memories they changed
+(delete_memories, wiping a category) mark the category as not indexed, and the
+next search of the category indexes it again from the collection. This also
+indexes the memories that were created before the index existed.
+
+The index ranks matches with BM25. reciprocal_rank_fusion() combines a BM25
+ranking with the ranking of a vector search for the hybrid search mode. A second
+FTS5 table of the same documents, tokenized into trigrams, finds the documents
+that contain a text anywhere, in the middle of a word too, for exact matches.
+"""
+
+import os
+import re
+import sqlite3
+import threading
+
+import logs
+
+logger = logs.Log("keyword_index", "keyword_index.log").get_logger()
+
+USERS_PATH = "users"
+INDEX_FILE = "keyword_index.db"
+# constant of the reciprocal rank fusion, a higher k lowers the weight of the
+# top ranks
+RRF_K = int(os.environ.get("MEMORY_RRF_K", 60))
+# documents read from the collection at once while (re)indexing a category
+REINDEX_BATCH_SIZE = 1000
+# the trigram table can't find texts shorter than this, they are looked up with
+# a scan of the index
+TRIGRAM_LENGTH = 3
+# stored in PRAGMA user_version, tables added by later versions are filled from
+# the documents of the index when it is opened
+SCHEMA_VERSION = 2
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS documents (
+    rowid INTEGER PRIMARY KEY,
+    category TEXT NOT NULL,
+    memory_id TEXT NOT NULL,
+    document TEXT NOT NULL,
+    UNIQUE (category, memory_id)
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS documents_fts USING fts5(
+    document,
+    content='documents',
+    content_rowid='rowid',
+    tokenize='unicode61 remove_diacritics 2'
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS documents_trigram USING fts5(
+    document,
+    content='documents',
+    content_rowid='rowid',
+    tokenize='trigram'
+);
+CREATE TRIGGER IF NOT EXISTS documents_insert AFTER INSERT ON documents BEGIN
+    INSERT INTO documents_fts (rowid, document) VALUES (new.rowid, new.document);
+END;
+CREATE TRIGGER IF NOT EXISTS documents_delete AFTER DELETE ON documents BEGIN
+    INSERT INTO documents_fts (documents_fts, rowid, document)
+    VALUES ('delete', old.rowid, old.document);
+END;
+CREATE TRIGGER IF NOT EXISTS documents_update AFTER UPDATE ON documents BEGIN
+    INSERT INTO documents_fts (documents_fts, rowid, document)
+    VALUES ('delete', old.rowid, old.document);
+    INSERT INTO documents_fts (rowid, document) VALUES (new.rowid, new.document);
+END;
+CREATE TRIGGER IF NOT EXISTS documents_trigram_insert AFTER INSERT ON documents BEGIN
+    INSERT INTO documents_trigram (rowid, document) VALUES (new.rowid, new.document);
+END;
+CREATE TRIGGER IF NOT EXISTS documents_trigram_delete AFTER DELETE ON documents BEGIN
+    INSERT INTO documents_trigram (documents_trigram, rowid, document)
+    VALUES ('delete', old.rowid, old.document);
+END;
+CREATE TRIGGER IF NOT EXISTS documents_trigram_update AFTER UPDATE ON documents BEGIN
+    INSERT INTO documents_trigram (documents_trigram, rowid, document)
+    VALUES ('delete', old.rowid, old.document);
+    INSERT INTO documents_trigram (rowid, document)
+    VALUES (new.rowid, new.document);
+END;
+-- the categories whose documents are all in the index
+CREATE TABLE IF NOT EXISTS indexed_categories (category TEXT PRIMARY KEY);
+"""
+
+_phrase_pattern = re.compile(r'"([^"]*)"')
+_word_pattern = re.compile(r"[^\W_]", re.UNICODE)
+
+
+def _quote(text):
+    return '"' + text.replace('"', '""') + '"'
+
+
+def build_match_query(text, match_all=True):
+    """
+    Turn a search text into an FTS5 query, None if it has no words.
+
+    Every word (a word like user_id or 3.14 included) and every quoted part of
+    the text must match, or any of them with match_all=False.
+    """
+    parts = _phrase_pattern.findall(text) + _phrase_pattern.sub(" ", text).split()
+    terms = [_quote(part) for part in parts if _word_pattern.search(part)]
+    if not terms:
+        return None
+    return (" AND " if match_all else " OR ").join(terms)
+
+
+def reciprocal_rank_fusion(*rankings, k=RRF_K):
+    """
+    Fuse rankings (lists of ids, best first) into one list of (id, score).
+
+    An id scores the sum of 1 / (k + rank) over the rankings it is in.
+    """
+    scores = {}
+    for ranking in rankings:
+        for rank, id in enumerate(ranking, start=1):
+            scores[id] = scores.get(id, 0.0) + 1.0 / (k + rank)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
+
+
+class KeywordIndex:
+    def __init__(self, users_path=USERS_PATH):
+        self.users_path = users_path
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def path(self, username):
+        return os.path.join(self.users_path, username, INDEX_FILE)
+
+    def connect(self, username):
+        path = self.path(username)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        connection = sqlite3.connect(path, timeout=30)
+        # cheap when the tables exist, and the users' directories may be deleted
+        connection.execute("PRAGMA journal_mode=WAL")
+        (version,) = connection.execute("PRAGMA user_version").fetchone()
+        connection.executescript(SCHEMA)
+        if version < SCHEMA_VERSION:
+            with connection:
+                # version 1 had no trigram table
+                connection.execute(
+                    "INSERT INTO documents_trigram (documents_trigram) VALUES ('rebuild')"
+                )
+                connection.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        return connection
+
+    def _user_lock(self, username):
+        with self._lock:
+            return self._locks.setdefault(username, threading.Lock())
+
+    def upsert(self, username, category, ids, documents):
+        with self.connect(username) as connection:
+            connection.executemany(
+                "INSERT INTO documents (category, memory_id, document) VALUES (?, ?, ?)"
+                " ON CONFLICT (category, memory_id) DO UPDATE"
+                " SET document = excluded.document",
+                [
+                    (category, str(id), str(document))
+                    for id, document in zip(ids, documents)
+                ],
+            )
+        connection.close()
+
+    def delete(self, username, category, ids):
+        with self.connect(username) as connection:
+            connection.executemany(
+                "DELETE FROM documents WHERE category = ? AND memory_id = ?",
+                [(category, str(id)) for id in ids],
+            )
+        connection.close()
+
+    def invalidate(self, username, category=None):
+        """Drop the documents of a category (or all of them), it is indexed again when searched."""
+        if not os.path.exists(self.path(username)):
+            return
+        with self.connect(username) as connection:
+            if category is None:
+                connection.execute("DELETE FROM documents")
+                connection.execute("DELETE FROM indexed_categories")
+            else:
+                connection.execute(
+                    "DELETE FROM documents WHERE category = ?", (category,)
+                )
+                connection.execute(
+                    "DELETE FROM indexed_categories WHERE category = ?", (category,)
+                )
+        connection.close()
+
+    def safely(self, operation, username, category, *args):
+        """Run an index update, on failure the category is indexed again when searched."""
+        if username is None:
+            return
+        try:
+            operation(username, category, *args)
+        except Exception as e:
+            logger.error(f"Could not update the keyword index of {username}: {e}")
+            try:
+                self.invalidate(username, category)
+            except Exception as e:
+                logger.error(f"Could not invalidate the keyword index: {e}")
+
+    def ensure_indexed(self, username, category, collection):
+        """Index the documents of the collection if the category isn't indexed."""
+        with self._user_lock(username):
+            connection = self.connect(username)
+            try:
+                indexed = connection.execute(
+                    "SELECT 1 FROM indexed_categories WHERE category = ?", (category,)
+                ).fetchone()
+            finally:
+                connection.close()
+            if indexed:
+                return
+            logger.info(f"Indexing the {category} memories of {username}")
+            self.invalidate(username, category)
+            offset = 0
+            while True:
+                batch = collection.get(
+                    include=["documents"], limit=REINDEX_BATCH_SIZE, offset=offset
+                )
+                if not batch["ids"]:
+                    break
+                self.upsert(username, category, batch["ids"], batch["documents"])
+                offset += len(batch["ids"])
+            with self.connect(username) as connection:
+                connection.execute(
+                    "INSERT OR IGNORE INTO indexed_categories (category) VALUES (?)",
+                    (category,),
+                )
+            connection.close()
+
+    def search(self, username, category, query, n_results=50):
+        """
+        Return the ids and BM25 scores (higher is better) of the best matches of
+        an FTS5 query, see build_match_query().
+        """
+        connection = self.connect(username)
+        try:
+            rows = connection.execute(
+                "SELECT documents.memory_id, bm25(documents_fts) AS rank"
+                " FROM documents_fts"
+                " JOIN documents ON documents.rowid = documents_fts.rowid"
+                " WHERE documents_fts MATCH ? AND documents.category = ?"
+                " ORDER BY rank LIMIT ?",
+                (query, category, n_results),
+            ).fetchall()
+        finally:
+            connection.close()
+        # bm25() is lower for better matches
+        return [(memory_id, -rank) for memory_id, rank in rows]
+
+    def search_substring(self, username, category, text, n_results=50, offset=0):
+        """
+        Return the ids and BM25 scores of the documents that contain text,
+        ignoring case, best first. The matches of texts shorter than
+        TRIGRAM_LENGTH aren't ranked, and only the case of ASCII letters is
+        ignored in them.
+        """
+        if len(text) >= TRIGRAM_LENGTH:
+            match = "documents_trigram MATCH ?"
+            order = "rank"
+            text = _quote(text)
+        else:
+            match = "documents_trigram.document LIKE ? ESCAPE '\\'"
+            order = "documents.rowid"
+            text = "%" + re.sub(r"([%_\\])", r"\\\1", text) + "%"
+        connection = self.connect(username)
+        try:
+            rows = connection.execute(
+                "SELECT documents.memory_id, bm25(documents_trigram) AS rank"
+                " FROM documents_trigram"
+                " JOIN documents ON documents.rowid = documents_trigram.rowid"
+                f" WHERE {match} AND documents.category = ?"
+                f" ORDER BY {order} LIMIT ? OFFSET ?",
+                (text, category, n_results, offset),
+            ).fetchall()
+        finally:
+            connection.close()
+        return [(memory_id, -rank) for memory_id, rank in rows]
+
+
+keyword_index = KeywordIndex()
@@ -1,4 +1,5 @@
 import datetime
+import functools
 import os
 import time
 import logs
@@ -15,7 +16,14 @@ from agentmemory.helpers import (
 )
 
 
-from agentmemory.client import get_client
+from agentmemory.client import CLIENT_TYPE, get_client
+from agentmemory.keyword_index import (
+    build_match_query,
+    keyword_index,
+    reciprocal_rank_fusion,
+)
+
+SEARCH_MODES = ("vector", "keyword", "hybrid")
 
 
 def create_memory(
@@ -89,6 +97,7 @@ def create_memory(
             metadatas=[metadata],
             embeddings=[embedding] if embedding is not None else None,
         )
+        keyword_index.safely(keyword_index.upsert, username, category, [id], [text])
         debug_log(f"Created memory {id}: {text}", metadata)
         return id
     except Exception as e:
@@ -163,6 +172,7 @@ def search_memory_by_date(
     min_distance=None,  # 0.0 - 1.0
     novel=False,
     username=None,
+    query_embedding=None,
 ):
     if filter_date is not None:
         # convert filter_date to string
@@ -243,9 +253,38 @@ def search_memory_by_date(
         min_distance=min_distance,
         novel=novel,
         username=username,
+        query_embedding=query_embedding,
     )
 
 
+@functools.lru_cache(maxsize=None)
+def _default_embedding_function():
+    from chromadb.utils.embedding_functions import DefaultEmbeddingFunction
+
+    return DefaultEmbeddingFunction()
+
+
+@functools.lru_cache(maxsize=256)
+def _embed_query(search_text):
+    if CLIENT_TYPE == "POSTGRES":
+        from agentmemory.check_model import infer_embeddings
+
+        embedding = infer_embeddings([search_text], model_path=os.environ["MODEL_PATH"])
+        return tuple(embedding[0].tolist())
+    return tuple(_default_embedding_function()([search_text])[0])
+
+
+def embed_query(search_text):
+    """
+    Embed a search text with the embedding model of the collections.
+
+    The embeddings of recent search texts are cached. Pass the embedding to
+    search_memory as query_embedding to embed a search text once for several
+    searches.
+    """
+    return list(_embed_query(search_text))
+
+
 def get_memory_by_date(
     category,
     filter_date=None,
@@ -332,6 +371,8 @@ def search_memory(
     novel=False,
     username=None,
     exact_match=False,
+    query_embedding=None,
+    search_mode="vector",
 ):
     """
     Search a collection with given query texts.
@@ -351,6 +392,12 @@ def search_memory(
     novel (bool): Only include memories that are marked as novel
     username (str): Username for the client
     exact_match (bool): Whether to perform an exact match search
+    query_embedding (list): Embedding of search_text (see embed_query), it is
+        embedded here if not given
+    search_mode (str): "vector" ranks by the distance of the embeddings,
+        "keyword" by the BM25 score of the words (and "quoted phrases") of
+        search_text, "hybrid" fuses both rankings. Keyword and hybrid results
+        have a score, the higher the better.
 
     Returns:
     list: List of search results.
@@ -378,20 +425,85 @@ def search_memory(
     if contains_text:
         where_document = {"$contains": contains_text}
 
-    # For exact match, we'll use get() instead of query()
-    if exact_match:
+    if search_mode not in SEARCH_MODES:
+        raise ValueError(f"search_mode must be one of {', '.join(SEARCH_MODES)}")
+    if username is None:
+        # the keyword index is kept per user
+        search_mode = "vector"
+
+    def get_ranked(ranking):
+        # the memories of the (id, score) ranking that match the filters, in order
+        if not ranking:
+            return []
         results = memories.get(
-            where=filter_metadata, where_document=where_document, include=include_types
+            ids=[id for id, _ in ranking],
+            where=filter_metadata,
+            where_document=where_document,
+            limit=len(ranking),
+            include=include_types,
         )
-        result_list = chroma_collection_to_list(results)
-        result_list = [
-            res for res in result_list if search_text.lower() in res["document"].lower()
-        ]
+        by_id = {str(res["id"]): res for res in chroma_collection_to_list(results)}
+        result_list = []
+        for id, score in ranking:
+            if id in by_id:
+                by_id[id]["score"] = score
+                result_list.append(by_id[id])
+        return result_list
+
+    def search_keywords(query, limit):
+        keyword_index.ensure_indexed(username, category, memories)
+        return keyword_index.search(username, category, query, limit)
+
+    if exact_match:
+
+        def contains_search_text(res):
+            return search_text.lower() in res["document"].lower()
+
+        if username is None:
+            # the keyword index is kept per user, scan the documents
+            results = memories.get(
+                where=filter_metadata,
+                where_document=where_document,
+                include=include_types,
+            )
+            result_list = [
+                res
+                for res in chroma_collection_to_list(results)
+                if contains_search_text(res)
+            ]
+        else:
+            # the trigram index finds the memories that contain search_text,
+            # they are read in batches until enough of them match the filters
+            keyword_index.ensure_indexed(username, category, memories)
+            batch_size = n_results * 2
+            result_list = []
+            offset = 0
+            while len(result_list) < n_results:
+                ranking = keyword_index.search_substring(
+                    username, category, search_text, batch_size, offset
+                )
+                result_list += [
+                    res for res in get_ranked(ranking) if contains_search_text(res)
+                ]
+                if len(ranking) < batch_size:
+                    break
+                offset += batch_size
         result_list = result_list[:n_results]  # Limit results after filtering
+        for res in result_list:
+            res.pop("score", None)
+    elif search_mode == "keyword":
+        query = build_match_query(search_text)
+        if query is None:
+            return []
+        # more candidates than needed, the filters may drop some of them
+        result_list = get_ranked(search_keywords(query, n_results * 2))
+        result_list = result_list[:n_results]
     else:
         # Perform the query for non-exact match
+        if query_embedding is None:
+            query_embedding = embed_query(search_text)
         query = memories.query(
-            query_texts=[search_text],
+            query_embeddings=[query_embedding],
             where=filter_metadata,
             where_document=where_document,
             n_results=n_results,
@@ -400,7 +512,6 @@ def search_memory(
         query = flatten_arrays(query)
         result_list = chroma_collection_to_list(query)
 
-    if not exact_match:
         if min_distance is not None and min_distance > 0:
             result_list = [
                 res for res in result_list if res.get("distance", 0) >= min_distance
@@ -411,6 +522,25 @@ def search_memory(
                 res for res in result_list if res.get("distance", 0) <= max_distance
             ]
 
+        if search_mode == "hybrid":
+            # any of the words may match, the fusion ranks the memories that
+            # match more of them and are close to the query first
+            query = build_match_query(search_text, match_all=False)
+            keyword_ranking = search_keywords(query, n_results) if query else []
+            by_id = {str(res["id"]): res for res in result_list}
+            fused = reciprocal_rank_fusion(
+                list(by_id), [id for id, _ in keyword_ranking]
+            )[:n_results]
+            keyword_only = get_ranked(
+                [(id, score) for id, score in fused if id not in by_id]
+            )
+            by_id.update({str(res["id"]): res for res in keyword_only})
+            result_list = []
+            for id, score in fused:
+                if id in by_id:
+                    by_id[id]["score"] = score
+                    result_list.append(by_id[id])
+
     debug_log(f"Searched memory: {search_text}", result_list)
 
     return result_list
@@ -633,6 +763,8 @@ def update_memory(
     memories.update(
         ids=[str(id)], documents=documents, metadatas=metadatas, embeddings=embeddings
     )
+    if text is not None:
+        keyword_index.safely(keyword_index.upsert, username, category, [id], [text])
 
     debug_log(
         f"Updated memory {id} in category {category}",
@@ -665,6 +797,7 @@ def delete_memory(category, id, username=None):
         return
     # Delete the memory
     memories.delete(ids=[str(id)])
+    keyword_index.safely(keyword_index.delete, username, category, [id])
 
     debug_log(f"Deleted memory {id} in category {category}")
 
@@ -693,6 +826,8 @@ def delete_memories(category, document=None, metadata=None, username=None):
         memories.delete(where_document={"$contains": document})
     if metadata is not None:
         memories.delete(where=metadata)
+    # the deleted ids aren't known, the category is indexed again when searched
+    keyword_index.safely(keyword_index.invalidate, username, category)
 
     debug_log(f"Deleted memories from category {category}")
 
@@ -823,6 +958,7 @@ def wipe_category(category, username=None):
     if collection is not None:
         # Delete the entire category
         get_client(username=username).delete_collection(category)
+        keyword_index.safely(keyword_index.invalidate, username, category)
 
 
 def wipe_all_memories(username=None):
@@ -838,6 +974,7 @@ def wipe_all_memories(username=None):
     # Iterate over all collections
     for collection in collections:
         client.delete_collection(collection.name)
+    keyword_index.safely(keyword_index.invalidate, username, None)
 
     debug_log("Wiped all memories", type="system")
 
@@ -851,3 +988,4 @@ def stop_database(username=None):
     """
     client = get_client(username=username)
     client.reset()
+    keyword_index.safely(keyword_index.invalidate, username, None)
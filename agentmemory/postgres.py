@@ -1,4 +1,6 @@
 from pathlib import Path
+
+import numpy as np
 import psycopg2
 
 from agentmemory.check_model import check_model, infer_embeddings
@@ -189,7 +191,12 @@ class PostgresCollection:
         include=["metadatas", "documents", "distances"],
     ):
         return self.client.query(
-            self.category, query_texts, n_results, where, where_document
+            self.category,
+            query_texts,
+            n_results,
+            where,
+            where_document,
+            query_embeddings=query_embeddings,
         )
 
     def update(self, ids, documents=None, metadatas=None, embeddings=None):
@@ -382,7 +389,13 @@ class PostgresClient:
             self.connection.commit()
 
     def query(
-        self, category, query_texts, n_results=5, where=None, where_document=None
+        self,
+        category,
+        query_texts,
+        n_results=5,
+        where=None,
+        where_document=None,
+        query_embeddings=None,
     ):
         self.ensure_table_exists(category)
         table_name = self._table_name(category)
@@ -423,8 +436,11 @@ class PostgresClient:
             "distances": [],
         }
         with self.connection.cursor() as cur:
-            for emb in query_texts:
-                query_emb = self.create_embedding(emb)
+            if query_embeddings is None:
+                query_embeddings = [self.create_embedding(text) for text in query_texts]
+            for query_emb in query_embeddings:
+                # pgvector adapts numpy arrays to vectors
+                query_emb = np.asarray(query_emb, dtype=np.float32)
                 params_with_emb = [query_emb] + params + [query_emb, n_results]
                 string = f"""
                     SELECT id, document, embedding, embedding <-> %s AS distance, *
@@ -1,13 +1,16 @@
 import datetime
-from typing import List
+from typing import Dict, List
+
+from sqlalchemy.orm import Session
 
 from chat_tabs.models import ChatTabs
-from common.dao import AbstractDAO
+from common.dao import AbstractDAO, AbstractAsyncDAO
+from user_context import user_context_cache
 
 
 class ChatTabsDAO(AbstractDAO):
-    def __init__(self):
-        super().__init__(ChatTabs)
+    def __init__(self, session: Session = None):
+        super().__init__(ChatTabs, session)
 
     def get_tab_data(self, user_id: int) -> List[ChatTabs]:
         return (
@@ -24,6 +27,17 @@ class ChatTabsDAO(AbstractDAO):
         tab = self.session.query(ChatTabs).filter(ChatTabs.tab_id == tab_id).first()
         return tab.chat_name if tab else None
 
+    def get_tab_descriptions(self, user_id: int, tab_ids: List[str]) -> Dict[str, str]:
+        """Return the chat names of the user's tabs in one query, by tab id."""
+        if not tab_ids:
+            return {}
+        rows = (
+            self.session.query(ChatTabs.tab_id, ChatTabs.chat_name)
+            .filter(ChatTabs.user_id == user_id, ChatTabs.tab_id.in_(set(tab_ids)))
+            .all()
+        )
+        return {tab_id: chat_name for tab_id, chat_name in rows}
+
     def get_active_tab_data(self, user_id: int):
         return (
             self.session.query(ChatTabs)
@@ -49,6 +63,7 @@ class ChatTabsDAO(AbstractDAO):
         )
         self.session.add(new_tab)
         self.session.commit()
+        user_context_cache.invalidate(user_id=user_id)
 
     def update_tab_data(
         self, user_id: int, chat_name: str, tab_id: str, is_active: bool
@@ -57,12 +72,14 @@ class ChatTabsDAO(AbstractDAO):
             {"chat_name": chat_name, "tab_id": tab_id, "is_active": is_active}
         )
         self.session.commit()
+        user_context_cache.invalidate(user_id=user_id)
 
     def update_tab_description(self, tab_id: str, chat_name: str):
         self.session.query(ChatTabs).filter(ChatTabs.tab_id == tab_id).update(
             {"chat_name": chat_name}
         )
         self.session.commit()
+        user_context_cache.invalidate()
 
     def set_active_tab(self, user_id: int, tab_id: str):
         self.session.query(ChatTabs).filter(ChatTabs.user_id == user_id).update(
@@ -72,10 +89,12 @@ class ChatTabsDAO(AbstractDAO):
             ChatTabs.user_id == user_id, ChatTabs.tab_id == tab_id
         ).update({"is_active": True, "is_enabled": True})
         self.session.commit()
+        user_context_cache.invalidate(user_id=user_id)
 
     def delete_tab_data(self, user_id: int):
         self.session.query(ChatTabs).filter(ChatTabs.user_id == user_id).delete()
         self.session.commit()
+        user_context_cache.invalidate(user_id=user_id)
 
     def disable_tab(self, user_id: int, chat_id: str) -> bool:
         updated_rows = (
@@ -84,6 +103,7 @@ class ChatTabsDAO(AbstractDAO):
             .update({"is_enabled": False})
         )
         self.session.commit()
+        user_context_cache.invalidate(user_id=user_id)
         return updated_rows > 0
 
     def needs_tab_description(self, chat_id):
@@ -92,3 +112,56 @@ class ChatTabsDAO(AbstractDAO):
             return True
         else:
             return False
+
+
+class AsyncChatTabsDAO(AbstractAsyncDAO):
+    sync_dao = ChatTabsDAO
+
+    async def get_tab_data(self, user_id: int) -> List[ChatTabs]:
+        return await self.run(ChatTabsDAO.get_tab_data, user_id)
+
+    async def get_tab_count(self, user_id: int) -> int:
+        return await self.run(ChatTabsDAO.get_tab_count, user_id)
+
+    async def get_tab_description(self, tab_id: str) -> str:
+        return await self.run(ChatTabsDAO.get_tab_description, tab_id)
+
+    async def get_tab_descriptions(
+        self, user_id: int, tab_ids: List[str]
+    ) -> Dict[str, str]:
+        return await self.run(ChatTabsDAO.get_tab_descriptions, user_id, tab_ids)
+
+    async def get_active_tab_data(self, user_id: int):
+        return await self.run(ChatTabsDAO.get_active_tab_data, user_id)
+
+    async def update_created_at(self, user_id: int, chat_id: str):
+        await self.run(ChatTabsDAO.update_created_at, user_id, chat_id)
+
+    async def insert_tab_data(
+        self, user_id: int, chat_id: str, chat_name: str, tab_id: str, is_active: bool
+    ):
+        await self.run(
+            ChatTabsDAO.insert_tab_data, user_id, chat_id, chat_name, tab_id, is_active
+        )
+
+    async def update_tab_data(
+        self, user_id: int, chat_name: str, tab_id: str, is_active: bool
+    ):
+        await self.run(
+            ChatTabsDAO.update_tab_data, user_id, chat_name, tab_id, is_active
+        )
+
+    async def update_tab_description(self, tab_id: str, chat_name: str):
+        await self.run(ChatTabsDAO.update_tab_description, tab_id, chat_name)
+
+    async def set_active_tab(self, user_id: int, tab_id: str):
+        await self.run(ChatTabsDAO.set_active_tab, user_id, tab_id)
+
+    async def delete_tab_data(self, user_id: int):
+        await self.run(ChatTabsDAO.delete_tab_data, user_id)
+
+    async def disable_tab(self, user_id: int, chat_id: str) -> bool:
+        return await self.run(ChatTabsDAO.disable_tab, user_id, chat_id)
+
+    async def needs_tab_description(self, chat_id):
+        return await self.run(ChatTabsDAO.needs_tab_description, chat_id)
@@ -11,7 +11,7 @@ from fastapi.templating import Jinja2Templates
 from database import Database
 import logs
 from agentmemory import wipe_all_memories, stop_database
-from chat_tabs.dao import ChatTabsDAO
+from chat_tabs.dao import AsyncChatTabsDAO
 from classes import (
     EditTabDescription,
     RecentMessages,
@@ -29,10 +29,10 @@ templates = Jinja2Templates(directory=get_root(STATIC))
 
 @router.post("/get_chat_tabs/", tags=[LOGIN_REQUIRED])
 async def get_chat_tabs(request: Request):
-    with ChatTabsDAO() as chat_tabs_dao:
+    async with AsyncChatTabsDAO() as chat_tabs_dao:
         user_id = request.state.user.id
-        tab_data = chat_tabs_dao.get_tab_data(user_id) or []
-        active_tab_data = chat_tabs_dao.get_active_tab_data(user_id)
+        tab_data = await chat_tabs_dao.get_tab_data(user_id) or []
+        active_tab_data = await chat_tabs_dao.get_active_tab_data(user_id)
         processed_tab_data = [tab for tab in tab_data if tab.is_enabled]
         if active_tab_data is None:
             active_tab_data = {}
@@ -44,18 +44,18 @@ async def get_chat_tabs(request: Request):
 
 @router.post("/delete_chat_tab/", tags=[LOGIN_REQUIRED])
 async def delete_chat_tab(request: Request, user: RecentMessages):
-    with ChatTabsDAO() as chat_tabs_dao:
-        if chat_tabs_dao.disable_tab(request.state.user.id, chat_id=user.chat_id):
+    async with AsyncChatTabsDAO() as chat_tabs_dao:
+        if await chat_tabs_dao.disable_tab(request.state.user.id, chat_id=user.chat_id):
             return {"message": "Tab deleted successfully"}
         return {"message": "Error while updating tab"}
 
 
 @router.post("/get_recent_messages/", tags=[LOGIN_REQUIRED])
 async def get_recent_messages(request: Request, message: RecentMessages):
-    with ChatTabsDAO() as chat_tabs_dao:
+    async with AsyncChatTabsDAO() as chat_tabs_dao:
         user = request.state.user
-        tab_data = chat_tabs_dao.get_tab_data(user.id)
-        active_tab_data = chat_tabs_dao.get_active_tab_data(user.id)
+        tab_data = await chat_tabs_dao.get_tab_data(user.id)
+        active_tab_data = await chat_tabs_dao.get_active_tab_data(user.id)
 
         tab_exists = False
         for tab in tab_data:
@@ -64,7 +64,7 @@ async def get_recent_messages(request: Request, message: RecentMessages):
                 break
         if not tab_exists:
             # if not, insert a new row
-            chat_tabs_dao.insert_tab_data(
+            await chat_tabs_dao.insert_tab_data(
                 user.id,
                 message.chat_id,
                 f"New Chat",
@@ -72,7 +72,7 @@ async def get_recent_messages(request: Request, message: RecentMessages):
                 False,
             )
         if active_tab_data is None or message.chat_id != active_tab_data.chat_id:
-            chat_tabs_dao.set_active_tab(user.id, message.chat_id)
+            await chat_tabs_dao.set_active_tab(user.id, message.chat_id)
 
         recent_messages = await MessageParser.get_recent_messages(
             message.username, message.chat_id
@@ -94,8 +94,8 @@ async def handle_delete_data_keep_settings(request: Request):
     # remove all users recent messages
     await BrainProcessor.delete_recent_messages(user.username)
     # remove chat tabs from the database
-    with ChatTabsDAO() as chat_tabs_dao:
-        chat_tabs_dao.delete_tab_data(request.state.user.id)
+    async with AsyncChatTabsDAO() as chat_tabs_dao:
+        await chat_tabs_dao.delete_tab_data(request.state.user.id)
     if user.username == "admin":
         with Database() as db:
             try:
@@ -137,8 +137,8 @@ async def handle_delete_data(request: Request):
     wipe_all_memories(user.username)
     stop_database(user.username)
     await BrainProcessor.delete_recent_messages(user.username)
-    with ChatTabsDAO() as db:
-        db.delete_tab_data(user.id)
+    async with AsyncChatTabsDAO() as db:
+        await db.delete_tab_data(user.id)
     if user.username == "admin":
         with Database() as db:
             try:
@@ -156,6 +156,6 @@ async def handle_delete_data(request: Request):
 # update_chat_tab_description route
 @router.post("/update_chat_tab_description/", tags=[LOGIN_REQUIRED])
 async def update_chat_tab_description(request: Request, user: EditTabDescription):
-    with ChatTabsDAO() as chat_tabs_dao:
-        chat_tabs_dao.update_tab_description(user.chat_id, user.description)
+    async with AsyncChatTabsDAO() as chat_tabs_dao:
+        await chat_tabs_dao.update_tab_description(user.chat_id, user.description)
     return {"message": "Tab description updated successfully"}
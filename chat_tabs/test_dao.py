@@ -118,3 +118,12 @@ def test_disable_tab(chat_tabs_dao):
     chat_tabs_dao.disable_tab(user_id, chat_id="chat1")
     disabled_tab = chat_tabs_dao.get_tab_data(user_id)[0]
     assert not disabled_tab.is_enabled
+
+
+def test_get_tab_descriptions(chat_tabs_dao):
+    chat_tabs_dao.insert_tab_data(1, "chat1", "First", "tab1", True)
+    chat_tabs_dao.insert_tab_data(1, "chat2", "Second", "tab2", False)
+    chat_tabs_dao.insert_tab_data(2, "chat1", "Other user", "tab1", True)
+    descriptions = chat_tabs_dao.get_tab_descriptions(1, ["tab1", "tab2", "tab3"])
+    assert descriptions == {"tab1": "First", "tab2": "Second"}
+    assert chat_tabs_dao.get_tab_descriptions(1, []) == {}
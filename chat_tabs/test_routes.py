@@ -7,7 +7,7 @@ from agentmemory import get_client
 from chat_tabs.dao import ChatTabsDAO
 from launcher import create_app
 from user_management.dao import UsersDAO
-from user_management.session import session_factory
+from user_management.session import async_session_factory, session_factory
 
 from sqlalchemy.orm import close_all_sessions
 from sqlalchemy import create_engine
@@ -33,6 +33,7 @@ def app():
             )
 
     session_factory.get_refreshed()
+    async_session_factory.get_refreshed()
     from chat_tabs.routes import router as chat_tabs_router
 
     application = create_app(routers=[chat_tabs_router])
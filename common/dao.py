@@ -2,10 +2,11 @@ from abc import ABC
 from typing import Type, Generic
 
 from sqlalchemy import Engine
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession
 from sqlalchemy.orm import Session, DeclarativeMeta
 
 from user_management.models import Base
-from user_management.session import session_factory
+from user_management.session import session_factory, async_session_factory
 
 
 class AbstractDAO(ABC):
@@ -13,10 +14,14 @@ class AbstractDAO(ABC):
     session: Session = None
     model: Type[DeclarativeMeta]
 
-    def __init__(self, model: Type[DeclarativeMeta]):
-        sess = session_factory.get_session()
-        self.engine = sess.engine
-        self.session: Session = sess.session
+    def __init__(self, model: Type[DeclarativeMeta], session: Session = None):
+        if session is None:
+            sess = session_factory.get_session()
+            self.engine = sess.engine
+            self.session: Session = sess.session
+        else:
+            self.engine = session.get_bind()
+            self.session = session
         self.model = model
 
     def create_all_tables(self):
@@ -39,3 +44,47 @@ class AbstractDAO(ABC):
 
     def close_session(self) -> None:
         self.session.close()
+
+
+class AbstractAsyncDAO(ABC):
+    """
+    Async variant of a DAO for the route handlers, the queries run on the async
+    engine and don't block the event loop:
+
+        async with AsyncUsersDAO() as dao:
+            user = await dao.get_user(username)
+
+    The methods run the queries of the sync DAO (sync_dao) on the async session,
+    so both variants behave the same. The sync DAOs stay for the tests, the
+    migrations and the code that doesn't run on the event loop.
+    """
+
+    engine: AsyncEngine = None
+    session: AsyncSession = None
+    sync_dao: Type[AbstractDAO]
+
+    def __init__(self):
+        sess = async_session_factory.get_session()
+        self.engine = sess.engine
+        self.session: AsyncSession = sess.session
+
+    async def run(self, method, *args, **kwargs):
+        """Run a method of the sync DAO with the sync view of the async session."""
+
+        def call(session: Session):
+            return method(self.sync_dao(session=session), *args, **kwargs)
+
+        result = await self.session.run_sync(call)
+        # end the transaction of a read too, the connection goes back to the pool
+        # while the handler awaits something else
+        await self.session.commit()
+        return result
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close_session()
+
+    async def close_session(self) -> None:
+        await self.session.close()
@@ -6,10 +6,9 @@ async def authenticate_websocket(websocket: WebSocket):
     session_token = websocket.cookies.get("session_token")
     username = websocket.cookies.get("username")
     if session_token:
-        from authentication import Authentication
+        from session_cache import session_cache
 
-        auth = Authentication()
-        if auth.check_token(username=username, session_token=session_token):
+        if session_cache.get(username, session_token) is not None:
             await websocket.accept()
             await websocket.send_text("Connection successful")
             return True
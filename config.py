@@ -68,6 +68,162 @@ DEFAULT_CLANG_SYSTEM_CONFIGURATION_FILE = get_root("users/user.env")
 PRODUCTION = os.getenv("PRODUCTION", "false").lower() in ["true", "1", "yes"]
 USERS_DIR = "users"
 
+# small and fast models per provider, used by default for the auxiliary llm roles
+SMALL_MODELS = {
+    "openai": "gpt-4o-mini",
+    "anthropic": "claude-3-haiku-20240307",
+}
+
+# default max_tokens cap per auxiliary llm role, 0 means the memory output budget
+ROLE_MAX_TOKENS = {
+    "date-extractor": 20,
+    "categorise_query": 200,
+    "categorise": 50,
+    "tab_title": 20,
+    "query_rewrite": 100,
+    "summary_memory": 0,
+    "summarize": 0,
+    "notetaker": 0,
+}
+
+# response cache for the auxiliary llm roles (date-extractor, categorise, ...)
+LLM_CACHE_MAX_ENTRIES = int(os.environ.get("LLM_CACHE_MAX_ENTRIES", 2048))
+LLM_CACHE_TTL = int(os.environ.get("LLM_CACHE_TTL", 3600))
+LLM_CACHE_DISK = os.getenv("LLM_CACHE_DISK", "false").lower() in ["true", "1", "yes"]
+LLM_CACHE_DISK_PATH = os.environ.get(
+    "LLM_CACHE_DISK_PATH", os.path.join(USERS_DIR, "llm_cache.db")
+)
+
+# seconds a cached settings snapshot is used before the settings file is stat'ed again
+SETTINGS_REVALIDATE_INTERVAL = float(os.environ.get("SETTINGS_REVALIDATE_INTERVAL", 2))
+
+# seconds between two scans of the addons directory for new or modified addons
+ADDON_SCAN_INTERVAL = float(os.environ.get("ADDON_SCAN_INTERVAL", 2))
+
+# synchronous addons run on a thread pool, with a timeout (seconds) and a limit on
+# the calls per addon that run at the same time
+ADDON_MAX_WORKERS = int(os.environ.get("ADDON_MAX_WORKERS", 8))
+ADDON_TIMEOUT = float(os.environ.get("ADDON_TIMEOUT", 120))
+ADDON_TIMEOUTS = {
+    "generate_image": 300,
+    "send_email_by_id": 60,
+}
+ADDON_CONCURRENCY = int(os.environ.get("ADDON_CONCURRENCY", 4))
+ADDON_CONCURRENCY_LIMITS = {
+    "generate_image": 2,
+}
+
+# fetch engine of the web addons
+WEB_FETCH_MAX_BYTES = int(os.environ.get("WEB_FETCH_MAX_BYTES", 2 * 1024 * 1024))
+WEB_FETCH_TIMEOUT = float(os.environ.get("WEB_FETCH_TIMEOUT", 20))
+WEB_FETCH_PER_HOST = int(os.environ.get("WEB_FETCH_PER_HOST", 4))
+WEB_FETCH_MAX_CONNECTIONS = int(os.environ.get("WEB_FETCH_MAX_CONNECTIONS", 32))
+WEB_FETCH_USER_AGENT = os.environ.get(
+    "WEB_FETCH_USER_AGENT", "Mozilla/5.0 (compatible; CharlieMnemonic)"
+)
+
+# shared on-disk cache of the web addons (extracted page text and search results)
+WEB_CACHE_PATH = os.environ.get(
+    "WEB_CACHE_PATH", os.path.join(USERS_DIR, "web_cache.db")
+)
+WEB_CACHE_MAX_BYTES = int(os.environ.get("WEB_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+# lifetime (seconds) of pages without freshness headers and of search results
+WEB_CACHE_DEFAULT_TTL = int(os.environ.get("WEB_CACHE_DEFAULT_TTL", 300))
+WEB_CACHE_SEARCH_TTL = int(os.environ.get("WEB_CACHE_SEARCH_TTL", 3600))
+
+# sandbox for run_python_code, the containers of the users are kept warm and reused
+CODE_IMAGE = os.environ.get("CODE_IMAGE", "goodaidev/charlie-mnemonic-python-env")
+CODE_POOL_MAX_CONTAINERS = int(os.environ.get("CODE_POOL_MAX_CONTAINERS", 8))
+CODE_POOL_IDLE_TIMEOUT = int(os.environ.get("CODE_POOL_IDLE_TIMEOUT", 600))
+CODE_POOL_REAP_INTERVAL = int(os.environ.get("CODE_POOL_REAP_INTERVAL", 60))
+# start the container of a user when the app is opened, before the first execution
+CODE_POOL_WARM_ON_CONNECT = os.getenv("CODE_POOL_WARM_ON_CONNECT", "false").lower() in [
+    "true",
+    "1",
+    "yes",
+]
+
+# wheel cache of the code sandbox, and derived images per package set
+CODE_PIP_CACHE_MAX_BYTES = int(
+    os.environ.get("CODE_PIP_CACHE_MAX_BYTES", 2 * 1024 * 1024 * 1024)
+)
+CODE_PIP_CACHE_MAX_AGE = int(os.environ.get("CODE_PIP_CACHE_MAX_AGE", 30 * 24 * 3600))
+CODE_DERIVED_IMAGES = os.getenv("CODE_DERIVED_IMAGES", "false").lower() in [
+    "true",
+    "1",
+    "yes",
+]
+CODE_DERIVED_IMAGES_MAX = int(os.environ.get("CODE_DERIVED_IMAGES_MAX", 10))
+# wall-clock limit of a code execution, the hard limit on the output it may produce
+# while streaming, and the tail of the output that is given to the llm
+CODE_EXEC_TIMEOUT = int(os.environ.get("CODE_EXEC_TIMEOUT", 120))
+CODE_OUTPUT_MAX_BYTES = int(os.environ.get("CODE_OUTPUT_MAX_BYTES", 1024 * 1024))
+CODE_OUTPUT_TAIL_CHARS = int(os.environ.get("CODE_OUTPUT_TAIL_CHARS", 2000))
+# "docker" runs code in the sandbox containers, "subprocess" in local python worker
+# processes with their own mount namespace and resource limits (see
+# subprocess_sandbox.py), which start in milliseconds but need user namespaces
+# (or root) unless SINGLE_USER is set
+CODE_SANDBOX = os.environ.get("CODE_SANDBOX", "docker").lower()
+CODE_SANDBOX_WORKERS = int(os.environ.get("CODE_SANDBOX_WORKERS", 2))
+CODE_SANDBOX_CPU_SECONDS = int(os.environ.get("CODE_SANDBOX_CPU_SECONDS", 60))
+CODE_SANDBOX_MEMORY_MB = int(os.environ.get("CODE_SANDBOX_MEMORY_MB", 1024))
+CODE_SANDBOX_FILE_SIZE_MB = int(os.environ.get("CODE_SANDBOX_FILE_SIZE_MB", 100))
+CODE_SANDBOX_MAX_PROCESSES = int(os.environ.get("CODE_SANDBOX_MAX_PROCESSES", 64))
+# without network the code runs in its own network namespace
+CODE_SANDBOX_NETWORK = os.getenv("CODE_SANDBOX_NETWORK", "true").lower() in [
+    "true",
+    "1",
+    "yes",
+]
+
+# connection pool of database.Database, DB_POOL_SIZE connections are kept open and
+# up to DB_POOL_MAX_CONNECTIONS are used under load, a block waits at most
+# DB_POOL_TIMEOUT seconds for a free connection
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 5))
+DB_POOL_MAX_CONNECTIONS = int(os.environ.get("DB_POOL_MAX_CONNECTIONS", 20))
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", 30))
+
+# connection pool of the SQLAlchemy engines of the DAOs (sync and async), idle
+# connections are checked before use and reopened after ORM_POOL_RECYCLE seconds
+ORM_POOL_SIZE = int(os.environ.get("ORM_POOL_SIZE", 5))
+ORM_POOL_MAX_OVERFLOW = int(os.environ.get("ORM_POOL_MAX_OVERFLOW", 10))
+ORM_POOL_TIMEOUT = float(os.environ.get("ORM_POOL_TIMEOUT", 30))
+ORM_POOL_RECYCLE = int(os.environ.get("ORM_POOL_RECYCLE", 1800))
+ORM_POOL_PRE_PING = os.getenv("ORM_POOL_PRE_PING", "true").lower() in [
+    "true",
+    "1",
+    "yes",
+]
+
+# usage statistics are written in batches every USAGE_FLUSH_INTERVAL seconds or
+# after USAGE_FLUSH_EVENTS llm calls, totals read from the database are cached
+# for USAGE_CACHE_TTL seconds
+USAGE_FLUSH_INTERVAL = float(os.environ.get("USAGE_FLUSH_INTERVAL", 5))
+USAGE_FLUSH_EVENTS = int(os.environ.get("USAGE_FLUSH_EVENTS", 50))
+USAGE_CACHE_TTL = float(os.environ.get("USAGE_CACHE_TTL", 60))
+
+# the global totals of the admin statistics are read from a rollup that is
+# refreshed every STATS_ROLLUP_INTERVAL seconds, the daily stats of a user are
+# shown for the last STATS_DEFAULT_DAYS days unless a range is given, with
+# STATS_DAYS_PER_PAGE days per page
+STATS_ROLLUP_INTERVAL = float(os.environ.get("STATS_ROLLUP_INTERVAL", 60))
+STATS_DEFAULT_DAYS = int(os.environ.get("STATS_DEFAULT_DAYS", 90))
+STATS_DAYS_PER_PAGE = int(os.environ.get("STATS_DAYS_PER_PAGE", 31))
+
+# the user context of the messaging routes (access, limit, tabs) is cached for
+# USER_CONTEXT_TTL seconds, the DAOs invalidate it when it changes
+USER_CONTEXT_TTL = float(os.environ.get("USER_CONTEXT_TTL", 30))
+
+# the admin controls (daily limit, maintenance mode) are cached for
+# ADMIN_CONTROLS_TTL seconds and revalidated in the background, on postgres the
+# workers notify each other when they change
+ADMIN_CONTROLS_TTL = float(os.environ.get("ADMIN_CONTROLS_TTL", 300))
+
+# a checked session token and a snapshot of its user are cached for
+# SESSION_CACHE_TTL seconds, logout and user changes invalidate them (in all
+# workers on postgres, see session_cache)
+SESSION_CACHE_TTL = float(os.environ.get("SESSION_CACHE_TTL", 300))
+
 # not used for now, embedding model used in the ChromaDB files
 OPENAI_EMBEDDING_MODEL = os.environ.get("OPENAI_EMBEDDING_MODEL", "text-davinci-003")
 
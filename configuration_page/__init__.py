@@ -30,9 +30,26 @@ def is_any_ai_available():
     return result
 
 
+_configured = None
+
+
+def is_configured():
+    """is_any_ai_available(), cached until the configuration or an api key changes."""
+    global _configured
+    if _configured is None:
+        _configured = is_any_ai_available()
+    return _configured
+
+
+def reset_configured():
+    global _configured
+    _configured = None
+
+
 def update_openai_api_key(value: str):
     openai.api_key = value
     os.environ["OPENAI_API_KEY"] = value
+    reset_configured()
 
 
 def update_google_client_key(value: str):
@@ -61,6 +78,7 @@ def validate_openai_key(value: str):
 def update_anthropic_api_key(value: str):
     Anthropic.api_key = value
     os.environ["ANTHROPIC_API_KEY"] = value
+    reset_configured()
 
 
 def validate_anthropic_key(value: str):
@@ -83,6 +101,7 @@ def reload_configuration():
         value = os.environ.get(config_meta_item.key, None)
         if value:
             config_meta_item.update_callback(value)
+    reset_configured()
 
 
 @dataclass
@@ -1,104 +1,180 @@
-from fastapi import Request, HTTPException
-from starlette.middleware.base import BaseHTTPMiddleware
-from starlette.responses import JSONResponse
+"""
+Authentication middlewares.
+
+Both are plain ASGI middlewares: they don't wrap the request and response
+streams, websockets and lifespan events pass through untouched, and the route
+of a request path is matched once and remembered (see RouteMatcher).
+"""
+
+import threading
+from collections import OrderedDict
+
+from fastapi import Request
+from starlette.responses import JSONResponse, Response
 from starlette.routing import Match
 
-from classes import UserCheckToken
-from config import LOGIN_REQUIRED, SINGLE_USER_USERNAME, ADMIN_REQUIRED
-from user_management.dao import UsersDAO
-from user_management.models import Users
+from config import LOGIN_REQUIRED, SINGLE_USER_USERNAME, ADMIN_REQUIRED, STATIC
+from session_cache import UserSnapshot, session_cache
 
+# routes that serve public files, requests for them skip the authentication
+PUBLIC_ROUTE_PATHS = {"/{file_path:path}"}
 
-def get_route(request: Request) -> Match:
-    for route in request.app.router.routes:
-        match, scope = route.matches(request)
-        if match == Match.FULL:
-            return route
 
+class RouteMatcher:
+    """Remembers the route that fully matches a request method and path.
 
-def set_user_as_logged_in(session_token: str, username: str, request: Request) -> Users:
-    with UsersDAO() as users_dao:
-        user = users_dao.get_user(username)
-        request.state.user = user
+    The public file route matches any path, so the number of remembered paths
+    is bounded, least recently used first out.
+    """
+
+    def __init__(self, max_size=4096):
+        self.max_size = max_size
+        self._routes = OrderedDict()
+        self._lock = threading.Lock()
+
+    def match(self, scope):
+        router = scope["app"].router
+        key = (id(router), scope["type"], scope.get("method"), scope["path"])
+        with self._lock:
+            if key in self._routes:
+                self._routes.move_to_end(key)
+                return self._routes[key]
+        route = None
+        for candidate in router.routes:
+            match, _ = candidate.matches(scope)
+            if match == Match.FULL:
+                route = candidate
+                break
+        with self._lock:
+            self._routes[key] = route
+            if len(self._routes) > self.max_size:
+                self._routes.popitem(last=False)
+        return route
+
+    def clear(self):
+        with self._lock:
+            self._routes.clear()
+
+
+route_matcher = RouteMatcher()
+
+
+def get_route(request: Request):
+    return route_matcher.match(request.scope)
+
+
+def is_public_request(request: Request, route=None) -> bool:
+    """Static files and the public file route don't need a logged in user."""
+    if request.url.path.startswith(f"/{STATIC}/"):
+        return True
+    return route is not None and getattr(route, "path", None) in PUBLIC_ROUTE_PATHS
+
+
+def set_user_as_logged_in(
+    session_token: str, username: str, request: Request
+) -> UserSnapshot:
+    user = session_cache.get(username, session_token)
+    request.state.user = user
     return user
 
 
-def check_token_login(request: Request) -> bool:
-    session_token = request.cookies.get("session_token")
-    username = request.cookies.get("username")
-    if session_token:
-        from authentication import Authentication
+def get_logged_in_user(request: Request):
+    """Return the user of the session cookies, or the user a previous middleware logged in."""
+    user = session_cache.get(
+        request.cookies.get("username"), request.cookies.get("session_token")
+    )
+    if user is not None:
+        return user
+    # only missing if LoginAdminMiddleware and LoginRequiredCheckMiddleware are
+    # missing (in some test setup for example)
+    return getattr(request.state, "user", None)
 
-        auth = Authentication()
-        if auth.check_token(username=username, session_token=session_token):
-            return True
-    try:
-        return request.state.user is not None
-    except AttributeError:
-        # shouldn't really happen, only if LoginAdminMiddleware and LoginRequiredCheckMiddleware are
-        # missing (in some test setup for example)
-        return False
 
+def check_token_login(request: Request) -> bool:
+    return get_logged_in_user(request) is not None
 
-class LoginRequiredCheckMiddleware(BaseHTTPMiddleware):
+
+class LoginRequiredCheckMiddleware:
     """
     This middleware checks if the route has the LOGIN_REQUIRED
     tag and throws 401 if it does and the user is not logged in.
-    It also sets request.state.user to the user of type UserCheckToken if the user is logged in.
+    It also sets request.state.user to the UserSnapshot of the user if the user is logged in.
     """
 
-    async def dispatch(self, request: Request, call_next):
-        user_check_token = None
+    def __init__(self, app):
+        self.app = app
 
-        if check_token_login(request):
-            username = request.cookies.get("username")
-            session_token = request.cookies.get("session_token")
-            user_check_token = set_user_as_logged_in(session_token, username, request)
-        else:
-            request.state.user = None
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
 
+        request = Request(scope)
         route = get_route(request)
+        if is_public_request(request, route):
+            request.state.user = None
+            return await self.app(scope, receive, send)
+
+        user_check_token = get_logged_in_user(request)
+        request.state.user = user_check_token
+
         if route and getattr(route, "tags", None):
             tags = route.tags
             if LOGIN_REQUIRED in tags and not user_check_token:
-                return JSONResponse(
+                response = JSONResponse(
                     status_code=401,
                     content={"detail": f"Not authenticated for {route.path}"},
                 )
+                return await response(scope, receive, send)
             if ADMIN_REQUIRED in tags and not user_check_token.role == "admin":
-                return JSONResponse(
+                response = JSONResponse(
                     status_code=403,
                     content={
                         "detail": f"Not authorized for {route.path} with role '{user_check_token.role}'"
                     },
                 )
+                return await response(scope, receive, send)
 
-        return await call_next(request)
+        await self.app(scope, receive, send)
 
 
-class LoginAdminMiddleware(BaseHTTPMiddleware):
+class LoginAdminMiddleware:
     """
     This middleware automatically logs in user if not logged in.
     This is used for single user mode.
     """
 
-    async def dispatch(self, request: Request, call_next):
-        request.state.user = None
-        username = SINGLE_USER_USERNAME
-
-        new_session_token = None
-        if not check_token_login(request):
-            from authentication import Authentication
+    def __init__(self, app):
+        self.app = app
 
-            auth = Authentication()
-            new_session_token = auth.force_login(username, regenerate_token=False)
-            set_user_as_logged_in(new_session_token, username, request)
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
 
-        response = await call_next(request)
-
-        if new_session_token:
-            from user_management.routes import set_login_cookies
+        request = Request(scope)
+        request.state.user = None
+        username = SINGLE_USER_USERNAME
+        if is_public_request(request, get_route(request)) or check_token_login(request):
+            return await self.app(scope, receive, send)
 
-            set_login_cookies(new_session_token, username, response)
+        from authentication import Authentication
+        from user_management.routes import set_login_cookies
 
-        return response
+        auth = Authentication()
+        new_session_token = auth.force_login(username, regenerate_token=False)
+        set_user_as_logged_in(new_session_token, username, request)
+
+        # add the login cookies to the headers of the response
+        cookies = Response()
+        set_login_cookies(new_session_token, username, cookies)
+        cookie_headers = [
+            (name, value)
+            for name, value in cookies.raw_headers
+            if name == b"set-cookie"
+        ]
+
+        async def send_with_cookies(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = [*message.get("headers", []), *cookie_headers]
+            await send(message)
+
+        await self.app(scope, receive, send_with_cookies)
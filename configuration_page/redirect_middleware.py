@@ -1,27 +1,27 @@
-from fastapi import Request
 from fastapi.responses import RedirectResponse
-from starlette.middleware.base import BaseHTTPMiddleware
 
 from config import STATIC, CONFIGURATION_URL
 
 
-def is_configuration_missing(request: Request):
-    from configuration_page import configuration_meta_list, is_any_ai_available
+def is_configuration_missing():
+    from configuration_page import is_configured
 
-    if not is_any_ai_available():
-        return True
-    return False
+    return not is_configured()
 
 
-class RedirectToConfigurationMiddleware(BaseHTTPMiddleware):
-    async def dispatch(self, request: Request, call_next):
+class RedirectToConfigurationMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
         if (
-            request.method == "GET"
-            and not request.url.path.startswith(f"/{STATIC}/")
-            and not request.url.path.startswith(CONFIGURATION_URL)
-            and is_configuration_missing(request)
+            scope["type"] == "http"
+            and scope["method"] == "GET"
+            and not scope["path"].startswith(f"/{STATIC}/")
+            and not scope["path"].startswith(CONFIGURATION_URL)
+            and is_configuration_missing()
         ):
-            return RedirectResponse(url=CONFIGURATION_URL)
+            response = RedirectResponse(url=CONFIGURATION_URL)
+            return await response(scope, receive, send)
 
-        response = await call_next(request)
-        return response
+        await self.app(scope, receive, send)
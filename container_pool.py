@@ -0,0 +1,279 @@
+"""
+Pool of warm sandbox containers for run_python_code.
+
+Every user gets a long running container (with the user's data directory mounted
+on /data) that is reused by the next code executions instead of starting and
+removing a container per call. Packages installed with pip stay installed for
+the life of the container, and the wheel cache of pip_cache is mounted on
+/pip-cache so a new container installs them again without downloading.
+Containers that are idle for CODE_POOL_IDLE_TIMEOUT seconds are removed by a
+reaper thread, and when the pool is full the least recently used idle container
+makes room.
+
+The image is pulled in the background at startup, and the time spent waiting for
+a user's container (queue) and starting it (startup) is reported with every run.
+"""
+
+import os
+import threading
+import time
+
+import docker
+
+import logs
+from config import (
+    CODE_IMAGE,
+    CODE_POOL_IDLE_TIMEOUT,
+    CODE_POOL_MAX_CONTAINERS,
+    CODE_POOL_REAP_INTERVAL,
+)
+from pip_cache import normalize_packages, pip_cache
+
+logger = logs.Log("container_pool", "container_pool.log").get_logger()
+
+POOL_LABEL = "charlie-mnemonic.pool"
+
+
+def get_data_dir(username):
+    """Return the host directory that is mounted on /data for the (converted) username."""
+    users_dir = os.environ.get("CHARLIE_MNEMONIC_USER_DIR") or os.path.join(
+        os.getcwd(), "users"
+    )
+    return os.path.join(users_dir, username, "data")
+
+
+class PooledContainer:
+    def __init__(self, username):
+        self.username = username
+        self.container = None
+        self.installed_packages = set()
+        self.last_used = time.monotonic()
+        self.lock = threading.Lock()
+
+
+class Lease:
+    """A container that is reserved for one code execution."""
+
+    def __init__(self, pooled, queue_time, startup_time):
+        self.pooled = pooled
+        self.container = pooled.container
+        self.queue_time = queue_time
+        self.startup_time = startup_time
+
+    @property
+    def installed_packages(self):
+        return self.pooled.installed_packages
+
+
+class ContainerPool:
+    def __init__(
+        self,
+        image=CODE_IMAGE,
+        max_containers=CODE_POOL_MAX_CONTAINERS,
+        idle_timeout=CODE_POOL_IDLE_TIMEOUT,
+        reap_interval=CODE_POOL_REAP_INTERVAL,
+    ):
+        self.image = image
+        self.max_containers = max_containers
+        self.idle_timeout = idle_timeout
+        self.reap_interval = reap_interval
+        self._client = None
+        self._containers = {}
+        self._lock = threading.Lock()
+        self._reaper = None
+        self._stopped = threading.Event()
+
+    @property
+    def client(self):
+        if self._client is None:
+            self._client = docker.from_env()
+        return self._client
+
+    def prepull(self):
+        """Pull the sandbox image if it isn't available yet, returns the seconds it took."""
+        started = time.perf_counter()
+        try:
+            self.client.images.get(self.image)
+        except docker.errors.ImageNotFound:
+            logger.info(f"Pulling {self.image}")
+            self.client.images.pull(self.image)
+        return time.perf_counter() - started
+
+    def start(self, prepull=True):
+        """Start the reaper thread and pull the image in the background."""
+        if self._reaper is not None:
+            return
+
+        def run():
+            if prepull:
+                try:
+                    logger.info(f"{self.image} ready after {self.prepull():.1f}s")
+                except Exception as e:
+                    logger.warning(f"Could not pull {self.image}: {e}")
+            while not self._stopped.wait(self.reap_interval):
+                self.reap()
+                try:
+                    pip_cache.evict()
+                    pip_cache.evict_images(self.client)
+                except Exception as e:
+                    logger.warning(f"Could not evict the pip cache: {e}")
+
+        self._stopped.clear()
+        self._reaper = threading.Thread(
+            target=run, name="container-pool-reaper", daemon=True
+        )
+        self._reaper.start()
+
+    def acquire(self, username, packages=()):
+        """Reserve the user's container, starting it if needed. Call release() when done.
+
+        A new container starts from the derived image of the packages if there is one.
+        """
+        queued_at = time.perf_counter()
+        while True:
+            with self._lock:
+                pooled = self._containers.get(username)
+                if pooled is None:
+                    pooled = self._containers[username] = PooledContainer(username)
+            pooled.lock.acquire()
+            with self._lock:
+                if self._containers.get(username) is pooled:
+                    break
+            # the container was reaped while we were waiting for it
+            pooled.lock.release()
+        queue_time = time.perf_counter() - queued_at
+        try:
+            startup_time = self._ensure_running(pooled, packages)
+        except Exception:
+            pooled.lock.release()
+            raise
+        self._make_room(keep=username)
+        return Lease(pooled, queue_time, startup_time)
+
+    def release(self, lease, broken=False):
+        """Give the container back to the pool, a broken container is removed."""
+        pooled = lease.pooled
+        pooled.last_used = time.monotonic()
+        if broken:
+            self._remove(pooled)
+        pooled.lock.release()
+
+    def _ensure_running(self, pooled, packages=()):
+        """Start the container of the user if it isn't running, returns the startup time."""
+        if pooled.container is not None:
+            try:
+                pooled.container.reload()
+                if pooled.container.status == "running":
+                    return 0.0
+            except docker.errors.NotFound:
+                pass
+            self._remove(pooled)
+
+        started = time.perf_counter()
+        # a container with the same name can be left over from a previous run
+        try:
+            self.client.containers.get(pooled.username).remove(force=True)
+        except docker.errors.NotFound:
+            pass
+        data_dir = get_data_dir(pooled.username)
+        os.makedirs(data_dir, exist_ok=True)
+        derived_image = pip_cache.get_derived_image(self.client, packages)
+        pooled.container = self.client.containers.run(
+            derived_image or self.image,
+            name=pooled.username,
+            detach=True,
+            tty=True,
+            volumes={
+                data_dir: {"bind": "/data", "mode": "rw"},
+                **pip_cache.volumes(),
+            },
+            labels={POOL_LABEL: "1"},
+        )
+        pooled.installed_packages = (
+            set(normalize_packages(packages)) if derived_image else set()
+        )
+        startup_time = time.perf_counter() - started
+        logger.info(f"Started container for {pooled.username} in {startup_time:.2f}s")
+        return startup_time
+
+    def _remove(self, pooled):
+        container, pooled.container = pooled.container, None
+        pooled.installed_packages = set()
+        if container is not None:
+            try:
+                container.remove(force=True)
+            except docker.errors.NotFound:
+                pass
+            except Exception as e:
+                logger.warning(f"Could not remove container {pooled.username}: {e}")
+
+    def _idle(self):
+        """Return the idle pooled containers, least recently used first."""
+        with self._lock:
+            pooled_containers = list(self._containers.values())
+        return sorted(
+            (
+                pooled
+                for pooled in pooled_containers
+                if pooled.container is not None and not pooled.lock.locked()
+            ),
+            key=lambda pooled: pooled.last_used,
+        )
+
+    def _try_remove(self, pooled):
+        if not pooled.lock.acquire(blocking=False):
+            return False
+        try:
+            self._remove(pooled)
+            with self._lock:
+                if self._containers.get(pooled.username) is pooled:
+                    del self._containers[pooled.username]
+        finally:
+            pooled.lock.release()
+        return True
+
+    def _make_room(self, keep):
+        with self._lock:
+            running = sum(1 for pooled in self._containers.values() if pooled.container)
+        for pooled in self._idle():
+            if running <= self.max_containers:
+                break
+            if pooled.username != keep and self._try_remove(pooled):
+                running -= 1
+
+    def reap(self):
+        """Remove the containers that have been idle for longer than the idle timeout."""
+        now = time.monotonic()
+        reaped = 0
+        for pooled in self._idle():
+            if now - pooled.last_used < self.idle_timeout:
+                break
+            if self._try_remove(pooled):
+                logger.info(f"Removed idle container {pooled.username}")
+                reaped += 1
+        return reaped
+
+    def warm(self, username):
+        """Start the user's container ahead of the first code execution."""
+        try:
+            self.release(self.acquire(username))
+        except Exception as e:
+            logger.warning(f"Could not warm a container for {username}: {e}")
+
+    def warm_in_background(self, username):
+        threading.Thread(
+            target=self.warm, args=(username,), name="container-pool-warm", daemon=True
+        ).start()
+
+    def shutdown(self):
+        """Stop the reaper and remove all pooled containers."""
+        self._stopped.set()
+        self._reaper = None
+        with self._lock:
+            pooled_containers = list(self._containers.values())
+            self._containers.clear()
+        for pooled in pooled_containers:
+            self._remove(pooled)
+
+
+container_pool = ContainerPool()
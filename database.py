@@ -3,53 +3,242 @@ import importlib
 import json
 import os
 import sys
+import threading
+import time
 
 import logs
 import psycopg2
 import psycopg2.extras
+import psycopg2.pool
 from psycopg2.extras import RealDictCursor
 
 from chat_tabs.dao import ChatTabsDAO
+from config import (
+    DB_POOL_MAX_CONNECTIONS,
+    DB_POOL_SIZE,
+    DB_POOL_TIMEOUT,
+    STATS_DAYS_PER_PAGE,
+    STATS_DEFAULT_DAYS,
+)
 from configuration_page.settings_util import is_single_user
 
 logger = logs.Log("database", "database.log").get_logger()
 
+# the per (role, model) amounts of Database.apply_usage, in this order
+ROLE_USAGE_COLUMNS = (
+    "call_count",
+    "prompt_tokens",
+    "completion_tokens",
+    "spending_count",
+    "total_response_time",
+)
+
+
+def llm_usage_deltas(
+    prompt_tokens,
+    completion_tokens,
+    spending_count,
+    response_time,
+    brain=False,
+    total_tokens=None,
+):
+    """Return the statistics, daily stats and role stats deltas of one llm call."""
+    statistics = {
+        "total_tokens_used": (
+            prompt_tokens + completion_tokens if total_tokens is None else total_tokens
+        ),
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_spending_count": spending_count,
+    }
+    daily = {
+        "spending_count": spending_count,
+        "total_response_time": response_time,
+        "response_count": 1,
+    }
+    if brain:
+        daily["brain_tokens"] = prompt_tokens
+    else:
+        daily["prompt_tokens"] = prompt_tokens
+        daily["generation_tokens"] = completion_tokens
+    role = (1, prompt_tokens, completion_tokens, spending_count, response_time)
+    return statistics, daily, role
+
+
+class ConnectionPool:
+    """Thread-safe pool of the connections of Database, shared by the whole process.
+
+    Up to size connections are kept open, at most max_connections are in use at
+    the same time and a caller waits up to timeout seconds for a free one. The
+    pool is created again when DATABASE_URL or PRODUCTION change.
+    """
+
+    def __init__(
+        self,
+        size=DB_POOL_SIZE,
+        max_connections=DB_POOL_MAX_CONNECTIONS,
+        timeout=DB_POOL_TIMEOUT,
+    ):
+        self.size = size
+        self.max_connections = max(size, max_connections)
+        self.timeout = timeout
+        self._pool = None
+        self._key = None
+        self._lock = threading.Lock()
+        self._available = threading.BoundedSemaphore(self.max_connections)
+        self._stats = {
+            "borrowed": 0,
+            "in_use": 0,
+            "max_in_use": 0,
+            "waits": 0,
+            "total_wait_time": 0.0,
+            "max_wait_time": 0.0,
+            "timeouts": 0,
+            "discarded": 0,
+        }
+
+    def _get_pool(self):
+        key = (os.environ["DATABASE_URL"], os.environ["PRODUCTION"])
+        with self._lock:
+            if self._pool is None or self._key != key:
+                old_pool = self._pool
+                kwargs = {} if key[1] == "false" else {"sslmode": "require"}
+                # psycopg2 keeps minconn connections open and closes the others
+                self._pool = psycopg2.pool.ThreadedConnectionPool(
+                    self.size, self.max_connections, key[0], **kwargs
+                )
+                self._key = key
+                if old_pool is not None:
+                    # connections that are still in use are closed when they are returned
+                    old_pool.closeall()
+            return self._pool
+
+    def getconn(self):
+        """Borrow a connection, returns the pool it belongs to and the connection."""
+        started = time.perf_counter()
+        if not self._available.acquire(timeout=self.timeout):
+            with self._lock:
+                self._stats["timeouts"] += 1
+            raise psycopg2.pool.PoolError(
+                f"No database connection available after {self.timeout} seconds"
+            )
+        waited = time.perf_counter() - started
+        try:
+            pool = self._get_pool()
+            conn = pool.getconn()
+            # drop connections that were closed while they were idle
+            while conn.closed:
+                pool.putconn(conn, close=True)
+                conn = pool.getconn()
+        except BaseException:
+            self._available.release()
+            raise
+        with self._lock:
+            stats = self._stats
+            stats["borrowed"] += 1
+            stats["in_use"] += 1
+            stats["max_in_use"] = max(stats["max_in_use"], stats["in_use"])
+            if waited > 0.001:
+                stats["waits"] += 1
+            stats["total_wait_time"] += waited
+            stats["max_wait_time"] = max(stats["max_wait_time"], waited)
+        return pool, conn
+
+    def putconn(self, pool, conn, discard=False):
+        """Return a borrowed connection, an open transaction is rolled back.
+
+        A discarded connection (after a connection error) is closed instead of reused.
+        """
+        discard = discard or bool(conn.closed)
+        try:
+            pool.putconn(conn, close=discard)
+        except psycopg2.pool.PoolError:
+            # the pool was replaced while the connection was in use
+            conn.close()
+        finally:
+            with self._lock:
+                self._stats["in_use"] -= 1
+                if discard:
+                    self._stats["discarded"] += 1
+            self._available.release()
+
+    def get_statistics(self):
+        with self._lock:
+            stats = dict(self._stats)
+            pool = self._pool
+        stats["idle"] = len(pool._pool) if pool is not None and not pool.closed else 0
+        stats["size"] = self.size
+        stats["max_connections"] = self.max_connections
+        stats["average_wait_time"] = round(
+            stats["total_wait_time"] / (stats["borrowed"] or 1), 4
+        )
+        stats["total_wait_time"] = round(stats["total_wait_time"], 4)
+        stats["max_wait_time"] = round(stats["max_wait_time"], 4)
+        return stats
+
+    def closeall(self):
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None and not pool.closed:
+            pool.closeall()
+
+
+connection_pool = ConnectionPool()
+
 
 class Database:
     def __init__(self):
-        self.DATABASE_URL = os.environ["DATABASE_URL"]
-        self.PRODUCTION = os.environ["PRODUCTION"]
         self.single_user = is_single_user()
         self.conn = None
         self.cursor = None
+        self._pool = None
+        self._users_dao = None
+        self._chat_tabs_dao = None
         self.migrations_dir = "migrations"
         if getattr(sys, "frozen", False):
             # If the application is frozen (bundled)
             sys.path.append(os.path.join(sys._MEIPASS, "migrations"))
-        from user_management.dao import UsersDAO
 
-        self.users_dao = UsersDAO()
-        self.chat_tabs_dao = ChatTabsDAO()
+    @property
+    def users_dao(self):
+        if self._users_dao is None:
+            from user_management.dao import UsersDAO
+
+            self._users_dao = UsersDAO()
+        return self._users_dao
+
+    @property
+    def chat_tabs_dao(self):
+        if self._chat_tabs_dao is None:
+            self._chat_tabs_dao = ChatTabsDAO()
+        return self._chat_tabs_dao
 
     def open(self):
-        if self.PRODUCTION == "false":
-            self.conn = psycopg2.connect(self.DATABASE_URL)
-        else:
-            self.conn = psycopg2.connect(self.DATABASE_URL, sslmode="require")
+        self._pool, self.conn = connection_pool.getconn()
         self.cursor = self.conn.cursor()
 
-    def close(self):
+    def close(self, discard=False):
+        for dao in (self._users_dao, self._chat_tabs_dao):
+            if dao is not None:
+                dao.close_session()
+        self._users_dao = self._chat_tabs_dao = None
         if self.conn:
-            self.conn.close()
+            connection_pool.putconn(self._pool, self.conn, discard)
             self.conn = None
             self.cursor = None
+            self._pool = None
 
     def __enter__(self):
         self.open()
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self.close()
+        # a connection that failed is not given to the next block
+        self.close(
+            discard=isinstance(
+                exc_val, (psycopg2.OperationalError, psycopg2.InterfaceError)
+            )
+        )
 
     def load_migrations(self):
         migrations = []
@@ -126,36 +315,70 @@ class Database:
         self.users_dao.create_default_user()
 
     def get_global_statistics(self):
-        """Get the global statistics.
+        """Get the global statistics from the rollup, see refresh_statistics_rollup.
 
         returns: a dictionary containing the global statistics
         """
         dict_cursor = self.conn.cursor(cursor_factory=RealDictCursor)
         dict_cursor.execute(
-            "SELECT SUM(amount_of_messages) as total_messages, SUM(total_tokens_used) as total_tokens, SUM(prompt_tokens) as total_prompt_tokens, SUM(completion_tokens) as total_completion_tokens, SUM(voice_usage) as total_voice_usage, SUM(total_spending_count) as total_spending, AVG(total_average_response_time) as average_response_time FROM statistics"
+            "SELECT total_users, total_messages, total_tokens, total_prompt_tokens, total_completion_tokens, total_voice_usage, total_spending, average_response_time, refreshed_at FROM statistics_rollup"
         )
         row = dict_cursor.fetchone()
         return json.dumps(row, default=str)
 
+    def refresh_statistics_rollup(self):
+        """Recompute the global statistics rollup without blocking its readers."""
+        self.cursor.execute("REFRESH MATERIALIZED VIEW CONCURRENTLY statistics_rollup")
+        self.conn.commit()
+
     def get_all_statistics(self):
         dict_cursor = self.conn.cursor(cursor_factory=RealDictCursor)
-        dict_cursor.execute("SELECT * FROM statistics")
+        dict_cursor.execute(
+            "SELECT statistics.*, users.username FROM statistics JOIN users ON users.id = statistics.user_id"
+        )
         rows = dict_cursor.fetchall()
-
-        # replace the user_id with the username
-        for row in rows:
-            row["username"] = self.get_username(row["user_id"])[0]
         return json.dumps(rows, default=str)
 
-    def get_user_statistics(self, user_id):
+    @staticmethod
+    def get_statistics_range(start_day=None, end_day=None):
+        """Return the (start_day, end_day) range, the last STATS_DEFAULT_DAYS days by default."""
+        end_day = end_day or datetime.datetime.now().date()
+        start_day = start_day or end_day - datetime.timedelta(
+            days=STATS_DEFAULT_DAYS - 1
+        )
+        return start_day, end_day
+
+    def get_user_statistics(
+        self,
+        user_id,
+        start_day=None,
+        end_day=None,
+        page=1,
+        items_per_page=STATS_DAYS_PER_PAGE,
+    ):
+        """Get a page of the daily stats of the user between start_day and end_day, newest first."""
+        start_day, end_day = self.get_statistics_range(start_day, end_day)
         dict_cursor = self.conn.cursor(cursor_factory=RealDictCursor)
         dict_cursor.execute(
-            "SELECT * FROM daily_stats WHERE user_id = %s ORDER BY timestamp DESC",
-            (user_id,),
+            """
+            SELECT * FROM daily_stats
+            WHERE user_id = %s AND day BETWEEN %s AND %s
+            ORDER BY day DESC LIMIT %s OFFSET %s
+            """,
+            (user_id, start_day, end_day, items_per_page, (page - 1) * items_per_page),
         )
         rows = dict_cursor.fetchall()
         return json.dumps(rows, default=str)
 
+    def get_user_statistics_count(self, user_id, start_day=None, end_day=None):
+        """Get the number of days with daily stats of the user between start_day and end_day."""
+        start_day, end_day = self.get_statistics_range(start_day, end_day)
+        self.cursor.execute(
+            "SELECT COUNT(*) FROM daily_stats WHERE user_id = %s AND day BETWEEN %s AND %s",
+            (user_id, start_day, end_day),
+        )
+        return self.cursor.fetchone()[0]
+
     def get_statistics(self, page, items_per_page):
         dict_cursor = self.conn.cursor(cursor_factory=RealDictCursor)
         offset = (page - 1) * items_per_page
@@ -240,7 +463,7 @@ class Database:
 
         # execute the SQL query with the user_id and the current date
         dict_cursor.execute(
-            "SELECT * FROM daily_stats WHERE user_id = %s AND DATE(timestamp) = %s",
+            "SELECT * FROM daily_stats WHERE user_id = %s AND day = %s",
             (user_id, current_date),
         )
         return dict_cursor.fetchone()
@@ -282,42 +505,24 @@ class Database:
         # get the user_id for the given username
         user_id = self.users_dao.get_user_id(username)
 
-        # get the current timestamp
-        current_timestamp = datetime.datetime.now()
-
-        # check if a record for the current date exists
-        self.cursor.execute(
-            "SELECT 1 FROM daily_stats WHERE user_id = %s AND DATE(timestamp) = DATE(%s)",
-            (user_id, current_timestamp),
+        # insert the token usage of today or add it to the existing row
+        columns = ", ".join(kwargs.keys())
+        values = ", ".join(["%s"] * len(kwargs))
+        set_clause = ", ".join(
+            [f"{k} = daily_stats.{k} + EXCLUDED.{k}" for k in kwargs.keys()]
         )
-        record_exists = self.cursor.fetchone() is not None
-
-        # update or insert the token usage in the daily stats table
-        if record_exists:
-            set_clause = ", ".join([f"{k} = {k} + %s" for k in kwargs.keys()])
-            query = f"""
-            UPDATE daily_stats SET {set_clause} 
-            WHERE user_id = %s AND DATE(timestamp) = DATE(%s)
-            """
-            params = (*kwargs.values(), user_id, current_timestamp)
-        else:
-            columns = ", ".join(kwargs.keys())
-            values = ", ".join(["%s"] * len(kwargs))
-            query = f"""
-            INSERT INTO daily_stats (user_id, {columns}) 
-            VALUES (%s, {values})
-            """
-            params = (user_id, *kwargs.values())
-
-        self.cursor.execute(query, params)
-        self.conn.commit()
-
-        # get the token usage
         self.cursor.execute(
-            f"SELECT {', '.join(kwargs.keys())} FROM daily_stats WHERE user_id = %s AND DATE(timestamp) = DATE(%s)",
-            (user_id, current_timestamp),
+            f"""
+            INSERT INTO daily_stats (user_id, day, {columns})
+            VALUES (%s, %s, {values})
+            ON CONFLICT (user_id, day) DO UPDATE SET {set_clause}
+            RETURNING {columns}
+            """,
+            (user_id, datetime.datetime.now().date(), *kwargs.values()),
         )
-        return self.cursor.fetchone()
+        row = self.cursor.fetchone()
+        self.conn.commit()
+        return row
 
     def replace_daily_stats_token_usage(self, username, **kwargs):
         """Replace the token usage for the given username.
@@ -344,42 +549,22 @@ class Database:
         # get the user_id for the given username
         user_id = self.users_dao.get_user_id(username)
 
-        # get the current timestamp
-        current_timestamp = datetime.datetime.now()
-
-        # check if a record for the current date exists
+        # insert the token usage of today or replace the values of the existing row
+        columns = ", ".join(kwargs.keys())
+        values = ", ".join(["%s"] * len(kwargs))
+        set_clause = ", ".join([f"{k} = EXCLUDED.{k}" for k in kwargs.keys()])
         self.cursor.execute(
-            "SELECT 1 FROM daily_stats WHERE user_id = %s AND DATE(timestamp) = DATE(%s)",
-            (user_id, current_timestamp),
+            f"""
+            INSERT INTO daily_stats (user_id, day, {columns})
+            VALUES (%s, %s, {values})
+            ON CONFLICT (user_id, day) DO UPDATE SET {set_clause}
+            RETURNING {columns}
+            """,
+            (user_id, datetime.datetime.now().date(), *kwargs.values()),
         )
-        record_exists = self.cursor.fetchone() is not None
-
-        # update or insert the token usage in the daily stats table
-        if record_exists:
-            set_clause = ", ".join([f"{k} = %s" for k in kwargs.keys()])
-            query = f"""
-            UPDATE daily_stats SET {set_clause} 
-            WHERE user_id = %s AND DATE(timestamp) = DATE(%s)
-            """
-            params = (*kwargs.values(), user_id, current_timestamp)
-        else:
-            columns = ", ".join(kwargs.keys())
-            values = ", ".join(["%s"] * len(kwargs))
-            query = f"""
-            INSERT INTO daily_stats (user_id, {columns}) 
-            VALUES (%s, {values})
-            """
-            params = (user_id, *kwargs.values())
-
-        self.cursor.execute(query, params)
+        row = self.cursor.fetchone()
         self.conn.commit()
-
-        # get the token usage
-        self.cursor.execute(
-            f"SELECT {', '.join(kwargs.keys())} FROM daily_stats WHERE user_id = %s AND DATE(timestamp) = DATE(%s)",
-            (user_id, current_timestamp),
-        )
-        return self.cursor.fetchone()
+        return row
 
     def delete_daily_stats(self, user_id):
         self.cursor.execute("DELETE FROM daily_stats WHERE user_id = %s", (user_id,))
@@ -436,7 +621,7 @@ class Database:
             # execute the SQL query with the user_id and the current date
             self.cursor = self.conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
             self.cursor.execute(
-                "SELECT * FROM daily_stats WHERE user_id = %s AND DATE(timestamp) = %s",
+                "SELECT * FROM daily_stats WHERE user_id = %s AND day = %s",
                 (user_id, current_date),
             )
             row = self.cursor.fetchone()
@@ -480,54 +665,30 @@ class Database:
         # get the user_id for the given username
         user_id = self.users_dao.get_user_id(username)
 
-        # get the current timestamp
-        current_timestamp = datetime.datetime.now()
-
-        # check if a record for the current date exists
-        self.cursor.execute(
-            "SELECT 1 FROM daily_stats WHERE user_id = %s AND DATE(timestamp) = DATE(%s)",
-            (user_id, current_timestamp),
-        )
-        record_exists = self.cursor.fetchone() is not None
-
         # update or insert the message count in the daily stats table
-        if record_exists:
-            query = """
-            UPDATE daily_stats SET message_amount = daily_stats.message_amount + 1 
-            WHERE user_id = %s AND DATE(timestamp) = DATE(%s)
-            """
-            params = (user_id, current_timestamp)
-        else:
-            query = """
-            INSERT INTO daily_stats (user_id, message_amount) 
-            VALUES (%s, 1)
-            """
-            params = (user_id,)
-
-        self.cursor.execute(query, params)
-        self.conn.commit()
-
-        # get the daily message count
         self.cursor.execute(
-            "SELECT message_amount FROM daily_stats WHERE user_id = %s AND DATE(timestamp) = DATE(%s)",
-            (user_id, current_timestamp),
+            """
+            INSERT INTO daily_stats (user_id, day, message_amount)
+            VALUES (%s, %s, 1)
+            ON CONFLICT (user_id, day) DO UPDATE SET message_amount = daily_stats.message_amount + 1
+            RETURNING message_amount
+            """,
+            (user_id, datetime.datetime.now().date()),
         )
         daily_messages_count = self.cursor.fetchone()
 
         # update or insert the message count in the statistics table
-        query = """
-        INSERT INTO statistics (user_id, amount_of_messages) 
-        VALUES (%s, 1)
-        ON CONFLICT (user_id) DO UPDATE SET amount_of_messages = statistics.amount_of_messages + 1
-        """
-        self.cursor.execute(query, (user_id,))
-        self.conn.commit()
-
-        # get the total message count
         self.cursor.execute(
-            "SELECT amount_of_messages FROM statistics WHERE user_id = %s", (user_id,)
+            """
+            INSERT INTO statistics (user_id, amount_of_messages)
+            VALUES (%s, 1)
+            ON CONFLICT (user_id) DO UPDATE SET amount_of_messages = statistics.amount_of_messages + 1
+            RETURNING amount_of_messages
+            """,
+            (user_id,),
         )
         total_messages_count = self.cursor.fetchone()
+        self.conn.commit()
 
         return daily_messages_count, total_messages_count
 
@@ -549,6 +710,146 @@ class Database:
         result = self.update_token_usage(username, voice_usage=cost)
         return result
 
+    def apply_usage(self, username, day, statistics, daily, roles=None):
+        """Add usage deltas to the statistics, the daily stats of the day and the role stats.
+
+        statistics and daily map column names to the amounts that are added,
+        roles maps (role, model) to ROLE_USAGE_COLUMNS amounts. All increments
+        happen in one statement, so concurrent writers can't lose updates.
+
+        returns: a dictionary with total_tokens_used, prompt_tokens,
+        completion_tokens and daily_spending_count, or None for an unknown user
+        """
+        statistics = {
+            "total_tokens_used": 0,
+            "prompt_tokens": 0,
+            "completion_tokens": 0,
+            **statistics,
+        }
+        daily = {"spending_count": 0, **daily}
+        roles = roles or {}
+        for column in (*statistics, *daily):
+            if not column.isidentifier():
+                raise ValueError(f"Invalid column: {column}")
+
+        statistics_set = ", ".join(
+            f"{column} = COALESCE(statistics.{column}, 0) + EXCLUDED.{column}"
+            for column in statistics
+        )
+        daily_set = ", ".join(
+            f"{column} = COALESCE(daily_stats.{column}, 0) + EXCLUDED.{column}"
+            for column in daily
+        )
+        if daily.get("response_count"):
+            daily_set += (
+                ", average_response_time = (COALESCE(daily_stats.total_response_time, 0) + EXCLUDED.total_response_time)"
+                " / (COALESCE(daily_stats.response_count, 0) + EXCLUDED.response_count)"
+            )
+            daily_columns = [*daily, "average_response_time"]
+            params_average = (
+                daily.get("total_response_time", 0) / daily["response_count"]
+            )
+        else:
+            daily_columns = list(daily)
+            params_average = None
+
+        params = {
+            "username": username,
+            "day": day,
+            **{f"statistics_{column}": value for column, value in statistics.items()},
+            **{f"daily_{column}": value for column, value in daily.items()},
+            "daily_average_response_time": params_average,
+        }
+        params.update(
+            {
+                f"role_{column}": [usage[i] for usage in roles.values()]
+                for i, column in enumerate(ROLE_USAGE_COLUMNS)
+            }
+        )
+        params["role_role"] = [role for role, _ in roles]
+        params["role_model"] = [model for _, model in roles]
+
+        dict_cursor = self.conn.cursor(cursor_factory=RealDictCursor)
+        dict_cursor.execute(
+            f"""
+            WITH usr AS (
+                SELECT id FROM users WHERE username = %(username)s
+            ),
+            stats AS (
+                INSERT INTO statistics (user_id, {", ".join(statistics)})
+                SELECT id, {", ".join(f"%(statistics_{column})s" for column in statistics)} FROM usr
+                ON CONFLICT (user_id) DO UPDATE SET {statistics_set}
+                RETURNING total_tokens_used, prompt_tokens, completion_tokens
+            ),
+            daily AS (
+                INSERT INTO daily_stats (user_id, day, {", ".join(daily_columns)})
+                SELECT id, %(day)s, {", ".join(f"%(daily_{column})s" for column in daily_columns)}
+                FROM usr
+                ON CONFLICT (user_id, day) DO UPDATE SET {daily_set}
+                RETURNING spending_count
+            ),
+            roles AS (
+                INSERT INTO role_stats (user_id, role, model, day, {", ".join(ROLE_USAGE_COLUMNS)})
+                SELECT usr.id, r.role, r.model, %(day)s, {", ".join(f"r.{column}" for column in ROLE_USAGE_COLUMNS)}
+                FROM usr, unnest(
+                    %(role_role)s::varchar[], %(role_model)s::varchar[], %(role_call_count)s::integer[],
+                    %(role_prompt_tokens)s::integer[], %(role_completion_tokens)s::integer[],
+                    %(role_spending_count)s::float[], %(role_total_response_time)s::float[]
+                ) AS r(role, model, {", ".join(ROLE_USAGE_COLUMNS)})
+                ON CONFLICT (user_id, role, model, day) DO UPDATE SET
+                    {", ".join(f"{column} = role_stats.{column} + EXCLUDED.{column}" for column in ROLE_USAGE_COLUMNS)}
+                RETURNING 1
+            )
+            SELECT stats.total_tokens_used, stats.prompt_tokens, stats.completion_tokens,
+                daily.spending_count AS daily_spending_count
+            FROM stats, daily
+            """,
+            params,
+        )
+        row = dict_cursor.fetchone()
+        self.conn.commit()
+        return row
+
+    def get_usage_totals(self, username, day):
+        """Get the token totals of the user and the spending of the day.
+
+        returns: a dictionary like apply_usage, or None for an unknown user
+        """
+        dict_cursor = self.conn.cursor(cursor_factory=RealDictCursor)
+        dict_cursor.execute(
+            """
+            SELECT COALESCE(statistics.total_tokens_used, 0) AS total_tokens_used,
+                COALESCE(statistics.prompt_tokens, 0) AS prompt_tokens,
+                COALESCE(statistics.completion_tokens, 0) AS completion_tokens,
+                COALESCE(daily_stats.spending_count, 0) AS daily_spending_count
+            FROM users
+            LEFT JOIN statistics ON statistics.user_id = users.id
+            LEFT JOIN daily_stats ON daily_stats.user_id = users.id AND daily_stats.day = %s
+            WHERE users.username = %s
+            """,
+            (day, username),
+        )
+        return dict_cursor.fetchone()
+
+    def get_role_statistics(self, user_id=None, days=30):
+        """Get the per role call count, latency and cost of the last days, optionally for one user."""
+        dict_cursor = self.conn.cursor(cursor_factory=RealDictCursor)
+        query = """
+            SELECT role, model, SUM(call_count) AS call_count, SUM(prompt_tokens) AS prompt_tokens,
+                SUM(completion_tokens) AS completion_tokens, SUM(spending_count) AS spending_count,
+                SUM(total_response_time) / NULLIF(SUM(call_count), 0) AS average_response_time
+            FROM role_stats
+            WHERE day >= CURRENT_DATE - %s
+            """
+        params = [days]
+        if user_id is not None:
+            query += " AND user_id = %s"
+            params.append(user_id)
+        query += " GROUP BY role, model ORDER BY spending_count DESC"
+        dict_cursor.execute(query, params)
+        rows = dict_cursor.fetchall()
+        return json.dumps(rows, default=str)
+
     def purge_user_by_username(self, username: str) -> bool:
         try:
             user_id = self.users_dao.get_user_id(username)
@@ -570,6 +871,11 @@ class Database:
             daily_stats_deleted = self.cursor.rowcount
             logger.debug(f"Deleted {daily_stats_deleted} daily_stats entries.")
 
+            # Delete related data in role_stats
+            self.cursor.execute("DELETE FROM role_stats WHERE user_id = %s", (user_id,))
+            role_stats_deleted = self.cursor.rowcount
+            logger.debug(f"Deleted {role_stats_deleted} role_stats entries.")
+
             # Delete related data in statistics
             self.cursor.execute("DELETE FROM statistics WHERE user_id = %s", (user_id,))
             statistics_deleted = self.cursor.rowcount
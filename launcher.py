@@ -2,14 +2,13 @@ import os
 from typing import List, Type
 
 from fastapi import FastAPI, APIRouter
-from starlette.middleware.base import BaseHTTPMiddleware
 
 from config import origins
 from user_management.dao import UsersDAO
 from agentmemory.check_model import check_model, default_model_path
 
 
-def default_middleware() -> List[Type[BaseHTTPMiddleware]]:
+def default_middleware() -> List[Type]:
     from configuration_page.middleware import LoginAdminMiddleware
     from configuration_page.redirect_middleware import RedirectToConfigurationMiddleware
     from configuration_page.middleware import LoginRequiredCheckMiddleware
@@ -52,7 +51,7 @@ def load_data():
 
 
 def create_app(
-    middlewares: List[BaseHTTPMiddleware] = None, routers: List[APIRouter] = None
+    middlewares: List[Type] = None, routers: List[APIRouter] = None
 ) -> FastAPI:
     from configuration_page import reload_configuration
 
@@ -61,6 +60,15 @@ def create_app(
     import nltk
     import logs
     import utils
+    from addon_executor import addon_executor
+    from admin_controls_cache import admin_controls_cache
+    from config import CODE_SANDBOX
+    from container_pool import container_pool
+    from database import connection_pool
+    from subprocess_sandbox import subprocess_sandbox
+    from usage_aggregator import usage_aggregator
+    from user_management.session import async_session_factory
+    from web_fetch import web_fetcher
 
     nltk.download("punkt")
 
@@ -92,9 +100,31 @@ def create_app(
         allow_headers=["*"],
     )
 
+    @app.on_event("startup")
+    def startup_event():
+        # write the usage statistics in batches
+        usage_aggregator.start()
+        # keep the admin controls cached and listen for changes of other workers
+        admin_controls_cache.start()
+        if CODE_SANDBOX == "subprocess":
+            # start the idle sandbox worker processes
+            subprocess_sandbox.start()
+        else:
+            # pull the sandbox image and start reaping idle sandbox containers
+            container_pool.start()
+
     @app.on_event("shutdown")
-    def shutdown_event():
+    async def shutdown_event():
         logs.Log("main", "main.log").get_logger().debug("Shutting down server")
+        addon_executor.shutdown()
+        admin_controls_cache.shutdown()
+        container_pool.shutdown()
+        subprocess_sandbox.shutdown()
+        await web_fetcher.close()
+        # write the pending usage before the connections are closed
+        usage_aggregator.shutdown()
+        connection_pool.closeall()
+        await async_session_factory.dispose()
 
     if middlewares is None:
         middlewares = default_middleware()
@@ -0,0 +1,212 @@
+"""
+Response cache for the auxiliary LLM roles.
+
+The date-extractor, categorise_query, categorise, tab title and query rewrite
+calls are small, low temperature prompts that are repeated a lot. Their answers
+are cached here, keyed by (role, model, normalized prompt hash), so identical
+prompts are answered without another round-trip to the provider.
+"""
+
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+
+import logs
+from config import (
+    LLM_CACHE_DISK,
+    LLM_CACHE_DISK_PATH,
+    LLM_CACHE_MAX_ENTRIES,
+    LLM_CACHE_TTL,
+)
+
+logger = logs.Log("llm_cache", "llm_cache.log").get_logger()
+
+# roles that are safe to cache, the value is the default enable flag in the settings
+CACHEABLE_ROLES = {
+    "date-extractor": True,
+    "categorise_query": True,
+    "categorise": True,
+    "tab_title": True,
+    "query_rewrite": True,
+}
+
+
+@dataclass(frozen=True)
+class CacheEntry:
+    response: str
+    input_tokens: int
+    output_tokens: int
+    created_at: float
+
+
+class ResponseCache:
+    """Bounded in-memory LRU with a TTL and an optional sqlite tier on disk."""
+
+    def __init__(self, max_entries=2048, ttl=3600, disk_path=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.disk_path = disk_path
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn = None
+        self._writes = 0
+
+    @staticmethod
+    def normalize_prompt(prompt):
+        """Return the prompt as a single string with collapsed whitespace.
+
+        The system messages are left out, they are fully determined by the role.
+        """
+        if isinstance(prompt, list):
+            prompt = "\n".join(
+                f"{message.get('role')}: {message.get('content')}"
+                for message in prompt
+                if message.get("role") != "system"
+            )
+        return re.sub(r"\s+", " ", str(prompt)).strip()
+
+    @staticmethod
+    def make_key(role, model, prompt, context=""):
+        """Hash the role, model, context (e.g. the current date) and normalized prompt."""
+        payload = json.dumps(
+            [role, model, context, ResponseCache.normalize_prompt(prompt)]
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        """Return the cached entry for the key or None if missing or expired."""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if now - entry.created_at <= self.ttl:
+                    self._entries.move_to_end(key)
+                    return entry
+                del self._entries[key]
+
+            entry = self._disk_get(key, now)
+            if entry is not None:
+                self._remember(key, entry)
+            return entry
+
+    def set(self, key, response, input_tokens=0, output_tokens=0):
+        """Store a response in the cache."""
+        entry = CacheEntry(response, input_tokens, output_tokens, time.time())
+        with self._lock:
+            self._remember(key, entry)
+            self._disk_set(key, entry)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            conn = self._get_connection()
+            if conn is not None:
+                conn.execute("DELETE FROM llm_cache")
+                conn.commit()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _remember(self, key, entry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _get_connection(self):
+        if self.disk_path is None:
+            return None
+        if self._conn is None:
+            directory = os.path.dirname(self.disk_path)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory)
+            self._conn = sqlite3.connect(self.disk_path, check_same_thread=False)
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS llm_cache (
+                    key TEXT PRIMARY KEY,
+                    response TEXT NOT NULL,
+                    input_tokens INTEGER DEFAULT 0,
+                    output_tokens INTEGER DEFAULT 0,
+                    created_at REAL NOT NULL
+                )
+                """
+            )
+            self._conn.commit()
+        return self._conn
+
+    def _disk_get(self, key, now):
+        try:
+            conn = self._get_connection()
+            if conn is None:
+                return None
+            row = conn.execute(
+                "SELECT response, input_tokens, output_tokens, created_at FROM llm_cache WHERE key = ? AND created_at >= ?",
+                (key, now - self.ttl),
+            ).fetchone()
+        except sqlite3.Error as e:
+            logger.error(f"Error reading the llm cache from disk: {e}")
+            return None
+        if row is None:
+            return None
+        return CacheEntry(*row)
+
+    def _disk_set(self, key, entry):
+        try:
+            conn = self._get_connection()
+            if conn is None:
+                return
+            conn.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, response, input_tokens, output_tokens, created_at) VALUES (?, ?, ?, ?, ?)",
+                (
+                    key,
+                    entry.response,
+                    entry.input_tokens,
+                    entry.output_tokens,
+                    entry.created_at,
+                ),
+            )
+            self._writes += 1
+            # every so often drop the expired entries and keep the table bounded
+            if self._writes % 100 == 0:
+                conn.execute(
+                    "DELETE FROM llm_cache WHERE created_at < ?",
+                    (time.time() - self.ttl,),
+                )
+                conn.execute(
+                    "DELETE FROM llm_cache WHERE key NOT IN (SELECT key FROM llm_cache ORDER BY created_at DESC LIMIT ?)",
+                    (self.max_entries * 10,),
+                )
+            conn.commit()
+        except sqlite3.Error as e:
+            logger.error(f"Error writing the llm cache to disk: {e}")
+
+
+def is_enabled(settings, role):
+    """Check if caching is enabled for the role in the user settings."""
+    if role not in CACHEABLE_ROLES:
+        return False
+    return bool(settings.get("llm_cache", {}).get(role, CACHEABLE_ROLES[role]))
+
+
+def usage_tokens(response):
+    """Return the (input, output) tokens of an OpenAI or Claude response."""
+    usage = getattr(response, "usage", None)
+    if usage is None:
+        return 0, 0
+    if hasattr(usage, "input_tokens") and hasattr(usage, "output_tokens"):
+        return usage.input_tokens, usage.output_tokens
+    return getattr(usage, "prompt_tokens", 0), getattr(usage, "completion_tokens", 0)
+
+
+response_cache = ResponseCache(
+    max_entries=LLM_CACHE_MAX_ENTRIES,
+    ttl=LLM_CACHE_TTL,
+    disk_path=LLM_CACHE_DISK_PATH if LLM_CACHE_DISK else None,
+)
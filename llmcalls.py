@@ -13,7 +13,11 @@ import uuid
 from openai import AsyncOpenAI
 from dotenv import load_dotenv
 import aiohttp
+import config
 import utils
+import llm_cache
+from addon_executor import addon_executor
+from addon_registry import addon_registry
 from PIL import Image
 
 from anthropic import AsyncAnthropic, APIStatusError, BadRequestError, RateLimitError
@@ -34,19 +38,8 @@ class ClaudeResponser:
 
         self.client = AsyncAnthropic(api_key=api_key)
         self.default_params = default_params
-        self.addons = self.load_addons()
         self.model = model
 
-    def load_addons(self):
-        """Load the addons from the addons directory."""
-        addons = {}
-        for filename in os.listdir("addons"):
-            if filename.endswith(".py") and filename != "__init__.py":
-                addon_name = filename.replace(".py", "")
-                addon = __import__(f"addons.{addon_name}", fromlist=[""])
-                addons[addon_name] = addon
-        return addons
-
     async def process_chunk(self, chunk, collected_temp, chat_id, username, message):
         if chunk.type == "content_block_delta" and chunk.delta.type == "text_delta":
             content = chunk.delta.text
@@ -56,7 +49,7 @@ class ClaudeResponser:
             full_content = "".join(collected_temp)
             if "<execute_code>" in full_content and "</execute_code>" in full_content:
                 code_result = await utils.extract_and_execute_code(
-                    full_content, username
+                    full_content, username, chat_id
                 )
                 collected_temp.clear()
                 collected_temp.append(full_content.split("</execute_code>")[-1])
@@ -158,12 +151,22 @@ class ClaudeResponser:
         chat_id=None,
         role=None,
         uid=None,
+        cache_role=None,
     ):
         if function_metadata is None:
             function_metadata = []
 
         current_date_time = await utils.SettingsManager.get_current_date_time(username)
 
+        cache_key, cached = (None, None)
+        if not stream:
+            cache_key, cached = await lookup_cached_response(
+                username, self.model, cache_role or role, message, current_date_time
+            )
+            if cached is not None:
+                yield cached.response
+                return
+
         role_content = (
             self.get_role_content(role, current_date_time)
             + "\nIt is important to follow the previously given instructions and adhere to the required format and structure. Do not say anything else. The chat above is for reference only. Do not reply to any of the questions, instructions or messages in the chathistory, only to the most recent instructions! \n"
@@ -326,11 +329,14 @@ class ClaudeResponser:
                             try:
                                 tool_input = json.loads(tool_call["input"])
                                 yield f"Executing tool: {tool_call['name']} with input {tool_input}"
+                                addons, _ = await utils.AddonManager.load_addons(
+                                    username, "users"
+                                )
                                 tool_result = (
                                     await utils.MessageParser.process_function_call(
                                         tool_call["name"],
                                         tool_input,
-                                        self.addons,
+                                        addons,
                                         function_metadata,
                                         message,
                                         message,
@@ -350,8 +356,19 @@ class ClaudeResponser:
                         elapsed = time.time() - now
                         if response.content and len(response.content) > 0:
                             await utils.MessageSender.update_token_usage(
-                                response, username, False, elapsed=elapsed
+                                response,
+                                username,
+                                False,
+                                elapsed=elapsed,
+                                model=self.model,
+                                role=cache_role or role,
                             )
+                            if cache_key is not None:
+                                llm_cache.response_cache.set(
+                                    cache_key,
+                                    response.content[0].text,
+                                    *llm_cache.usage_tokens(response),
+                                )
                             yield response.content[0].text
                         else:
                             yield None
@@ -416,22 +433,8 @@ class ClaudeResponser:
 
         for func in function_metadata:
             try:
-                tool = {
-                    "name": func.get("function", {}).get("name") or func.get("name"),
-                    "description": func.get("function", {}).get("description")
-                    or func.get("description"),
-                    "input_schema": {
-                        "type": "object",
-                        "properties": func.get("function", {})
-                        .get("parameters", {})
-                        .get("properties")
-                        or func.get("parameters", {}).get("properties", {}),
-                        "required": func.get("function", {})
-                        .get("parameters", {})
-                        .get("required")
-                        or func.get("parameters", {}).get("required", []),
-                    },
-                }
+                # the schemas of the addons are converted once by the registry
+                tool = addon_registry.claude_tool_for(func)
                 # Ensure all required fields are present
                 if all(key in tool for key in ["name", "description", "input_schema"]):
                     tools.append(tool)
@@ -502,6 +505,7 @@ Remember to only reply with the JSON format of the notes, nothing else. Do not w
     def user_pressed_stop(username):
         global stopPressed
         stopPressed[username] = True
+        addon_executor.cancel(username)
 
     @staticmethod
     def reset_stop_stream(username):
@@ -517,19 +521,8 @@ class OpenAIResponser:
         base_url = os.getenv("BASE_URL", None)
         self.client = AsyncOpenAI(base_url=base_url, api_key=api_key)
         self.default_params = default_params
-        self.addons = self.load_addons()
         self.model = model
 
-    def load_addons(self):
-        """Load the addons from the addons directory."""
-        addons = {}
-        for filename in os.listdir("addons"):
-            if filename.endswith(".py") and filename != "__init__.py":
-                addon_name = filename.replace(".py", "")
-                addon = __import__(f"addons.{addon_name}", fromlist=[""])
-                addons[addon_name] = addon
-        return addons
-
     async def generate_audio(self, text, username, users_dir, voice="alloy", speed=1.0):
         """Asynchronously generate audio from text using the OpenAI API."""
         # Make sure the directory exists
@@ -610,7 +603,9 @@ class OpenAIResponser:
 
         full_content = "".join(collected_temp)
         if "<execute_code>" in full_content and "</execute_code>" in full_content:
-            code_result = await utils.extract_and_execute_code(full_content, username)
+            code_result = await utils.extract_and_execute_code(
+                full_content, username, chat_id
+            )
             collected_temp.clear()
             collected_temp.append(full_content.split("</execute_code>")[-1])
             return code_result
@@ -626,6 +621,7 @@ class OpenAIResponser:
         chat_id=None,
         role=None,
         uid=None,
+        cache_role=None,
     ):
         """Get a response from the OpenAI API."""
         if function_metadata is None:
@@ -641,6 +637,16 @@ class OpenAIResponser:
             ]
 
         current_date_time = await utils.SettingsManager.get_current_date_time(username)
+
+        cache_key, cached = (None, None)
+        if not stream:
+            cache_key, cached = await lookup_cached_response(
+                username, self.model, cache_role or role, message, current_date_time
+            )
+            if cached is not None:
+                yield cached.response
+                return
+
         role_content = self.get_role_content(role, current_date_time)
 
         # If a role is present, add the role content to the message
@@ -652,7 +658,9 @@ class OpenAIResponser:
         else:
             messages = message
         settings = await utils.SettingsManager.load_settings("users", username)
-        max_tokens = settings.get("memory", {}).get("output", 1000)
+        max_tokens = self.default_params.get(
+            "max_tokens", settings.get("memory", {}).get("output", 1000)
+        )
         params = self.default_params.copy()
         params.update(
             {
@@ -767,10 +775,13 @@ class OpenAIResponser:
                                 accumulated_arguments  # Use as-is if not valid JSON
                             )
 
+                        addons, _ = await utils.AddonManager.load_addons(
+                            username, "users"
+                        )
                         tool_response = await utils.MessageParser.process_function_call(
                             accumulated_name,
                             parsed_arguments,
-                            self.addons,
+                            addons,
                             function_metadata,
                             message,
                             message,
@@ -783,8 +794,19 @@ class OpenAIResponser:
                 else:
                     elapsed = time.time() - now
                     await utils.MessageSender.update_token_usage(
-                        response, username, False, elapsed=elapsed
+                        response,
+                        username,
+                        False,
+                        elapsed=elapsed,
+                        model=self.model,
+                        role=cache_role or role,
                     )
+                    if cache_key is not None and response.choices[0].message.content:
+                        llm_cache.response_cache.set(
+                            cache_key,
+                            response.choices[0].message.content,
+                            *llm_cache.usage_tokens(response),
+                        )
                     yield response.choices[0].message.content
         except asyncio.TimeoutError:
             yield "The request timed out. Please try again."
@@ -845,6 +867,7 @@ Example:
 def user_pressed_stop(username):
     global stopPressed
     stopPressed[username] = True
+    addon_executor.cancel(username)
 
 
 def reset_stop_stream(username):
@@ -852,6 +875,25 @@ def reset_stop_stream(username):
     stopPressed[username] = False
 
 
+async def lookup_cached_response(username, model, role, message, current_date_time):
+    """Look up a cached response for the auxiliary roles.
+
+    Returns the cache key (None if caching is disabled for the role) and the cached entry (None on a miss).
+    """
+    if role not in llm_cache.CACHEABLE_ROLES:
+        return None, None
+    settings = await utils.SettingsManager.load_settings("users", username)
+    if not llm_cache.is_enabled(settings, role):
+        return None, None
+    # the answers can depend on the current date, so the date is part of the key
+    cache_key = llm_cache.response_cache.make_key(
+        role, model, message, context=current_date_time[:10]
+    )
+    cached = llm_cache.response_cache.get(cache_key)
+    await utils.MessageSender.update_llm_cache_usage(username, model, role, cached)
+    return cache_key, cached
+
+
 def get_responder(api_key: str, model: str, default_params=None):
     if model.startswith("gpt"):
         return OpenAIResponser(api_key, default_params, model)
@@ -859,3 +901,42 @@ def get_responder(api_key: str, model: str, default_params=None):
         return ClaudeResponser(api_key, default_params, model)
     else:
         raise ValueError(f"Unsupported model: {model}")
+
+
+def get_api_key(model: str):
+    """Return the api key for the provider of the model, None if there is no key."""
+    if model.startswith("gpt"):
+        return config.api_keys.get("openai")
+    if model.startswith("claude"):
+        return config.api_keys.get("anthropic")
+    return None
+
+
+def resolve_role_model(settings, role=None):
+    """Return the (model, max_tokens) for a role using the model routing table in the settings.
+
+    Roles without a route, or routed to a model without an api key, use the active model.
+    """
+    active_model = settings.get("active_model", {}).get(
+        "active_model", config.default_params["model"]
+    )
+    max_tokens = settings.get("memory", {}).get("output", 1000)
+    route = settings.get("model_routing", {}).get(role) if role else None
+    if not route:
+        return active_model, max_tokens
+
+    model = route.get("model") or active_model
+    if not get_api_key(model):
+        model = active_model
+    if route.get("max_tokens"):
+        max_tokens = min(route["max_tokens"], max_tokens)
+    return model, max_tokens
+
+
+def get_role_responder(settings, role=None):
+    """Get a responder for the role, routed through the model routing table in the settings."""
+    model, max_tokens = resolve_role_model(settings, role)
+    params = config.default_params.copy()
+    params["model"] = model
+    params["max_tokens"] = max_tokens
+    return get_responder(get_api_key(model), model, params)
@@ -40,6 +40,7 @@ import config
 import logs
 import llmcalls
 import simple_utils
+import tokenizer
 
 logger = logs.Log("memory", "memory.log").get_logger()
 
@@ -47,9 +48,14 @@ logger = logs.Log("memory", "memory.log").get_logger()
 class MemoryManager:
     """A class to manage the memory of the agent."""
 
-    def __init__(self):
-        self.model_used = "gpt-4o"
-        pass
+    def __init__(self, model_used=None):
+        self.model_used = model_used or config.default_params["model"]
+
+    def use_active_model(self, settings):
+        """Count tokens with the model the user chose in the settings."""
+        active_model = (settings or {}).get("active_model", {}).get("active_model")
+        if active_model:
+            self.model_used = active_model
 
     async def create_memory(
         self,
@@ -185,7 +191,9 @@ class MemoryManager:
 
         def add_to_chunk(line):
             nonlocal chunk, token_count, chunks
-            current_line_token_count = utils.MessageParser.num_tokens_from_string(line)
+            current_line_token_count = utils.MessageParser.num_tokens_from_string(
+                line, self.model_used
+            )
             if token_count + current_line_token_count > max_chunk_len:
                 # If the current chunk is full, add it to chunks and start a new chunk
                 chunks.append("\n".join(chunk))
@@ -241,7 +249,9 @@ class MemoryManager:
         remaining_tokens=1000,
         verbose=False,
         settings={},
+        query_embedding=None,
     ):
+        self.use_active_model(settings)
         category = "active_brain"
         process_dict = {
             "input": new_messages,
@@ -250,20 +260,7 @@ class MemoryManager:
             "error": None,
         }
 
-        default_params = config.default_params
-
-        default_params["max_tokens"] = settings.get("memory", {}).get("output", 1000)
-        default_params["model"] = settings.get("active_model").get("active_model")
-
-        responder = llmcalls.get_responder(
-            (
-                config.api_keys["openai"]
-                if settings.get("active_model").get("active_model").startswith("gpt")
-                else config.api_keys["anthropic"]
-            ),
-            settings.get("active_model").get("active_model"),
-            default_params,
-        )
+        responder = llmcalls.get_role_responder(settings, "date-extractor")
         response = None
         async for resp in responder.get_response(
             username,
@@ -314,7 +311,11 @@ class MemoryManager:
                 f"searching for episodic messages on a specific date: {parsed_date} in category: {category} for user: {username} and message: {new_messages}"
             )
             episodic_messages = search_memory_by_date(
-                category, new_messages, username=username, filter_date=parsed_date
+                category,
+                new_messages,
+                username=username,
+                filter_date=parsed_date,
+                query_embedding=query_embedding,
             )
             logger.debug(f"episodic_messages: {len(episodic_messages)}")
 
@@ -329,23 +330,13 @@ class MemoryManager:
         verbose=False,
         settings={},
     ):
+        self.use_active_model(settings)
         category = "active_brain"
         process_dict = {"input": new_messages}
 
         subject = "none"
 
-        default_params = config.default_params
-        default_params["max_tokens"] = settings.get("memory", {}).get("output", 1000)
-        default_params["model"] = settings.get("active_model").get("active_model")
-        responder = llmcalls.get_responder(
-            (
-                config.api_keys["openai"]
-                if settings.get("active_model").get("active_model").startswith("gpt")
-                else config.api_keys["anthropic"]
-            ),
-            settings.get("active_model").get("active_model"),
-            default_params,
-        )
+        responder = llmcalls.get_role_responder(settings, "date-extractor")
         async for resp in responder.get_response(
             username,
             all_messages,
@@ -392,7 +383,7 @@ class MemoryManager:
                 return "", ""
 
         if parsed_date is not None:
-            results_string = ""
+            results_lines = []
             logger.debug(
                 f"searching for episodic messages on a specific date: {parsed_date} in category: {category} for user: {username} and message: {new_messages}"
             )
@@ -405,21 +396,15 @@ class MemoryManager:
                 formatted_date = datetime.fromtimestamp(date).strftime(
                     "%Y-%m-%d %H:%M:%S"
                 )
-                results_string += f"({formatted_date}) [{memory['metadata']['username']}]: {memory['document']} (score: {memory['distance']:.4f})\n"
-            logger.debug(f"results_string:\n{results_string}")
-
-            # Check tokens
-            token_count = utils.MessageParser.num_tokens_from_string(results_string)
-            while token_count > min(1000, remaining_tokens):
-                # Split the result_string by newline and remove the last line if possible
-                result_lines = results_string.split("\n")
-                if len(result_lines) > 1:
-                    result_lines.pop(-1)
-                    results_string = "\n".join(result_lines)
-                else:
-                    # If there are no newline characters, remove a certain number of characters from the endsecretso
-                    results_string = results_string[:-100]
-                token_count = utils.MessageParser.num_tokens_from_string(results_string)
+                results_lines.append(
+                    f"({formatted_date}) [{memory['metadata']['username']}]: {memory['document']} (score: {memory['distance']:.4f})"
+                )
+
+            # keep the first results that fit in the budget
+            results_string, token_count, _ = tokenizer.get_token_packer(
+                self.model_used
+            ).pack(results_lines, min(1000, remaining_tokens), contiguous=True)
+            logger.debug(f"results_string ({token_count} tokens):\n{results_string}")
             return results_string, subject
 
     async def process_active_brain(
@@ -436,6 +421,7 @@ class MemoryManager:
         custom_metadata={},
     ):
         """Process the active brain and return the updated active brain data."""
+        self.use_active_model(settings)
         category = "active_brain"
         process_dict = {"input": new_messages}
         seen_ids = set()
@@ -464,22 +450,7 @@ class MemoryManager:
             subject_query = None
             response = ""
 
-            default_params = config.default_params
-            default_params["max_tokens"] = settings.get("memory", {}).get(
-                "output", 1000
-            )
-            default_params["model"] = settings.get("active_model").get("active_model")
-            responder = llmcalls.get_responder(
-                (
-                    config.api_keys["openai"]
-                    if settings.get("active_model")
-                    .get("active_model")
-                    .startswith("gpt")
-                    else config.api_keys["anthropic"]
-                ),
-                settings.get("active_model").get("active_model"),
-                default_params,
-            )
+            responder = llmcalls.get_role_responder(settings, "date-extractor")
             async for resp in responder.get_response(
                 username,
                 all_messages,
@@ -526,37 +497,21 @@ class MemoryManager:
                         )
 
             process_dict["results_list_before_token_check"] = results_list.copy()
-            result_string = ""
-            result_string = "\n".join(
-                f"({id}) {formatted_date} - {document} (score: {distance})"
-                for id, document, distance, formatted_date in results_list
-            )
-            token_count = utils.MessageParser.num_tokens_from_string(result_string)
-            while token_count > min(1000, remaining_tokens):
-                if len(results_list) > 1:
-                    results_list.sort(key=lambda x: int(x[2]), reverse=True)
-                    results_list.pop(0)
-                    result_string = "\n".join(
-                        f"({id}) {formatted_date} - {document} (score: {distance})"
-                        for id, document, distance, formatted_date in results_list
-                    )
-                else:
-                    # If there's only one entry, shorten the document content
-                    id, document, distance, formatted_date = results_list[0]
-                    document = document[:-100]
-                    result_string = (
-                        f"({id}) {formatted_date} - {document} (score: {distance})"
-                    )
-                token_count = utils.MessageParser.num_tokens_from_string(result_string)
 
-            unique_results = set()  # Create a set to store unique results
-            for id, document, distance, formatted_date in results_list:
-                unique_results.add((id, document, distance, formatted_date))
-                results_list.sort(key=lambda x: int(x[0]))
-            result_string = "\n".join(
-                f"({id}) {formatted_date} - {document} (score: {distance})"
-                for id, document, distance, formatted_date in results_list
+            # keep the closest results that fit in the budget, ordered by id
+            results_list.sort(key=lambda x: int(x[0]))
+            result_string, token_count, selected = tokenizer.get_token_packer(
+                self.model_used
+            ).pack(
+                [
+                    f"({id}) {formatted_date} - {document} (score: {distance})"
+                    for id, document, distance, formatted_date in results_list
+                ],
+                min(1000, remaining_tokens),
+                priority=[distance for _, _, distance, _ in results_list],
             )
+            results_list = [results_list[i] for i in selected]
+            unique_results = set(results_list)
 
             process_dict["results_list_after_token_check"] = results_list
             process_dict["result_string"] = result_string
@@ -579,23 +534,13 @@ class MemoryManager:
         settings={},
     ):
         """Process the incoming memory and return the updated active brain data."""
+        self.use_active_model(settings)
         process_dict = {"input": content}
         unique_results = set()
         logger.debug(f"Processing incoming memory: {content}")
         subject_query = "none"
 
-        default_params = config.default_params
-        default_params["max_tokens"] = settings.get("memory", {}).get("output", 1000)
-        default_params["model"] = settings.get("active_model").get("active_model")
-        responder = llmcalls.get_responder(
-            (
-                config.api_keys["openai"]
-                if settings.get("active_model").get("active_model").startswith("gpt")
-                else config.api_keys["anthropic"]
-            ),
-            settings.get("active_model").get("active_model"),
-            default_params,
-        )
+        responder = llmcalls.get_role_responder(settings, "categorise_query")
         async for resp in responder.get_response(
             username,
             content,
@@ -650,24 +595,20 @@ class MemoryManager:
                         logger.error(
                             f"Error while adding result to unique_results: {e}"
                         )
-                result_string += search_result
-                result_string = "\n".join(
-                    f"({id}) {formatted_date} - {document} (score: {distance})"
-                    for id, document, distance, formatted_date in unique_results
-                )
 
-        # Check tokens
-        token_count = utils.MessageParser.num_tokens_from_string(result_string)
-        while token_count > min(1000, remaining_tokens):
-            # Split the result_string by newline and remove the last line if possible
-            result_lines = result_string.split("\n")
-            if len(result_lines) > 1:
-                result_lines.pop(-1)
-                result_string = "\n".join(result_lines)
-            else:
-                # If there are no newline characters, remove a certain number of characters from the end
-                result_string = result_string[:-100]
-            token_count = utils.MessageParser.num_tokens_from_string(result_string)
+        # keep the closest results that fit in the budget, ordered by id
+        results_list = sorted(unique_results, key=lambda x: int(x[0]))
+        result_string, token_count, selected = tokenizer.get_token_packer(
+            self.model_used
+        ).pack(
+            [
+                f"({id}) {formatted_date} - {document} (score: {distance})"
+                for id, document, distance, formatted_date in results_list
+            ],
+            min(1000, remaining_tokens),
+            priority=[distance for _, _, distance, _ in results_list],
+        )
+        unique_results = {results_list[i] for i in selected}
 
         similar_messages = None
         if len(parts) > 0:
@@ -693,22 +634,7 @@ class MemoryManager:
         else:
             subject_category = "none"
 
-            default_params = config.default_params
-            default_params["max_tokens"] = settings.get("memory", {}).get(
-                "output", 1000
-            )
-            default_params["model"] = settings.get("active_model").get("active_model")
-            responder = llmcalls.get_responder(
-                (
-                    config.api_keys["openai"]
-                    if settings.get("active_model")
-                    .get("active_model")
-                    .startswith("gpt")
-                    else config.api_keys["anthropic"]
-                ),
-                settings.get("active_model").get("active_model"),
-                default_params,
-            )
+            responder = llmcalls.get_role_responder(settings, "categorise")
             async for resp in responder.get_response(
                 username,
                 content,
@@ -905,6 +831,7 @@ class MemoryManager:
         tokens_notes=1000,
         settings={},
     ):
+        self.use_active_model(settings)
         max_tokens = tokens_notes
         process_dict = {
             "actions": [],
@@ -932,7 +859,9 @@ class MemoryManager:
 
         process_dict["files_content_string"] = files_content_string
 
-        token_count = utils.MessageParser.num_tokens_from_string(files_content_string)
+        token_count = utils.MessageParser.num_tokens_from_string(
+            files_content_string, self.model_used
+        )
         if token_count > max_tokens:
             new_files_content_string = ""
             for file in dir_list:
@@ -942,23 +871,8 @@ class MemoryManager:
                     with open(current_file, "r") as f:
                         file_content = f.read()
 
-                        default_params = config.default_params
-                        default_params["max_tokens"] = settings.get("memory", {}).get(
-                            "output", 1000
-                        )
-                        default_params["model"] = settings.get("active_model").get(
-                            "active_model"
-                        )
-                        responder = llmcalls.get_responder(
-                            (
-                                config.api_keys["openai"]
-                                if settings.get("active_model")
-                                .get("active_model")
-                                .startswith("gpt")
-                                else config.api_keys["anthropic"]
-                            ),
-                            settings.get("active_model").get("active_model"),
-                            default_params,
+                        responder = llmcalls.get_role_responder(
+                            settings, "summary_memory"
                         )
                         async for response in responder.get_response(
                             username,
@@ -985,26 +899,11 @@ class MemoryManager:
             timestamp = await utils.SettingsManager.get_current_date_time(username)
             process_dict["timestamp"] = timestamp
 
-            token_count = utils.MessageParser.num_tokens_from_string(message)
+            token_count = utils.MessageParser.num_tokens_from_string(
+                message, self.model_used
+            )
             if token_count > 500:
-                default_params = config.default_params
-                default_params["max_tokens"] = settings.get("memory", {}).get(
-                    "output", 1000
-                )
-                default_params["model"] = settings.get("active_model").get(
-                    "active_model"
-                )
-                responder = llmcalls.get_responder(
-                    (
-                        config.api_keys["openai"]
-                        if settings.get("active_model")
-                        .get("active_model")
-                        .startswith("gpt")
-                        else config.api_keys["anthropic"]
-                    ),
-                    settings.get("active_model").get("active_model"),
-                    default_params,
-                )
+                responder = llmcalls.get_role_responder(settings, "summarize")
                 async for response in responder.get_response(
                     username,
                     message,
@@ -1026,24 +925,7 @@ class MemoryManager:
                 try:
                     note_taking_query = {}
 
-                    default_params = config.default_params
-                    default_params["max_tokens"] = settings.get("memory", {}).get(
-                        "output", 1000
-                    )
-                    default_params["model"] = settings.get("active_model").get(
-                        "active_model"
-                    )
-                    responder = llmcalls.get_responder(
-                        (
-                            config.api_keys["openai"]
-                            if settings.get("active_model")
-                            .get("active_model")
-                            .startswith("gpt")
-                            else config.api_keys["anthropic"]
-                        ),
-                        settings.get("active_model").get("active_model"),
-                        default_params,
-                    )
+                    responder = llmcalls.get_role_responder(settings, "notetaker")
                     async for resp in responder.get_response(
                         username,
                         final_message,
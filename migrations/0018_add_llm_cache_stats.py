@@ -0,0 +1,14 @@
+name = "Add llm response cache statistics"
+query = """
+    ALTER TABLE statistics
+    ADD COLUMN IF NOT EXISTS llm_cache_lookups INTEGER DEFAULT 0,
+    ADD COLUMN IF NOT EXISTS llm_cache_hits INTEGER DEFAULT 0,
+    ADD COLUMN IF NOT EXISTS llm_cache_saved_tokens INTEGER DEFAULT 0,
+    ADD COLUMN IF NOT EXISTS llm_cache_saved_cost FLOAT DEFAULT 0;
+
+    ALTER TABLE daily_stats
+    ADD COLUMN IF NOT EXISTS llm_cache_lookups INTEGER DEFAULT 0,
+    ADD COLUMN IF NOT EXISTS llm_cache_hits INTEGER DEFAULT 0,
+    ADD COLUMN IF NOT EXISTS llm_cache_saved_tokens INTEGER DEFAULT 0,
+    ADD COLUMN IF NOT EXISTS llm_cache_saved_cost FLOAT DEFAULT 0;
+"""
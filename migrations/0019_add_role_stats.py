@@ -0,0 +1,16 @@
+name = "Add per role llm usage tracking"
+query = """
+    CREATE TABLE IF NOT EXISTS role_stats (
+        id SERIAL PRIMARY KEY,
+        user_id INTEGER REFERENCES users(id),
+        role VARCHAR(255) NOT NULL,
+        model VARCHAR(255) NOT NULL,
+        day DATE NOT NULL DEFAULT CURRENT_DATE,
+        call_count INTEGER DEFAULT 0,
+        prompt_tokens INTEGER DEFAULT 0,
+        completion_tokens INTEGER DEFAULT 0,
+        spending_count FLOAT DEFAULT 0,
+        total_response_time FLOAT DEFAULT 0,
+        UNIQUE (user_id, role, model, day)
+    );
+"""
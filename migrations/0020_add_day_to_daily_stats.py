@@ -0,0 +1,64 @@
+name = "Add a day column and a unique user and day constraint to daily stats"
+query = """
+    ALTER TABLE daily_stats
+    ADD COLUMN IF NOT EXISTS day DATE;
+
+    UPDATE daily_stats SET day = DATE(timestamp) WHERE day IS NULL;
+
+    -- merge the rows of the same user and day into the oldest one
+    WITH merged AS (
+        SELECT MIN(id) AS id,
+            SUM(message_characters) AS message_characters,
+            SUM(message_tokens) AS message_tokens,
+            SUM(message_length) AS message_length,
+            SUM(message_amount) AS message_amount,
+            SUM(prompt_tokens) AS prompt_tokens,
+            SUM(generation_tokens) AS generation_tokens,
+            SUM(brain_tokens) AS brain_tokens,
+            SUM(spending_count) AS spending_count,
+            SUM(total_response_time) AS total_response_time,
+            SUM(response_count) AS response_count,
+            SUM(llm_cache_lookups) AS llm_cache_lookups,
+            SUM(llm_cache_hits) AS llm_cache_hits,
+            SUM(llm_cache_saved_tokens) AS llm_cache_saved_tokens,
+            SUM(llm_cache_saved_cost) AS llm_cache_saved_cost
+        FROM daily_stats
+        WHERE user_id IS NOT NULL
+        GROUP BY user_id, day
+        HAVING COUNT(*) > 1
+    )
+    UPDATE daily_stats SET
+        message_characters = merged.message_characters,
+        message_tokens = merged.message_tokens,
+        message_length = merged.message_length,
+        message_amount = merged.message_amount,
+        prompt_tokens = merged.prompt_tokens,
+        generation_tokens = merged.generation_tokens,
+        brain_tokens = merged.brain_tokens,
+        spending_count = merged.spending_count,
+        total_response_time = merged.total_response_time,
+        response_count = merged.response_count,
+        average_response_time = COALESCE(
+            merged.total_response_time / NULLIF(merged.response_count, 0),
+            daily_stats.average_response_time
+        ),
+        llm_cache_lookups = merged.llm_cache_lookups,
+        llm_cache_hits = merged.llm_cache_hits,
+        llm_cache_saved_tokens = merged.llm_cache_saved_tokens,
+        llm_cache_saved_cost = merged.llm_cache_saved_cost
+    FROM merged
+    WHERE daily_stats.id = merged.id;
+
+    DELETE FROM daily_stats duplicate
+    USING daily_stats kept
+    WHERE duplicate.user_id = kept.user_id
+        AND duplicate.day = kept.day
+        AND duplicate.id > kept.id;
+
+    ALTER TABLE daily_stats
+    ALTER COLUMN day SET DEFAULT CURRENT_DATE,
+    ALTER COLUMN day SET NOT NULL;
+
+    ALTER TABLE daily_stats
+    ADD CONSTRAINT daily_stats_user_id_day_key UNIQUE (user_id, day);
+"""
@@ -0,0 +1,18 @@
+name = "Add a rollup of the global statistics"
+query = """
+    CREATE MATERIALIZED VIEW IF NOT EXISTS statistics_rollup AS
+    SELECT 1 AS id,
+        COUNT(*) AS total_users,
+        SUM(amount_of_messages) AS total_messages,
+        SUM(total_tokens_used) AS total_tokens,
+        SUM(prompt_tokens) AS total_prompt_tokens,
+        SUM(completion_tokens) AS total_completion_tokens,
+        SUM(voice_usage) AS total_voice_usage,
+        SUM(total_spending_count) AS total_spending,
+        AVG(total_average_response_time) AS average_response_time,
+        NOW() AS refreshed_at
+    FROM statistics;
+
+    -- needed to refresh the view concurrently
+    CREATE UNIQUE INDEX IF NOT EXISTS statistics_rollup_id_key ON statistics_rollup (id);
+"""
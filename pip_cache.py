@@ -0,0 +1,356 @@
+"""
+Package cache for the code sandbox.
+
+The wheels of every package installed in a sandbox container are kept in a
+directory on the host that is mounted (read-only) in the containers on
+/pip-cache. Packages are installed from that directory first without touching
+the network. Missing wheels are downloaded into the cache outside of the
+sandboxes, by a throwaway container of the base image that only mounts the
+cache, and only binary wheels are downloaded so no code of a package runs while
+the cache is filled. The code of one user can't change the wheels another user
+installs. Packages without a wheel are built and installed in the user's own
+sandbox and aren't cached. The subprocess sandbox works the same way: its pip
+workers see the wheel directory read-only, only the download gets write access. So a repeated install costs close to nothing and
+works offline once the wheels are in the cache.
+
+Optionally a package set is installed in a clean container of the base image,
+which is committed to a derived image when pip is done, tagged with the hash of
+the sorted package set, and new sandbox containers that need exactly that set
+start from it.
+
+Wheels and derived images that haven't been used for CODE_PIP_CACHE_MAX_AGE
+seconds are evicted, and the oldest wheels are evicted when the cache is over
+CODE_PIP_CACHE_MAX_BYTES.
+"""
+
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+
+import docker
+from docker.models.containers import ExecResult
+
+import logs
+from config import (
+    CODE_DERIVED_IMAGES,
+    CODE_DERIVED_IMAGES_MAX,
+    CODE_EXEC_TIMEOUT,
+    CODE_IMAGE,
+    CODE_PIP_CACHE_MAX_AGE,
+    CODE_PIP_CACHE_MAX_BYTES,
+    USERS_DIR,
+)
+
+logger = logs.Log("pip_cache", "pip_cache.log").get_logger()
+
+CONTAINER_CACHE_DIR = "/pip-cache"
+CONTAINER_WHEEL_DIR = CONTAINER_CACHE_DIR + "/wheels"
+DERIVED_IMAGE_REPOSITORY = "charlie-mnemonic-python-env-packages"
+PACKAGE_SET_LABEL = "charlie-mnemonic.package-set"
+
+
+def normalize_packages(packages):
+    """Return the sorted, de-duplicated package specifiers, options are refused."""
+    normalized = set()
+    for package in packages:
+        package = package.strip()
+        if not package:
+            continue
+        if package.startswith("-"):
+            raise ValueError(f"Invalid package: {package}")
+        normalized.add(re.sub(r"\s+", "", package).lower())
+    return sorted(normalized)
+
+
+def package_set_key(packages):
+    """Content address of a package set, the same for any order of the packages."""
+    payload = json.dumps(normalize_packages(packages))
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:16]
+
+
+class PipCache:
+    def __init__(
+        self,
+        cache_dir=os.path.join(USERS_DIR, ".pip_cache"),
+        host_cache_dir=None,
+        max_bytes=CODE_PIP_CACHE_MAX_BYTES,
+        max_age=CODE_PIP_CACHE_MAX_AGE,
+        derived_images=CODE_DERIVED_IMAGES,
+        max_derived_images=CODE_DERIVED_IMAGES_MAX,
+        base_image=CODE_IMAGE,
+    ):
+        # cache_dir is the directory as seen by this process, host_cache_dir the
+        # same directory as seen by the docker daemon
+        self.cache_dir = cache_dir
+        self._host_cache_dir = host_cache_dir
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.derived_images = derived_images
+        self.max_derived_images = max_derived_images
+        self.base_image = base_image
+        self._lock = threading.Lock()
+
+    @property
+    def wheel_dir(self):
+        return os.path.join(self.cache_dir, "wheels")
+
+    @property
+    def host_cache_dir(self):
+        if self._host_cache_dir is not None:
+            return self._host_cache_dir
+        users_dir = os.environ.get("CHARLIE_MNEMONIC_USER_DIR") or os.path.join(
+            os.getcwd(), USERS_DIR
+        )
+        return os.path.join(users_dir, os.path.basename(self.cache_dir))
+
+    def volumes(self, writable=False):
+        """Return the docker volume that mounts the cache, read-only for the sandboxes."""
+        os.makedirs(self.wheel_dir, exist_ok=True)
+        mode = "rw" if writable else "ro"
+        return {self.host_cache_dir: {"bind": CONTAINER_CACHE_DIR, "mode": mode}}
+
+    def filler(self, client):
+        """Return the runner of the pip command that fills the cache, see CacheFiller."""
+        return CacheFiller(client, self.base_image, self.volumes(writable=True))
+
+    def install(
+        self,
+        container,
+        packages,
+        filler,
+        wheel_dir=CONTAINER_WHEEL_DIR,
+        install_args=(),
+    ):
+        """Install the packages in the container, from the cache when possible.
+
+        filler runs the pip command that downloads the missing wheels into the
+        cache, outside of the sandbox (see CacheFiller). wheel_dir is the wheel
+        directory as seen by the container and the filler, install_args are
+        added to the pip install commands. Returns (success, pip output, True if
+        no download was needed).
+        """
+        packages = normalize_packages(packages)
+        if not packages:
+            return True, "", True
+        offline = [
+            "pip",
+            "install",
+            *install_args,
+            "--no-index",
+            "--find-links",
+            wheel_dir,
+            *packages,
+        ]
+        result = container.exec_run(offline)
+        output = result.output.decode("utf-8", errors="replace")
+        if result.exit_code == 0:
+            self.touch_wheels(output, wheel_dir)
+            return True, output, True
+
+        # download the missing wheels into the cache, then install offline; only
+        # binary wheels, building a package would run its code outside the sandbox
+        download = filler.exec_run(
+            [
+                "pip",
+                "download",
+                "--only-binary",
+                ":all:",
+                "--dest",
+                wheel_dir,
+                "--find-links",
+                wheel_dir,
+                *packages,
+            ]
+        )
+        download_output = download.output.decode("utf-8", errors="replace")
+        if download.exit_code == 0:
+            result = container.exec_run(offline)
+            output = result.output.decode("utf-8", errors="replace")
+            if result.exit_code == 0:
+                self.touch_wheels(download_output + output, wheel_dir)
+                self.evict()
+                return True, output, False
+
+        # a package has no wheel, it is built in the sandbox and not cached
+        result = container.exec_run(
+            ["pip", "install", *install_args, "--find-links", wheel_dir, *packages]
+        )
+        output = result.output.decode("utf-8", errors="replace")
+        return result.exit_code == 0, output, False
+
+    def touch_wheels(self, pip_output, wheel_dir=CONTAINER_WHEEL_DIR):
+        """Mark the wheels that pip used as recently used, for the eviction."""
+        now = time.time()
+        pattern = re.escape(wheel_dir.rstrip("/")) + r"/([^\s'\"]+\.whl)"
+        for wheel in set(re.findall(pattern, pip_output)):
+            path = os.path.join(self.wheel_dir, os.path.basename(wheel))
+            try:
+                os.utime(path, (now, now))
+            except OSError:
+                pass
+
+    def evict(self):
+        """Remove the wheels older than max_age, then the oldest until the cache fits max_bytes."""
+        with self._lock:
+            try:
+                entries = [
+                    entry for entry in os.scandir(self.wheel_dir) if entry.is_file()
+                ]
+            except FileNotFoundError:
+                return 0
+            wheels = sorted(
+                ((entry.stat().st_mtime, entry.stat().st_size, entry.path))
+                for entry in entries
+            )
+            total = sum(size for _, size, _ in wheels)
+            cutoff = time.time() - self.max_age
+            removed = 0
+            for mtime, size, path in wheels:
+                if mtime >= cutoff and total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                total -= size
+                removed += 1
+            if removed:
+                logger.info(f"Evicted {removed} wheels from the pip cache")
+            return removed
+
+    def get_derived_image(self, client, packages):
+        """Return the tag of the derived image for the package set, None if there is none."""
+        if not self.derived_images or not packages:
+            return None
+        tag = f"{DERIVED_IMAGE_REPOSITORY}:{package_set_key(packages)}"
+        try:
+            client.images.get(tag)
+        except docker.errors.ImageNotFound:
+            return None
+        self._touch_image(tag)
+        return tag
+
+    def build_derived_image(self, client, packages):
+        """
+        Install the package set in a new container of the base image and commit it
+        to a derived image once pip exited, so the image has nothing of a user's
+        runs and no running container is paused for the commit.
+        """
+        if not self.derived_images or not packages:
+            return None
+        packages = normalize_packages(packages)
+        key = package_set_key(packages)
+        container = client.containers.run(
+            self.base_image,
+            ["pip", "install", "--find-links", CONTAINER_WHEEL_DIR, *packages],
+            detach=True,
+            volumes=self.volumes(),
+        )
+        try:
+            status = container.wait(timeout=CODE_EXEC_TIMEOUT)
+            if status["StatusCode"] != 0:
+                logger.warning(f"Could not install {packages} for a derived image")
+                return None
+            container.commit(
+                repository=DERIVED_IMAGE_REPOSITORY,
+                tag=key,
+                conf={
+                    # the command of the base image instead of the pip install
+                    "Cmd": client.images.get(self.base_image).attrs["Config"]["Cmd"],
+                    "Labels": {PACKAGE_SET_LABEL: json.dumps(packages)},
+                },
+            )
+        finally:
+            container.remove(force=True)
+        tag = f"{DERIVED_IMAGE_REPOSITORY}:{key}"
+        self._touch_image(tag)
+        logger.info(f"Built {tag} for {packages}")
+        return tag
+
+    def build_derived_image_in_background(self, client, packages):
+        if not self.derived_images or not packages:
+            return
+
+        def build():
+            try:
+                self.build_derived_image(client, packages)
+            except Exception as e:
+                logger.warning(f"Could not build a derived image: {e}")
+
+        threading.Thread(target=build, name="pip-cache-image", daemon=True).start()
+
+    def _image_index_path(self):
+        return os.path.join(self.cache_dir, "images.json")
+
+    def _load_image_index(self):
+        try:
+            with open(self._image_index_path()) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _touch_image(self, tag):
+        with self._lock:
+            index = self._load_image_index()
+            index[tag] = time.time()
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with open(self._image_index_path(), "w") as f:
+                json.dump(index, f)
+
+    def evict_images(self, client):
+        """Remove derived images that are too old or too many, least recently used first."""
+        with self._lock:
+            index = self._load_image_index()
+            cutoff = time.time() - self.max_age
+            by_age = sorted(index.items(), key=lambda item: item[1])
+            removed = []
+            for tag, last_used in by_age:
+                if (
+                    last_used >= cutoff
+                    and len(index) - len(removed) <= self.max_derived_images
+                ):
+                    break
+                try:
+                    client.images.remove(tag, force=True)
+                except docker.errors.ImageNotFound:
+                    pass
+                except Exception as e:
+                    logger.warning(f"Could not remove {tag}: {e}")
+                    continue
+                removed.append(tag)
+            for tag in removed:
+                del index[tag]
+            if removed:
+                with open(self._image_index_path(), "w") as f:
+                    json.dump(index, f)
+            return removed
+
+
+class CacheFiller:
+    """
+    Runs a pip command in a throwaway container of the base image that only
+    mounts the cache, writable. No user code runs in it, unlike in the sandbox
+    containers that mount the cache read-only.
+    """
+
+    def __init__(self, client, image, volumes):
+        self.client = client
+        self.image = image
+        self.volumes = volumes
+
+    def exec_run(self, command):
+        container = self.client.containers.run(
+            self.image, command, detach=True, volumes=self.volumes
+        )
+        try:
+            status = container.wait(timeout=CODE_EXEC_TIMEOUT)
+            output = container.logs(stdout=True, stderr=True)
+            return ExecResult(status["StatusCode"], output)
+        finally:
+            container.remove(force=True)
+
+
+pip_cache = PipCache()
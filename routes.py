@@ -1,14 +1,17 @@
+import asyncio
 import json
+import math
 import os
 import shutil
 import signal
 import tempfile
+import time
 import urllib.parse
 import zipfile
-from datetime import datetime
+from datetime import date, datetime
 from typing import List, Optional
 from agentmemory.helpers import chroma_collection_to_list
-from agentmemory.main import search_memory
+from agentmemory.main import SEARCH_MODES, embed_query, search_memory
 import llmcalls
 
 import logs
@@ -38,7 +41,7 @@ from google.auth.transport import requests
 from google.oauth2 import id_token
 
 from authentication import Authentication
-from chat_tabs.dao import ChatTabsDAO
+from chat_tabs.dao import AsyncChatTabsDAO
 from classes import (
     CreateChat,
     UserName,
@@ -52,7 +55,12 @@ from classes import (
     emailMessage,
     TimeTravelMessage,
 )
-from database import Database
+from addon_executor import addon_executor, AddonCancelledError
+from admin_controls_cache import admin_controls_cache
+from container_pool import container_pool
+from database import Database, connection_pool
+from usage_aggregator import usage_aggregator
+from user_context import UserContext, get_user_context
 from memory import (
     export_memory_to_file,
     import_file_to_memory,
@@ -63,27 +71,30 @@ from memory import (
     MemoryManager,
 )
 from simple_utils import get_root, convert_name
-from user_management.dao import UsersDAO, AdminControlsDAO
+from user_management.dao import AsyncUsersDAO, AsyncAdminControlsDAO
 from user_management.routes import set_login_cookies
 from utils import (
     process_message,
     AudioProcessor,
-    AddonManager,
     SettingsManager,
     BrainProcessor,
     MessageParser,
     queryRewrite,
     get_available_models,
+    convert_username,
 )
 
 logger = logs.Log("routes", "routes.log").get_logger()
 
 from config import (
     api_keys,
+    CODE_POOL_WARM_ON_CONNECT,
+    CODE_SANDBOX,
     STATIC,
     LOGIN_REQUIRED,
     PRODUCTION,
     ADMIN_REQUIRED,
+    STATS_DAYS_PER_PAGE,
     USERS_DIR,
 )
 
@@ -112,14 +123,29 @@ templates.env.filters["round"] = round_number
 connections = {}
 
 
+def check_can_send_message(context):
+    """Raise if the user has no access or reached the daily spending limit."""
+    if not context.allowed:
+        logger.info(f"user {context.username} does not have access")
+        raise HTTPException(
+            status_code=400,
+            detail="You do not have access yet, ask permission from the administrator or wait for your trial to start",
+        )
+    # today's spending, including the usage that isn't written to the database yet
+    if context.daily_cost >= context.daily_limit:
+        logger.info(f"user {context.username} reached daily limit")
+        raise HTTPException(
+            status_code=400,
+            detail="You reached your daily limit. Please wait until tomorrow to continue using the service.",
+        )
+
+
 @router.get("/", response_class=HTMLResponse)
 async def read_root(request: Request):
     version = SettingsManager.get_version()
-    with AdminControlsDAO() as db:
-        daily_limit = db.get_daily_limit()
-        template_name = (
-            "maintenance.html" if db.get_maintenance_mode() else "index.html"
-        )
+    admin_controls = admin_controls_cache.get()
+    daily_limit = admin_controls.daily_spending_limit
+    template_name = "maintenance.html" if admin_controls.maintenance else "index.html"
     context = {
         "request": request,
         "version": version,
@@ -142,13 +168,12 @@ async def read_root():
     "/memory_explorer/{category}", response_class=HTMLResponse, tags=[LOGIN_REQUIRED]
 )
 async def get_memory_explorer(request: Request, category: str):
-    with UsersDAO() as dao:
-        username = request.state.user.username
-        memories = get_memories(category, username=username)
-        return templates.TemplateResponse(
-            "memory_explorer.html",
-            {"request": request, "category": category, "memories": memories},
-        )
+    username = request.state.user.username
+    memories = get_memories(category, username=username)
+    return templates.TemplateResponse(
+        "memory_explorer.html",
+        {"request": request, "category": category, "memories": memories},
+    )
 
 
 async def send_debug_message(username: str, message: str):
@@ -224,16 +249,17 @@ async def websocket_endpoint(websocket: WebSocket, username: str):
 )
 async def handle_get_settings(request: Request):
     username = request.state.user.username
-    await AddonManager.load_addons(username, USERS_DIR)
-    with open(os.path.join(USERS_DIR, username, "settings.json"), "r") as f:
-        settings = json.load(f)
+    settings = (await SettingsManager.load_settings(USERS_DIR, username)).to_dict()
+    if CODE_POOL_WARM_ON_CONNECT and CODE_SANDBOX == "docker":
+        container_pool.warm_in_background(convert_username(username))
     logger.debug(f"Loaded settings for user {username}")
     logger.debug(settings)
     total_tokens_used, total_cost = 0, 0
-    with Database() as db, UsersDAO() as dao:
+    with Database() as db:
         total_tokens_used, total_cost = db.get_token_usage(username)
-        total_daily_tokens_used, total_daily_cost = db.get_token_usage(username, True)
-        display_name = dao.get_display_name(username)
+        total_daily_cost = usage_aggregator.get_daily_cost(username)
+    async with AsyncUsersDAO() as dao:
+        display_name = await dao.get_display_name(username)
     settings["usage"] = {"total_tokens": total_tokens_used, "total_cost": total_cost}
     settings["daily_usage"] = {"daily_cost": total_daily_cost}
     settings["display_name"] = display_name
@@ -292,18 +318,7 @@ def count_tokens(message):
 )
 async def handle_update_settings(request: Request, user: editSettings):
     username = request.state.user.username
-    # create the directory if it doesn't exist
-    user_dir = os.path.join(USERS_DIR, username)
-    if not os.path.exists(user_dir):
-        os.makedirs(user_dir)
-    # check if the settings file exists
-    settings_file = os.path.join(user_dir, "settings.json")
-    if not os.path.exists(settings_file):
-        # create the settings file
-        with open(settings_file, "w") as f:
-            json.dump({}, f)
-    with open(settings_file, "r") as f:
-        settings = json.load(f)
+    settings = (await SettingsManager.load_settings(USERS_DIR, username)).to_dict()
     if user.category in settings:
         if isinstance(user.setting, dict):
             # iterate over the dictionary
@@ -322,19 +337,21 @@ async def handle_update_settings(request: Request, user: editSettings):
         else:
             raise HTTPException(status_code=400, detail="Setting not found")
     elif user.category == "db":
-        with UsersDAO() as db:
+        async with AsyncUsersDAO() as db:
             if user.setting == "display_name":
-                db.update_display_name(username, user.value)
+                await db.update_display_name(username, user.value)
             else:
                 raise HTTPException(status_code=400, detail="Setting not found")
     else:
         raise HTTPException(status_code=400, detail="Category not found")
-    with open(settings_file, "w") as f:
-        json.dump(settings, f)
-    with Database() as db, UsersDAO() as dao:
+    settings = (
+        await SettingsManager.update_settings(USERS_DIR, username, settings)
+    ).to_dict()
+    with Database() as db:
         total_tokens_used, total_cost = db.get_token_usage(username)
-        total_daily_tokens_used, total_daily_cost = db.get_token_usage(username, True)
-        display_name = dao.get_display_name(username)
+        total_daily_cost = usage_aggregator.get_daily_cost(username)
+    async with AsyncUsersDAO() as dao:
+        display_name = await dao.get_display_name(username)
     settings["usage"] = {"total_tokens": total_tokens_used, "total_cost": total_cost}
     settings["daily_usage"] = {"daily_cost": total_daily_cost}
     settings["display_name"] = display_name
@@ -386,55 +403,32 @@ async def handle_update_settings(request: Request, user: editSettings):
         },
     },
 )
-async def handle_message(request: Request, message: userMessage):
+async def handle_message(
+    request: Request,
+    message: userMessage,
+    context: UserContext = Depends(get_user_context),
+):
     user = request.state.user
     settings = await SettingsManager.load_settings(USERS_DIR, user.username)
     if count_tokens(message.prompt) > settings["memory"]["input"]:
         raise HTTPException(status_code=400, detail="Prompt is too long")
-    (
-        total_tokens_used,
-        total_cost,
-        daily_limit,
-        total_daily_tokens_used,
-        total_daily_cost,
-        display_name,
-    ) = (0, 0, 0, 0, 0, "")
-    with Database() as db, UsersDAO() as dao, ChatTabsDAO() as chat_tabs_dao, AdminControlsDAO() as admin_controls_dao:
-        total_tokens_used, total_cost = db.get_token_usage(user.username)
-        total_daily_tokens_used, total_daily_cost = db.get_token_usage(
-            user.username, True
-        )
-        display_name = dao.get_display_name(user.username)
-        daily_limit = admin_controls_dao.get_daily_limit()
-        has_access = dao.get_user_access(user.username)
-        user_id = dao.get_user_id(user.username)
-        tab_data = chat_tabs_dao.get_tab_data(user_id)
-        active_tab_data = chat_tabs_dao.get_active_tab_data(user_id)
+    check_can_send_message(context)
+    user_id = context.user_id
+    active_tab_data = context.active_tab
+    async with AsyncChatTabsDAO() as chat_tabs_dao:
         # if no active tab, set chat_id to 0
         if message.chat_id is None and active_tab_data is None:
             message.chat_id = "0"
             # put the data in the database
-            chat_tabs_dao.insert_tab_data(
+            await chat_tabs_dao.insert_tab_data(
                 user_id, message.chat_id, "new chat", message.chat_id, True
             )
         # if there is an active tab, set chat_id to the active tab's chat_id
         # this logic is a bit weird when used as API
         else:
-            chat_tabs_dao.update_created_at(user_id, message.chat_id)
+            await chat_tabs_dao.update_created_at(user_id, message.chat_id)
             if active_tab_data is not None:
                 message.chat_id = active_tab_data.chat_id
-    if not has_access or has_access == "false" or has_access == "False":
-        logger.info(f"user {user.username} does not have access")
-        raise HTTPException(
-            status_code=400,
-            detail="You do not have access yet, ask permission from the administrator or wait for your trial to start",
-        )
-    if total_daily_cost >= daily_limit:
-        logger.info(f"user {user.username} reached daily limit")
-        raise HTTPException(
-            status_code=400,
-            detail="You reached your daily limit. Please wait until tomorrow to continue using the service.",
-        )
     return await process_message(
         message.prompt,
         user.username,
@@ -447,9 +441,9 @@ async def handle_message(request: Request, message: userMessage):
 @router.post("/create_chat_tab/", tags=[LOGIN_REQUIRED])
 async def create_chat_tab(request: Request, message: CreateChat):
     user = request.state.user
-    with ChatTabsDAO() as chat_tabs_dao:
+    async with AsyncChatTabsDAO() as chat_tabs_dao:
         user_id = user.id
-        chat_tabs_dao.insert_tab_data(
+        await chat_tabs_dao.insert_tab_data(
             user_id, message.chat_id, message.chat_name, message.chat_id, False
         )
     return {"message": "Chat tab created successfully"}
@@ -458,39 +452,28 @@ async def create_chat_tab(request: Request, message: CreateChat):
 @router.post("/set_active_tab/", tags=[LOGIN_REQUIRED])
 async def set_active_tab(request: Request, message: setActiveChat):
     user = request.state.user
-    with ChatTabsDAO() as chat_tabs_dao:
+    async with AsyncChatTabsDAO() as chat_tabs_dao:
         user_id = user.id
-        chat_tabs_dao.set_active_tab(user_id, message.chat_id)
+        await chat_tabs_dao.set_active_tab(user_id, message.chat_id)
     return {"message": "Active tab set successfully"}
 
 
 @router.post("/regenerate_response/", tags=[LOGIN_REQUIRED])
-async def regenerate_response(request: Request, message: regenerateMessage):
+async def regenerate_response(
+    request: Request,
+    message: regenerateMessage,
+    context: UserContext = Depends(get_user_context),
+):
     user = request.state.user
     settings = await SettingsManager.load_settings(USERS_DIR, user.username)
 
-    (
-        total_tokens_used,
-        total_cost,
-        daily_limit,
-        total_daily_tokens_used,
-        total_daily_cost,
-        display_name,
-    ) = (0, 0, 0, 0, 0, "")
     print(
         f"getting user data for {user.username} to regenerate response with uuid {message.uuid} and chat_id {message.chat_id}"
     )
-    with Database() as db, UsersDAO() as dao, ChatTabsDAO() as chat_tabs_dao, AdminControlsDAO() as admin_controls_dao:
-        total_tokens_used, total_cost = db.get_token_usage(user.username)
-        total_daily_tokens_used, total_daily_cost = db.get_token_usage(
-            user.username, True
-        )
-        display_name = dao.get_display_name(user.username)
-        daily_limit = admin_controls_dao.get_daily_limit()
-        has_access = dao.get_user_access(user.username)
-        user_id = dao.get_user_id(user.username)
-        tab_data = chat_tabs_dao.get_tab_data(user_id)
-        active_tab_data = chat_tabs_dao.get_active_tab_data(user_id)
+    check_can_send_message(context)
+    user_id = context.user_id
+    active_tab_data = context.active_tab
+    async with AsyncChatTabsDAO() as chat_tabs_dao:
         last_message = get_last_message(
             "active_brain", message.chat_id, user.username, message.uuid
         )
@@ -498,30 +481,18 @@ async def regenerate_response(request: Request, message: regenerateMessage):
         if active_tab_data is None:
             message.chat_id = "0"
             # put the data in the database
-            chat_tabs_dao.insert_tab_data(
+            await chat_tabs_dao.insert_tab_data(
                 user_id, message.chat_id, "new chat", message.chat_id, True
             )
         # if there is an active tab, set chat_id to the active tab's chat_id
         else:
-            chat_tabs_dao.update_created_at(user_id, message.chat_id)
+            await chat_tabs_dao.update_created_at(user_id, message.chat_id)
             message.chat_id = active_tab_data.chat_id
-    if not has_access or has_access == "false" or has_access == "False":
-        logger.info(f"user {user.username} does not have access")
-        raise HTTPException(
-            status_code=400,
-            detail="You do not have access yet, ask permission from the administrator or wait for your trial to start",
-        )
-    if total_daily_cost >= daily_limit:
-        logger.info(f"user {user.username} reached daily limit")
-        raise HTTPException(
-            status_code=400,
-            detail="You reached your daily limit. Please wait until tomorrow to continue using the service.",
-        )
     return await process_message(
         last_message,
         user.username,
         USERS_DIR,
-        display_name,
+        context.display_name,
         chat_id=message.chat_id,
         regenerate=True,
         uuid=message.uuid,
@@ -540,44 +511,28 @@ async def handle_message_image(
     image_file: UploadFile,
     prompt: str = Form(...),
     chat_id: str = Form(...),
+    context: UserContext = Depends(get_user_context),
 ):
     user = request.state.user
     username = user.username
     settings = await SettingsManager.load_settings(USERS_DIR, username)
     if count_tokens(prompt) > settings["memory"]["input"]:
         raise HTTPException(status_code=400, detail="Prompt is too long")
-    with Database() as db, UsersDAO() as dao, ChatTabsDAO() as chat_tabs_dao, AdminControlsDAO() as admin_controls_dao:
-        total_tokens_used, total_cost = db.get_token_usage(user.username)
-        total_daily_tokens_used, total_daily_cost = db.get_token_usage(
-            user.username, True
-        )
-        display_name = dao.get_display_name(user.username)
-        daily_limit = admin_controls_dao.get_daily_limit()
-        has_access = dao.get_user_access(user.username)
-        user_id = dao.get_user_id(user.username)
-        tab_data = chat_tabs_dao.get_tab_data(user_id)
-        active_tab_data = chat_tabs_dao.get_active_tab_data(user_id)
+    check_can_send_message(context)
+    user_id = context.user_id
+    active_tab_data = context.active_tab
+    async with AsyncChatTabsDAO() as chat_tabs_dao:
         # if no active tab, set chat_id to 0
         if active_tab_data is None:
             chat_id = "0"
             # put the data in the database
-            chat_tabs_dao.insert_tab_data(user_id, chat_id, "new chat", chat_id, True)
+            await chat_tabs_dao.insert_tab_data(
+                user_id, chat_id, "new chat", chat_id, True
+            )
         # if there is an active tab, set chat_id to the active tab's chat_id
         else:
-            chat_tabs_dao.update_created_at(user_id, chat_id)
+            await chat_tabs_dao.update_created_at(user_id, chat_id)
             chat_id = active_tab_data.chat_id
-    if not has_access or has_access == "false" or has_access == "False":
-        logger.info(f"user {username} does not have access")
-        raise HTTPException(
-            status_code=400,
-            detail="You do not have access yet, ask permission from the administrator or wait for your trial to start",
-        )
-    if total_daily_cost >= daily_limit:
-        logger.info(f"user {username} reached daily limit")
-        raise HTTPException(
-            status_code=400,
-            detail="You reached your daily limit. Please wait until tomorrow to continue using the service.",
-        )
     # check the size of the image, if it's too big +5mb, return an error
     if image_file.size > 20000000:
         raise HTTPException(
@@ -600,7 +555,7 @@ async def handle_message_image(
         image_path, prompt, image_file.filename, username
     )
     return await process_message(
-        prompt, username, "users", display_name, result, chat_id
+        prompt, username, "users", context.display_name, result, chat_id
     )
 
 
@@ -610,6 +565,7 @@ async def handle_message_files(
     files: List[UploadFile] = File(...),
     prompt: str = Form(...),
     chat_id: str = Form(...),
+    context: UserContext = Depends(get_user_context),
 ):
     file_details = ""
     user = request.state.user
@@ -617,38 +573,21 @@ async def handle_message_files(
     settings = await SettingsManager.load_settings(USERS_DIR, username)
     if count_tokens(prompt) > settings["memory"]["input"]:
         raise HTTPException(status_code=400, detail="Prompt is too long")
-    with Database() as db, UsersDAO() as dao, ChatTabsDAO() as chat_tabs_dao, AdminControlsDAO() as admin_controls_dao:
-        total_tokens_used, total_cost = db.get_token_usage(user.username)
-        total_daily_tokens_used, total_daily_cost = db.get_token_usage(
-            user.username, True
-        )
-        display_name = dao.get_display_name(user.username)
-        daily_limit = admin_controls_dao.get_daily_limit()
-        has_access = dao.get_user_access(user.username)
-        user_id = dao.get_user_id(user.username)
-        tab_data = chat_tabs_dao.get_tab_data(user_id)
-        active_tab_data = chat_tabs_dao.get_active_tab_data(user_id)
+    check_can_send_message(context)
+    user_id = context.user_id
+    active_tab_data = context.active_tab
+    async with AsyncChatTabsDAO() as chat_tabs_dao:
         # if no active tab, set chat_id to 0
         if active_tab_data is None:
             chat_id = "0"
             # put the data in the database
-            chat_tabs_dao.insert_tab_data(user_id, chat_id, "new chat", chat_id, True)
+            await chat_tabs_dao.insert_tab_data(
+                user_id, chat_id, "new chat", chat_id, True
+            )
         # if there is an active tab, set chat_id to the active tab's chat_id
         else:
-            chat_tabs_dao.update_created_at(user_id, chat_id)
+            await chat_tabs_dao.update_created_at(user_id, chat_id)
             chat_id = active_tab_data.chat_id
-    if not has_access or has_access == "false" or has_access == "False":
-        logger.info(f"user {username} does not have access")
-        raise HTTPException(
-            status_code=400,
-            detail="You do not have access yet, ask permission from the administrator or wait for your trial to start",
-        )
-    if total_daily_cost >= daily_limit:
-        logger.info(f"user {username} reached daily limit")
-        raise HTTPException(
-            status_code=400,
-            detail="You reached your daily limit. Please wait until tomorrow to continue using the service.",
-        )
     # check the total size of all files, if it's too big +200mb, return an error
     total_size = sum(file.size for file in files)
     if total_size > 200000000:
@@ -694,7 +633,7 @@ async def handle_message_files(
     prompt = file_details + "<p>" + prompt + "</p>"
     result = MessageParser.add_file_paths_to_message(prompt, file_details)
     return await process_message(
-        prompt, username, "users", display_name, result, chat_id
+        prompt, username, "users", context.display_name, result, chat_id
     )
 
 
@@ -722,53 +661,30 @@ async def handle_message_files(
         },
     },
 )
-async def handle_message_no_modules(request: Request, message: userMessage):
+async def handle_message_no_modules(
+    request: Request,
+    message: userMessage,
+    context: UserContext = Depends(get_user_context),
+):
     user = request.state.user
     settings = await SettingsManager.load_settings(USERS_DIR, user.username)
     if count_tokens(message.prompt) > settings["memory"]["input"]:
         raise HTTPException(status_code=400, detail="Prompt is too long")
-    (
-        total_tokens_used,
-        total_cost,
-        daily_limit,
-        total_daily_tokens_used,
-        total_daily_cost,
-        display_name,
-    ) = (0, 0, 0, 0, 0, "")
-    with Database() as db, UsersDAO() as dao, ChatTabsDAO() as chat_tabs_dao, AdminControlsDAO() as admin_controls_dao:
-        total_tokens_used, total_cost = db.get_token_usage(user.username)
-        total_daily_tokens_used, total_daily_cost = db.get_token_usage(
-            user.username, True
-        )
-        display_name = dao.get_display_name(user.username)
-        daily_limit = admin_controls_dao.get_daily_limit()
-        has_access = dao.get_user_access(user.username)
-        user_id = dao.get_user_id(user.username)
-        tab_data = chat_tabs_dao.get_tab_data(user_id)
-        active_tab_data = chat_tabs_dao.get_active_tab_data(user_id)
+    check_can_send_message(context)
+    user_id = context.user_id
+    active_tab_data = context.active_tab
+    async with AsyncChatTabsDAO() as chat_tabs_dao:
         # if no active tab, set chat_id to 0
         if message.chat_id is None and active_tab_data is None:
             message.chat_id = "0"
             # put the data in the database
-            chat_tabs_dao.insert_tab_data(
+            await chat_tabs_dao.insert_tab_data(
                 user_id, message.chat_id, "new chat", message.chat_id, True
             )
         # if there is an active tab, set chat_id to the active tab's chat_id
         else:
-            chat_tabs_dao.update_created_at(user_id, message.chat_id)
+            await chat_tabs_dao.update_created_at(user_id, message.chat_id)
             message.chat_id = active_tab_data.chat_id
-    if not has_access or has_access == "false" or has_access == "False":
-        logger.info(f"user {user.username} does not have access")
-        raise HTTPException(
-            status_code=400,
-            detail="You do not have access yet, ask permission from the administrator or wait for your trial to start",
-        )
-    if total_daily_cost >= daily_limit:
-        logger.info(f"user {user.username} reached daily limit")
-        raise HTTPException(
-            status_code=400,
-            detail="You reached your daily limit. Please wait until tomorrow to continue using the service.",
-        )
     return await process_message(
         message.prompt,
         user.username,
@@ -972,6 +888,7 @@ async def handle_upload_data(request: Request, data_file: UploadFile = File(...)
         # Extract the zip file
         with zipfile.ZipFile(file_path, "r") as zip_ref:
             zip_ref.extractall(os.path.join(USERS_DIR, username))
+        SettingsManager.invalidate_settings(USERS_DIR, username)
 
         # Check for 'memory.json', and 'settings.json'
         if "memory.json" not in os.listdir(
@@ -1112,12 +1029,15 @@ async def get_statistics(
     page: int,
     items_per_page: int = 5,
 ):
-    with Database() as db, UsersDAO() as users, AdminControlsDAO() as admin_controls:
+    page = max(page, 1)
+    items_per_page = min(max(items_per_page, 1), 100)
+    with Database() as db:
         global_stats = json.loads(db.get_global_statistics())
         # Fetch data based on page number and items per page
         page_statistics = json.loads(db.get_statistics(page, items_per_page))
-        total_pages = users.get_total_statistics_pages(items_per_page)
-        admin_controls = json.loads(admin_controls.get_admin_controls_json())
+    async with AsyncUsersDAO() as users, AsyncAdminControlsDAO() as admin_controls:
+        total_pages = await users.get_total_statistics_pages(items_per_page)
+        admin_controls = json.loads(await admin_controls.get_admin_controls_json())
         return templates.TemplateResponse(
             "stats.html",
             {
@@ -1138,27 +1058,96 @@ async def get_statistics(
     response_class=HTMLResponse,
     tags=[LOGIN_REQUIRED, ADMIN_REQUIRED],
 )
-async def get_user_statistics(request: Request, user_id: int):
+async def get_user_statistics(
+    request: Request,
+    user_id: int,
+    start: Optional[date] = None,
+    end: Optional[date] = None,
+    page: int = 1,
+    items_per_page: int = STATS_DAYS_PER_PAGE,
+):
+    daily_stats = get_daily_stats_page(user_id, start, end, page, items_per_page)
+    return templates.TemplateResponse(
+        "user_stats.html",
+        {
+            "request": request,
+            "rows": daily_stats.pop("rows"),
+            "user_id": user_id,
+            **daily_stats,
+        },
+    )
+
+
+def get_daily_stats_page(user_id, start, end, page, items_per_page):
+    """Return a page of the daily stats of the user and the values of the paging controls."""
+    page = max(page, 1)
+    items_per_page = min(max(items_per_page, 1), 366)
     with Database() as db:
-        user_stats = json.loads(db.get_user_statistics(user_id))
-        return templates.TemplateResponse(
-            "user_stats.html", {"request": request, "rows": user_stats}
+        start, end = db.get_statistics_range(start, end)
+        rows = json.loads(
+            db.get_user_statistics(user_id, start, end, page, items_per_page)
         )
+        total_pages = math.ceil(
+            db.get_user_statistics_count(user_id, start, end) / items_per_page
+        )
+    return {
+        "rows": rows,
+        "start": start,
+        "end": end,
+        "page": page,
+        "items_per_page": items_per_page,
+        "total_pages": total_pages,
+    }
+
+
+@router.get(
+    "/admin/role_statistics/",
+    tags=[LOGIN_REQUIRED, ADMIN_REQUIRED],
+)
+async def get_role_statistics(
+    request: Request, user_id: Optional[int] = None, days: int = 30
+):
+    with Database() as db:
+        role_stats = json.loads(db.get_role_statistics(user_id, days))
+    return JSONResponse(content=role_stats)
+
+
+@router.get(
+    "/admin/addon_statistics/",
+    tags=[LOGIN_REQUIRED, ADMIN_REQUIRED],
+)
+async def get_addon_statistics(request: Request):
+    return JSONResponse(content=addon_executor.get_statistics())
+
+
+@router.get(
+    "/admin/database_pool_statistics/",
+    tags=[LOGIN_REQUIRED, ADMIN_REQUIRED],
+)
+async def get_database_pool_statistics(request: Request):
+    return JSONResponse(content=connection_pool.get_statistics())
 
 
 @router.get("/profile", response_class=HTMLResponse)
-async def get_user_profile(request: Request):
-    with Database() as db, UsersDAO() as users:
-        user = request.state.user
-        daily_stats = json.loads(db.get_user_statistics(user.id))
-        user_profile = json.loads(users.get_user_profile(user.username))
+async def get_user_profile(
+    request: Request,
+    start: Optional[date] = None,
+    end: Optional[date] = None,
+    page: int = 1,
+    items_per_page: int = STATS_DAYS_PER_PAGE,
+):
+    user = request.state.user
+    daily_stats = get_daily_stats_page(user.id, start, end, page, items_per_page)
+    async with AsyncUsersDAO() as users:
+        user_profile = json.loads(await users.get_user_profile(user.username))
         return templates.TemplateResponse(
             "user_profile.html",
             {
                 "request": request,
                 "profile": user_profile,
-                "daily_stats": daily_stats,
+                "daily_stats": daily_stats.pop("rows"),
                 "production": PRODUCTION,
+                **daily_stats,
             },
         )
 
@@ -1333,10 +1322,29 @@ async def send_email(request: Request, message: emailMessage):
     draft_id = message.draft_id
     from addons.gmail_addon import send_email_by_id
 
-    response = send_email_by_id(draft_id, username)
+    try:
+        response, _ = await addon_executor.run(
+            "send_email_by_id",
+            send_email_by_id,
+            {"message_id": draft_id, "username": username},
+            username,
+        )
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=504, detail="Sending the email timed out")
+    except AddonCancelledError:
+        raise HTTPException(status_code=409, detail="Sending the email was cancelled")
     return response
 
 
+async def timed(timings, phase, awaitable):
+    """Await the awaitable and record how long it took in timings[phase]."""
+    started = time.perf_counter()
+    try:
+        return await awaitable
+    finally:
+        timings[phase] = round(time.perf_counter() - started, 4)
+
+
 @router.post("/search_chats/", tags=[LOGIN_REQUIRED])
 async def search_memories(
     request: Request,
@@ -1345,17 +1353,53 @@ async def search_memories(
     sort_by: str = Form(...),
     sort_order: str = Form(...),
     exact_match: bool = Form(False),
+    search_mode: str = Form("vector"),
 ):
-    username = request.state.user.username
+    if search_mode not in SEARCH_MODES:
+        raise HTTPException(status_code=400, detail="Invalid search mode")
+    user = request.state.user
+    username = user.username
+    timings = {}
+    started = time.perf_counter()
+    settings = await SettingsManager.load_settings(USERS_DIR, username)
+
+    def search(text, query_embedding=None):
+        return search_memory(
+            category,
+            text,
+            username=username,
+            n_results=100,
+            max_distance=1.4,
+            min_distance=0.0,
+            exact_match=exact_match,
+            query_embedding=query_embedding,
+            search_mode=search_mode,
+        )
 
-    memories = search_memory(
-        category,
-        search_query,
-        username=username,
-        n_results=100,
-        max_distance=1.4,
-        min_distance=0.0,
-        exact_match=exact_match,
+    # the query is embedded once for the search and the episodic memory, the
+    # rewritten query reuses it if it is the same (embed_query caches it)
+    query_embedding = await timed(
+        timings, "embedding", asyncio.to_thread(embed_query, search_query)
+    )
+
+    # search while the episodic memory is looked up
+    memory_manager = MemoryManager(settings["active_model"]["active_model"])
+    memories, episodic_memory = await asyncio.gather(
+        timed(
+            timings, "search", asyncio.to_thread(search, search_query, query_embedding)
+        ),
+        timed(
+            timings,
+            "episodic",
+            memory_manager.get_episodic_memory(
+                search_query,
+                username,
+                search_query,
+                2560,
+                settings=settings,
+                query_embedding=query_embedding,
+            ),
+        ),
     )
 
     # Sort the memories based on the selected sorting option and order
@@ -1363,19 +1407,15 @@ async def search_memories(
         memories.sort(
             key=lambda x: x["metadata"]["created_at"], reverse=sort_order == "desc"
         )
-    elif sort_by == "distance" and not exact_match:
+    elif sort_by == "distance" and not exact_match and search_mode == "vector":
         memories.sort(
             key=lambda x: x.get("distance", 0.0), reverse=sort_order == "desc"
         )
+    elif sort_by == "distance" and not exact_match:
+        # keyword and hybrid results are ranked by their score
+        memories.sort(key=lambda x: x["score"], reverse=sort_order == "asc")
     else:
         memories.sort(key=lambda x: x["id"], reverse=sort_order == "desc")
-    settings = await SettingsManager.load_settings(USERS_DIR, username)
-    # get episodic memories
-    memory_manager = MemoryManager()
-    memory_manager.model_used = settings["active_model"]["active_model"]
-    episodic_memory = await memory_manager.get_episodic_memory(
-        search_query, username, search_query, 2560, settings=settings
-    )
     # add the episodic memory to the memories if it exists
     if episodic_memory:
         # convert the query response to list and return
@@ -1383,38 +1423,50 @@ async def search_memories(
         memories.extend(result_list)
 
     # Include the distance value in each memory object
+    chat_ids = set()
     for memory in memories:
         if isinstance(memory, dict):
             memory["distance"] = memory.get("distance", 0.0)
-            # get the title of the chat tab based on the chat_id
-            with ChatTabsDAO() as chat_tabs_dao:
-                chat_id = memory.get("metadata", {}).get("chat_id")
-                if chat_id:
-                    chat_title = chat_tabs_dao.get_tab_description(chat_id)
-                    memory["chat_title"] = chat_title
+            chat_id = memory.get("metadata", {}).get("chat_id")
+            if chat_id:
+                chat_ids.add(str(chat_id))
         else:
             print("memory is not a dict", memory)
 
-    rewritten = await queryRewrite(search_query, username, USERS_DIR, memories)
-
-    rewritten_memories = search_memory(
-        category,
-        rewritten,
-        username=username,
-        n_results=100,
-        max_distance=1.4,
-        min_distance=0.0,
-        exact_match=exact_match,
+    async def add_chat_titles():
+        # the titles of the chat tabs of all memories in one query
+        async with AsyncChatTabsDAO() as chat_tabs_dao:
+            titles = await chat_tabs_dao.get_tab_descriptions(user.id, list(chat_ids))
+        for memory in memories:
+            if isinstance(memory, dict):
+                chat_id = memory.get("metadata", {}).get("chat_id")
+                if chat_id:
+                    memory["chat_title"] = titles.get(str(chat_id))
+
+    rewritten, _ = await asyncio.gather(
+        timed(
+            timings,
+            "rewrite",
+            queryRewrite(search_query, username, USERS_DIR, memories),
+        ),
+        timed(timings, "titles", add_chat_titles()),
     )
 
-    return JSONResponse(
-        content={
-            "category": category,
-            "memories": memories,
-            "rewritten": rewritten,
-            "rewritten_memories": rewritten_memories,
-        }
+    rewritten_memories = await timed(
+        timings, "rewritten_search", asyncio.to_thread(search, rewritten)
     )
+    timings["total"] = round(time.perf_counter() - started, 4)
+    logger.debug(f"Searched the chats of {username}: {timings}")
+
+    content = {
+        "category": category,
+        "memories": memories,
+        "rewritten": rewritten,
+        "rewritten_memories": rewritten_memories,
+    }
+    if settings.get("verbose", {}).get("verbose"):
+        content["timings"] = timings
+    return JSONResponse(content=content)
 
 
 @router.post(
@@ -1442,35 +1494,30 @@ async def search_memories(
         },
     },
 )
-async def handle_time_travel_message(request: Request, message: TimeTravelMessage):
+async def handle_time_travel_message(
+    request: Request,
+    message: TimeTravelMessage,
+    context: UserContext = Depends(get_user_context),
+):
     user = request.state.user
     settings = await SettingsManager.load_settings(USERS_DIR, user.username)
     if count_tokens(message.prompt) > settings["memory"]["input"]:
         raise HTTPException(status_code=400, detail="Prompt is too long")
 
-    with Database() as db, UsersDAO() as dao, ChatTabsDAO() as chat_tabs_dao, AdminControlsDAO() as admin_controls_dao:
-        total_tokens_used, total_cost = db.get_token_usage(user.username)
-        total_daily_tokens_used, total_daily_cost = db.get_token_usage(
-            user.username, True
-        )
-        display_name = dao.get_display_name(user.username)
-        daily_limit = admin_controls_dao.get_daily_limit()
-        has_access = dao.get_user_access(user.username)
-        user_id = dao.get_user_id(user.username)
-
-        if not has_access:
-            raise HTTPException(status_code=400, detail="You do not have access.")
-        if total_daily_cost >= daily_limit:
-            raise HTTPException(status_code=400, detail="You reached your daily limit.")
+    if not context.allowed:
+        raise HTTPException(status_code=400, detail="You do not have access.")
+    if context.daily_cost >= context.daily_limit:
+        raise HTTPException(status_code=400, detail="You reached your daily limit.")
 
+    async with AsyncChatTabsDAO() as chat_tabs_dao:
         # Handle chat_id logic
         if message.chat_id is None:
             message.chat_id = "0"
-            chat_tabs_dao.insert_tab_data(
-                user_id, message.chat_id, "new chat", message.chat_id, True
+            await chat_tabs_dao.insert_tab_data(
+                context.user_id, message.chat_id, "new chat", message.chat_id, True
             )
         else:
-            chat_tabs_dao.update_created_at(user_id, message.chat_id)
+            await chat_tabs_dao.update_created_at(context.user_id, message.chat_id)
 
     # Process the time-travelled message
     return await process_message(
@@ -1,11 +1,39 @@
+"""
+Run python code in the user's sandbox container, or in a local worker process
+with CODE_SANDBOX=subprocess (see subprocess_sandbox.py).
+
+The output of the code is streamed to on_output while it runs. Only the output
+up to CODE_OUTPUT_MAX_BYTES is read, the container is killed when the code goes
+over that or runs longer than CODE_EXEC_TIMEOUT, and the last
+CODE_OUTPUT_TAIL_CHARS characters of the output are returned for the llm.
+"""
+
 import asyncio
+import codecs
+import functools
+import threading
+import time
+
 import docker
-from unidecode import unidecode
-import os
-from logs import Log
+
+import logs
+from config import (
+    CODE_EXEC_TIMEOUT,
+    CODE_OUTPUT_MAX_BYTES,
+    CODE_OUTPUT_TAIL_CHARS,
+    CODE_SANDBOX,
+)
+from container_pool import container_pool
+from pip_cache import normalize_packages, pip_cache
+from subprocess_sandbox import subprocess_sandbox
 from utils import convert_username
 
-description = """This addon allows you to execute python code in a non persistant terminal, When opening files be sure to open from /data/filename.
+logger = logs.Log("run_python_code", "run_python_code.log").get_logger()
+
+# exit code of a process that was killed with SIGKILL
+KILLED_EXIT_CODE = 137
+
+description = """This addon allows you to execute python code in the user's sandbox. Every call runs the code in a new python process, so variables, imports and open files of a previous call are gone, but the sandbox itself is kept between calls for a while: packages installed with pip stay installed and files written anywhere (also outside /data) may still be there, so don't rely on a clean environment and don't rely on anything outside /data persisting either. When opening files be sure to open from /data/filename.
 Always include print statements to track the progress or path and name(s) of generated files.
 Save any generated files in the /data/ directory with the format /data/filename.ext.
 You must always display media that's been saved in the /data/ directory, using the markdown format [description](data/filename.ext) or html tags for video's (without triple quotes).
@@ -28,14 +56,131 @@ parameters = {
 }
 
 
-async def run_python_code(content, pip_packages=[], previous_content="", username=None):
+async def run_python_code(
+    content, pip_packages=[], previous_content="", username=None, on_output=None
+):
+    """Run the code, on_output is awaited with the text of the output as it arrives."""
     loop = asyncio.get_event_loop()
-    return await loop.run_in_executor(
-        None, sync_run_python_code, content, pip_packages, previous_content, username
+    if on_output is None:
+        return await loop.run_in_executor(
+            None,
+            sync_run_python_code,
+            content,
+            pip_packages,
+            previous_content,
+            username,
+        )
+
+    queue = asyncio.Queue()
+
+    def forward(text):
+        loop.call_soon_threadsafe(queue.put_nowait, text)
+
+    future = loop.run_in_executor(
+        None,
+        functools.partial(
+            sync_run_python_code,
+            content,
+            pip_packages,
+            previous_content,
+            username,
+            on_output=forward,
+        ),
     )
+    # scheduled after the output the worker forwarded before returning
+    future.add_done_callback(lambda _: queue.put_nowait(None))
+    done = False
+    while not done:
+        parts = [await queue.get()]
+        # send what arrived in the meantime as one message
+        while not queue.empty():
+            parts.append(queue.get_nowait())
+        if parts[-1] is None:
+            parts.pop()
+            done = True
+        if parts:
+            try:
+                await on_output("".join(parts))
+            except Exception as e:
+                logger.warning(f"Could not forward the code output: {e}")
+    return await future
+
+
+class OutputBuffer:
+    """Output of a code execution, capped at max_bytes, with a rolling tail of the text."""
+
+    def __init__(
+        self, max_bytes=CODE_OUTPUT_MAX_BYTES, tail_chars=CODE_OUTPUT_TAIL_CHARS
+    ):
+        self.max_bytes = max_bytes
+        self.tail_chars = tail_chars
+        self.size = 0
+        self.chars = 0
+        self._tail = ""
+        self._decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+
+    @property
+    def full(self):
+        return self.size >= self.max_bytes
+
+    def write(self, data):
+        """Add a chunk of output and return its text, the part over max_bytes is dropped."""
+        data = data[: self.max_bytes - self.size]
+        self.size += len(data)
+        text = self._decoder.decode(data, final=self.full)
+        self.chars += len(text)
+        self._tail = (self._tail + text)[-self.tail_chars :]
+        return text
+
+    def tail(self):
+        if self.chars <= len(self._tail):
+            return self._tail
+        omitted = self.chars - len(self._tail)
+        return f"[... {omitted} characters of output omitted ...]\n{self._tail}"
+
+
+def stream_exec(container, command, buffer, on_output=None, timeout=CODE_EXEC_TIMEOUT):
+    """Run a command in the container and pass its output to on_output while it runs.
+
+    The container is killed when the command runs longer than the timeout or its
+    output fills the buffer. Returns the exit code and "ok", "timeout" or "output_limit".
+    """
+    api = container.client.api
+    exec_id = api.exec_create(container.id, command)["Id"]
+    status = []
 
+    def kill(reason):
+        status.append(reason)
+        try:
+            container.kill()
+        except docker.errors.APIError as e:
+            logger.warning(f"Could not kill the container after {reason}: {e}")
 
-def sync_run_python_code(content, pip_packages=[], previous_content="", username=None):
+    timer = threading.Timer(timeout, kill, args=("timeout",))
+    timer.daemon = True
+    timer.start()
+    output = api.exec_start(exec_id, stream=True)
+    try:
+        for chunk in output:
+            text = buffer.write(chunk)
+            if text and on_output is not None:
+                on_output(text)
+            if buffer.full:
+                kill("output_limit")
+                break
+    finally:
+        timer.cancel()
+        if hasattr(output, "close"):
+            output.close()
+
+    if status:
+        return KILLED_EXIT_CODE, status[0]
+    return api.exec_inspect(exec_id)["ExitCode"], "ok"
+
+
+def sync_run_python_code(
+    content, pip_packages=[], previous_content="", username=None, on_output=None
+):
     # print(
     #     f"trying to run python code: {content}\n\nwith pip packages: {pip_packages}\n\nfor user: {username}"
     # )
@@ -48,71 +193,107 @@ def sync_run_python_code(content, pip_packages=[], previous_content="", username
     else:
         new_content = content
 
-    new_content = escape_string(new_content)
+    if CODE_SANDBOX == "subprocess":
+        return run_in_subprocess(username, new_content, pip_packages, on_output)
 
     try:
-        client = docker.from_env()
+        packages = normalize_packages(pip_packages)
+        lease = container_pool.acquire(username, packages)
+    except Exception as e:
+        return {"error": str(e)}
 
-        # Get the environment variable value
-        charlie_mnemonic_user_dir = os.environ.get(
-            "CHARLIE_MNEMONIC_USER_DIR"
-        ) or os.path.join(os.getcwd(), "users")
+    broken = False
+    try:
+        container = lease.container
 
-        full_path = os.path.join(charlie_mnemonic_user_dir, username, "data")
+        # Install the missing pip packages, from the package cache when possible
+        missing = [
+            package for package in packages if package not in lease.installed_packages
+        ]
+        success, pip_output, from_cache = pip_cache.install(
+            container, missing, pip_cache.filler(container.client)
+        )
+        if not success:
+            return {"error": "Failed to install package: " + pip_output}
+        lease.installed_packages.update(missing)
+        if missing and not from_cache:
+            pip_cache.build_derived_image_in_background(container.client, packages)
+        pip_string = "".join(
+            f"successfully installed package: {package}\n" for package in packages
+        )
 
-        # Define the path inside the container
-        container_path = "/data"
+        # Execute the code in the container, streaming the output
+        started = time.perf_counter()
+        buffer = OutputBuffer()
+        exit_code, status = stream_exec(
+            container, ["python3", "-c", new_content], buffer, on_output
+        )
+        # a killed container is removed and started again on the next run
+        broken = status != "ok"
+        return build_response(
+            pip_string,
+            buffer,
+            exit_code,
+            status,
+            lease.queue_time,
+            lease.startup_time,
+            time.perf_counter() - started,
+        )
 
-        # Define the volume
-        volumes = {full_path: {"bind": container_path, "mode": "rw"}}
+    except Exception as e:
+        broken = True
+        return {"error": str(e)}
+    finally:
+        container_pool.release(lease, broken=broken)
 
-        # Remove existing container with the same name
-        for c in client.containers.list(all=True):
-            if c.name == username:
-                c.remove(force=True)
 
-        # Start a new container with the volume
-        container = client.containers.run(
-            "goodaidev/charlie-mnemonic-python-env",
-            name=username,
-            detach=True,
-            tty=True,
-            volumes=volumes,
+def run_in_subprocess(username, content, pip_packages, on_output=None):
+    try:
+        packages = normalize_packages(pip_packages)
+        success, pip_output = subprocess_sandbox.install(username, packages)
+        if not success:
+            return {"error": "Failed to install package: " + pip_output}
+        pip_string = "".join(
+            f"successfully installed package: {package}\n" for package in packages
         )
 
-        pip_string = ""
-        # Install pip packages in the container
-        for package in pip_packages:
-            pip_install_result = container.exec_run(f"pip install {package}")
-            if pip_install_result.exit_code != 0:
-                return {
-                    "error": "Failed to install package: "
-                    + pip_install_result.output.decode("utf-8")
-                }
-            else:
-                pip_string += f"successfully installed package: {package}\n"
-
-        # Execute the code in the container
-        exec_result = container.exec_run(f'python3 -c "{new_content}"')
-        output = exec_result.output.decode("utf-8")[:2000]
-
-        # Prepare the response
-        response = {
-            "pip": pip_string,
-            "output": output,
-            "exit_code": exec_result.exit_code,
-        }
-
-        # Remove the container
-        container.remove(force=True)
-
-        return response
-
+        started = time.perf_counter()
+        buffer = OutputBuffer()
+        exit_code, status, startup_time = subprocess_sandbox.run(
+            username, content, buffer, on_output
+        )
+        return build_response(
+            pip_string,
+            buffer,
+            exit_code,
+            status,
+            0.0,
+            startup_time,
+            time.perf_counter() - started - startup_time,
+        )
     except Exception as e:
         return {"error": str(e)}
 
 
-def escape_string(s):
-    s = s.replace("\\", "\\\\")
-    s = s.replace('"', '\\"')
-    return s
+def build_response(
+    pip_string, buffer, exit_code, status, queue_time, startup_time, execution_time
+):
+    response = {
+        "pip": pip_string,
+        "output": buffer.tail(),
+        "exit_code": exit_code,
+        "timings": {
+            "queue": round(queue_time, 3),
+            "startup": round(startup_time, 3),
+            "execution": round(execution_time, 3),
+        },
+    }
+    if status == "timeout":
+        response[
+            "error"
+        ] = f"Execution timed out after {CODE_EXEC_TIMEOUT} seconds and was stopped"
+    elif status == "output_limit":
+        response[
+            "error"
+        ] = f"Output exceeded {buffer.max_bytes} bytes, the execution was stopped"
+    return response
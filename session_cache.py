@@ -0,0 +1,96 @@
+"""
+Cache of the logged in sessions for the authentication middlewares.
+
+Checking the session token and loading the user used to take two queries on
+every request. Now a valid (username, session token) pair is looked up in one
+query and a snapshot of the user is kept for SESSION_CACHE_TTL seconds, so a
+warm request doesn't touch the database. UsersDAO invalidates the sessions of
+a user on logout, when the token is regenerated and when the user's access,
+role or display name change. On postgres it also sends NOTIFY user_sessions in
+the same transaction, and the listener thread of admin_controls_cache drops the
+user's sessions in the other workers.
+"""
+
+import json
+import threading
+import time
+
+from sqlalchemy import text
+
+from config import SESSION_CACHE_TTL
+from user_management.models import Users
+from user_management.session import session_factory
+
+
+NOTIFY_CHANNEL = "user_sessions"
+
+
+def notify_sessions_changed(session, username=None, user_id=None):
+    """Tell the other workers to drop the sessions of the user when the session commits."""
+    if session.get_bind().dialect.name == "postgresql":
+        session.execute(
+            text("SELECT pg_notify(:channel, :payload)"),
+            {
+                "channel": NOTIFY_CHANNEL,
+                "payload": json.dumps({"username": username, "user_id": user_id}),
+            },
+        )
+
+
+class UserSnapshot:
+    """The columns of a Users row, detached from the database session."""
+
+    def __init__(self, user):
+        for column in Users.__table__.columns:
+            setattr(self, column.name, getattr(user, column.name))
+
+    def __repr__(self):
+        return f"<UserSnapshot(id={self.id}, username='{self.username}', role='{self.role}')>"
+
+
+class SessionCache:
+    def __init__(self, ttl=SESSION_CACHE_TTL):
+        self.ttl = ttl
+        self._entries = {}
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def get(self, username, session_token):
+        """Return the snapshot of the user if the session token is valid, else None."""
+        if not username or not session_token:
+            return None
+        key = (username, session_token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() - entry[0] < self.ttl:
+                return entry[1]
+            generation = self._generation
+        session = session_factory.get_session().session
+        try:
+            user = (
+                session.query(Users)
+                .filter_by(username=username, session_token=session_token)
+                .first()
+            )
+            snapshot = UserSnapshot(user) if user is not None else None
+        finally:
+            session.close()
+        with self._lock:
+            # don't cache what a logout in the meantime may have invalidated
+            if snapshot is not None and self._generation == generation:
+                self._entries[key] = (time.monotonic(), snapshot)
+        return snapshot
+
+    def invalidate(self, username=None, user_id=None):
+        """Drop the sessions of a user (by name or id), or of all users."""
+        with self._lock:
+            self._generation += 1
+            if username is None and user_id is None:
+                self._entries.clear()
+                return
+            for key, (_, snapshot) in list(self._entries.items()):
+                if key[0] == username or snapshot.id == user_id:
+                    del self._entries[key]
+
+
+session_cache = SessionCache()
@@ -0,0 +1,187 @@
+"""
+Per-user settings snapshot cache.
+
+The settings file of a user is read and validated once, after that the callers
+get an immutable snapshot from memory. The file is only stat'ed again after
+SETTINGS_REVALIDATE_INTERVAL seconds, to pick up edits made outside of the app,
+and it is only written (atomically) when its content actually changes.
+"""
+
+import json
+import os
+import tempfile
+import threading
+import time
+
+from config import SETTINGS_REVALIDATE_INTERVAL
+
+
+class SettingsSnapshot(dict):
+    """A read-only settings dict, nested dicts are read-only too and lists become tuples.
+
+    It is still a dict, so json.dumps and the .get() chains keep working.
+    Use to_dict() to get a mutable deep copy.
+    """
+
+    def __init__(self, *args, **kwargs):
+        items = dict(*args, **kwargs)
+        super().__init__((key, _freeze(value)) for key, value in items.items())
+
+    def _read_only(self, *args, **kwargs):
+        raise TypeError(
+            "settings snapshots are read-only, use SettingsManager.update_settings"
+        )
+
+    __setitem__ = _read_only
+    __delitem__ = _read_only
+    __ior__ = _read_only
+    clear = _read_only
+    pop = _read_only
+    popitem = _read_only
+    setdefault = _read_only
+    update = _read_only
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __reduce__(self):
+        return SettingsSnapshot, (self.to_dict(),)
+
+    def to_dict(self):
+        """Return a mutable deep copy of the snapshot."""
+        return {key: _thaw(value) for key, value in self.items()}
+
+
+def _freeze(value):
+    if isinstance(value, SettingsSnapshot):
+        return value
+    if isinstance(value, dict):
+        return SettingsSnapshot(value)
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(item) for item in value)
+    return value
+
+
+def _thaw(value):
+    if isinstance(value, SettingsSnapshot):
+        return value.to_dict()
+    if isinstance(value, tuple):
+        return [_thaw(item) for item in value]
+    return value
+
+
+def _file_signature(path):
+    """Return what identifies the current version of a file, None if it doesn't exist."""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+def _signature(path, dependencies):
+    return tuple(_file_signature(p) for p in (path, *dependencies))
+
+
+def write_json_atomic(path, data):
+    """Write data as json to path, the file is replaced in one step so readers never see a partial file."""
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".settings-", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(data, f)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+class _Entry:
+    __slots__ = ("snapshot", "signature", "checked_at")
+
+    def __init__(self, snapshot, signature, checked_at):
+        self.snapshot = snapshot
+        self.signature = signature
+        self.checked_at = checked_at
+
+
+class SettingsCache:
+    """Cache of settings snapshots, keyed by settings file path."""
+
+    def __init__(self, revalidate_interval=SETTINGS_REVALIDATE_INTERVAL):
+        self.revalidate_interval = revalidate_interval
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, path, dependencies=()):
+        """Return the cached snapshot of a settings file, None if it has to be (re)loaded.
+
+        dependencies: other paths the loaded settings depend on (e.g. the addons
+        directory), the entry is stale if one of them changed as well
+        """
+        with self._lock:
+            entry = self._entries.get(path)
+        if entry is None:
+            return None
+        now = time.monotonic()
+        if now - entry.checked_at < self.revalidate_interval:
+            return entry.snapshot
+        if entry.signature != _signature(path, dependencies):
+            self.invalidate(path)
+            return None
+        entry.checked_at = now
+        return entry.snapshot
+
+    def put(self, path, settings, dependencies=(), on_disk=None):
+        """Store the settings of a file and return their snapshot.
+
+        The file is written atomically, but only if the content differs from
+        what is on disk. on_disk is the current content of the file if the
+        caller just read it, otherwise the cached snapshot or the file is used.
+        """
+        snapshot = (
+            settings
+            if isinstance(settings, SettingsSnapshot)
+            else SettingsSnapshot(settings)
+        )
+        content = snapshot.to_dict()
+        if on_disk is None:
+            with self._lock:
+                entry = self._entries.get(path)
+            if entry is not None and entry.signature[0] == _file_signature(path):
+                on_disk = entry.snapshot.to_dict()
+            else:
+                on_disk = self._read_file(path)
+        if on_disk != content:
+            write_json_atomic(path, content)
+        with self._lock:
+            self._entries[path] = _Entry(
+                snapshot,
+                _signature(path, dependencies),
+                time.monotonic(),
+            )
+        return snapshot
+
+    def invalidate(self, path=None):
+        """Drop the snapshot of a settings file, or of all files."""
+        with self._lock:
+            if path is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(path, None)
+
+    @staticmethod
+    def _read_file(path):
+        try:
+            with open(path, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+
+settings_cache = SettingsCache()
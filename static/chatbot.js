@@ -1496,6 +1496,35 @@ function handleChunkMessage(msg) {
     setTimeout(() => scrollToBottom(), 10);
 }
 
+// Show the output of running code while it executes, the final result replaces it
+function handleCodeOutput(msg) {
+    const chatTabs = document.getElementById('chat-tabs-container');
+    const activeTab = chatTabs.querySelector('.active');
+    const current_chat_id = activeTab.id.replace('chat-tab-', '');
+
+    if (current_chat_id !== msg.chat_id) {
+        return;
+    }
+
+    const lastMessage = document.querySelector('.last-message .bubble');
+    if (!lastMessage) {
+        return;
+    }
+    let outputBlock = lastMessage.querySelector('.code-output-live');
+    if (!outputBlock) {
+        outputBlock = document.createElement('pre');
+        outputBlock.className = 'code-output-live';
+        lastMessage.appendChild(outputBlock);
+    }
+    // only keep the end of very long output in the page
+    const maxLength = 20000;
+    const text = outputBlock.textContent + msg.code_output;
+    outputBlock.textContent = text.length > maxLength ? text.slice(-maxLength) : text;
+    outputBlock.scrollTop = outputBlock.scrollHeight;
+
+    setTimeout(() => scrollToBottom(), 10);
+}
+
 function parseAndFormatStreamingMessage(content) {
     let formattedContent = content;
 
@@ -2232,6 +2261,9 @@ function get_settings(username) {
             else if (msg.chunk_message) {
                 handleChunkMessage(msg);
             }
+            else if (msg.code_output) {
+                handleCodeOutput(msg);
+            }
             else if (msg.stop_message) {
                 handleStopMessage(msg);
             }
@@ -0,0 +1,545 @@
+"""
+Subprocess backend for run_python_code (CODE_SANDBOX=subprocess).
+
+Instead of a docker container the code runs in a local python worker process.
+A few workers are started ahead of time (CODE_SANDBOX_WORKERS), so a snippet
+only waits for the job to be handed over, and every worker runs one job and
+exits. Before the code runs the worker:
+
+- moves to its own mount namespace (and network namespace when
+  CODE_SANDBOX_NETWORK is off), directly when the app runs as root, else in a
+  new user namespace,
+- switches to a new root that only has the system directories and the python
+  installation (read-only), a few files of /etc and /dev, a private /tmp, and
+  the directories of the job: the user's data directory (users/<name>/data) and
+  package directory, where pip installs the packages of the user from the
+  shared wheel cache. The app, its configuration (user.env with the api keys),
+  the other users' directories and the wheel cache aren't visible, and there is
+  no /proc,
+- runs as an unprivileged user (nobody when the app runs as root) without
+  capabilities, in a user namespace of its own so the process limit counts the
+  processes of this worker only,
+- changes to the data directory, paths in string literals that start with /data
+  are mapped to it, and sets the rlimits for cpu time, address space, file size
+  and the number of processes.
+
+The workers get a minimal environment. pip runs in a worker the same way, with
+the network and without the file size limit, because building a package runs
+its code: it sees the user's package directory (writable) and the wheel cache
+(read-only). Only the download of missing binary wheels, which runs no package
+code, gets write access to the cache.
+
+If the namespaces can't be created (e.g. in a container without user
+namespaces) the code is refused, unless the app runs in single-user mode where
+it runs with the files of the app visible.
+"""
+
+import json
+import os
+import queue
+import re
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import logs
+from config import (
+    CODE_EXEC_TIMEOUT,
+    CODE_SANDBOX_CPU_SECONDS,
+    CODE_SANDBOX_FILE_SIZE_MB,
+    CODE_SANDBOX_MAX_PROCESSES,
+    CODE_SANDBOX_MEMORY_MB,
+    CODE_SANDBOX_NETWORK,
+    CODE_SANDBOX_WORKERS,
+)
+from configuration_page.settings_util import is_single_user
+from container_pool import get_data_dir
+from pip_cache import normalize_packages, pip_cache
+
+logger = logs.Log("subprocess_sandbox", "subprocess_sandbox.log").get_logger()
+
+# runs in the worker process, it waits for the job on stdin
+WORKER_SOURCE = r"""
+import builtins, ctypes, json, os, platform, resource, sys, traceback
+
+CLONE_NEWNS = 0x00020000
+CLONE_NEWUSER = 0x10000000
+CLONE_NEWNET = 0x40000000
+MS_RDONLY, MS_NOSUID, MS_NODEV, MS_REMOUNT = 0x1, 0x2, 0x4, 0x20
+MS_BIND, MS_REC, MS_PRIVATE = 0x1000, 0x4000, 0x40000
+MNT_DETACH = 0x2
+PR_SET_NO_NEW_PRIVS = 38
+# a read-only remount of a bind mount has to keep these flags of the mount
+KEPT_FLAGS = {
+    os.ST_NOSUID: MS_NOSUID,
+    os.ST_NODEV: MS_NODEV,
+    os.ST_NOEXEC: 0x8,
+    os.ST_NOATIME: 0x400,
+    os.ST_NODIRATIME: 0x800,
+    os.ST_RELATIME: 0x200000,
+}
+SYS_PIVOT_ROOT = {"x86_64": 155, "aarch64": 41, "riscv64": 41, "ppc64le": 203, "s390x": 217}
+SANDBOX_UID = SANDBOX_GID = 65534
+SYSTEM_DIRS = ["/usr", "/bin", "/sbin", "/lib", "/lib32", "/lib64", "/libx32"]
+ETC_PATHS = [
+    "/etc/passwd", "/etc/group", "/etc/hosts", "/etc/resolv.conf", "/etc/nsswitch.conf",
+    "/etc/localtime", "/etc/ld.so.cache", "/etc/ssl", "/etc/pki", "/etc/ca-certificates",
+]
+DEVICES = ["/dev/null", "/dev/zero", "/dev/full", "/dev/random", "/dev/urandom"]
+
+libc = ctypes.CDLL(None, use_errno=True)
+
+
+class IsolationUnavailable(Exception):
+    pass
+
+
+def check(result):
+    if result != 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
+
+
+def mount(source, target, fstype, flags, data=None):
+    encode = lambda value: value.encode() if value is not None else None
+    check(libc.mount(encode(source), encode(target), encode(fstype), ctypes.c_ulong(flags), encode(data)))
+
+
+def unshare(flags):
+    # directly with CAP_SYS_ADMIN, else in a new user namespace
+    if libc.unshare(flags) == 0:
+        return False
+    uid, gid = os.getuid(), os.getgid()
+    if libc.unshare(flags | CLONE_NEWUSER) != 0:
+        errno = ctypes.get_errno()
+        raise IsolationUnavailable(os.strerror(errno))
+    with open("/proc/self/setgroups", "w") as f:
+        f.write("deny")
+    with open("/proc/self/uid_map", "w") as f:
+        f.write(f"{uid} {uid} 1")
+    with open("/proc/self/gid_map", "w") as f:
+        f.write(f"{gid} {gid} 1")
+    return True
+
+
+def bind(source, target, writable=False, device=False):
+    if os.path.isdir(source):
+        os.makedirs(target, exist_ok=True)
+    else:
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        open(target, "a").close()
+    mount(source, target, None, MS_BIND | MS_REC)
+    flags = MS_REMOUNT | MS_BIND | MS_NOSUID
+    flags |= 0 if device else MS_NODEV
+    flags |= 0 if writable else MS_RDONLY
+    current = os.statvfs(target).f_flag
+    for statvfs_flag, mount_flag in KEPT_FLAGS.items():
+        if current & statvfs_flag:
+            flags |= mount_flag
+    mount(None, target, None, flags)
+
+
+def chown_tree(path):
+    for directory, _, files in os.walk(path):
+        for name in [directory] + [os.path.join(directory, f) for f in files]:
+            if os.lstat(name).st_uid != SANDBOX_UID:
+                os.lchown(name, SANDBOX_UID, SANDBOX_GID)
+
+
+def drop_capabilities():
+    header = (ctypes.c_uint32 * 2)(0x20080522, 0)
+    data = (ctypes.c_uint32 * 6)()
+    check(libc.capset(header, data))
+
+
+def build_root(job, drop_uid):
+    root = job["root"]
+    mount(None, "/", None, MS_REC | MS_PRIVATE)
+    mount("tmpfs", root, "tmpfs", MS_NOSUID | MS_NODEV, "mode=755")
+    bound = []
+    for path in SYSTEM_DIRS:
+        if os.path.islink(path):
+            os.symlink(os.readlink(path), root + path)
+        elif os.path.isdir(path):
+            bind(path, root + path)
+            bound.append(path)
+    prefixes = {sys.prefix, sys.base_prefix, sys.exec_prefix, sys.base_exec_prefix}
+    for path in sorted(os.path.realpath(prefix) for prefix in prefixes):
+        if not any(path == b or path.startswith(b + "/") for b in bound):
+            bind(path, root + path)
+            bound.append(path)
+    for path in ETC_PATHS:
+        if os.path.exists(path):
+            bind(os.path.realpath(path), root + path)
+    for path in DEVICES:
+        if os.path.exists(path):
+            bind(path, root + path, writable=True, device=True)
+    size = f",size={job['tmp_size_mb']}m" if job["tmp_size_mb"] else ""
+    for path in ("/tmp", "/dev/shm"):
+        os.makedirs(root + path, exist_ok=True)
+        mount("tmpfs", root + path, "tmpfs", MS_NOSUID | MS_NODEV, "mode=1777" + size)
+    for path, writable in job["binds"]:
+        bind(os.path.realpath(path), root + path, writable)
+        if writable and drop_uid:
+            chown_tree(root + path)
+
+
+def confine(job):
+    machine = platform.machine()
+    if machine not in SYS_PIVOT_ROOT:
+        raise IsolationUnavailable(f"unsupported machine {machine}")
+    in_user_namespace = unshare(CLONE_NEWNS | (0 if job["network"] else CLONE_NEWNET))
+    drop_uid = os.getuid() == 0 and not in_user_namespace
+    try:
+        build_root(job, drop_uid)
+    except OSError as e:
+        # nothing is hidden yet, e.g. mounting isn't allowed in a container
+        raise IsolationUnavailable(str(e))
+    os.chdir(job["root"])
+    check(libc.syscall(SYS_PIVOT_ROOT[machine], b".", b"."))
+    check(libc.umount2(b".", MNT_DETACH))
+    os.chdir("/")
+    mount(None, "/", None, MS_REMOUNT | MS_RDONLY | MS_NOSUID | MS_NODEV)
+    if drop_uid:
+        os.setgroups([])
+        os.setresgid(SANDBOX_GID, SANDBOX_GID, SANDBOX_GID)
+        os.setresuid(SANDBOX_UID, SANDBOX_UID, SANDBOX_UID)
+        # RLIMIT_NPROC counts the processes of a user per user namespace
+        libc.unshare(CLONE_NEWUSER)
+    drop_capabilities()
+    check(libc.prctl(PR_SET_NO_NEW_PRIVS, 1, 0, 0, 0))
+
+
+def unshare_network():
+    if not unshare(CLONE_NEWNET):
+        return
+    # only the network namespace is needed, not the capabilities of the user namespace
+    drop_capabilities()
+
+
+job = json.loads(sys.stdin.buffer.read())
+try:
+    confine(job)
+except IsolationUnavailable as e:
+    if job["require_isolation"]:
+        print(
+            f"The code can't be isolated on this system ({e}). The subprocess sandbox "
+            "needs user namespaces, or SINGLE_USER=true.",
+            file=sys.stderr,
+        )
+        sys.exit(126)
+    # single-user mode, the code sees the files of the app
+    if not job["network"]:
+        try:
+            unshare_network()
+        except IsolationUnavailable as e:
+            print(f"Network isolation is not available: {e}", file=sys.stderr)
+            sys.exit(126)
+except OSError as e:
+    print(f"The sandbox could not be set up: {e}", file=sys.stderr)
+    sys.exit(126)
+os.chdir(job["cwd"])
+os.environ["HOME"] = job["cwd"]
+os.environ.update(job.get("env", {}))
+if job["packages_dir"]:
+    sys.path.insert(0, job["packages_dir"])
+for name, limit in job["limits"].items():
+    resource.setrlimit(getattr(resource, name), (limit, limit))
+sys.argv = job.get("argv", ["-c"])
+try:
+    exec(compile(job["code"], "<code>", "exec"), {"__name__": "__main__", "__builtins__": builtins})
+except SystemExit:
+    raise
+except BaseException:
+    traceback.print_exc()
+    sys.exit(1)
+"""
+
+_data_path_pattern = re.compile(r"(?<=[\"'])/data(?=[/\"'])")
+
+
+def map_data_paths(code, data_dir):
+    """Replace /data at the start of string literals with the user's data directory."""
+    return _data_path_pattern.sub(lambda match: data_dir, code)
+
+
+def get_packages_dir(username):
+    return os.path.join(os.path.dirname(get_data_dir(username)), "python_packages")
+
+
+# runs pip in a worker, the arguments are in sys.argv
+PIP_SOURCE = (
+    "import runpy; runpy.run_module('pip', run_name='__main__', alter_sys=True)"
+)
+
+
+class ExecResult:
+    __slots__ = ("exit_code", "output")
+
+    def __init__(self, exit_code, output):
+        self.exit_code = exit_code
+        self.output = output
+
+
+class PipOutput:
+    """Collects the output of a pip worker."""
+
+    full = False
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, chunk):
+        self.chunks.append(chunk)
+
+    def getvalue(self):
+        return b"".join(self.chunks)
+
+
+class LocalPip:
+    """Runs the pip commands of pip_cache in a sandbox worker."""
+
+    def __init__(self, sandbox, cwd, binds=()):
+        self.sandbox = sandbox
+        self.cwd = cwd
+        self.binds = binds
+
+    def exec_run(self, command):
+        return self.sandbox.pip(command, self.cwd, self.binds)
+
+
+class SubprocessSandbox:
+    def __init__(
+        self,
+        workers=CODE_SANDBOX_WORKERS,
+        cpu_seconds=CODE_SANDBOX_CPU_SECONDS,
+        memory_mb=CODE_SANDBOX_MEMORY_MB,
+        file_size_mb=CODE_SANDBOX_FILE_SIZE_MB,
+        max_processes=CODE_SANDBOX_MAX_PROCESSES,
+        network=CODE_SANDBOX_NETWORK,
+    ):
+        self.workers = workers
+        self.cpu_seconds = cpu_seconds
+        self.memory_mb = memory_mb
+        self.file_size_mb = file_size_mb
+        self.max_processes = max_processes
+        self.network = network
+        self._idle = queue.Queue()
+        self._lock = threading.Lock()
+        self._refilling = False
+        self._stopped = False
+        self._installed = {}
+        self._install_locks = {}
+        self._root_dir = None
+
+    def get_limits(self):
+        """Return the rlimits of the workers, a limit of 0 is not set."""
+        limits = {
+            "RLIMIT_CPU": self.cpu_seconds,
+            "RLIMIT_AS": self.memory_mb * 1024 * 1024,
+            "RLIMIT_FSIZE": self.file_size_mb * 1024 * 1024,
+            "RLIMIT_NPROC": self.max_processes,
+        }
+        return {name: limit for name, limit in limits.items() if limit > 0}
+
+    def get_pip_limits(self):
+        """The rlimits of the workers without the file size limit, wheels are often larger."""
+        limits = self.get_limits()
+        limits.pop("RLIMIT_FSIZE", None)
+        return limits
+
+    @property
+    def root_dir(self):
+        """The empty directory the workers mount their new root on."""
+        with self._lock:
+            if self._root_dir is None:
+                self._root_dir = tempfile.mkdtemp(prefix="sandbox-root-")
+            return self._root_dir
+
+    def new_job(self, code, cwd, binds, network, limits, tmp_size_mb):
+        """A job for a worker, cwd is bound writable, binds are (path, writable) pairs."""
+        return {
+            "code": code,
+            "cwd": cwd,
+            "binds": [(cwd, True), *binds],
+            "root": self.root_dir,
+            "network": network,
+            "limits": limits,
+            "tmp_size_mb": tmp_size_mb,
+            "require_isolation": not is_single_user(),
+        }
+
+    def _spawn(self):
+        return subprocess.Popen(
+            [sys.executable, "-I", "-u", "-X", "utf8", "-c", WORKER_SOURCE],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            env={"PATH": os.environ.get("PATH", os.defpath), "LANG": "C.UTF-8"},
+            # in its own process group, so a timeout kills the children too
+            start_new_session=True,
+        )
+
+    def _refill(self):
+        try:
+            while not self._stopped and self._idle.qsize() < self.workers:
+                self._idle.put(self._spawn())
+        except Exception as e:
+            logger.error(f"Could not start a sandbox worker: {e}")
+        finally:
+            with self._lock:
+                self._refilling = False
+
+    def refill_in_background(self):
+        with self._lock:
+            if self._refilling or self._stopped:
+                return
+            self._refilling = True
+        threading.Thread(
+            target=self._refill, name="sandbox-refill", daemon=True
+        ).start()
+
+    def start(self):
+        """Start the idle workers in the background."""
+        self._stopped = False
+        self.refill_in_background()
+
+    def acquire(self):
+        """Return an idle worker (or a new one if there is none) and the startup time."""
+        started = time.perf_counter()
+        process = None
+        while process is None:
+            try:
+                process = self._idle.get_nowait()
+            except queue.Empty:
+                process = self._spawn()
+            if process.poll() is not None:
+                process = None
+        self.refill_in_background()
+        return process, time.perf_counter() - started
+
+    def install(self, username, packages):
+        """Install the packages for the user from the wheel cache, returns (success, output)."""
+        with self._lock:
+            installed = self._installed.setdefault(username, set())
+            lock = self._install_locks.setdefault(username, threading.Lock())
+        with lock:
+            missing = [
+                package
+                for package in normalize_packages(packages)
+                if package not in installed
+            ]
+            wheel_dir = os.path.abspath(pip_cache.wheel_dir)
+            os.makedirs(wheel_dir, exist_ok=True)
+            packages_dir = os.path.abspath(get_packages_dir(username))
+            # pip of the user only reads the wheel cache, the download of
+            # binary wheels (which runs no package code) fills it
+            success, output, _ = pip_cache.install(
+                LocalPip(self, packages_dir, [(wheel_dir, False)]),
+                missing,
+                LocalPip(self, os.path.abspath(pip_cache.cache_dir)),
+                wheel_dir=wheel_dir,
+                install_args=("--target", packages_dir, "--upgrade"),
+            )
+            if success:
+                installed.update(missing)
+            return success, output
+
+    def run(self, username, code, buffer, on_output=None, timeout=CODE_EXEC_TIMEOUT):
+        """Run the code for the user, streaming the output to on_output.
+
+        Returns the exit code, "ok", "timeout" or "output_limit" like
+        run_python_code.stream_exec, and the startup time.
+        """
+        data_dir = os.path.abspath(get_data_dir(username))
+        packages_dir = os.path.abspath(get_packages_dir(username))
+        os.makedirs(data_dir, exist_ok=True)
+        os.makedirs(packages_dir, exist_ok=True)
+        job = self.new_job(
+            map_data_paths(code, data_dir),
+            data_dir,
+            [(packages_dir, False)],
+            self.network,
+            self.get_limits(),
+            self.file_size_mb,
+        )
+        job["packages_dir"] = packages_dir
+        return self.run_job(job, buffer, on_output, timeout)
+
+    def pip(self, command, cwd, binds=(), timeout=CODE_EXEC_TIMEOUT):
+        """Run a pip command (["pip", ...]) in a worker, returns an ExecResult.
+
+        The worker sees cwd (writable) and binds, see new_job().
+        """
+        os.makedirs(cwd, exist_ok=True)
+        job = self.new_job(
+            PIP_SOURCE, cwd, binds, True, self.get_pip_limits(), self.memory_mb
+        )
+        job["argv"] = command
+        # the packages of the user don't replace pip
+        job["packages_dir"] = None
+        # wheels built by pip aren't kept in the home directory
+        job["env"] = {"PIP_NO_CACHE_DIR": "1"}
+        output = PipOutput()
+        exit_code, status, _ = self.run_job(job, output, timeout=timeout)
+        if status == "timeout":
+            output.write(f"\npip timed out after {timeout} seconds".encode("utf-8"))
+        return ExecResult(exit_code, output.getvalue())
+
+    def run_job(self, job, buffer, on_output=None, timeout=CODE_EXEC_TIMEOUT):
+        """Run a job in a worker, see run()."""
+        process, startup_time = self.acquire()
+        status = []
+
+        def kill(reason):
+            status.append(reason)
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+
+        timer = threading.Timer(timeout, kill, args=("timeout",))
+        timer.daemon = True
+        timer.start()
+        try:
+            process.stdin.write(json.dumps(job).encode("utf-8"))
+            process.stdin.close()
+            while True:
+                chunk = os.read(process.stdout.fileno(), 64 * 1024)
+                if not chunk:
+                    break
+                text = buffer.write(chunk)
+                if text and on_output is not None:
+                    on_output(text)
+                if buffer.full:
+                    kill("output_limit")
+                    break
+        except BaseException:
+            kill("error")
+            raise
+        finally:
+            timer.cancel()
+            process.stdout.close()
+            exit_code = process.wait()
+
+        # like a shell, a process killed by a signal exits with 128 + the signal
+        if exit_code < 0:
+            exit_code = 128 - exit_code
+        return exit_code, status[0] if status else "ok", startup_time
+
+    def shutdown(self):
+        """Stop the idle workers."""
+        self._stopped = True
+        while True:
+            try:
+                process = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            process.kill()
+            process.wait()
+
+
+subprocess_sandbox = SubprocessSandbox()
@@ -0,0 +1,94 @@
+"""
+Token budget packing for the context trimming.
+
+Instead of removing one line at a time and re-tokenizing the whole string until
+it fits, every candidate item is tokenized once (the counts are cached between
+calls) and the items are selected greedily by priority within the budget.
+"""
+
+import threading
+from collections import OrderedDict
+
+
+class TokenBudgetPacker:
+    """Pack text items into a token budget, tokenizing every item only once."""
+
+    def __init__(self, count_tokens, separator="\n", max_cached_items=4096):
+        self.count_tokens = count_tokens
+        self.separator = separator
+        self.max_cached_items = max_cached_items
+        self._counts = OrderedDict()
+        self._lock = threading.Lock()
+
+    def count(self, text):
+        """Return the (cached) token count of a single item."""
+        with self._lock:
+            if text in self._counts:
+                self._counts.move_to_end(text)
+                return self._counts[text]
+        token_count = self.count_tokens(text)
+        with self._lock:
+            self._counts[text] = token_count
+            while len(self._counts) > self.max_cached_items:
+                self._counts.popitem(last=False)
+        return token_count
+
+    def truncate(self, text, budget):
+        """Return the longest prefix of the text that fits in the budget."""
+        if self.count_tokens(text) <= budget:
+            return text
+        low, high = 0, len(text)
+        while low < high:
+            middle = (low + high + 1) // 2
+            if self.count_tokens(text[:middle]) <= budget:
+                low = middle
+            else:
+                high = middle - 1
+        return text[:low]
+
+    def pack(self, items, budget, priority=None, contiguous=False, truncate=True):
+        """Select items greedily by priority within the budget.
+
+        items: the candidate strings, in the order they should appear in the output
+        priority: optional sort keys, the item with the lowest key is packed first, defaults to the item order
+        contiguous: stop at the first item that does not fit instead of skipping it
+        truncate: if not even the first item fits, truncate it to the budget
+
+        Returns the packed string, its exact token count and the indices of the packed items in output order.
+        """
+        if budget <= 0 or not items:
+            return "", 0, []
+
+        if priority is None:
+            order = list(range(len(items)))
+        else:
+            order = sorted(range(len(items)), key=lambda i: priority[i])
+        separator_tokens = self.count(self.separator) if self.separator else 0
+
+        selected = []
+        used = 0
+        for i in order:
+            cost = self.count(items[i]) + (separator_tokens if selected else 0)
+            if used + cost <= budget:
+                selected.append(i)
+                used += cost
+            elif contiguous:
+                break
+
+        if not selected:
+            if not truncate:
+                return "", 0, []
+            text = self.truncate(items[order[0]], budget)
+            if not text:
+                return "", 0, []
+            return text, self.count_tokens(text), [order[0]]
+
+        # the tokens can merge across the separators, so count the packed string once
+        output = sorted(selected)
+        packed = self.separator.join(items[i] for i in output)
+        token_count = self.count_tokens(packed)
+        while token_count > budget and len(selected) > 1:
+            output.remove(selected.pop())
+            packed = self.separator.join(items[i] for i in output)
+            token_count = self.count_tokens(packed)
+        return packed, token_count, output
@@ -0,0 +1,162 @@
+"""
+Tokenizer service.
+
+The tiktoken encoders are loaded once per model family, token counts of recently
+seen strings are kept in an LRU and the token count of the addon schemas is
+memoized by a hash of the function metadata.
+"""
+
+import functools
+import hashlib
+import json
+import math
+import threading
+import time
+
+import tiktoken
+
+import logs
+from token_budget import TokenBudgetPacker
+
+logger = logs.Log("tokenizer", "tokenizer.log").get_logger()
+
+# Claude has its own tokenizer, it uses roughly 10% more tokens than cl100k_base
+ANTHROPIC_TOKEN_RATIO = 1.1
+# rough number of characters per token, only used when no encoding can be loaded
+CHARS_PER_TOKEN = 4
+# seconds to wait before trying to load an encoding again after a failure
+ENCODING_RETRY_DELAY = 300
+
+_encodings = {}
+_encoding_failures = {}
+_encodings_lock = threading.RLock()
+_function_tokens = {}
+
+
+def model_family(model):
+    """Return the tokenizer family of a model."""
+    model = (model or "").lower()
+    if model.startswith("claude"):
+        return "anthropic"
+    if model.startswith("gpt-4o"):
+        return "o200k_base"
+    return "cl100k_base"
+
+
+def get_encoding(family):
+    """Return the (cached) tiktoken encoding for a model family, None if it cannot be loaded."""
+    name = "cl100k_base" if family == "anthropic" else family
+    if name in _encodings:
+        return _encodings[name]
+    if time.time() - _encoding_failures.get(name, 0) < ENCODING_RETRY_DELAY:
+        return None
+
+    with _encodings_lock:
+        if name in _encodings:
+            return _encodings[name]
+        try:
+            encoding = tiktoken.get_encoding(name)
+        except ValueError:
+            # older tiktoken versions don't know the newer encodings
+            encoding = None if name == "cl100k_base" else get_encoding("cl100k_base")
+        except Exception as e:
+            logger.warning(
+                f"Could not load the {name} encoding, estimating token counts: {e}"
+            )
+            _encoding_failures[name] = time.time()
+            return None
+        if encoding is not None:
+            _encodings[name] = encoding
+        return encoding
+
+
+def _scale(family, token_count):
+    if family == "anthropic":
+        return math.ceil(token_count * ANTHROPIC_TOKEN_RATIO)
+    return token_count
+
+
+@functools.lru_cache(maxsize=8192)
+def _count_encoded(family, text):
+    encoding = get_encoding(family)
+    return _scale(family, len(encoding.encode(text, disallowed_special=())))
+
+
+def _count_tokens(family, text):
+    if get_encoding(family) is None:
+        # not cached, the count is exact once the encoding can be loaded again
+        return _scale(family, math.ceil(len(text) / CHARS_PER_TOKEN))
+    return _count_encoded(family, text)
+
+
+def count_tokens(text, model="gpt-4"):
+    """Return the number of tokens in a text string for the given model."""
+    if not text:
+        return 0
+    return _count_tokens(model_family(model), str(text))
+
+
+def count_function_tokens(functions, model="gpt-4"):
+    """Return the number of tokens used by a list of functions, memoized by a hash of the functions."""
+    family = model_family(model)
+    key = hashlib.sha256(
+        (family + json.dumps(functions, sort_keys=True, default=str)).encode("utf-8")
+    ).hexdigest()
+    if key in _function_tokens:
+        return _function_tokens[key]
+    num_tokens = _count_function_tokens(functions, model)
+    # don't memoize an estimate made while the encoding can't be loaded
+    if get_encoding(family) is not None:
+        if len(_function_tokens) > 256:
+            _function_tokens.clear()
+        _function_tokens[key] = num_tokens
+    return num_tokens
+
+
+def _count_function_tokens(functions, model):
+    num_tokens = 0
+    for tool in functions:  # Iterate over the tools
+        if tool["type"] == "function":  # Ensure it's a function type
+            function = tool["function"]  # Extract the function details
+            function_tokens = count_tokens(function["name"], model)
+            function_tokens += count_tokens(function["description"], model)
+
+            if "parameters" in function:
+                parameters = function["parameters"]
+                if "properties" in parameters:
+                    for propertiesKey, v in parameters["properties"].items():
+                        function_tokens += count_tokens(propertiesKey, model)
+                        for field in v:
+                            if field == "type":
+                                function_tokens += 2
+                                function_tokens += count_tokens(v["type"], model)
+                            elif field == "description":
+                                function_tokens += 2
+                                function_tokens += count_tokens(v["description"], model)
+                            elif field == "default":
+                                function_tokens += 2
+                            elif field == "enum":
+                                function_tokens -= 3
+                                for o in v["enum"]:
+                                    function_tokens += 3
+                                    function_tokens += count_tokens(o, model)
+                            elif field == "items":
+                                function_tokens += 10
+                            else:
+                                logger.warning(f"Warning: not supported field {field}")
+                    function_tokens += 11
+
+            num_tokens += function_tokens
+
+    num_tokens += 12  # Account for any additional overhead
+    return num_tokens
+
+
+@functools.lru_cache(maxsize=None)
+def _get_token_packer(family):
+    return TokenBudgetPacker(lambda text: _count_tokens(family, text) if text else 0)
+
+
+def get_token_packer(model="gpt-4"):
+    """Return the shared token budget packer for the tokenizer family of the model."""
+    return _get_token_packer(model_family(model))
@@ -0,0 +1,117 @@
+import asyncio
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+from fastapi import HTTPException
+
+import routes
+from addon_executor import AddonCancelledError, AddonExecutor
+from classes import emailMessage
+
+
+def sleep(seconds, username=None):
+    time.sleep(seconds)
+
+
+def test_sync_addons_run_off_the_event_loop():
+    executor = AddonExecutor(max_workers=2, default_timeout=5)
+
+    def slow_addon(username=None):
+        time.sleep(0.2)
+        return threading.current_thread().name
+
+    async def main():
+        ticks = 0
+
+        async def ticker():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.01)
+                ticks += 1
+
+        ticking = asyncio.ensure_future(ticker())
+        thread_name, call = await executor.run("slow", slow_addon, {}, "bob")
+        ticking.cancel()
+        return thread_name, call, ticks
+
+    thread_name, call, ticks = asyncio.run(main())
+    assert thread_name.startswith("addon")
+    assert ticks > 5
+    assert call.execution_time >= 0.2
+    assert executor.get_statistics()["slow"]["calls"] == 1
+    executor.shutdown()
+
+
+def test_concurrency_limit_and_queue_wait():
+    executor = AddonExecutor(
+        max_workers=4, default_timeout=5, concurrency_limits={"limited": 1}
+    )
+    running = []
+
+    def limited():
+        running.append(1)
+        concurrent = len(running)
+        time.sleep(0.1)
+        running.pop()
+        return concurrent
+
+    async def main():
+        return await asyncio.gather(
+            executor.run("limited", limited, {}, "bob"),
+            executor.run("limited", limited, {}, "alice"),
+        )
+
+    results = asyncio.run(main())
+    assert [result for result, _ in results] == [1, 1]
+    assert max(call.queue_wait for _, call in results) >= 0.09
+    executor.shutdown()
+
+
+def test_timeout():
+    executor = AddonExecutor(max_workers=1, timeouts={"hang": 0.05})
+
+    async def main():
+        await executor.run("hang", sleep, {"seconds": 0.3})
+
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(main())
+    assert executor.get_statistics()["hang"]["timeouts"] == 1
+    executor.shutdown()
+
+
+def test_stop_cancels_the_calls_of_the_user():
+    executor = AddonExecutor(max_workers=1, default_timeout=5)
+
+    async def main():
+        task = asyncio.ensure_future(
+            executor.run("hang", sleep, {"seconds": 0.3}, "bob")
+        )
+        await asyncio.sleep(0.05)
+        assert executor.cancel("alice") == 0
+        assert executor.cancel("bob") == 1
+        await task
+
+    with pytest.raises(AddonCancelledError):
+        asyncio.run(main())
+    assert executor.get_statistics()["hang"]["cancelled"] == 1
+    executor.shutdown()
+
+
+@pytest.mark.parametrize(
+    "error, status_code",
+    [(asyncio.TimeoutError(), 504), (AddonCancelledError("cancelled"), 409)],
+)
+def test_send_email_errors(monkeypatch, error, status_code):
+    async def run(*args, **kwargs):
+        raise error
+
+    monkeypatch.setattr(routes.addon_executor, "run", run)
+    request = SimpleNamespace(
+        state=SimpleNamespace(user=SimpleNamespace(username="bob"))
+    )
+    message = emailMessage(username="bob", draft_id="draft")
+    with pytest.raises(HTTPException) as raised:
+        asyncio.run(routes.send_email(request, message))
+    assert raised.value.status_code == status_code
@@ -0,0 +1,80 @@
+import os
+import sys
+
+import pytest
+
+from addon_registry import AddonRegistry
+
+
+def write_addon(directory, name, body, mtime_ns=None):
+    path = directory / f"{name}.py"
+    path.write_text(body)
+    if mtime_ns is not None:
+        os.utime(path, ns=(mtime_ns, mtime_ns))
+
+
+@pytest.fixture
+def addons_dir(tmp_path, monkeypatch):
+    directory = tmp_path / "registry_test_addons"
+    directory.mkdir()
+    monkeypatch.syspath_prepend(str(tmp_path))
+    yield directory
+    for name in list(sys.modules):
+        if name.startswith("registry_test_addons"):
+            del sys.modules[name]
+
+
+ADDON = """
+description = "say hello"
+parameters = {"type": "object", "properties": {"name": {"type": "string"}}, "required": ["name"]}
+calls = globals().get("calls", 0) + 1
+
+def hello(name, username=None):
+    return "{greeting} " + name
+"""
+
+
+def test_schemas_are_built_once_and_filtered_per_user(addons_dir):
+    write_addon(addons_dir, "hello", ADDON.replace("{greeting}", "hi"))
+    write_addon(addons_dir, "other", ADDON.replace("hello", "other"))
+    registry = AddonRegistry(str(addons_dir), "registry_test_addons", 0)
+
+    tools = registry.get_openai_tools()
+    assert [tool["function"]["name"] for tool in tools] == ["hello", "other"]
+    assert registry.get_openai_tools()[0] is tools[0]
+    assert registry.get_modules()["hello"].calls == 1
+
+    enabled = {"hello": False, "other": True}
+    assert list(registry.get_modules(enabled)) == ["other"]
+    claude_tool = registry.get_claude_tools(enabled)[0]
+    assert claude_tool["input_schema"]["required"] == ["name"]
+    assert (
+        registry.claude_tool_for(registry.get_openai_tools(enabled)[0]) is claude_tool
+    )
+
+
+def test_modified_addons_are_reloaded(addons_dir):
+    write_addon(addons_dir, "hello", ADDON.replace("{greeting}", "hi"), 10**18)
+    registry = AddonRegistry(str(addons_dir), "registry_test_addons", 0)
+    module = registry.get_modules()["hello"]
+    assert module.hello("bob") == "hi bob"
+
+    registry.get_modules()
+    assert module.calls == 1
+
+    write_addon(addons_dir, "hello", ADDON.replace("{greeting}", "hey"), 2 * 10**18)
+    assert registry.get_modules()["hello"].hello("bob") == "hey bob"
+    assert module.calls == 2
+
+    os.remove(addons_dir / "hello.py")
+    assert registry.get_modules() == {}
+
+
+def test_broken_addons_are_skipped(addons_dir):
+    write_addon(addons_dir, "broken", "raise RuntimeError('nope')")
+    write_addon(addons_dir, "nameless", "description = 'no function'")
+    registry = AddonRegistry(str(addons_dir), "registry_test_addons", 0)
+    assert registry.get_openai_tools() == []
+    errors = {addon.name: addon.error for addon in registry.get_addons()}
+    assert "nope" in errors["broken"]
+    assert "does not have a function" in errors["nameless"]
@@ -0,0 +1,99 @@
+import threading
+import time
+
+import docker
+import pytest
+
+from container_pool import ContainerPool
+from pip_cache import pip_cache
+
+
+class FakeContainer:
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+        self.status = "running"
+
+    def reload(self):
+        if self.name not in self.client.running:
+            raise docker.errors.NotFound("gone")
+
+    def remove(self, force=False):
+        self.client.running.pop(self.name, None)
+        self.client.removed.append(self.name)
+
+
+class FakeContainers:
+    def __init__(self, client):
+        self.client = client
+
+    def run(self, image, name, **kwargs):
+        self.client.started.append(name)
+        container = self.client.running[name] = FakeContainer(self.client, name)
+        return container
+
+    def get(self, name):
+        if name not in self.client.running:
+            raise docker.errors.NotFound("missing")
+        return self.client.running[name]
+
+
+class FakeClient:
+    def __init__(self):
+        self.running = {}
+        self.started = []
+        self.removed = []
+        self.containers = FakeContainers(self)
+
+
+@pytest.fixture
+def pool(tmp_path, monkeypatch):
+    monkeypatch.setenv("CHARLIE_MNEMONIC_USER_DIR", str(tmp_path))
+    monkeypatch.setattr(pip_cache, "cache_dir", str(tmp_path / ".pip_cache"))
+    pool = ContainerPool("image", max_containers=2, idle_timeout=60, reap_interval=1)
+    pool._client = FakeClient()
+    return pool
+
+
+def test_containers_are_reused(pool):
+    lease = pool.acquire("bob")
+    assert lease.startup_time > 0
+    lease.installed_packages.add("numpy")
+    pool.release(lease)
+
+    lease = pool.acquire("bob")
+    assert lease.startup_time == 0.0
+    assert "numpy" in lease.installed_packages
+    pool.release(lease)
+    assert pool.client.started == ["bob"]
+
+    # a container that died is started again
+    pool.client.running.clear()
+    lease = pool.acquire("bob")
+    assert lease.startup_time > 0 and lease.installed_packages == set()
+    pool.release(lease, broken=True)
+    assert "bob" not in pool.client.running
+
+
+def test_queue_time_for_concurrent_runs_of_a_user(pool):
+    lease = pool.acquire("bob")
+    leases = []
+    thread = threading.Thread(target=lambda: leases.append(pool.acquire("bob")))
+    thread.start()
+    time.sleep(0.1)
+    pool.release(lease)
+    thread.join()
+    assert leases[0].queue_time >= 0.09
+    pool.release(leases[0])
+
+
+def test_reap_idle_and_make_room(pool):
+    for username in ["a", "b", "c"]:
+        pool.release(pool.acquire(username))
+    # the pool holds two containers, the least recently used one made room
+    assert sorted(pool.client.running) == ["b", "c"]
+
+    assert pool.reap() == 0
+    pool.idle_timeout = 0
+    assert pool.reap() == 2
+    assert pool.client.running == {}
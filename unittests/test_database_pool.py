@@ -0,0 +1,93 @@
+import threading
+import time
+
+import psycopg2
+import psycopg2.extensions
+import psycopg2.pool
+import pytest
+
+import database
+from database import ConnectionPool, Database
+
+
+class FakeInfo:
+    transaction_status = psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+
+class FakeConnection:
+    connects = 0
+
+    def __init__(self, *args, **kwargs):
+        FakeConnection.connects += 1
+        self.closed = 0
+        self.info = FakeInfo()
+        self.rolled_back = False
+
+    def cursor(self, *args, **kwargs):
+        return object()
+
+    def rollback(self):
+        self.rolled_back = True
+
+    def close(self):
+        self.closed = 1
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    monkeypatch.setenv("DATABASE_URL", "postgres://localhost/test")
+    monkeypatch.setenv("PRODUCTION", "false")
+    monkeypatch.setattr(psycopg2, "connect", FakeConnection)
+    FakeConnection.connects = 0
+    pool = ConnectionPool(size=2, max_connections=3, timeout=0.2)
+    monkeypatch.setattr(database, "connection_pool", pool)
+    yield pool
+    pool.closeall()
+
+
+def test_connections_are_reused(pool):
+    for _ in range(10):
+        with Database() as db:
+            assert db.conn is not None
+    assert FakeConnection.connects == 2
+    stats = pool.get_statistics()
+    assert stats["borrowed"] == 10 and stats["in_use"] == 0 and stats["idle"] == 2
+
+
+def test_database_does_not_create_daos():
+    db = Database()
+    assert db._users_dao is None and db._chat_tabs_dao is None
+
+
+def test_open_transaction_is_rolled_back(pool):
+    with Database() as db:
+        conn = db.conn
+        conn.info.transaction_status = psycopg2.extensions.TRANSACTION_STATUS_INTRANS
+    assert conn.rolled_back
+
+
+def test_failed_connection_is_discarded(pool):
+    with pytest.raises(psycopg2.OperationalError):
+        with Database() as db:
+            conn = db.conn
+            raise psycopg2.OperationalError("server closed the connection")
+    assert conn.closed
+    with Database() as db:
+        assert db.conn is not conn
+    assert pool.get_statistics()["discarded"] == 1
+
+
+def test_waits_for_a_free_connection(pool):
+    borrowed = [pool.getconn() for _ in range(3)]
+    with pytest.raises(psycopg2.pool.PoolError):
+        pool.getconn()
+    assert pool.get_statistics()["timeouts"] == 1
+
+    threading.Timer(0.05, pool.putconn, args=borrowed.pop()).start()
+    started = time.perf_counter()
+    borrowed.append(pool.getconn())
+    assert time.perf_counter() - started >= 0.04
+    for connection in borrowed:
+        pool.putconn(*connection)
+    stats = pool.get_statistics()
+    assert stats["waits"] == 1 and stats["max_in_use"] == 3 and stats["in_use"] == 0
@@ -0,0 +1,159 @@
+import sqlite3
+
+import pytest
+from chromadb.api.models.Collection import Collection
+
+from agentmemory import main
+from agentmemory.keyword_index import (
+    build_match_query,
+    keyword_index,
+    reciprocal_rank_fusion,
+)
+
+DOCUMENTS = {
+    "1": "The tortilla recipe needs eggs and potatoes",
+    "2": "We booked the train to Madrid",
+    "3": "Potatoes are cheaper at the market",
+    "4": "A recipe for gazpacho, no potatoes",
+}
+EMBEDDINGS = {
+    "1": [1.0, 0.0, 0.0],
+    "2": [0.0, 1.0, 0.0],
+    "3": [0.0, 0.0, 1.0],
+    "4": [0.7, 0.7, 0.0],
+}
+
+
+@pytest.fixture
+def memories(tmp_path, monkeypatch):
+    # get_client and the keyword index keep the users' data in ./users
+    monkeypatch.chdir(tmp_path)
+    for id, document in DOCUMENTS.items():
+        main.create_memory(
+            "active_brain",
+            document,
+            metadata={"chat_id": id},
+            embedding=EMBEDDINGS[id],
+            id=id,
+            username="alice",
+        )
+    return tmp_path
+
+
+def search(text, **kwargs):
+    return main.search_memory(
+        "active_brain",
+        text,
+        username="alice",
+        query_embedding=[1.0, 0.0, 0.0],
+        **kwargs,
+    )
+
+
+def ids(results):
+    return [res["id"] for res in results]
+
+
+def test_build_match_query():
+    assert build_match_query("tortilla recipe") == '"tortilla" AND "recipe"'
+    assert build_match_query('"train to" Madrid') == '"train to" AND "Madrid"'
+    assert build_match_query("eggs, or", match_all=False) == '"eggs," OR "or"'
+    assert build_match_query("- ...") is None
+
+
+def test_reciprocal_rank_fusion():
+    fused = reciprocal_rank_fusion(["a", "b", "c"], ["c", "a"], k=1)
+    assert [id for id, _ in fused] == ["a", "c", "b"]
+    assert fused[0][1] == pytest.approx(1 / 2 + 1 / 3)
+
+
+def test_keyword_search(memories):
+    assert set(ids(search("potatoes", search_mode="keyword"))) == {"1", "3", "4"}
+    assert ids(search("recipe potatoes", search_mode="keyword")) in (
+        ["1", "4"],
+        ["4", "1"],
+    )
+    assert ids(search('"train to Madrid"', search_mode="keyword")) == ["2"]
+    assert search("potatoes", search_mode="keyword")[0]["score"] > 0
+    filtered = search("recipe", search_mode="keyword", filter_metadata={"chat_id": "4"})
+    assert ids(filtered) == ["4"]
+    assert search("...", search_mode="keyword") == []
+
+
+def test_hybrid_search(memories):
+    # the vector ranking alone puts the memory about the market last
+    assert ids(search("market", n_results=4))[-1] == "3"
+    results = search("market", search_mode="hybrid", n_results=4)
+    assert ids(results)[:2] == ["3", "1"]
+    assert results[0]["score"] > results[1]["score"]
+
+    # found by its words only, it has no distance
+    results = {
+        res["id"]: res for res in search("market", search_mode="hybrid", n_results=2)
+    }
+    assert set(results) == {"1", "3"}
+    assert "distance" in results["1"] and "distance" not in results["3"]
+
+
+def test_exact_match(memories):
+    assert ids(search("booked the tr", exact_match=True)) == ["2"]
+    assert ids(search("RECIPE", exact_match=True)) in (["1", "4"], ["4", "1"])
+    assert search("recipe needs potatoes", exact_match=True) == []
+    assert "score" not in search("recipe", exact_match=True)[0]
+    # not the start of a word
+    assert ids(search("ortilla", exact_match=True)) == ["1"]
+    assert ids(search("ooked the", exact_match=True)) == ["2"]
+    # shorter than a trigram
+    assert ids(search("dR", exact_match=True)) == ["2"]
+    assert ids(search("%", exact_match=True)) == []
+    found = ids(search("potatoes", exact_match=True, n_results=2))
+    assert len(found) == 2 and set(found) <= {"1", "3", "4"}
+    filtered = search("potatoes", exact_match=True, filter_metadata={"chat_id": "3"})
+    assert ids(filtered) == ["3"]
+
+
+def test_exact_match_reads_only_the_matches(memories, monkeypatch):
+    # indexes the category
+    search("recipe", exact_match=True)
+    calls = []
+    get = Collection.get
+
+    def recording_get(self, *args, **kwargs):
+        calls.append(kwargs)
+        return get(self, *args, **kwargs)
+
+    monkeypatch.setattr(Collection, "get", recording_get)
+    assert ids(search("ortilla", exact_match=True)) == ["1"]
+    assert search("no such text", exact_match=True) == []
+    assert [call.get("ids") for call in calls] == [["1"]]
+
+
+def test_index_follows_changes(memories):
+    main.update_memory(
+        "active_brain",
+        "2",
+        text="We took the bus",
+        embedding=EMBEDDINGS["2"],
+        username="alice",
+    )
+    assert search("train", search_mode="keyword") == []
+    assert ids(search("bus", search_mode="keyword")) == ["2"]
+    main.delete_memory("active_brain", "3", username="alice")
+    assert "3" not in ids(search("potatoes", search_mode="keyword"))
+
+    # deleted by a filter, the category is indexed again from the collection
+    main.delete_memories("active_brain", metadata={"chat_id": "1"}, username="alice")
+    assert ids(search("potatoes", search_mode="keyword")) == ["4"]
+
+
+def test_existing_memories_are_indexed(memories):
+    keyword_index.invalidate("alice")
+    connection = sqlite3.connect(keyword_index.path("alice"))
+    assert connection.execute("SELECT COUNT(*) FROM documents").fetchone() == (0,)
+    connection.close()
+    assert ids(search("gazpacho", search_mode="keyword")) == ["4"]
+
+
+def test_invalid_search_mode(memories):
+    with pytest.raises(ValueError):
+        search("recipe", search_mode="fuzzy")
@@ -0,0 +1,57 @@
+import time
+
+from llm_cache import ResponseCache, is_enabled
+
+
+def test_key_ignores_whitespace_and_system_messages():
+    first = ResponseCache.make_key(
+        "tab_title",
+        "gpt-4o",
+        [
+            {"role": "system", "content": "Current date: 2024-01-01 10:00:00"},
+            {"role": "user", "content": "hello   world\n"},
+        ],
+    )
+    second = ResponseCache.make_key(
+        "tab_title",
+        "gpt-4o",
+        [
+            {"role": "system", "content": "Current date: 2024-01-01 10:00:05"},
+            {"role": "user", "content": "hello world"},
+        ],
+    )
+    assert first == second
+    assert first != ResponseCache.make_key("categorise", "gpt-4o", "hello world")
+    assert first != ResponseCache.make_key("tab_title", "gpt-4o-mini", "hello world")
+
+
+def test_lru_eviction_and_ttl():
+    cache = ResponseCache(max_entries=2, ttl=60)
+    cache.set("a", "1")
+    cache.set("b", "2")
+    cache.get("a")
+    cache.set("c", "3")
+    assert cache.get("b") is None
+    assert cache.get("a").response == "1"
+    assert len(cache) == 2
+
+    cache.ttl = 0
+    time.sleep(0.01)
+    assert cache.get("a") is None
+
+
+def test_disk_tier(tmp_path):
+    path = str(tmp_path / "llm_cache.db")
+    cache = ResponseCache(max_entries=10, ttl=60, disk_path=path)
+    cache.set("key", "25-09-2023", input_tokens=120, output_tokens=5)
+
+    entry = ResponseCache(max_entries=10, ttl=60, disk_path=path).get("key")
+    assert entry.response == "25-09-2023"
+    assert entry.input_tokens == 120
+    assert entry.output_tokens == 5
+
+
+def test_is_enabled():
+    assert is_enabled({}, "date-extractor")
+    assert not is_enabled({"llm_cache": {"date-extractor": False}}, "date-extractor")
+    assert not is_enabled({}, "notetaker")
@@ -306,3 +306,13 @@ class TestMemoryManager(unittest.TestCase):
             0.1,
             username="test_user",
         )
+
+    def test_counts_with_the_active_model(self):
+        self.assertEqual(MemoryManager("claude-3-opus").model_used, "claude-3-opus")
+        self.memory_manager.use_active_model(
+            {"active_model": {"active_model": "claude-3-haiku"}}
+        )
+        self.assertEqual(self.memory_manager.model_used, "claude-3-haiku")
+        # settings without a model keep the current one
+        self.memory_manager.use_active_model({})
+        self.assertEqual(self.memory_manager.model_used, "claude-3-haiku")
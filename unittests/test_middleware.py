@@ -0,0 +1,157 @@
+import asyncio
+import os
+import time
+
+import httpx
+import pytest
+from fastapi import FastAPI, Request, WebSocket
+
+import configuration_page
+from config import LOGIN_REQUIRED
+from configuration_page.middleware import (
+    LoginRequiredCheckMiddleware,
+    route_matcher,
+)
+from configuration_page.redirect_middleware import RedirectToConfigurationMiddleware
+from session_cache import session_cache
+from user_management.dao import UsersDAO
+from user_management.session import session_factory
+
+
+@pytest.fixture
+def users(tmp_path, monkeypatch):
+    monkeypatch.setenv("NEW_DATABASE_URL", f"sqlite:///{tmp_path / 'users.db'}")
+    session_factory.get_refreshed()
+    session_cache.invalidate()
+    route_matcher.clear()
+    dao = UsersDAO()
+    dao.create_all_tables()
+    dao.add_user("alice", "password", "token", "Alice")
+    yield dao
+    dao.close_session()
+    session_factory.engine.dispose()
+    session_factory.engine = None
+
+
+@pytest.fixture
+def configured(monkeypatch):
+    checks = []
+
+    def is_any_ai_available():
+        checks.append(1)
+        return True
+
+    monkeypatch.setattr(configuration_page, "is_any_ai_available", is_any_ai_available)
+    configuration_page.reset_configured()
+    yield checks
+    configuration_page.reset_configured()
+
+
+@pytest.fixture
+def app(users, configured):
+    app = FastAPI()
+
+    @app.get("/ping", tags=[LOGIN_REQUIRED])
+    async def ping(request: Request):
+        return {"username": request.state.user.username}
+
+    @app.websocket("/ws")
+    async def ws(websocket: WebSocket):
+        await websocket.accept()
+        await websocket.send_text("hello")
+        await websocket.close()
+
+    app.add_middleware(LoginRequiredCheckMiddleware)
+    app.add_middleware(RedirectToConfigurationMiddleware)
+    return app
+
+
+def send_requests(app, path, count=1, cookies=None):
+    async def send():
+        async with httpx.AsyncClient(
+            transport=httpx.ASGITransport(app=app),
+            base_url="http://testserver",
+            cookies=cookies or {"username": "alice", "session_token": "token"},
+        ) as client:
+            return [await client.get(path) for _ in range(count)]
+
+    return asyncio.run(send())
+
+
+def test_route_match_is_remembered(app, monkeypatch):
+    assert send_requests(app, "/ping")[0].json() == {"username": "alice"}
+    scope = {"type": "http", "method": "GET", "path": "/ping", "app": app}
+    route = route_matcher.match(scope)
+    assert route.path == "/ping"
+
+    def fail(scope):
+        raise AssertionError("the routes were scanned again")
+
+    for candidate in app.router.routes:
+        monkeypatch.setattr(candidate, "matches", fail)
+    assert route_matcher.match(scope) is route
+
+
+def test_configuration_check_is_cached_until_reset(app, configured):
+    send_requests(app, "/ping", count=3)
+    assert len(configured) == 1
+    configuration_page.reset_configured()
+    send_requests(app, "/ping")
+    assert len(configured) == 2
+
+
+def test_missing_configuration_redirects(app, monkeypatch):
+    monkeypatch.setattr(configuration_page, "is_any_ai_available", lambda: False)
+    configuration_page.reset_configured()
+    response = send_requests(app, "/ping")[0]
+    assert response.status_code == 307
+
+
+def test_websocket_passes_through(app):
+    messages = [
+        {"type": "websocket.connect"},
+        {"type": "websocket.disconnect", "code": 1000},
+    ]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {
+        "type": "websocket",
+        "path": "/ws",
+        "raw_path": b"/ws",
+        "root_path": "",
+        "query_string": b"",
+        "headers": [],
+        "scheme": "ws",
+        "server": ("testserver", 80),
+        "client": ("testclient", 50000),
+        "subprotocols": [],
+    }
+    asyncio.run(app(scope, receive, send))
+    assert [message["type"] for message in sent] == [
+        "websocket.accept",
+        "websocket.send",
+        "websocket.close",
+    ]
+    assert sent[1]["text"] == "hello"
+
+
+@pytest.mark.skipif(
+    not os.environ.get("BENCHMARK"), reason="Set BENCHMARK=1 to run the benchmark."
+)
+def test_requests_per_second(app):
+    # a measurement, not a pass/fail threshold: run with
+    # BENCHMARK=1 pytest -s unittests/test_middleware.py -k requests_per_second
+    # warm up the session cache and the route match
+    send_requests(app, "/ping")
+    count = 500
+    started = time.perf_counter()
+    responses = send_requests(app, "/ping", count=count)
+    elapsed = time.perf_counter() - started
+    assert all(response.status_code == 200 for response in responses)
+    print(f"{count / elapsed:.0f} requests/sec on an authenticated endpoint")
@@ -0,0 +1,26 @@
+import config
+from llmcalls import resolve_role_model
+
+settings = {
+    "active_model": {"active_model": "gpt-4o"},
+    "memory": {"output": 3840},
+    "model_routing": {
+        "date-extractor": {"model": "gpt-4o-mini", "max_tokens": 20},
+        "notetaker": {"model": "gpt-4o-mini", "max_tokens": 0},
+        "summarize": {"model": "claude-3-haiku-20240307", "max_tokens": 500},
+    },
+}
+
+
+def test_resolve_role_model(monkeypatch):
+    monkeypatch.setitem(config.api_keys, "openai", "sk-test")
+    monkeypatch.setitem(config.api_keys, "anthropic", None)
+
+    assert resolve_role_model(settings, "date-extractor") == ("gpt-4o-mini", 20)
+    # 0 means the memory output budget
+    assert resolve_role_model(settings, "notetaker") == ("gpt-4o-mini", 3840)
+    # roles without a route use the active model
+    assert resolve_role_model(settings, "brain") == ("gpt-4o", 3840)
+    assert resolve_role_model(settings) == ("gpt-4o", 3840)
+    # routed to a provider without an api key, fall back to the active model
+    assert resolve_role_model(settings, "summarize") == ("gpt-4o", 500)
@@ -0,0 +1,160 @@
+import os
+import time
+
+from unittest.mock import MagicMock
+
+import pytest
+
+from pip_cache import PipCache, normalize_packages, package_set_key
+
+
+class ExecResult:
+    def __init__(self, exit_code, output):
+        self.exit_code = exit_code
+        self.output = output.encode("utf-8")
+
+
+class FakeContainer:
+    """Installs from the wheel directory of the cache like pip would."""
+
+    def __init__(self, cache, online=True):
+        self.cache = cache
+        self.online = online
+        self.commands = []
+
+    def exec_run(self, command):
+        self.commands.append(command[:2])
+        packages = [arg for arg in command[2:] if not arg.startswith(("-", "/", ":"))]
+        offline = "--no-index" in command
+        wheels = []
+        for package in packages:
+            wheel = os.path.join(
+                self.cache.wheel_dir, f"{package}-1.0-py3-none-any.whl"
+            )
+            if package.startswith("sdist") and command[1] == "install":
+                # built from the source distribution, not cached
+                if offline or not self.online:
+                    return ExecResult(1, f"No matching distribution for {package}")
+                continue
+            if not os.path.exists(wheel):
+                if offline or package.startswith("sdist") or not self.online:
+                    return ExecResult(1, f"No matching distribution for {package}")
+                if command[1] == "download":
+                    with open(wheel, "wb") as f:
+                        f.write(b"x" * 10)
+            wheels.append(f"Processing /pip-cache/wheels/{os.path.basename(wheel)}")
+        return ExecResult(0, "\n".join(wheels))
+
+
+class FakeClient:
+    """Runs commands in containers like docker would, records what is committed."""
+
+    def __init__(self, exit_code=0):
+        self.exit_code = exit_code
+        self.started = []
+        self.images = self
+        self.containers = self
+
+    def run(self, image, command, detach, volumes):
+        container = MagicMock()
+        container.wait.return_value = {"StatusCode": self.exit_code}
+        container.logs.return_value = b"Saved"
+        self.started.append((image, command, volumes, container))
+        return container
+
+    def get(self, image):
+        return MagicMock(attrs={"Config": {"Cmd": ["python3"]}})
+
+
+@pytest.fixture
+def cache(tmp_path):
+    cache = PipCache(str(tmp_path / "cache"), max_bytes=1000, max_age=3600)
+    cache.volumes()
+    return cache
+
+
+def test_package_set_key():
+    assert normalize_packages(["Numpy", " pandas ", "numpy", ""]) == [
+        "numpy",
+        "pandas",
+    ]
+    assert package_set_key(["pandas", "numpy"]) == package_set_key(["NumPy", "pandas"])
+    assert package_set_key(["numpy"]) != package_set_key(["numpy==1.26"])
+    with pytest.raises(ValueError):
+        normalize_packages(["--index-url=http://example.com"])
+
+
+def test_install_from_cache_offline(cache):
+    container, filler = FakeContainer(cache, online=False), FakeContainer(cache)
+    assert cache.install(container, ["numpy"], filler)[::2] == (True, False)
+    # the sandbox only installs, the filler downloads the wheels into the cache
+    assert [command[1] for command in container.commands] == ["install", "install"]
+    assert [command[1] for command in filler.commands] == ["download"]
+    assert "--only-binary" in filler_command(cache)
+
+    # the second install doesn't need the network
+    container, filler = FakeContainer(cache, online=False), FakeContainer(cache)
+    assert cache.install(container, ["numpy"], filler)[::2] == (True, True)
+    assert [command[1] for command in container.commands] == ["install"]
+    assert filler.commands == []
+
+    filler = FakeContainer(cache, online=False)
+    success, output, _ = cache.install(container, ["pandas"], filler)
+    assert not success and "pandas" in output
+
+
+def filler_command(cache):
+    filler = MagicMock()
+    filler.exec_run.return_value = ExecResult(1, "")
+    cache.install(FakeContainer(cache, online=False), ["scipy"], filler)
+    return filler.exec_run.call_args[0][0]
+
+
+def test_packages_without_wheels_are_built_in_the_sandbox(cache):
+    container, filler = FakeContainer(cache), FakeContainer(cache)
+    assert cache.install(container, ["sdistpkg"], filler)[::2] == (True, False)
+    assert [command[1] for command in container.commands] == ["install", "install"]
+    assert os.listdir(cache.wheel_dir) == []
+
+
+def test_sandboxes_mount_the_cache_read_only(cache):
+    assert [volume["mode"] for volume in cache.volumes().values()] == ["ro"]
+    client = FakeClient()
+    cache.filler(client).exec_run(["pip", "download", "numpy"])
+    image, _, volumes, container = client.started[0]
+    assert image == cache.base_image
+    assert [volume["mode"] for volume in volumes.values()] == ["rw"]
+    container.remove.assert_called_once_with(force=True)
+
+
+def test_derived_image_from_a_clean_container(cache):
+    cache.derived_images = True
+    client = FakeClient()
+    tag = cache.build_derived_image(client, ["pandas", "numpy"])
+    assert tag.endswith(package_set_key(["numpy", "pandas"]))
+    image, command, volumes, container = client.started[0]
+    assert image == cache.base_image and command[-2:] == ["numpy", "pandas"]
+    assert [volume["mode"] for volume in volumes.values()] == ["ro"]
+    # committed after pip exited, with the command of the base image
+    container.wait.assert_called_once()
+    assert container.commit.call_args.kwargs["conf"]["Cmd"] == ["python3"]
+    container.remove.assert_called_once_with(force=True)
+
+    client = FakeClient(exit_code=1)
+    assert cache.build_derived_image(client, ["numpy"]) is None
+    client.started[0][3].commit.assert_not_called()
+
+
+def test_evict_by_age_and_size(cache):
+    old = time.time() - 7200
+    for name, mtime in [("old", old), ("a", old + 3700), ("b", None), ("c", None)]:
+        path = os.path.join(cache.wheel_dir, f"{name}.whl")
+        with open(path, "wb") as f:
+            f.write(b"x" * 400)
+        if mtime:
+            os.utime(path, (mtime, mtime))
+
+    # old is too old, then a is the oldest of the three that don't fit
+    assert cache.evict() == 2
+    assert sorted(os.listdir(cache.wheel_dir)) == ["b.whl", "c.whl"]
+    assert cache.evict() == 0
@@ -0,0 +1,96 @@
+import asyncio
+import threading
+import time
+
+import utils  # noqa: F401 (run_python_code and utils import each other)
+import run_python_code
+from run_python_code import OutputBuffer, stream_exec
+
+
+class FakeAPI:
+    def __init__(self, chunks, exit_code=0, delay=0.0):
+        self.chunks = chunks
+        self.exit_code = exit_code
+        self.delay = delay
+        self.killed = threading.Event()
+
+    def exec_create(self, container_id, command):
+        return {"Id": "exec"}
+
+    def exec_start(self, exec_id, stream=False):
+        for chunk in self.chunks:
+            if self.killed.wait(self.delay):
+                return
+            yield chunk
+
+    def exec_inspect(self, exec_id):
+        return {"ExitCode": self.exit_code}
+
+
+class FakeContainer:
+    id = "container"
+
+    def __init__(self, api):
+        self.client = type("Client", (), {"api": api})()
+
+    def kill(self):
+        self.client.api.killed.set()
+
+
+def test_output_buffer_keeps_tail_and_cap():
+    buffer = OutputBuffer(max_bytes=10, tail_chars=4)
+    assert buffer.write(b"abcdef") == "abcdef"
+    assert buffer.write(b"ghijkl") == "ghij"
+    assert buffer.full and buffer.write(b"more") == ""
+    assert buffer.tail() == "[... 6 characters of output omitted ...]\nghij"
+
+    # multi byte characters split over chunks
+    buffer = OutputBuffer(max_bytes=100, tail_chars=100)
+    data = "héllo".encode("utf-8")
+    assert buffer.write(data[:2]) + buffer.write(data[2:]) == "héllo"
+
+
+def test_stream_exec_forwards_output():
+    output = []
+    api = FakeAPI([b"1\n", b"2\n"], exit_code=3)
+    result = stream_exec(FakeContainer(api), ["python3"], OutputBuffer(), output.append)
+    assert result == (3, "ok")
+    assert output == ["1\n", "2\n"]
+
+
+def test_stream_exec_stops_at_output_limit():
+    api = FakeAPI([b"x" * 8] * 100)
+    buffer = OutputBuffer(max_bytes=20, tail_chars=100)
+    assert stream_exec(FakeContainer(api), ["python3"], buffer) == (
+        run_python_code.KILLED_EXIT_CODE,
+        "output_limit",
+    )
+    assert api.killed.is_set() and buffer.size == 20
+
+
+def test_stream_exec_timeout_kills():
+    api = FakeAPI([b"tick\n"] * 100, delay=0.05)
+    started = time.perf_counter()
+    result = stream_exec(FakeContainer(api), ["python3"], OutputBuffer(), timeout=0.2)
+    assert result == (run_python_code.KILLED_EXIT_CODE, "timeout")
+    assert time.perf_counter() - started < 1
+
+
+def test_run_python_code_streams_to_callback(monkeypatch):
+    def fake_run(content, pip_packages, previous_content, username, on_output=None):
+        for part in ["a", "b", "c"]:
+            on_output(part)
+            time.sleep(0.01)
+        return {"output": "abc"}
+
+    monkeypatch.setattr(run_python_code, "sync_run_python_code", fake_run)
+    received = []
+
+    async def on_output(text):
+        received.append(text)
+
+    result = asyncio.run(
+        run_python_code.run_python_code("print()", [], on_output=on_output)
+    )
+    assert result == {"output": "abc"}
+    assert "".join(received) == "abc"
@@ -0,0 +1,152 @@
+import asyncio
+import threading
+
+import httpx
+import pytest
+from fastapi import FastAPI
+from sqlalchemy import event
+
+import routes
+from chat_tabs.dao import ChatTabsDAO
+from configuration_page.middleware import LoginRequiredCheckMiddleware
+from memory import MemoryManager
+from session_cache import session_cache
+from user_management.dao import UsersDAO
+from user_management.session import async_session_factory, session_factory
+
+
+def memory(id, chat_id, distance=0.5):
+    return {
+        "id": id,
+        "document": f"memory {id}",
+        "metadata": {"created_at": 1700000000 + id, "chat_id": chat_id},
+        "distance": distance,
+    }
+
+
+@pytest.fixture
+def search(tmp_path, monkeypatch):
+    monkeypatch.setenv("NEW_DATABASE_URL", f"sqlite:///{tmp_path / 'search.db'}")
+    session_factory.get_refreshed()
+    async_session_factory.get_refreshed()
+    session_cache.invalidate()
+    with UsersDAO() as users:
+        users.create_all_tables()
+        user_id = users.add_user("alice", "password", "token", "Alice")
+    with ChatTabsDAO() as tabs:
+        tabs.insert_tab_data(user_id, "1", "Recipes", "1", True)
+        tabs.insert_tab_data(user_id, "2", "Travel", "2", False)
+
+    calls = {"embedded": [], "searched": [], "verbose": False}
+    episodic_started = threading.Event()
+
+    async def load_settings(users_dir, username):
+        return {
+            "active_model": {"active_model": "gpt-4o"},
+            "verbose": {"verbose": calls["verbose"]},
+        }
+
+    def embed_query(text):
+        calls["embedded"].append(text)
+        return [0.1, 0.2]
+
+    def search_memory(category, text, query_embedding=None, **kwargs):
+        calls["searched"].append((text, query_embedding))
+        if text == "tortilla":
+            # the episodic lookup runs while the first search waits
+            calls["concurrent"] = episodic_started.wait(2)
+            return [memory(i, str(i % 2 + 1)) for i in range(1, 21)]
+        return [memory(100, "2")]
+
+    async def get_episodic_memory(self, *args, query_embedding=None, **kwargs):
+        episodic_started.set()
+        calls["episodic_embedding"] = query_embedding
+        return []
+
+    async def query_rewrite(query, username, user_dir, memories):
+        return "tortilla recipes"
+
+    monkeypatch.setattr(routes.SettingsManager, "load_settings", load_settings)
+    monkeypatch.setattr(routes, "embed_query", embed_query)
+    monkeypatch.setattr(routes, "search_memory", search_memory)
+    monkeypatch.setattr(MemoryManager, "get_episodic_memory", get_episodic_memory)
+    monkeypatch.setattr(routes, "queryRewrite", query_rewrite)
+
+    app = FastAPI()
+    app.include_router(routes.router)
+    app.add_middleware(LoginRequiredCheckMiddleware)
+
+    def post():
+        async def send():
+            try:
+                async with httpx.AsyncClient(
+                    transport=httpx.ASGITransport(app=app),
+                    base_url="http://testserver",
+                    cookies={"username": "alice", "session_token": "token"},
+                ) as client:
+                    return await client.post(
+                        "/search_chats/",
+                        data={
+                            "category": "active_brain",
+                            "search_query": "tortilla",
+                            "sort_by": "distance",
+                            "sort_order": "asc",
+                        },
+                    )
+            finally:
+                # the connections belong to the event loop of this request
+                await async_session_factory.dispose()
+
+        episodic_started.clear()
+        return asyncio.run(send())
+
+    yield post, calls
+    session_factory.engine.dispose()
+    session_factory.engine = None
+
+
+def test_titles_are_fetched_in_one_query(search):
+    post, calls = search
+    statements = []
+
+    def count(conn, cursor, statement, *args):
+        if "chat_tabs" in statement:
+            statements.append(statement)
+
+    async_session_factory.get_refreshed()
+    engine = async_session_factory.engine.sync_engine
+    event.listen(engine, "before_cursor_execute", count)
+    response = post()
+    event.remove(engine, "before_cursor_execute", count)
+
+    assert response.status_code == 200
+    memories = response.json()["memories"]
+    assert len(memories) == 20
+    assert {m["chat_title"] for m in memories} == {"Recipes", "Travel"}
+    assert len(statements) == 1 and " IN " in statements[0]
+
+
+def test_pipeline(search):
+    post, calls = search
+    content = post().json()
+    # the episodic lookup ran concurrently with the first search
+    assert calls["concurrent"]
+    # the query is embedded once for the search and the episodic lookup
+    assert calls["embedded"] == ["tortilla"]
+    assert calls["searched"][0] == ("tortilla", [0.1, 0.2])
+    assert calls["episodic_embedding"] == [0.1, 0.2]
+    assert content["rewritten"] == "tortilla recipes"
+    assert [m["id"] for m in content["rewritten_memories"]] == [100]
+    assert "timings" not in content
+
+    calls["verbose"] = True
+    timings = post().json()["timings"]
+    assert set(timings) == {
+        "embedding",
+        "search",
+        "episodic",
+        "rewrite",
+        "titles",
+        "rewritten_search",
+        "total",
+    }
@@ -0,0 +1,141 @@
+import asyncio
+import json
+from unittest.mock import MagicMock
+
+import httpx
+import pytest
+from fastapi import FastAPI, Request
+from sqlalchemy import event
+
+from admin_controls_cache import AdminControlsCache
+from config import ADMIN_REQUIRED, LOGIN_REQUIRED
+from configuration_page.middleware import LoginRequiredCheckMiddleware
+from session_cache import notify_sessions_changed, session_cache
+from user_management.dao import UsersDAO
+from user_management.session import session_factory
+
+
+@pytest.fixture
+def users(tmp_path, monkeypatch):
+    monkeypatch.setenv("NEW_DATABASE_URL", f"sqlite:///{tmp_path / 'users.db'}")
+    session_factory.get_refreshed()
+    session_cache.invalidate()
+    dao = UsersDAO()
+    dao.create_all_tables()
+    dao.add_user("alice", "password", "token", "Alice")
+    yield dao
+    dao.close_session()
+    session_factory.engine.dispose()
+    session_factory.engine = None
+
+
+@pytest.fixture
+def queries(users):
+    statements = []
+
+    def count(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(session_factory.engine, "before_cursor_execute", count)
+    yield statements
+    event.remove(session_factory.engine, "before_cursor_execute", count)
+
+
+@pytest.fixture
+def client(users):
+    app = FastAPI()
+
+    @app.get("/me", tags=[LOGIN_REQUIRED])
+    async def me(request: Request):
+        return {"username": request.state.user.username}
+
+    @app.get("/admin", tags=[LOGIN_REQUIRED, ADMIN_REQUIRED])
+    async def admin(request: Request):
+        return {}
+
+    @app.get("/{file_path:path}")
+    async def read_file(file_path: str):
+        return {"file": file_path}
+
+    app.add_middleware(LoginRequiredCheckMiddleware)
+    return Client(app)
+
+
+class Client:
+    """Sends requests straight to the ASGI app, with the cookies of alice."""
+
+    def __init__(self, app):
+        self.app = app
+        self.cookies = {"username": "alice", "session_token": "token"}
+
+    def get(self, path):
+        async def send():
+            async with httpx.AsyncClient(
+                transport=httpx.ASGITransport(app=self.app),
+                base_url="http://testserver",
+                cookies=self.cookies,
+            ) as client:
+                return await client.get(path)
+
+        return asyncio.run(send())
+
+
+def test_warm_request_does_not_query_the_database(client, queries):
+    assert client.get("/me").json() == {"username": "alice"}
+    assert len(queries) == 1
+    queries.clear()
+    assert client.get("/me").json() == {"username": "alice"}
+    assert queries == []
+
+
+def test_invalid_token_is_rejected(client):
+    client.cookies["session_token"] = "wrong"
+    assert client.get("/me").status_code == 401
+
+
+def test_logout_and_new_token_invalidate_the_session(client, users):
+    assert client.get("/me").status_code == 200
+    users.validate_and_clear_session_token("alice")
+    assert client.get("/me").status_code == 401
+
+    users.update_session_token("alice", "new-token")
+    client.cookies["session_token"] = "new-token"
+    assert client.get("/me").status_code == 200
+
+
+def test_role_change_invalidates_the_session(client, users):
+    assert client.get("/admin").status_code == 403
+    users.update_user(users.get_user_id("alice"), True, "admin")
+    assert client.get("/admin").status_code == 200
+
+
+def test_public_paths_skip_authentication(client, queries):
+    client.cookies["session_token"] = "wrong"
+    assert client.get("/static/chatbot.js").json() == {"file": "static/chatbot.js"}
+    assert client.get("/favicon.ico").status_code == 200
+    assert queries == []
+
+
+def test_other_workers_are_notified(users, queries):
+    notify_sessions_changed(users.session, username="alice")
+    assert queries == []
+
+    session = MagicMock()
+    session.get_bind.return_value.dialect.name = "postgresql"
+    notify_sessions_changed(session, user_id=3)
+    statement, params = session.execute.call_args[0]
+    assert "pg_notify" in str(statement)
+    assert params["channel"] == "user_sessions"
+    assert json.loads(params["payload"]) == {"username": None, "user_id": 3}
+
+
+def test_notified_invalidation(users):
+    users.add_user("bob", "password", "bob-token", "Bob")
+    assert session_cache.get("alice", "token") is not None
+    assert session_cache.get("bob", "bob-token") is not None
+
+    # what the listener does when another worker logged alice out
+    AdminControlsCache._sessions_changed('{"username": "alice", "user_id": null}')
+    assert [key[0] for key in session_cache._entries] == ["bob"]
+    AdminControlsCache._sessions_changed("not json")
+    assert session_cache._entries == {}
@@ -0,0 +1,65 @@
+import json
+import os
+
+import pytest
+
+from settings_cache import SettingsCache, SettingsSnapshot
+
+
+def test_snapshot_is_read_only():
+    snapshot = SettingsSnapshot({"memory": {"output": 100}, "list": [1, {"a": 2}]})
+    with pytest.raises(TypeError):
+        snapshot["memory"] = {}
+    with pytest.raises(TypeError):
+        snapshot["memory"]["output"] = 5
+    with pytest.raises(TypeError):
+        snapshot["list"][1]["a"] = 3
+    assert json.loads(json.dumps(snapshot)) == snapshot.to_dict()
+
+    copy = snapshot.to_dict()
+    copy["memory"]["output"] = 5
+    assert snapshot["memory"]["output"] == 100
+
+
+def test_served_from_memory_until_the_file_changes(tmp_path):
+    path = str(tmp_path / "settings.json")
+    cache = SettingsCache(revalidate_interval=0)
+    assert cache.get(path) is None
+
+    cache.put(path, {"language": {"language": "en"}})
+    with open(path) as f:
+        assert json.load(f) == {"language": {"language": "en"}}
+    assert cache.get(path)["language"]["language"] == "en"
+
+    with open(path, "w") as f:
+        json.dump({"language": {"language": "nl", "extra": True}}, f)
+    assert cache.get(path) is None
+
+
+def test_no_stat_within_the_revalidate_interval(tmp_path, monkeypatch):
+    path = str(tmp_path / "settings.json")
+    cache = SettingsCache(revalidate_interval=60)
+    cache.put(path, {"a": {"b": 1}})
+
+    def fail(*args, **kwargs):
+        raise AssertionError("settings were read from disk")
+
+    monkeypatch.setattr(os, "stat", fail)
+    monkeypatch.setattr("builtins.open", fail)
+    assert cache.get(path)["a"]["b"] == 1
+
+
+def test_only_written_when_changed(tmp_path):
+    path = str(tmp_path / "settings.json")
+    cache = SettingsCache(revalidate_interval=0)
+    cache.put(path, {"a": {"b": 1}})
+    mtime = os.stat(path).st_mtime_ns
+    os.utime(path, ns=(mtime - 10**9, mtime - 10**9))
+    mtime = os.stat(path).st_mtime_ns
+
+    cache.put(path, {"a": {"b": 1}})
+    assert os.stat(path).st_mtime_ns == mtime
+
+    cache.put(path, {"a": {"b": 2}})
+    assert os.stat(path).st_mtime_ns != mtime
+    assert [name for name in os.listdir(tmp_path)] == ["settings.json"]
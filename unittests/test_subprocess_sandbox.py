@@ -0,0 +1,147 @@
+import os
+import time
+
+import pytest
+
+import utils  # noqa: F401 (run_python_code and utils import each other)
+from pip_cache import pip_cache
+from run_python_code import OutputBuffer
+from subprocess_sandbox import (
+    ExecResult,
+    SubprocessSandbox,
+    get_packages_dir,
+    map_data_paths,
+)
+
+
+@pytest.fixture
+def sandbox(tmp_path, monkeypatch):
+    monkeypatch.setenv("CHARLIE_MNEMONIC_USER_DIR", str(tmp_path))
+    sandbox = SubprocessSandbox(workers=1, memory_mb=512, max_processes=0)
+    sandbox.start()
+    yield sandbox
+    sandbox.shutdown()
+
+
+def test_map_data_paths():
+    code = "open('/data/a.txt'); open(\"/data\"); x = '/database'"
+    assert map_data_paths(code, "/home/u/data") == (
+        "open('/home/u/data/a.txt'); open(\"/home/u/data\"); x = '/database'"
+    )
+
+
+def test_runs_in_data_dir(sandbox, tmp_path):
+    output = []
+    code = "import os\nprint(os.getcwd())\nopen('/data/out.txt', 'w').write('hi')"
+    exit_code, status, _ = sandbox.run("bob", code, OutputBuffer(), output.append)
+    data_dir = str(tmp_path / "bob" / "data")
+    assert (exit_code, status) == (0, "ok")
+    assert "".join(output).strip() == data_dir
+    assert open(os.path.join(data_dir, "out.txt")).read() == "hi"
+
+    # the environment of the app isn't passed on
+    buffer = OutputBuffer()
+    sandbox.run("bob", "import os; print(sorted(os.environ))", buffer)
+    assert "CHARLIE_MNEMONIC_USER_DIR" not in buffer.tail()
+
+
+def test_errors_and_limits(sandbox):
+    buffer = OutputBuffer()
+    assert sandbox.run("bob", "raise ValueError('boom')", buffer)[0] == 1
+    assert "ValueError: boom" in buffer.tail()
+
+    buffer = OutputBuffer()
+    exit_code, _, _ = sandbox.run("bob", "x = bytearray(2 * 1024 ** 3)", buffer)
+    assert exit_code == 1 and "MemoryError" in buffer.tail()
+
+    started = time.perf_counter()
+    exit_code, status, _ = sandbox.run(
+        "bob", "while True: pass", OutputBuffer(), timeout=0.5
+    )
+    assert (exit_code, status) == (137, "timeout")
+    assert time.perf_counter() - started < 5
+
+    buffer = OutputBuffer(max_bytes=1000)
+    status = sandbox.run("bob", "while True: print('x' * 100)", buffer)[1]
+    assert status == "output_limit" and buffer.size == 1000
+
+
+def test_prestarted_worker_startup(sandbox):
+    deadline = time.monotonic() + 5
+    while sandbox._idle.qsize() < 1 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    prestarted = sandbox._idle.queue[0]
+    buffer = OutputBuffer()
+    exit_code, _, _ = sandbox.run("bob", "import os; print(os.getpid())", buffer)
+    # the code ran in the worker that was started ahead of time
+    assert exit_code == 0 and buffer.tail().strip() == str(prestarted.pid)
+
+
+def test_pip_runs_in_a_worker(sandbox, tmp_path, monkeypatch):
+    jobs = []
+    run_job = sandbox.run_job
+
+    def record(job, *args, **kwargs):
+        jobs.append(job)
+        return run_job(job, *args, **kwargs)
+
+    monkeypatch.setattr(sandbox, "run_job", record)
+    result = sandbox.pip(["pip", "--version"], str(tmp_path / "bob"))
+    assert result.exit_code == 0 and b"pip" in result.output
+    assert jobs[0]["argv"] == ["pip", "--version"]
+    assert jobs[0]["packages_dir"] is None
+    assert "RLIMIT_AS" in jobs[0]["limits"]
+
+
+def test_users_pip_reads_the_wheel_cache(sandbox, tmp_path, monkeypatch):
+    monkeypatch.setattr(pip_cache, "cache_dir", str(tmp_path / ".pip_cache"))
+    commands = []
+
+    def pip(command, cwd, binds=()):
+        commands.append((command[1], cwd, list(binds)))
+        return ExecResult(0, b"")
+
+    monkeypatch.setattr(sandbox, "pip", pip)
+    assert sandbox.install("bob", ["requests"])[0]
+    wheel_dir = os.path.abspath(pip_cache.wheel_dir)
+    packages_dir = os.path.abspath(get_packages_dir("bob"))
+    assert commands == [("install", packages_dir, [(wheel_dir, False)])]
+
+
+def test_code_only_sees_its_directories(sandbox, tmp_path):
+    (tmp_path / "user.env").write_text("OPENAI_API_KEY=secret")
+    (tmp_path / "alice" / "data").mkdir(parents=True)
+    (tmp_path / "alice" / "data" / "notes.txt").write_text("private")
+    code = "\n".join(
+        f"print(os.path.exists({path!r}))"
+        for path in [
+            str(tmp_path / "user.env"),
+            str(tmp_path / "alice" / "data" / "notes.txt"),
+            os.path.abspath(pip_cache.cache_dir),
+            os.getcwd(),
+            "/proc/self/environ",
+        ]
+    )
+    buffer = OutputBuffer()
+    exit_code, _, _ = sandbox.run("bob", "import os\n" + code, buffer)
+    assert exit_code == 0
+    assert buffer.tail().split() == ["False"] * 5
+
+    # the system directories are read-only
+    buffer = OutputBuffer()
+    exit_code, _, _ = sandbox.run("bob", "open('/usr/x', 'w')", buffer)
+    assert exit_code == 1 and "Read-only file system" in buffer.tail()
+
+
+def test_refused_without_isolation(sandbox, tmp_path, monkeypatch):
+    # the new root can't be mounted on a missing directory
+    monkeypatch.setattr(sandbox, "_root_dir", str(tmp_path / "missing"))
+    monkeypatch.delenv("SINGLE_USER", raising=False)
+    buffer = OutputBuffer()
+    exit_code, _, _ = sandbox.run("bob", "print('ran')", buffer)
+    assert exit_code == 126 and "SINGLE_USER=true" in buffer.tail()
+
+    monkeypatch.setenv("SINGLE_USER", "true")
+    buffer = OutputBuffer()
+    exit_code, _, _ = sandbox.run("bob", "print('ran')", buffer)
+    assert exit_code == 0 and buffer.tail().strip() == "ran"
@@ -0,0 +1,49 @@
+from token_budget import TokenBudgetPacker
+
+
+def count_words(text):
+    return len(text.split())
+
+
+def test_pack_by_priority_keeps_output_order():
+    calls = []
+
+    def counter(text):
+        calls.append(text)
+        return count_words(text)
+
+    packer = TokenBudgetPacker(counter, separator=" ")
+    items = ["a b c", "d", "e f", "g h i j"]
+    packed, token_count, selected = packer.pack(items, 5, priority=[3, 0, 1, 2])
+    # d and e f are packed first, g h i j and a b c no longer fit
+    assert selected == [1, 2]
+    assert packed == "d e f"
+    assert token_count == 3
+
+    # the item counts are cached, only the packed strings are counted again
+    calls.clear()
+    packer.pack(items, 5, priority=[3, 0, 1, 2])
+    assert calls == ["d e f"]
+
+
+def test_pack_contiguous_recent_messages():
+    packer = TokenBudgetPacker(count_words, separator=" ")
+    items = ["old message here", "a", "long message in the middle", "b", "c"]
+    priority = [-i for i in range(len(items))]
+    packed, token_count, selected = packer.pack(
+        items, 5, priority=priority, contiguous=True
+    )
+    assert selected == [3, 4]
+    assert packed == "b c"
+    assert token_count == 2
+
+
+def test_pack_truncates_a_single_item():
+    packer = TokenBudgetPacker(count_words, separator=" ")
+    packed, token_count, selected = packer.pack(["one two three four"], 2)
+    assert packed.split() == ["one", "two"]
+    assert token_count == 2
+    assert selected == [0]
+
+    assert packer.pack(["one two three"], 2, truncate=False) == ("", 0, [])
+    assert packer.pack([], 10) == ("", 0, [])
@@ -0,0 +1,75 @@
+import pytest
+
+import tokenizer
+
+
+def test_model_family():
+    assert tokenizer.model_family("gpt-4") == "cl100k_base"
+    assert tokenizer.model_family("gpt-4o-mini") == "o200k_base"
+    assert tokenizer.model_family("claude-3-opus-20240229") == "anthropic"
+    assert tokenizer.model_family(None) == "cl100k_base"
+
+
+class WordEncoding:
+    def encode(self, text, disallowed_special=()):
+        return text.split()
+
+
+@pytest.fixture
+def encoding(monkeypatch):
+    # the real encodings may have to be downloaded
+    monkeypatch.setattr(tokenizer, "get_encoding", lambda family: WordEncoding())
+    tokenizer._count_encoded.cache_clear()
+    tokenizer._function_tokens.clear()
+    yield
+    tokenizer._count_encoded.cache_clear()
+    tokenizer._function_tokens.clear()
+
+
+def test_count_tokens_is_cached_per_family(encoding):
+    text = "The quick brown fox jumps over the lazy dog."
+    gpt_tokens = tokenizer.count_tokens(text, "gpt-4")
+    assert gpt_tokens > 0
+    assert tokenizer.count_tokens(text, "gpt-4-turbo") == gpt_tokens
+    assert tokenizer._count_encoded.cache_info().hits == 1
+    # claude is estimated from cl100k_base with a ratio, so it never counts less
+    assert tokenizer.count_tokens(text, "claude-3-opus-20240229") >= gpt_tokens
+    assert tokenizer.count_tokens("", "gpt-4") == 0
+
+
+def test_count_function_tokens_is_memoized(encoding, monkeypatch):
+    functions = [
+        {
+            "type": "function",
+            "function": {
+                "name": "visit_website",
+                "description": "Visit a website",
+                "parameters": {
+                    "type": "object",
+                    "properties": {
+                        "urls": {"type": "array", "description": "The urls"},
+                    },
+                },
+            },
+        }
+    ]
+    first = tokenizer.count_function_tokens(functions, "gpt-4")
+
+    def fail(*args):
+        raise AssertionError("the function tokens should be memoized")
+
+    monkeypatch.setattr(tokenizer, "_count_function_tokens", fail)
+    assert tokenizer.count_function_tokens(functions, "gpt-4") == first
+
+
+def test_estimates_are_not_cached(monkeypatch):
+    monkeypatch.setattr(tokenizer, "get_encoding", lambda family: None)
+    tokenizer._count_encoded.cache_clear()
+    text = "eight characters"
+    assert tokenizer.count_tokens(text, "gpt-4") == 4
+    assert tokenizer.count_tokens(text, "claude-3-opus-20240229") == 5
+
+    # the encoding can be loaded again, the count is exact
+    monkeypatch.setattr(tokenizer, "get_encoding", lambda family: WordEncoding())
+    assert tokenizer.count_tokens(text, "gpt-4") == 2
+    tokenizer._count_encoded.cache_clear()
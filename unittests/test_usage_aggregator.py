@@ -0,0 +1,187 @@
+import datetime
+
+import psycopg2
+import pytest
+
+import routes
+from database import Database
+from usage_aggregator import UsageAggregator
+
+
+class FakeConnection:
+    def __init__(self):
+        self.rollbacks = 0
+
+    def rollback(self):
+        self.rollbacks += 1
+
+
+class FakeDatabase:
+    """Keeps the totals in memory and records the apply_usage calls."""
+
+    totals = {}
+    calls = []
+    reads = 0
+    refreshes = 0
+    fail_for = set()
+
+    def __init__(self):
+        self.conn = FakeConnection()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def get_usage_totals(self, username, day):
+        FakeDatabase.reads += 1
+        return dict(
+            FakeDatabase.totals.get(
+                username,
+                {
+                    "total_tokens_used": 0,
+                    "prompt_tokens": 0,
+                    "completion_tokens": 0,
+                    "daily_spending_count": 0,
+                },
+            )
+        )
+
+    def refresh_statistics_rollup(self):
+        FakeDatabase.refreshes += 1
+
+    def apply_usage(self, username, day, statistics, daily, roles=None):
+        if username in FakeDatabase.fail_for:
+            raise psycopg2.OperationalError("connection lost")
+        FakeDatabase.calls.append((username, day, statistics, daily, roles))
+        totals = self.get_usage_totals(username, day)
+        for column in ("total_tokens_used", "prompt_tokens", "completion_tokens"):
+            totals[column] += statistics.get(column, 0)
+        totals["daily_spending_count"] += daily.get("spending_count", 0)
+        FakeDatabase.totals[username] = totals
+        return totals
+
+
+@pytest.fixture
+def aggregator():
+    FakeDatabase.totals = {}
+    FakeDatabase.calls = []
+    FakeDatabase.reads = 0
+    FakeDatabase.refreshes = 0
+    FakeDatabase.fail_for = set()
+    return UsageAggregator(
+        flush_interval=60, flush_events=1000, cache_ttl=60, database=FakeDatabase
+    )
+
+
+def add_call(aggregator, username="alice", role="chat", cost=0.5):
+    return aggregator.add_llm_usage(
+        username,
+        role,
+        "gpt-4",
+        prompt_tokens=100,
+        completion_tokens=20,
+        spending_count=cost,
+        response_time=1.5,
+    )
+
+
+def test_totals_include_pending_usage(aggregator):
+    add_call(aggregator)
+    totals = add_call(aggregator)
+    assert FakeDatabase.calls == []
+    assert totals["total_tokens_used"] == 240
+    assert totals["prompt_tokens"] == 200
+    assert totals["completion_tokens"] == 40
+    assert aggregator.get_daily_cost("alice") == pytest.approx(1.0)
+    # the totals from the database are cached
+    assert FakeDatabase.reads == 1
+
+
+def test_flush_writes_one_batch_per_user_and_day(aggregator):
+    add_call(aggregator, role="chat")
+    add_call(aggregator, role="chat")
+    add_call(aggregator, role="memory")
+    add_call(aggregator, username="bob")
+    aggregator.add_message("alice")
+
+    assert aggregator.flush() == 2
+    calls = {call[0]: call for call in FakeDatabase.calls}
+    assert len(FakeDatabase.calls) == 2
+    _, day, statistics, daily, roles = calls["alice"]
+    assert day == datetime.datetime.now().date()
+    assert statistics["total_tokens_used"] == 360
+    assert statistics["amount_of_messages"] == 1
+    assert daily["message_amount"] == 1
+    assert daily["spending_count"] == pytest.approx(1.5)
+    assert roles[("chat", "gpt-4")][0] == 2
+    assert roles[("memory", "gpt-4")][0] == 1
+
+    # nothing is counted twice after the flush
+    assert aggregator.get_totals("alice")["total_tokens_used"] == 360
+    assert aggregator.flush() == 0
+
+
+def test_flush_after_enough_events(aggregator, monkeypatch):
+    flushed = []
+    monkeypatch.setattr(aggregator, "flush_in_background", lambda: flushed.append(1))
+    aggregator.flush_events = 3
+    add_call(aggregator)
+    add_call(aggregator)
+    assert flushed == []
+    add_call(aggregator)
+    assert flushed == [1]
+
+
+def test_failed_writes_are_kept(aggregator):
+    FakeDatabase.fail_for = {"alice"}
+    add_call(aggregator)
+    add_call(aggregator, username="bob")
+    assert aggregator.flush() == 1
+    assert [call[0] for call in FakeDatabase.calls] == ["bob"]
+    assert aggregator.get_totals("alice")["total_tokens_used"] == 120
+
+    FakeDatabase.fail_for = set()
+    assert aggregator.flush() == 1
+    assert FakeDatabase.totals["alice"]["total_tokens_used"] == 120
+    assert aggregator.get_totals("alice")["total_tokens_used"] == 120
+
+
+def test_shutdown_flushes_pending_usage(aggregator):
+    aggregator.start()
+    add_call(aggregator)
+    aggregator.shutdown()
+    assert len(FakeDatabase.calls) == 1
+
+
+def test_rollup_is_refreshed_once_per_interval(aggregator):
+    aggregator.rollup_interval = 60
+    assert aggregator.refresh_rollup() is True
+    assert aggregator.refresh_rollup() is False
+    assert FakeDatabase.refreshes == 1
+    aggregator.rollup_interval = 0
+    assert aggregator.refresh_rollup() is True
+    assert FakeDatabase.refreshes == 2
+
+
+def test_daily_stats_page(monkeypatch):
+    calls = []
+
+    class StatsDatabase(FakeDatabase):
+        get_statistics_range = staticmethod(Database.get_statistics_range)
+
+        def get_user_statistics(self, user_id, start, end, page, items_per_page):
+            calls.append((user_id, start, end, page, items_per_page))
+            return '[{"day": "2024-03-31"}]'
+
+        def get_user_statistics_count(self, user_id, start, end):
+            return 62
+
+    monkeypatch.setattr(routes, "Database", StatsDatabase)
+    end = datetime.date(2024, 3, 31)
+    stats = routes.get_daily_stats_page(7, None, end, 0, 31)
+    assert stats["rows"] == [{"day": "2024-03-31"}]
+    assert (stats["page"], stats["total_pages"]) == (1, 2)
+    assert calls == [(7, stats["start"], end, 1, 31)]
+    assert stats["start"] < end
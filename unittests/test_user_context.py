@@ -0,0 +1,86 @@
+import os
+
+import pytest
+from sqlalchemy import event
+
+from chat_tabs.dao import ChatTabsDAO
+from user_context import UserContextCache, user_context_cache
+from user_management.dao import AdminControlsDAO, UsersDAO
+from user_management.session import session_factory
+
+
+@pytest.fixture
+def users(monkeypatch):
+    monkeypatch.setenv("NEW_DATABASE_URL", "sqlite:///:memory:")
+    session_factory.get_refreshed()
+    dao = UsersDAO()
+    dao.create_all_tables()
+    user_id = dao.add_user("alice", "password", "token", "Alice")
+    dao.update_user(user_id, True, "user")
+    yield dao
+    dao.drop_all_tables()
+    dao.close_session()
+    session_factory.engine = None
+
+
+@pytest.fixture
+def queries(users):
+    statements = []
+
+    def count(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(session_factory.engine, "before_cursor_execute", count)
+    yield statements
+    event.remove(session_factory.engine, "before_cursor_execute", count)
+
+
+def test_context_is_loaded_in_one_query(users, queries):
+    user_id = users.get_user_id("alice")
+    with ChatTabsDAO() as tabs:
+        tabs.insert_tab_data(user_id, "1", "first", "1", False)
+        tabs.insert_tab_data(user_id, "2", "second", "2", True)
+    queries.clear()
+
+    context = UserContextCache(ttl=60).get("alice")
+    assert len([q for q in queries if q.lstrip().startswith("SELECT")]) == 1
+    assert context.user_id == user_id
+    assert context.display_name == "Alice"
+    assert context.allowed
+    assert context.daily_limit == 20
+    assert [tab.chat_id for tab in context.tabs] == ["1", "2"]
+    assert context.active_tab.chat_id == "2"
+
+
+def test_user_without_tabs_and_unknown_user(users):
+    cache = UserContextCache(ttl=60)
+    context = cache.get("alice")
+    assert context.tabs == () and context.active_tab is None
+    assert cache.get("bob") is None
+
+
+def test_cached_until_invalidated(users, queries, monkeypatch):
+    monkeypatch.setattr(user_context_cache, "ttl", 60)
+    user_context_cache.invalidate()
+    user_id = users.get_user_id("alice")
+    context = user_context_cache.get("alice")
+    queries.clear()
+    assert user_context_cache.get("alice") is context
+    assert queries == []
+
+    # writes through the DAOs invalidate the cached context
+    with ChatTabsDAO() as tabs:
+        tabs.insert_tab_data(user_id, "1", "first", "1", True)
+    assert user_context_cache.get("alice").active_tab.chat_id == "1"
+
+    with AdminControlsDAO() as admin_controls:
+        admin_controls.update_admin_controls(1, 5, True, False)
+    assert user_context_cache.get("alice").daily_limit == 5
+
+    users.update_user(user_id, False, "user")
+    assert not user_context_cache.get("alice").allowed
+
+
+def test_expires_after_the_ttl(users):
+    cache = UserContextCache(ttl=0)
+    assert cache.get("alice") is not cache.get("alice")
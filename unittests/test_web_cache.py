@@ -0,0 +1,134 @@
+import asyncio
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import web_cache
+from web_cache import WebCache, freshness_lifetime
+from web_fetch import web_fetcher
+
+
+def test_freshness_lifetime():
+    assert freshness_lifetime({"Cache-Control": "no-store"}) is None
+    assert freshness_lifetime({"Cache-Control": "no-cache, max-age=60"}) == 0
+    assert (
+        freshness_lifetime({"Cache-Control": "public, max-age=60", "Age": "10"}) == 50
+    )
+    assert (
+        freshness_lifetime(
+            {
+                "Date": "Mon, 01 Jan 2024 00:00:00 GMT",
+                "Expires": "Mon, 01 Jan 2024 01:00:00 GMT",
+            }
+        )
+        == 3600
+    )
+    assert freshness_lifetime({"Expires": "0"}) == 0
+    assert (
+        freshness_lifetime(
+            {
+                "Date": "Mon, 11 Jan 2024 00:00:00 GMT",
+                "Last-Modified": "Mon, 01 Jan 2024 00:00:00 GMT",
+            }
+        )
+        == 86400
+    )
+    assert freshness_lifetime({}, default_ttl=123) == 123
+
+
+def test_store_compressed_and_evict_least_recently_used(tmp_path):
+    cache = WebCache(str(tmp_path / "web_cache.db"), max_bytes=10**6)
+    text = "hello world " * 10000
+    assert cache.put("a", {"text": text}, {"ETag": '"1"'})
+    assert cache.size() < len(text) // 10
+    cached = cache.get("a")
+    assert cached.fresh and cached.value == {"text": text}
+    assert cached.conditional_headers() == {"If-None-Match": '"1"'}
+    assert not cache.put("b", "private", {"Cache-Control": "no-store"})
+    assert cache.get("b") is None
+
+    cache.max_bytes = cache.size() * 2 + 100
+    cache.put("b", {"text": "b" + text})
+    cache.get("a")
+    cache.put("c", {"text": "c" + text})
+    assert cache.get("b") is None
+    assert cache.get("a") is not None and cache.get("c") is not None
+
+
+class Handler(BaseHTTPRequestHandler):
+    requests = []
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        Handler.requests.append(self.headers.get("If-None-Match"))
+        if self.headers.get("If-None-Match") == '"v1"':
+            self.send_response(304)
+            self.send_header("Cache-Control", "no-cache")
+            self.end_headers()
+            return
+        body = b"<html><body><p>cached page</p><a href='/x'>x</a></body></html>"
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header(
+            "Cache-Control", "no-cache" if "etag" in self.path else "max-age=60"
+        )
+        self.send_header("ETag", '"v1"')
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}"
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_visit_website_uses_the_cache(server, tmp_path, monkeypatch):
+    from addons import visit_website
+
+    threads = []
+
+    class ThreadRecordingCache(WebCache):
+        def get(self, key):
+            threads.append(threading.get_ident())
+            return super().get(key)
+
+        def put(self, *args):
+            threads.append(threading.get_ident())
+            return super().put(*args)
+
+        def revalidated(self, *args):
+            threads.append(threading.get_ident())
+            return super().revalidated(*args)
+
+    monkeypatch.setattr(
+        visit_website,
+        "web_cache",
+        ThreadRecordingCache(str(tmp_path / "web_cache.db")),
+    )
+    Handler.requests = []
+
+    async def main():
+        events, token = web_cache.track_events()
+        try:
+            for url in [f"{server}/fresh", f"{server}/etag"] * 2:
+                page, error = await visit_website.get_page(url)
+                assert error is None and page["text"] == "cached page x"
+        finally:
+            web_cache.stop_tracking(token)
+            await web_fetcher.close()
+        return events
+
+    events = asyncio.run(main())
+    assert [status for _, status in events] == ["miss", "miss", "fresh", "revalidated"]
+    assert Handler.requests == [None, None, '"v1"']
+    # the event loop ran on this thread, the cache was used on worker threads
+    assert len(threads) == 7 and threading.get_ident() not in threads
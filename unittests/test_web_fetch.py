@@ -0,0 +1,106 @@
+import asyncio
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from web_fetch import WebFetcher, extract_page, truncate_to_tokens
+
+PAGE = b"""<html><head><title>Test</title><style>body {color: red}</style></head>
+<body><script>var hidden = 1;</script><h1>Hello</h1><p>caf\xc3\xa9 world</p>
+<a href="/other">other</a><img src="/image.png"></body></html>"""
+
+
+class Handler(BaseHTTPRequestHandler):
+    active = 0
+    max_active = 0
+    lock = threading.Lock()
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if self.path == "/page":
+            self.respond(PAGE, "text/html; charset=utf-8")
+        elif self.path == "/big":
+            self.respond(b"<p>" + b"a" * 1024 * 1024 + b"</p>", "text/html")
+        elif self.path.startswith("/slow"):
+            with Handler.lock:
+                Handler.active += 1
+                Handler.max_active = max(Handler.max_active, Handler.active)
+            time.sleep(0.1)
+            with Handler.lock:
+                Handler.active -= 1
+            self.respond(b"<p>slow</p>", "text/html")
+        else:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+    def respond(self, body, content_type):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture(scope="module")
+def server():
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}"
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def fetch_all(fetcher, urls):
+    async def main():
+        try:
+            return await fetcher.fetch_all(urls)
+        finally:
+            await fetcher.close()
+
+    return asyncio.run(main())
+
+
+def test_fetch_and_extract(server):
+    page, missing = fetch_all(WebFetcher(), [f"{server}/page", f"{server}/missing"])
+    assert page.ok and page.encoding == "utf-8"
+    assert not missing.ok and "404" in missing.error
+
+    extracted = extract_page(page.body, page.encoding, include_images=True)
+    assert extracted["text"] == "Test Hello café world other"
+    assert extracted["links"] == ["/other"]
+    assert extracted["images"] == ["/image.png"]
+    assert extract_page(page.body, include_links=False)["links"] == []
+
+
+def test_body_is_capped(server):
+    (result,) = fetch_all(WebFetcher(max_bytes=1000), [f"{server}/big"])
+    assert result.truncated
+    assert len(result.body) == 1000
+
+
+def test_per_host_limit(server):
+    Handler.max_active = 0
+    fetcher = WebFetcher(limit_per_host=2)
+    results = fetch_all(fetcher, [f"{server}/slow{i}" for i in range(6)])
+    assert all(result.ok for result in results)
+    assert Handler.max_active == 2
+
+
+def test_unreachable_host():
+    (result,) = fetch_all(WebFetcher(timeout=5), ["http://127.0.0.1:1/"])
+    assert not result.ok
+
+
+def test_truncate_to_tokens():
+    text = "word " * 5000
+    truncated = truncate_to_tokens(text, 100)
+    assert text.startswith(truncated)
+    assert 0 < len(truncated) < len(text)
+    assert truncate_to_tokens("short text", 100) == "short text"
+    assert truncate_to_tokens(text, 0) == ""
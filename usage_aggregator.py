@@ -0,0 +1,298 @@
+"""
+Write-behind aggregator for the usage statistics.
+
+The token, cost, message and response time usage of every llm call used to be
+written to the statistics, daily_stats and role_stats tables while the response
+was streaming. Now it is added up per user and day in memory and written with
+one Database.apply_usage statement per user and day every USAGE_FLUSH_INTERVAL
+seconds, or as soon as USAGE_FLUSH_EVENTS calls are pending. Pending usage is
+flushed on shutdown.
+
+Readers (the usage messages and the daily spending limit check) get the totals
+from the database, cached for USAGE_CACHE_TTL seconds, plus the usage that
+hasn't been written yet, so the limit is enforced without a query per message.
+
+The background thread also refreshes the rollup of the global statistics that
+the admin dashboard reads, every STATS_ROLLUP_INTERVAL seconds.
+"""
+
+import datetime
+import threading
+import time
+
+import psycopg2
+
+import logs
+from config import (
+    STATS_ROLLUP_INTERVAL,
+    USAGE_CACHE_TTL,
+    USAGE_FLUSH_EVENTS,
+    USAGE_FLUSH_INTERVAL,
+)
+from database import Database, llm_usage_deltas
+
+logger = logs.Log("usage_aggregator", "usage_aggregator.log").get_logger()
+
+
+def _add(target, deltas):
+    for column, value in deltas.items():
+        target[column] = target.get(column, 0) + value
+
+
+class PendingUsage:
+    """Usage of one user on one day that hasn't been written yet."""
+
+    __slots__ = ("statistics", "daily", "roles", "events")
+
+    def __init__(self):
+        self.statistics = {}
+        self.daily = {}
+        self.roles = {}
+        self.events = 0
+
+    def add(self, statistics=None, daily=None, role=None, role_usage=None):
+        _add(self.statistics, statistics or {})
+        _add(self.daily, daily or {})
+        if role is not None:
+            current = self.roles.get(role, (0,) * len(role_usage))
+            self.roles[role] = tuple(a + b for a, b in zip(current, role_usage))
+        self.events += 1
+
+    def merge(self, other):
+        _add(self.statistics, other.statistics)
+        _add(self.daily, other.daily)
+        for role, role_usage in other.roles.items():
+            current = self.roles.get(role, (0,) * len(role_usage))
+            self.roles[role] = tuple(a + b for a, b in zip(current, role_usage))
+        self.events += other.events
+
+
+class UsageAggregator:
+    def __init__(
+        self,
+        flush_interval=USAGE_FLUSH_INTERVAL,
+        flush_events=USAGE_FLUSH_EVENTS,
+        cache_ttl=USAGE_CACHE_TTL,
+        rollup_interval=STATS_ROLLUP_INTERVAL,
+        database=Database,
+    ):
+        self.flush_interval = flush_interval
+        self.flush_events = flush_events
+        self.cache_ttl = cache_ttl
+        self.rollup_interval = rollup_interval
+        self._rollup_refreshed = None
+        self.database = database
+        self._pending = {}
+        self._in_flight = {}
+        self._totals = {}
+        self._generation = 0
+        self._events = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    @staticmethod
+    def today():
+        return datetime.datetime.now().date()
+
+    def add(self, username, statistics=None, daily=None, role=None, role_usage=None):
+        """Add usage deltas of the user for today, see Database.apply_usage."""
+        key = (username, self.today())
+        with self._lock:
+            self._pending.setdefault(key, PendingUsage()).add(
+                statistics, daily, role, role_usage
+            )
+            self._events += 1
+            flush = self._events >= self.flush_events
+        if flush:
+            self.flush_in_background()
+
+    def add_llm_usage(
+        self,
+        username,
+        role,
+        model,
+        prompt_tokens,
+        completion_tokens,
+        spending_count,
+        response_time,
+        brain=False,
+        total_tokens=None,
+    ):
+        """Add the usage of one llm call, returns the totals like get_totals()."""
+        statistics, daily, role_usage = llm_usage_deltas(
+            prompt_tokens,
+            completion_tokens,
+            spending_count,
+            response_time,
+            brain,
+            total_tokens,
+        )
+        self.add(username, statistics, daily, (role, model), role_usage)
+        return self.get_totals(username)
+
+    def add_message(self, username):
+        self.add(username, {"amount_of_messages": 1}, {"message_amount": 1})
+
+    def get_totals(self, username):
+        """Return total_tokens_used, prompt_tokens, completion_tokens and
+        daily_spending_count of the user, including the usage that isn't written yet.
+        """
+        day = self.today()
+        for _ in range(3):
+            with self._lock:
+                cached = self._totals.get(username)
+                if (
+                    cached is not None
+                    and cached[0] == day
+                    and time.monotonic() - cached[1] <= self.cache_ttl
+                ):
+                    return self._with_pending(cached[2], username, day)
+                generation = self._generation
+            with self.database() as db:
+                totals = self._clean(db.get_usage_totals(username, day))
+            with self._lock:
+                # a flush in the meantime may or may not be in what we read
+                if self._generation == generation:
+                    self._totals[username] = (day, time.monotonic(), totals)
+                    return self._with_pending(totals, username, day)
+        with self._lock:
+            return self._with_pending(totals, username, day)
+
+    def _with_pending(self, totals, username, day):
+        totals = dict(totals)
+        for (pending_username, pending_day), usage in (
+            *self._in_flight.items(),
+            *self._pending.items(),
+        ):
+            if pending_username != username:
+                continue
+            for column in ("total_tokens_used", "prompt_tokens", "completion_tokens"):
+                totals[column] += usage.statistics.get(column, 0)
+            if pending_day == day:
+                totals["daily_spending_count"] += usage.daily.get("spending_count", 0)
+        return totals
+
+    def get_daily_cost(self, username):
+        """Today's spending of the user, for the daily spending limit."""
+        return self.get_totals(username)["daily_spending_count"]
+
+    @staticmethod
+    def _clean(row):
+        return {
+            column: (row[column] or 0) if row is not None else 0
+            for column in (
+                "total_tokens_used",
+                "prompt_tokens",
+                "completion_tokens",
+                "daily_spending_count",
+            )
+        }
+
+    def flush(self):
+        """Write the pending usage, returns the number of users and days written."""
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, {}
+                self._in_flight = dict(batch)
+                self._events = 0
+            if not batch:
+                return 0
+            written = set()
+            try:
+                with self.database() as db:
+                    for (username, day), usage in batch.items():
+                        try:
+                            row = db.apply_usage(
+                                username,
+                                day,
+                                usage.statistics,
+                                usage.daily,
+                                usage.roles,
+                            )
+                        except psycopg2.Error as e:
+                            logger.error(
+                                f"Could not write the usage of {username}: {e}"
+                            )
+                            db.conn.rollback()
+                            continue
+                        written.add((username, day))
+                        if row is None:
+                            logger.warning(
+                                f"Dropped the usage of unknown user {username}"
+                            )
+                        with self._lock:
+                            # the written usage moves from in flight to the totals
+                            del self._in_flight[(username, day)]
+                            self._generation += 1
+                            if row is not None and day == self.today():
+                                self._totals[username] = (
+                                    day,
+                                    time.monotonic(),
+                                    self._clean(row),
+                                )
+                            else:
+                                self._totals.pop(username, None)
+            except Exception as e:
+                logger.error(f"Could not write the usage: {e}")
+            finally:
+                with self._lock:
+                    # keep what couldn't be written for the next flush
+                    for key, usage in self._in_flight.items():
+                        self._pending.setdefault(key, PendingUsage()).merge(usage)
+                    self._in_flight = {}
+            return len(written)
+
+    def flush_in_background(self):
+        threading.Thread(
+            target=self._safe_flush, name="usage-flush", daemon=True
+        ).start()
+
+    def _safe_flush(self):
+        try:
+            self.flush()
+        except Exception as e:
+            logger.error(f"Flushing the usage failed: {e}")
+
+    def refresh_rollup(self):
+        """Refresh the global statistics rollup if it is older than rollup_interval."""
+        now = time.monotonic()
+        if (
+            self._rollup_refreshed is not None
+            and now - self._rollup_refreshed < self.rollup_interval
+        ):
+            return False
+        self._rollup_refreshed = now
+        try:
+            with self.database() as db:
+                db.refresh_statistics_rollup()
+        except Exception as e:
+            logger.error(f"Could not refresh the statistics rollup: {e}")
+            return False
+        return True
+
+    def start(self):
+        """Flush every flush_interval seconds on a background thread."""
+        if self._thread is not None:
+            return
+
+        def run():
+            while not self._stopped.wait(self.flush_interval):
+                self._safe_flush()
+                self.refresh_rollup()
+
+        self._stopped.clear()
+        self._thread = threading.Thread(
+            target=run, name="usage-aggregator", daemon=True
+        )
+        self._thread.start()
+
+    def shutdown(self):
+        """Stop the background thread and write the pending usage."""
+        self._stopped.set()
+        self._thread = None
+        self._safe_flush()
+
+
+usage_aggregator = UsageAggregator()
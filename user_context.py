@@ -0,0 +1,178 @@
+"""
+Per-request user context for the messaging routes.
+
+Before a message is processed the routes need the user's id, display name,
+access flag and chat tabs, and the daily spending limit. load_user_context()
+reads all of it in one joined query and the result is cached per user for
+USER_CONTEXT_TTL seconds. The DAOs invalidate the cached context when the tabs
+of the user, the user's access, role or display name, or the admin controls
+change, so the TTL only bounds how long changes made outside of the DAOs stay
+invisible.
+
+The token usage isn't part of the cached context: UserContext.get_usage() reads
+it from the usage aggregator, which has its own cache and includes the usage
+that isn't written yet.
+
+Routes get the context with the get_user_context dependency:
+
+    async def handle_message(request: Request, context: UserContext = Depends(get_user_context)):
+"""
+
+import threading
+import time
+
+from fastapi import HTTPException, Request
+from sqlalchemy import func, select
+
+from chat_tabs.models import ChatTabs
+from config import USER_CONTEXT_TTL
+from user_management.models import AdminControls, Users
+from user_management.session import session_factory
+
+# daily spending limit when there are no admin controls yet, like AdminControlsDAO
+DEFAULT_DAILY_LIMIT = 20
+
+
+class ChatTab:
+    """A chat tab of the user, detached from the database session."""
+
+    __slots__ = ("id", "tab_id", "chat_id", "chat_name", "is_active", "is_enabled")
+
+    def __init__(self, id, tab_id, chat_id, chat_name, is_active, is_enabled):
+        self.id = id
+        self.tab_id = tab_id
+        self.chat_id = chat_id
+        self.chat_name = chat_name
+        self.is_active = is_active
+        self.is_enabled = is_enabled
+
+    def __repr__(self):
+        return f"<ChatTab(tab_id='{self.tab_id}', chat_id='{self.chat_id}', is_active={self.is_active})>"
+
+
+class UserContext:
+    __slots__ = (
+        "user_id",
+        "username",
+        "display_name",
+        "role",
+        "has_access",
+        "daily_limit",
+        "tabs",
+    )
+
+    def __init__(
+        self, user_id, username, display_name, role, has_access, daily_limit, tabs
+    ):
+        self.user_id = user_id
+        self.username = username
+        self.display_name = display_name
+        self.role = role
+        self.has_access = has_access
+        self.daily_limit = daily_limit
+        self.tabs = tuple(tabs)
+
+    @property
+    def allowed(self):
+        return bool(self.has_access) and self.has_access not in ("false", "False")
+
+    @property
+    def active_tab(self):
+        """The active chat tab, None if there is none."""
+        return next((tab for tab in self.tabs if tab.is_active), None)
+
+    def get_usage(self):
+        """Return total_tokens_used, prompt_tokens, completion_tokens and
+        daily_spending_count of the user, see UsageAggregator.get_totals.
+        """
+        # imported here, database imports the DAOs that invalidate the cache
+        from usage_aggregator import usage_aggregator
+
+        return usage_aggregator.get_totals(self.username)
+
+    @property
+    def daily_cost(self):
+        return self.get_usage()["daily_spending_count"]
+
+
+def load_user_context(session, username):
+    """Load the context of the user in one query, None for an unknown user."""
+    daily_limit = (
+        select(AdminControls.daily_spending_limit)
+        .order_by(AdminControls.id)
+        .limit(1)
+        .scalar_subquery()
+    )
+    rows = (
+        session.query(
+            Users.id,
+            Users.username,
+            Users.display_name,
+            Users.role,
+            Users.has_access,
+            func.coalesce(daily_limit, DEFAULT_DAILY_LIMIT),
+            ChatTabs.id,
+            ChatTabs.tab_id,
+            ChatTabs.chat_id,
+            ChatTabs.chat_name,
+            ChatTabs.is_active,
+            ChatTabs.is_enabled,
+        )
+        .outerjoin(ChatTabs, ChatTabs.user_id == Users.id)
+        .filter(Users.username == username)
+        .order_by(ChatTabs.id)
+        .all()
+    )
+    if not rows:
+        return None
+    tabs = [ChatTab(*row[6:]) for row in rows if row[6] is not None]
+    return UserContext(*rows[0][:6], tabs)
+
+
+class UserContextCache:
+    def __init__(self, ttl=USER_CONTEXT_TTL, loader=load_user_context):
+        self.ttl = ttl
+        self.loader = loader
+        self._entries = {}
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def get(self, username):
+        """Return the context of the user, from the cache when it is fresh."""
+        with self._lock:
+            entry = self._entries.get(username)
+            if entry is not None and time.monotonic() - entry[0] < self.ttl:
+                return entry[1]
+            generation = self._generation
+        session = session_factory.get_session().session
+        try:
+            context = self.loader(session, username)
+        finally:
+            session.close()
+        with self._lock:
+            # don't cache what an invalidation in the meantime may have changed
+            if context is not None and self._generation == generation:
+                self._entries[username] = (time.monotonic(), context)
+        return context
+
+    def invalidate(self, username=None, user_id=None):
+        """Drop the cached context of a user (by name or id), or of all users."""
+        with self._lock:
+            self._generation += 1
+            if username is None and user_id is None:
+                self._entries.clear()
+                return
+            for key, (_, context) in list(self._entries.items()):
+                if key == username or context.user_id == user_id:
+                    del self._entries[key]
+
+
+user_context_cache = UserContextCache()
+
+
+def get_user_context(request: Request) -> UserContext:
+    """Dependency that returns the context of the logged in user."""
+    context = user_context_cache.get(request.state.user.username)
+    if context is None:
+        raise HTTPException(status_code=401, detail="User not found")
+    return context
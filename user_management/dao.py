@@ -3,14 +3,18 @@ import math
 from typing import Optional, Dict, Any, List
 
 from sqlalchemy.exc import SQLAlchemyError, NoResultFound
+from sqlalchemy.orm import Session
 
-from common.dao import AbstractDAO
+from admin_controls_cache import admin_controls_cache, notify_admin_controls_changed
+from common.dao import AbstractDAO, AbstractAsyncDAO
+from session_cache import notify_sessions_changed, session_cache
+from user_context import user_context_cache
 from user_management.models import Users, AdminControls
 
 
 class UsersDAO(AbstractDAO):
-    def __init__(self):
-        super().__init__(Users)
+    def __init__(self, session: Session = None):
+        super().__init__(Users, session)
 
     def get_user_count(self) -> int:
         return self.session.query(Users).count()
@@ -42,7 +46,10 @@ class UsersDAO(AbstractDAO):
         self.session.query(Users).filter(Users.id == user_id).update(
             {Users.has_access: access, Users.role: role}
         )
+        notify_sessions_changed(self.session, user_id=user_id)
         self.session.commit()
+        user_context_cache.invalidate(user_id=user_id)
+        session_cache.invalidate(user_id=user_id)
 
     def get_password_by_username(self, username: str) -> str:
         user = self.session.query(Users).filter_by(username=username).first()
@@ -67,14 +74,19 @@ class UsersDAO(AbstractDAO):
 
     def delete_user_by_username(self, username: str) -> bool:
         affected_rows = self.session.query(Users).filter_by(username=username).delete()
+        notify_sessions_changed(self.session, username=username)
         self.session.commit()
+        user_context_cache.invalidate(username=username)
+        session_cache.invalidate(username=username)
         return affected_rows > 0
 
     def update_session_token(self, username: str, session_token: str) -> None:
         self.session.query(Users).filter_by(username=username).update(
             {"session_token": session_token}
         )
+        notify_sessions_changed(self.session, username=username)
         self.session.commit()
+        session_cache.invalidate(username=username)
 
     def add_or_update_google_user(
         self,
@@ -105,16 +117,21 @@ class UsersDAO(AbstractDAO):
             )
             self.session.add(new_user)
         try:
+            notify_sessions_changed(self.session, username=username)
             self.session.commit()
         except SQLAlchemyError:
             self.session.rollback()
             raise
+        user_context_cache.invalidate(username=username)
+        session_cache.invalidate(username=username)
 
     def validate_and_clear_session_token(self, username: str) -> bool:
         user = self.session.query(Users).filter_by(username=username).first()
         if user:
             user.session_token = ""
+            notify_sessions_changed(self.session, username=username)
             self.session.commit()
+            session_cache.invalidate(username=username)
             return True
         return False
 
@@ -154,7 +171,10 @@ class UsersDAO(AbstractDAO):
         user = self.session.query(Users).filter(Users.username == username).first()
         if user:
             user.display_name = display_name
+            notify_sessions_changed(self.session, username=username)
             self.session.commit()
+            user_context_cache.invalidate(username=username)
+            session_cache.invalidate(username=username)
             return True
         return False
 
@@ -182,8 +202,8 @@ class UsersDAO(AbstractDAO):
 
 
 class AdminControlsDAO(AbstractDAO):
-    def __init__(self):
-        super().__init__(AdminControls)
+    def __init__(self, session: Session = None):
+        super().__init__(AdminControls, session)
 
     def get_admin_controls_json(self) -> str:
         rows = self.session.query(AdminControls).all()
@@ -214,7 +234,10 @@ class AdminControlsDAO(AbstractDAO):
             )
         )
         self.session.add(obj)
+        notify_admin_controls_changed(self.session)
         self.session.commit()
+        admin_controls_cache.invalidate()
+        user_context_cache.invalidate()
 
     def get_maintenance_mode(self) -> bool:
         row = self.session.query(AdminControls).first()
@@ -229,12 +252,136 @@ class AdminControlsDAO(AbstractDAO):
     def add_admin_control(self, **kwargs) -> None:
         admin_control = AdminControls(**kwargs)
         self.session.add(admin_control)
+        notify_admin_controls_changed(self.session)
         self.session.commit()
+        admin_controls_cache.invalidate()
+        user_context_cache.invalidate()
 
     def update_admin_control(self, id: int, **kwargs) -> None:
         self.session.query(AdminControls).filter_by(id=id).update(kwargs)
+        notify_admin_controls_changed(self.session)
         self.session.commit()
+        admin_controls_cache.invalidate()
+        user_context_cache.invalidate()
 
     def delete_admin_control(self, id: int) -> None:
         self.session.query(AdminControls).filter(AdminControls.id == id).delete()
+        notify_admin_controls_changed(self.session)
         self.session.commit()
+        admin_controls_cache.invalidate()
+        user_context_cache.invalidate()
+
+
+class AsyncUsersDAO(AbstractAsyncDAO):
+    sync_dao = UsersDAO
+
+    async def get_user_count(self) -> int:
+        return await self.run(UsersDAO.get_user_count)
+
+    async def update_user(self, user_id: int, access: bool, role: str) -> None:
+        await self.run(UsersDAO.update_user, user_id, access, role)
+
+    async def get_password_by_username(self, username: str) -> str:
+        return await self.run(UsersDAO.get_password_by_username, username)
+
+    async def add_user(
+        self, username: str, password: str, session_token: str, display_name: str
+    ) -> int:
+        return await self.run(
+            UsersDAO.add_user, username, password, session_token, display_name
+        )
+
+    async def delete_user_by_username(self, username: str) -> bool:
+        return await self.run(UsersDAO.delete_user_by_username, username)
+
+    async def update_session_token(self, username: str, session_token: str) -> None:
+        await self.run(UsersDAO.update_session_token, username, session_token)
+
+    async def add_or_update_google_user(
+        self,
+        google_id: str,
+        username: str,
+        hashed_password: str,
+        session_token: str,
+        display_name: str,
+    ) -> None:
+        await self.run(
+            UsersDAO.add_or_update_google_user,
+            google_id,
+            username,
+            hashed_password,
+            session_token,
+            display_name,
+        )
+
+    async def validate_and_clear_session_token(self, username: str) -> bool:
+        return await self.run(UsersDAO.validate_and_clear_session_token, username)
+
+    async def check_session_token(self, username: str, session_token: str) -> bool:
+        return await self.run(UsersDAO.check_session_token, username, session_token)
+
+    async def get_username(self, user_id: int) -> str:
+        return await self.run(UsersDAO.get_username, user_id)
+
+    async def get_user_id(self, username: str) -> int:
+        return await self.run(UsersDAO.get_user_id, username)
+
+    async def get_user_profile(self, username: str) -> str:
+        return await self.run(UsersDAO.get_user_profile, username)
+
+    async def get_user(self, username: str) -> Optional[Users]:
+        return await self.run(UsersDAO.get_user, username)
+
+    async def update_display_name(self, username: str, display_name: str) -> bool:
+        return await self.run(UsersDAO.update_display_name, username, display_name)
+
+    async def get_total_statistics_pages(self, items_per_page: int) -> int:
+        return await self.run(UsersDAO.get_total_statistics_pages, items_per_page)
+
+    async def get_display_name(self, username: str) -> Optional[str]:
+        return await self.run(UsersDAO.get_display_name, username)
+
+    async def get_user_access(self, username):
+        return await self.run(UsersDAO.get_user_access, username)
+
+    async def get_user_role(self, username):
+        return await self.run(UsersDAO.get_user_role, username)
+
+
+class AsyncAdminControlsDAO(AbstractAsyncDAO):
+    sync_dao = AdminControlsDAO
+
+    async def get_admin_controls_json(self) -> str:
+        return await self.run(AdminControlsDAO.get_admin_controls_json)
+
+    async def get_admin_controls(self) -> List[AdminControls]:
+        return await self.run(AdminControlsDAO.get_admin_controls)
+
+    async def get_daily_limit(self) -> int:
+        return await self.run(AdminControlsDAO.get_daily_limit)
+
+    async def update_admin_controls(
+        self, id: int, daily_spending_limit: int, allow_access: bool, maintenance: bool
+    ) -> None:
+        await self.run(
+            AdminControlsDAO.update_admin_controls,
+            id,
+            daily_spending_limit,
+            allow_access,
+            maintenance,
+        )
+
+    async def get_maintenance_mode(self) -> bool:
+        return await self.run(AdminControlsDAO.get_maintenance_mode)
+
+    async def get_admin_control(self, id: int) -> AdminControls:
+        return await self.run(AdminControlsDAO.get_admin_control, id)
+
+    async def add_admin_control(self, **kwargs) -> None:
+        await self.run(AdminControlsDAO.add_admin_control, **kwargs)
+
+    async def update_admin_control(self, id: int, **kwargs) -> None:
+        await self.run(AdminControlsDAO.update_admin_control, id, **kwargs)
+
+    async def delete_admin_control(self, id: int) -> None:
+        await self.run(AdminControlsDAO.delete_admin_control, id)
@@ -27,7 +27,7 @@ from common.websocket import authenticate_websocket
 from config import STATIC, LOGIN_REQUIRED, PRODUCTION, origins, ADMIN_REQUIRED
 from configuration_page.middleware import set_user_as_logged_in
 from simple_utils import get_root
-from user_management.dao import UsersDAO, AdminControlsDAO
+from user_management.dao import AsyncUsersDAO, AsyncAdminControlsDAO
 
 templates = Jinja2Templates(directory=get_root(STATIC))
 router = APIRouter()
@@ -196,9 +196,9 @@ async def update_user(
     role: str = Form(...),
 ):
     user = request.state.user
-    with UsersDAO() as db:
+    async with AsyncUsersDAO() as db:
         has_access_bool = True if has_access == "true" else False
-        db.update_user(user_id, has_access_bool, role)
+        await db.update_user(user_id, has_access_bool, role)
         logger.info(f"User {user.username} (role: {user.role}) updated user: {user_id}")
         return {"message": f"User {user_id} updated successfully"}
 
@@ -211,10 +211,10 @@ async def update_controls(
     allow_access: bool = Form(...),
     maintenance: bool = Form(...),
 ):
-    with AdminControlsDAO() as db:
+    async with AsyncAdminControlsDAO() as db:
         if id == "" or id == None:
             id = 1
-        db.update_admin_controls(
+        await db.update_admin_controls(
             id, daily_spending_limit, allow_access=allow_access, maintenance=maintenance
         )
     return RedirectResponse(url="/admin/statistics/1", status_code=303)
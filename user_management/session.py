@@ -1,9 +1,50 @@
 from dataclasses import dataclass
 
 from sqlalchemy import create_engine, Engine
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import (
+    AsyncEngine,
+    AsyncSession,
+    async_sessionmaker,
+    create_async_engine,
+)
 from sqlalchemy.orm import sessionmaker, scoped_session, Session
 
-from config import new_database_url
+from config import (
+    ORM_POOL_MAX_OVERFLOW,
+    ORM_POOL_PRE_PING,
+    ORM_POOL_RECYCLE,
+    ORM_POOL_SIZE,
+    ORM_POOL_TIMEOUT,
+    new_database_url,
+)
+
+# drivers of the async engine for the drivers of NEW_DATABASE_URL
+ASYNC_DRIVERS = {
+    "postgresql": "postgresql+asyncpg",
+    "postgresql+psycopg2": "postgresql+asyncpg",
+    "sqlite": "sqlite+aiosqlite",
+    "sqlite+pysqlite": "sqlite+aiosqlite",
+}
+
+
+def async_database_url(url: str):
+    """NEW_DATABASE_URL with the driver replaced by its async driver."""
+    url = make_url(url)
+    return url.set(drivername=ASYNC_DRIVERS.get(url.drivername, url.drivername))
+
+
+def engine_options(url) -> dict:
+    """Pool settings of the engines, sqlite doesn't get a sized pool."""
+    options = {"pool_pre_ping": ORM_POOL_PRE_PING}
+    if not make_url(url).drivername.startswith("sqlite"):
+        options.update(
+            pool_size=ORM_POOL_SIZE,
+            max_overflow=ORM_POOL_MAX_OVERFLOW,
+            pool_recycle=ORM_POOL_RECYCLE,
+            pool_timeout=ORM_POOL_TIMEOUT,
+        )
+    return options
 
 
 @dataclass
@@ -18,7 +59,8 @@ class SessionFactory:
     SessionLocal = None
 
     def get_refreshed(self) -> SessionWithEngine:
-        self.engine = create_engine(new_database_url())
+        url = new_database_url()
+        self.engine = create_engine(url, **engine_options(url))
         self.SessionLocal = scoped_session(
             sessionmaker(autocommit=False, autoflush=False, bind=self.engine)
         )
@@ -30,4 +72,42 @@ class SessionFactory:
         return SessionWithEngine(engine=self.engine, session=self.SessionLocal())
 
 
+@dataclass
+class AsyncSessionWithEngine:
+    engine: AsyncEngine = None
+    session: AsyncSession = None
+
+
+@dataclass
+class AsyncSessionFactory:
+    """Sessions of the async engine, used by the async DAOs in the route handlers.
+
+    The connections of the engine belong to the event loop they were opened on,
+    dispose() the engine before it is used on another loop.
+    """
+
+    engine: AsyncEngine = None
+    SessionLocal = None
+
+    def get_refreshed(self) -> AsyncSessionWithEngine:
+        url = async_database_url(new_database_url())
+        self.engine = create_async_engine(url, **engine_options(url))
+        # the loaded objects stay usable after a commit, they aren't lazy loaded
+        self.SessionLocal = async_sessionmaker(
+            bind=self.engine, autoflush=False, expire_on_commit=False
+        )
+        return AsyncSessionWithEngine(engine=self.engine, session=self.SessionLocal())
+
+    def get_session(self) -> AsyncSessionWithEngine:
+        if self.engine is None:
+            return self.get_refreshed()
+        return AsyncSessionWithEngine(engine=self.engine, session=self.SessionLocal())
+
+    async def dispose(self):
+        if self.engine is not None:
+            await self.engine.dispose()
+            self.engine = None
+
+
 session_factory = SessionFactory()
+async_session_factory = AsyncSessionFactory()
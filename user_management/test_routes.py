@@ -9,7 +9,7 @@ from sqlalchemy.orm import close_all_sessions
 from starlette.websockets import WebSocketDisconnect
 
 from launcher import create_app
-from user_management.session import session_factory
+from user_management.session import async_session_factory, session_factory
 from user_management.test_dao_user import dao_session
 
 
@@ -35,6 +35,7 @@ def client():
             )
 
     session_factory.get_refreshed()
+    async_session_factory.get_refreshed()
     from configuration_page.redirect_middleware import RedirectToConfigurationMiddleware
     from configuration_page.middleware import LoginRequiredCheckMiddleware
     from user_management.routes import router as user_management_router
@@ -19,14 +19,27 @@ from fastapi import HTTPException, BackgroundTasks, UploadFile
 from werkzeug.utils import secure_filename
 from pathlib import Path
 from chat_tabs.dao import ChatTabsDAO
-from config import api_keys, default_params, fakedata, USERS_DIR
+from config import (
+    api_keys,
+    default_params,
+    fakedata,
+    ROLE_MAX_TOKENS,
+    SMALL_MODELS,
+    USERS_DIR,
+)
+from addon_executor import addon_executor, AddonCancelledError
+from addon_registry import addon_registry
+import web_cache
 from database import Database
-import tiktoken
+from usage_aggregator import usage_aggregator
+from settings_cache import settings_cache
+import tokenizer
 from pydub import audio_segment
 import logs
 import prompts
 from unidecode import unidecode
 import llmcalls
+import llm_cache
 from simple_utils import get_root
 from user_management.dao import UsersDAO
 from typing import List, Dict, Any
@@ -63,6 +76,10 @@ MODEL_COSTS = {
         "input": 0.000015,  # $15 / 1M tokens
         "output": 0.000075,  # $75 / 1M tokens
     },
+    "claude-3-haiku-20240307": {
+        "input": 0.00000025,  # $0.25 / 1M tokens
+        "output": 0.00000125,  # $1.25 / 1M tokens
+    },
 }
 
 
@@ -92,11 +109,13 @@ class MessageSender:
         await routes.send_debug_message(username, json.dumps(message))
 
     @staticmethod
-    async def update_token_usage(response, username, brain=False, elapsed=0):
-        """Update the token usage in the database"""
+    async def update_token_usage(
+        response, username, brain=False, elapsed=0, model=None, role=None
+    ):
+        """Update the token usage in the database, model and role are the model and llm role of the call"""
         try:
             settings = await SettingsManager.load_settings("users", username)
-            current_model = settings["active_model"]["active_model"]
+            current_model = model or settings["active_model"]["active_model"]
 
             # if the response is audio_cost update the audio cost
             if "audio_cost" in response:
@@ -140,104 +159,55 @@ class MessageSender:
             else:
                 return
 
-            with Database() as db:
-                result = db.update_token_usage(
-                    username,
-                    total_tokens_used=total_tokens_used,
-                    prompt_tokens=input_tokens,
-                    completion_tokens=output_tokens,
-                )
-                if result is not None:
-                    await MessageSender.send_debug(
-                        f"Last message: Input tokens: {input_tokens}, Output tokens: {output_tokens}\nTotal tokens used: {result[0]}, Input tokens: {result[1]}, Output tokens: {result[2]}",
-                        2,
-                        "red",
-                        username,
-                    )
-
-                    # Calculate costs based on the current model
-                    if current_model in MODEL_COSTS:
-                        model_cost = MODEL_COSTS[current_model]
-                        input_cost = round(input_tokens * model_cost["input"], 5)
-                        output_cost = round(output_tokens * model_cost["output"], 5)
-                    else:
-                        input_cost = round(input_tokens * 0.00001, 5)
-                        output_cost = round(output_tokens * 0.00003, 5)
-
-                    this_message_total_cost = round(input_cost + output_cost, 5)
-
-                    total_input_cost = round(result[1] * model_cost["input"], 5)
-                    total_output_cost = round(result[2] * model_cost["output"], 5)
-                    total_cost = round(total_input_cost + total_output_cost, 5)
-
-                    await MessageSender.send_message(
-                        {
-                            "usage": {
-                                "total_tokens": result[0],
-                                "total_cost": total_cost,
-                            }
-                        },
-                        "red",
-                        username,
-                    )
-
-                    daily_stats = db.get_daily_stats(username)
-                    if daily_stats is not None:
-                        current_spending_count = daily_stats["spending_count"] or 0
-                    else:
-                        current_spending_count = 0
-                    spending_count = current_spending_count + this_message_total_cost
+            # Calculate costs based on the model used for the call
+            model_cost = MODEL_COSTS.get(
+                current_model, {"input": 0.00001, "output": 0.00003}
+            )
+            input_cost = round(input_tokens * model_cost["input"], 5)
+            output_cost = round(output_tokens * model_cost["output"], 5)
+            this_message_total_cost = round(input_cost + output_cost, 5)
 
-                    await MessageSender.send_message(
-                        {"daily_usage": {"daily_cost": spending_count}}, "red", username
-                    )
+            # written to the statistics, daily stats and per role stats in batches
+            result = await asyncio.to_thread(
+                usage_aggregator.add_llm_usage,
+                username,
+                role or "chat",
+                current_model,
+                prompt_tokens=input_tokens,
+                completion_tokens=output_tokens,
+                spending_count=this_message_total_cost,
+                response_time=elapsed,
+                brain=brain,
+                total_tokens=total_tokens_used,
+            )
+            await MessageSender.send_debug(
+                f"Last message: Input tokens: {input_tokens}, Output tokens: {output_tokens}\nTotal tokens used: {result['total_tokens_used']}, Input tokens: {result['prompt_tokens']}, Output tokens: {result['completion_tokens']}",
+                2,
+                "red",
+                username,
+            )
 
-                    # update the daily_stats table
-                    if brain:
-                        db.update_daily_stats_token_usage(
-                            username,
-                            brain_tokens=input_tokens,
-                            spending_count=this_message_total_cost,
-                        )
-                    else:
-                        db.update_daily_stats_token_usage(
-                            username,
-                            prompt_tokens=input_tokens,
-                            generation_tokens=output_tokens,
-                            spending_count=this_message_total_cost,
-                        )
+            total_input_cost = round(result["prompt_tokens"] * model_cost["input"], 5)
+            total_output_cost = round(
+                result["completion_tokens"] * model_cost["output"], 5
+            )
+            total_cost = round(total_input_cost + total_output_cost, 5)
 
-                    current_stats_spending_count = (
-                        db.get_statistic(username)["total_spending_count"] or 0
-                    )
-                    spending_count = round(
-                        current_stats_spending_count + this_message_total_cost, 5
-                    )
-                    # update the statistics table
-                    db.update_statistic(username, total_spending_count=spending_count)
-
-                    # update the elapsed time
-                    # get the total response time and response count from the database
-                    stats = db.get_daily_stats(username)
-                    if stats is not None:
-                        total_response_time = stats["total_response_time"] or 0
-                        response_count = stats["response_count"] or 0
-                    else:
-                        total_response_time = 0
-                        response_count = 0
-                    # update the total response time and response count
-                    total_response_time += elapsed
-                    response_count += 1
-
-                    # calculate the new average response time
-                    average_response_time = total_response_time / response_count
-
-                    db.replace_daily_stats_token_usage(
-                        username,
-                        total_response_time=total_response_time,
-                        average_response_time=average_response_time,
-                        response_count=response_count,
-                    )
+            await MessageSender.send_message(
+                {
+                    "usage": {
+                        "total_tokens": result["total_tokens_used"],
+                        "total_cost": total_cost,
+                    }
+                },
+                "red",
+                username,
+            )
+            await MessageSender.send_message(
+                {"daily_usage": {"daily_cost": result["daily_spending_count"]}},
+                "red",
+                username,
+            )
 
         except Exception as e:
             logger.exception(f"An error occurred (utils): {e}")
@@ -245,151 +215,56 @@ class MessageSender:
                 {"error": "An error occurred (utils): " + str(e)}, "red", username
             )
 
+    @staticmethod
+    async def update_llm_cache_usage(username, model, role, entry=None):
+        """Record an llm response cache lookup, entry is the cached entry on a hit"""
+        saved_tokens = 0
+        saved_cost = 0
+        if entry is not None:
+            saved_tokens = entry.input_tokens + entry.output_tokens
+            model_cost = MODEL_COSTS.get(model, {"input": 0.00001, "output": 0.00003})
+            saved_cost = round(
+                entry.input_tokens * model_cost["input"]
+                + entry.output_tokens * model_cost["output"],
+                5,
+            )
+            await MessageSender.send_debug(
+                f"llm cache hit for {role} ({model}), saved {saved_tokens} tokens (${saved_cost})",
+                2,
+                "red",
+                username,
+            )
+        try:
+            usage = {
+                "llm_cache_lookups": 1,
+                "llm_cache_hits": 1 if entry is not None else 0,
+                "llm_cache_saved_tokens": saved_tokens,
+                "llm_cache_saved_cost": saved_cost,
+            }
+            usage_aggregator.add(username, usage, usage)
+        except Exception as e:
+            logger.exception(f"An error occurred while saving the llm cache usage: {e}")
+
 
 class AddonManager:
     """This class contains functions to load addons"""
 
     @staticmethod
     async def load_addons(username, users_dir):
-        anthropic_api_key = api_keys.get("anthropic")
-        openai_api_key = api_keys.get("openai")
-        if anthropic_api_key:
-            active_model = "claude-3-opus-20240229"
-        elif openai_api_key:
-            active_model = "gpt-4o"
-        else:
-            active_model = "gpt-4o"
-        default_settings = {
-            "addons": {},
-            "audio": {"voice_input": True, "voice_output": True},
-            "avatar": {"avatar": False},
-            "language": {"language": "en"},
-            "system_prompt": {"system_prompt": "stoic"},
-            "cot_enabled": {"cot_enabled": False},
-            "verbose": {"verbose": False},
-            "timezone": {"timezone": "Auto"},
-            "active_model": {"active_model": active_model},
-            "memory": {
-                "functions": 6400,
-                "ltm1": 2560,
-                "ltm2": 2560,
-                "episodic": 2560,
-                "recent": 2560,
-                "notes": 2560,
-                "input": 104960,
-                "output": 3840,
-                "max_tokens": 128000,
-                "min_tokens": 500,
-            },
-        }
-
-        data_username = convert_username(username)
-
-        function_dict = {}
-        function_metadata = []
-        module_timestamps = {}
+        """Return the enabled addons of the user and their tool schemas.
 
-        data_dir = os.path.join(users_dir, data_username, "data")
-        # create the users directory if it doesn't exist
-        if not os.path.exists(data_dir):
-            os.makedirs(data_dir)
+        The modules and schemas come from the shared addon registry, the
+        user's settings only filter them.
+        """
+        settings = await SettingsManager.load_settings(users_dir, username)
+        enabled = settings["addons"]
 
-        user_path = os.path.join(users_dir, username)
-        settings_file = os.path.join(user_path, "settings.json")
-
-        if not os.path.exists(user_path):
-            os.makedirs(user_path)
-
-        if not os.path.exists(settings_file):
-            with open(settings_file, "w") as f:
-                json.dump(default_settings, f)
-
-        # Check if settings file exists and is not empty
-        if os.path.exists(settings_file) and os.path.getsize(settings_file) > 0:
-            try:
-                with open(settings_file, "r") as f:
-                    settings = json.load(f)
-            except json.JSONDecodeError:
-                settings = default_settings
-        else:
-            settings = default_settings
-
-        # Validate and correct the settings
-        for key, default_value in default_settings.items():
-            # If the key is not in the settings or the type is not the same as the default value, set it to the default value
-            if key not in settings or type(settings[key]) != type(default_value):
-                settings[key] = default_value
-            # If the key is a dict, validate and correct the sub keys
-            elif isinstance(default_value, dict):
-                for sub_key, sub_default_value in default_value.items():
-                    if sub_key not in settings[key] or type(
-                        settings[key][sub_key]
-                    ) != type(sub_default_value):
-                        settings[key][sub_key] = sub_default_value
-
-        # Save the settings
-        with open(settings_file, "w") as f:
-            json.dump(settings, f)
-
-        # Delete addons that don't exist anymore
-        for addon in list(settings["addons"].keys()):
-            if not os.path.exists(os.path.join("addons", f"{addon}.py")):
-                del settings["addons"][addon]
-
-        # Load addons
-        for filename in os.listdir("addons"):
-            if filename.endswith(".py"):
-                addon_name = filename[:-3]
-                if addon_name not in settings["addons"]:
-                    settings["addons"][addon_name] = False
-
-                # Only load the addon if it is enabled
-                if settings["addons"].get(addon_name, True):
-                    file_path = os.path.join("addons", filename)
-                    spec = importlib.util.spec_from_file_location(
-                        filename[:-3], file_path
-                    )
-                    module = importlib.util.module_from_spec(spec)
-
-                    # Check if the module has been modified since it was last imported
-                    file_timestamp = os.path.getmtime(file_path)
-                    if (
-                        filename in module_timestamps
-                        and file_timestamp > module_timestamps[filename]
-                    ):
-                        module = importlib.reload(module)
-                    module_timestamps[filename] = file_timestamp
-
-                    spec.loader.exec_module(module)
-
-                    # Check for the function in the module and add it with the required structure
-                    if module.__name__ in module.__dict__:
-                        function_detail = {
-                            "name": module.__name__,
-                            "description": getattr(
-                                module, "description", "No description"
-                            ),
-                            "parameters": getattr(
-                                module, "parameters", "No parameters"
-                            ),
-                        }
-                        # Wrap the function detail in the required structure
-                        tool_metadata = {
-                            "type": "function",
-                            "function": function_detail,
-                        }
-                        function_metadata.append(tool_metadata)
-                    else:
-                        await MessageSender.send_debug(
-                            f"Module {module.__name__} does not have a function with the same name.",
-                            2,
-                            "red",
-                            username,
-                        )
-
-        with open(settings_file, "w") as f:
-            json.dump(settings, f)
+        for addon in addon_registry.get_addons(enabled):
+            if not addon.loaded:
+                await MessageSender.send_debug(addon.error, 2, "red", username)
 
+        function_dict = addon_registry.get_modules(enabled)
+        function_metadata = addon_registry.get_openai_tools(enabled)
         if not function_metadata:
             function_metadata = fakedata
 
@@ -416,9 +291,7 @@ class AudioProcessor:
             return {"transcription": ""}
 
         # get the user settings language
-        settings_file = os.path.join(userdir, "settings.json")
-        with open(settings_file, "r") as f:
-            settings = json.load(f)
+        settings = await SettingsManager.load_settings(user_dir, username)
         language = settings.get("language", {}).get("language", "en")
 
         # if no language is set, default to english
@@ -523,9 +396,8 @@ class MessageParser:
     async def get_recent_messages(
         username: str, chat_id: str, regenerator: bool = False, uuid: str = None
     ) -> List[Dict[str, Any]]:
-        memory = _memory.MemoryManager()
         settings = await SettingsManager.load_settings("users", username)
-        memory.model_used = settings["active_model"]["active_model"]
+        memory = _memory.MemoryManager(settings["active_model"]["active_model"])
         recent_messages = await memory.get_most_recent_messages(
             "active_brain", username, chat_id=chat_id
         )
@@ -615,24 +487,7 @@ class MessageParser:
                                 "users", username
                             )
 
-                            default_par = default_params
-                            default_par["max_tokens"] = settings.get("memory", {}).get(
-                                "output", 1000
-                            )
-                            default_par["model"] = settings.get("active_model").get(
-                                "active_model"
-                            )
-                            responder = llmcalls.get_responder(
-                                (
-                                    api_keys["openai"]
-                                    if settings.get("active_model")
-                                    .get("active_model")
-                                    .startswith("gpt")
-                                    else api_keys["anthropic"]
-                                ),
-                                settings.get("active_model").get("active_model"),
-                                default_par,
-                            )
+                            responder = llmcalls.get_role_responder(settings)
 
                             async for resp in responder.get_response(
                                 username,
@@ -657,21 +512,37 @@ class MessageParser:
         return arguments if isinstance(arguments, dict) else {}
 
     @staticmethod
-    def handle_function_response(function, args):
-        try:
-            function_response = function(**args)
-        except Exception as e:
-            logger.error(f"Error: {e}")
-            function_response = {"content": "error: " + str(e)}
-        return function_response
+    async def handle_function_response(name, function, args, username=None):
+        """Run an addon function through the addon executor.
 
-    @staticmethod
-    async def ahandle_function_response(function, args):
+        Synchronous addons run on the addon thread pool, so they don't block the event loop.
+        """
+        # the lookups in the web cache are shown in the debug message
+        cache_events, token = web_cache.track_events()
         try:
-            function_response = await function(**args)
+            function_response, call = await addon_executor.run(
+                name, function, args, username
+            )
+        except asyncio.TimeoutError:
+            timeout = addon_executor.get_timeout(name)
+            logger.error(f"Error: {name} timed out after {timeout} seconds")
+            function_response = {
+                "content": f"error: {name} timed out after {timeout} seconds"
+            }
+        except AddonCancelledError:
+            function_response = {"content": f"error: {name} was stopped by the user"}
         except Exception as e:
             logger.error(f"Error: {e}")
             function_response = {"content": "error: " + str(e)}
+        else:
+            debug_message = f"{name}: queue wait {call.queue_wait:.2f}s, execution time {call.execution_time:.2f}s"
+            if cache_events:
+                debug_message += "\nWeb cache: " + ", ".join(
+                    f"{key} ({status})" for key, status in cache_events
+                )
+            await MessageSender.send_debug(debug_message, 2, "gray", username)
+        finally:
+            web_cache.stop_tracking(token)
         return function_response
 
     @staticmethod
@@ -730,16 +601,17 @@ class MessageParser:
                     actual_function = getattr(module, function_call_name)
                     if actual_function and callable(actual_function):
                         # print(f"Executing {function_call_name}...")
-                        if asyncio.iscoroutinefunction(actual_function):
-                            function_response = (
-                                await MessageParser.ahandle_function_response(
-                                    actual_function, converted_function_call_arguments
-                                )
-                            )
-                        else:
-                            function_response = MessageParser.handle_function_response(
-                                actual_function, converted_function_call_arguments
+                        function_response = (
+                            await MessageParser.handle_function_response(
+                                function_call_name,
+                                actual_function,
+                                converted_function_call_arguments,
+                                username,
                             )
+                        )
+                        if not asyncio.iscoroutinefunction(
+                            actual_function
+                        ) and isinstance(function_response, list):
                             confirm_email_responses = [
                                 response
                                 for response in function_response
@@ -850,9 +722,8 @@ class MessageParser:
             if response["content"] is not None:
                 with UsersDAO() as db:
                     display_name = db.get_display_name(username)
-                memory = _memory.MemoryManager()
-                settings = await SettingsManager.load_settings("active_brain", username)
-                memory.model_used = settings["active_model"]["active_model"]
+                settings = await SettingsManager.load_settings("users", username)
+                memory = _memory.MemoryManager(settings["active_model"]["active_model"])
                 await memory.process_incoming_memory_assistant(
                     "active_brain",
                     response["content"],
@@ -866,64 +737,12 @@ class MessageParser:
     @staticmethod
     def num_tokens_from_string(string, model="gpt-4"):
         """Returns the number of tokens in a text string."""
-        try:
-            encoding = tiktoken.encoding_for_model(model)
-        except (KeyError, ValueError):
-            logger.warning("Warning: model not found. Using cl100k_base encoding.")
-            # encoding = tiktoken.get_encoding("cl100k_base")
-            return len(string)
-        num_tokens = len(encoding.encode(string))
-        return num_tokens
+        return tokenizer.count_tokens(string, model)
 
     @staticmethod
     def num_tokens_from_functions(functions, model="gpt-4"):
         """Return the number of tokens used by a list of functions."""
-        try:
-            encoding = tiktoken.encoding_for_model(model)
-        except (KeyError, ValueError):
-            logger.warning("Warning: model not found. Using cl100k_base encoding.")
-            return 0
-
-        num_tokens = 0
-        for tool in functions:  # Iterate over the tools
-            if tool["type"] == "function":  # Ensure it's a function type
-                function = tool["function"]  # Extract the function details
-                function_tokens = len(encoding.encode(function["name"]))
-                function_tokens += len(encoding.encode(function["description"]))
-
-                if "parameters" in function:
-                    parameters = function["parameters"]
-                    if "properties" in parameters:
-                        for propertiesKey, v in parameters["properties"].items():
-                            function_tokens += len(encoding.encode(propertiesKey))
-                            for field in v:
-                                if field == "type":
-                                    function_tokens += 2
-                                    function_tokens += len(encoding.encode(v["type"]))
-                                elif field == "description":
-                                    function_tokens += 2
-                                    function_tokens += len(
-                                        encoding.encode(v["description"])
-                                    )
-                                elif field == "default":
-                                    function_tokens += 2
-                                elif field == "enum":
-                                    function_tokens -= 3
-                                    for o in v["enum"]:
-                                        function_tokens += 3
-                                        function_tokens += len(encoding.encode(o))
-                                elif field == "items":
-                                    function_tokens += 10
-                                else:
-                                    logger.warning(
-                                        f"Warning: not supported field {field}"
-                                    )
-                        function_tokens += 11
-
-                num_tokens += function_tokens
-
-        num_tokens += 12  # Account for any additional overhead
-        return num_tokens
+        return tokenizer.count_function_tokens(functions, model)
 
     async def generate_full_message(username, merged_result_string, instruction_string):
         full_message = MessageParser.get_message(
@@ -957,60 +776,165 @@ class SettingsManager:
                 version = new_version
         return version
 
+    @staticmethod
+    def get_default_settings():
+        anthropic_api_key = api_keys.get("anthropic")
+        openai_api_key = api_keys.get("openai")
+        if anthropic_api_key:
+            active_model = "claude-3-opus-20240229"
+            small_model = SMALL_MODELS["anthropic"]
+        elif openai_api_key:
+            active_model = "gpt-4o"
+            small_model = SMALL_MODELS["openai"]
+        else:
+            active_model = "gpt-4o"
+            small_model = SMALL_MODELS["openai"]
+        default_settings = {
+            "addons": {},
+            "audio": {"voice_input": True, "voice_output": True},
+            "avatar": {"avatar": False},
+            "language": {"language": "en"},
+            "system_prompt": {"system_prompt": "stoic"},
+            "cot_enabled": {"cot_enabled": False},
+            "verbose": {"verbose": False},
+            "timezone": {"timezone": "Auto"},
+            "active_model": {"active_model": active_model},
+            "memory": {
+                "functions": 6400,
+                "ltm1": 2560,
+                "ltm2": 2560,
+                "episodic": 2560,
+                "recent": 2560,
+                "notes": 2560,
+                "input": 104960,
+                "output": 3840,
+                "max_tokens": 128000,
+                "min_tokens": 500,
+            },
+            "llm_cache": dict(llm_cache.CACHEABLE_ROLES),
+            "model_routing": {
+                role: {"model": small_model, "max_tokens": max_tokens}
+                for role, max_tokens in ROLE_MAX_TOKENS.items()
+            },
+        }
+        return default_settings
+
+    @staticmethod
+    def get_settings_file(users_dir, username):
+        return os.path.join(users_dir, username, "settings.json")
+
     @staticmethod
     async def load_settings(users_dir, username):
-        settings = {}
+        """Return an immutable snapshot of the user's settings.
+
+        The settings file is read and validated once, after that the snapshot is
+        served from memory until the file (or the addons directory) changes.
+        """
+        settings_file = SettingsManager.get_settings_file(users_dir, username)
+        settings = settings_cache.get(settings_file, dependencies=("addons",))
+        if settings is None:
+            settings = SettingsManager._read_settings(users_dir, username)
+        return settings
+
+    @staticmethod
+    def _read_settings(users_dir, username):
         settings_dir = os.path.join(users_dir, username)
         settings_file = os.path.join(settings_dir, "settings.json")
+        default_settings = SettingsManager.get_default_settings()
 
-        # Make sure the directory exists
-        if not os.path.exists(settings_dir):
-            os.makedirs(settings_dir)
+        # create the users directories if they don't exist
+        os.makedirs(settings_dir, exist_ok=True)
+        os.makedirs(
+            os.path.join(users_dir, convert_username(username), "data"),
+            exist_ok=True,
+        )
 
-        # Make sure the settings file exists
-        if not os.path.exists(settings_file):
-            with open(settings_file, "w") as f:
-                # Write default settings to the file
-                json.dump({}, f)
+        on_disk = settings_cache._read_file(settings_file)
+        if isinstance(on_disk, dict):
+            settings = json.loads(json.dumps(on_disk))
+        else:
+            settings = default_settings
 
-        # Load addons
-        await AddonManager.load_addons(username, users_dir)
+        # Validate and correct the settings
+        for key, default_value in default_settings.items():
+            # If the key is not in the settings or the type is not the same as the default value, set it to the default value
+            if key not in settings or type(settings[key]) != type(default_value):
+                settings[key] = default_value
+            # If the key is a dict, validate and correct the sub keys
+            elif isinstance(default_value, dict):
+                for sub_key, sub_default_value in default_value.items():
+                    if sub_key not in settings[key] or type(
+                        settings[key][sub_key]
+                    ) != type(sub_default_value):
+                        settings[key][sub_key] = sub_default_value
 
-        # Load settings
-        with open(settings_file, "r") as f:
-            settings = json.load(f)
+        # Delete addons that don't exist anymore and add the new ones, disabled
+        addon_names = [
+            filename[:-3]
+            for filename in os.listdir("addons")
+            if filename.endswith(".py")
+        ]
+        for addon in list(settings["addons"].keys()):
+            if addon not in addon_names:
+                del settings["addons"][addon]
+        for addon_name in addon_names:
+            if addon_name not in settings["addons"]:
+                settings["addons"][addon_name] = False
 
         # Update memory settings to the new format if needed
-        if "memory" in settings:
-            memory_settings = settings["memory"]
-            if isinstance(memory_settings.get("ltm1"), float):
-                max_tokens = memory_settings.get("max_tokens", 8000)
-                memory_settings["functions"] = int(
-                    memory_settings.get("functions", 0.05) * max_tokens
-                )
-                memory_settings["ltm1"] = int(
-                    memory_settings.get("ltm1", 0.02) * max_tokens
-                )
-                memory_settings["ltm2"] = int(
-                    memory_settings.get("ltm2", 0.02) * max_tokens
-                )
-                memory_settings["episodic"] = int(
-                    memory_settings.get("episodic", 0.02) * max_tokens
-                )
-                memory_settings["recent"] = int(
-                    memory_settings.get("recent", 0.02) * max_tokens
-                )
-                memory_settings["notes"] = int(
-                    memory_settings.get("notes", 0.02) * max_tokens
-                )
-                memory_settings["input"] = int(
-                    memory_settings.get("input", 0.82) * max_tokens
-                )
-                memory_settings["output"] = int(
-                    memory_settings.get("output", 0.03) * max_tokens
-                )
+        memory_settings = settings["memory"]
+        if isinstance(memory_settings.get("ltm1"), float):
+            max_tokens = memory_settings.get("max_tokens", 8000)
+            memory_settings["functions"] = int(
+                memory_settings.get("functions", 0.05) * max_tokens
+            )
+            memory_settings["ltm1"] = int(
+                memory_settings.get("ltm1", 0.02) * max_tokens
+            )
+            memory_settings["ltm2"] = int(
+                memory_settings.get("ltm2", 0.02) * max_tokens
+            )
+            memory_settings["episodic"] = int(
+                memory_settings.get("episodic", 0.02) * max_tokens
+            )
+            memory_settings["recent"] = int(
+                memory_settings.get("recent", 0.02) * max_tokens
+            )
+            memory_settings["notes"] = int(
+                memory_settings.get("notes", 0.02) * max_tokens
+            )
+            memory_settings["input"] = int(
+                memory_settings.get("input", 0.82) * max_tokens
+            )
+            memory_settings["output"] = int(
+                memory_settings.get("output", 0.03) * max_tokens
+            )
 
-        return settings
+        return settings_cache.put(
+            settings_file,
+            settings,
+            dependencies=("addons",),
+            on_disk=on_disk if on_disk is not None else {},
+        )
+
+    @staticmethod
+    async def update_settings(users_dir, username, settings):
+        """Replace the user's settings, the file is only written if they changed.
+
+        Returns the new snapshot.
+        """
+        settings_file = SettingsManager.get_settings_file(users_dir, username)
+        return settings_cache.put(settings_file, settings, dependencies=("addons",))
+
+    @staticmethod
+    def invalidate_settings(users_dir=None, username=None):
+        """Drop the cached settings of a user (or of all users), e.g. after the file was replaced."""
+        if username is None:
+            settings_cache.invalidate()
+        else:
+            settings_cache.invalidate(
+                SettingsManager.get_settings_file(users_dir, username)
+            )
 
     @staticmethod
     async def get_current_date_time(username):
@@ -1064,6 +988,7 @@ async def process_message(
 
     # load the setting for the user
     settings = await SettingsManager.load_settings(users_dir, username)
+    active_model = settings["active_model"]["active_model"]
 
     # Retrieve memory settings
     memory_settings = settings.get("memory", {})
@@ -1088,7 +1013,7 @@ async def process_message(
     )
 
     function_call_token_usage = MessageParser.num_tokens_from_functions(
-        function_metadata, "gpt-4"
+        function_metadata, active_model
     )
     logger.debug(f"function_call_token_usage: {function_call_token_usage}")
     token_usage += function_call_token_usage
@@ -1098,35 +1023,29 @@ async def process_message(
         username, chat_id, regenerate, uuid
     )
 
-    # for message in last_messages:
-    #     print(
-    #         f"{message['metadata'].get('username')}: {message['document']}",
-    #     )
-    last_messages_string = "\n".join(
-        f"{message['metadata'].get('username')}: {message['document']}"
-        for message in last_messages[-100:]
-    )
+    last_messages = last_messages[-100:]
 
-    # keep the last messages below 1000 tokens, if it is above 1000 tokens, delete the oldest messages until it is below 1000 tokens
-    last_messages_tokens = MessageParser.num_tokens_from_string(
-        last_messages_string, "gpt-4"
-    )
+    # keep the most recent messages that fit in the recent messages budget
     if tokens_recent_messages > 100:
+        last_messages_lines = [
+            f"{message['metadata'].get('username')}: {message['document']}"
+            for message in last_messages
+        ]
+        (
+            last_messages_string,
+            last_messages_tokens,
+            selected,
+        ) = tokenizer.get_token_packer(active_model).pack(
+            last_messages_lines,
+            tokens_recent_messages,
+            priority=[-i for i in range(len(last_messages_lines))],
+            contiguous=True,
+            truncate=False,
+        )
+        last_messages = [last_messages[i] for i in selected]
         logger.debug(
             f"last_messages_tokens: {last_messages_tokens} count: {len(last_messages)}"
         )
-        while last_messages_tokens > tokens_recent_messages:
-            last_messages.pop(0)
-            last_messages_string = "\n".join(
-                f"{message['metadata'].get('username')}: {message['document']}"
-                for message in last_messages[-100:]
-            )
-            last_messages_tokens = MessageParser.num_tokens_from_string(
-                last_messages_string, "gpt-4"
-            )
-            logger.debug(
-                f"new last_messages_tokens: {last_messages_tokens} count: {len(last_messages)}"
-            )
     else:
         last_messages_string = ""
 
@@ -1149,18 +1068,7 @@ async def process_message(
             {"role": "user", "content": all_messages},
         ]
         response = "New Chat"
-        default_par = default_params
-        default_par["max_tokens"] = settings.get("memory", {}).get("output", 1000)
-        default_par["model"] = settings.get("active_model").get("active_model")
-        responder = llmcalls.get_responder(
-            (
-                api_keys["openai"]
-                if settings.get("active_model").get("active_model").startswith("gpt")
-                else api_keys["anthropic"]
-            ),
-            settings.get("active_model").get("active_model"),
-            default_par,
-        )
+        responder = llmcalls.get_role_responder(settings, "tab_title")
 
         async for resp in responder.get_response(
             username,
@@ -1168,6 +1076,7 @@ async def process_message(
             stream=False,
             function_metadata=fakedata,
             chat_id=chat_id,
+            cache_role="tab_title",
         ):
             response = resp
 
@@ -1183,15 +1092,14 @@ async def process_message(
             username,
         )
 
-    message_tokens = MessageParser.num_tokens_from_string(all_messages, "gpt-4")
+    message_tokens = MessageParser.num_tokens_from_string(all_messages, active_model)
     token_usage += message_tokens
     remaining_tokens -= message_tokens
     logger.debug(f"1. remaining_tokens: {remaining_tokens}")
     verbose = settings.get("verbose").get("verbose")
 
     if regenerate is False:
-        memory = _memory.MemoryManager()
-        memory.model_used = settings["active_model"]["active_model"]
+        memory = _memory.MemoryManager(settings["active_model"]["active_model"])
         # Use the provided timestamp instead of the current time
         custom_metadata = {"created_at": timestamp.timestamp()} if timestamp else {}
         (
@@ -1237,7 +1145,7 @@ async def process_message(
         else:
             episodic_memory_string = ""
         episodic_memory_tokens = MessageParser.num_tokens_from_string(
-            episodic_memory_string, "gpt-4"
+            episodic_memory_string, active_model
         )
         token_usage += episodic_memory_tokens
         remaining_tokens -= episodic_memory_tokens
@@ -1308,7 +1216,7 @@ async def process_message(
             notes = ""
             notes_string = ""
 
-        notes_tokens = MessageParser.num_tokens_from_string(notes_string, "gpt-4")
+        notes_tokens = MessageParser.num_tokens_from_string(notes_string, active_model)
         token_usage += notes_tokens
         remaining_tokens -= notes_tokens
         logger.debug(f"5. remaining_tokens: {remaining_tokens}")
@@ -1387,8 +1295,7 @@ async def process_message(
         uuid=uuid,
     )
 
-    with Database() as db:
-        db.update_message_count(username)
+    usage_aggregator.add_message(username)
     return response
 
 
@@ -1452,18 +1359,7 @@ async def generate_response(
     #         prettyprint(f"System: {message['content']}", "green")
 
     response = ""
-    default_par = default_params
-    default_par["max_tokens"] = settings.get("memory", {}).get("output", 1000)
-    default_par["model"] = settings.get("active_model").get("active_model")
-    responder = llmcalls.get_responder(
-        (
-            api_keys["openai"]
-            if settings.get("active_model").get("active_model").startswith("gpt")
-            else api_keys["anthropic"]
-        ),
-        settings.get("active_model").get("active_model"),
-        default_par,
-    )
+    responder = llmcalls.get_role_responder(settings)
 
     async for resp in responder.get_response(
         username,
@@ -1487,19 +1383,11 @@ async def process_execute_python(
     full_response=None,
 ):
     settings = await SettingsManager.load_settings("users", username)
-    default_par = default_params
-    default_par["max_tokens"] = settings.get("memory", {}).get("output", 1000)
-    default_par["model"] = settings.get("active_model").get("active_model")
-    responder = llmcalls.get_responder(
-        (
-            api_keys["openai"]
-            if settings.get("active_model").get("active_model").startswith("gpt")
-            else api_keys["anthropic"]
-        ),
-        settings.get("active_model").get("active_model"),
-        default_par,
-    )
+    responder = llmcalls.get_role_responder(settings)
     joined_message = "".join(message)
+    if isinstance(function_response, dict):
+        # the output in a run_python_code result is already cut to its tail
+        function_response = format_result(function_response)
     messages = [
         {
             "role": "user",
@@ -1578,18 +1466,7 @@ async def process_function_reply(
                 "content": str(function_response),
             }
         )
-    default_par = default_params
-    default_par["max_tokens"] = settings.get("memory", {}).get("output", 1000)
-    default_par["model"] = settings.get("active_model").get("active_model")
-    responder = llmcalls.get_responder(
-        (
-            api_keys["openai"]
-            if settings.get("active_model").get("active_model").startswith("gpt")
-            else api_keys["anthropic"]
-        ),
-        settings.get("active_model").get("active_model"),
-        default_par,
-    )
+    responder = llmcalls.get_role_responder(settings)
     async for resp in responder.get_response(
         username,
         messages,
@@ -1622,23 +1499,13 @@ async def queryRewrite(query, username, user_dir, memories):
         },
     ]
     settings = await SettingsManager.load_settings(user_dir, username)
-    default_par = default_params
-    default_par["max_tokens"] = settings.get("memory", {}).get("output", 1000)
-    default_par["model"] = settings.get("active_model").get("active_model")
-    responder = llmcalls.get_responder(
-        (
-            api_keys["openai"]
-            if settings.get("active_model").get("active_model").startswith("gpt")
-            else api_keys["anthropic"]
-        ),
-        settings.get("active_model").get("active_model"),
-        default_par,
-    )
+    responder = llmcalls.get_role_responder(settings, "query_rewrite")
     async for resp in responder.get_response(
         username,
         messages,
         stream=False,
         function_metadata=fakedata,
+        cache_role="query_rewrite",
     ):
         rewritten_query = resp
 
@@ -1690,14 +1557,29 @@ from typing import Tuple, List
 from run_python_code import run_python_code
 
 
-async def extract_and_execute_code(text: str, username: str) -> str:
+async def extract_and_execute_code(text: str, username: str, chat_id=None) -> str:
     pip_packages = extract_pip_packages(text)
     code = extract_code(text)
 
     if not code:
         return "No code to execute."
 
-    result = await run_python_code(code, pip_packages, username=username)
+    async def send_output(output):
+        await MessageSender.send_message(
+            {"code_output": output, "chat_id": chat_id}, "blue", username
+        )
+
+    result = await run_python_code(
+        code, pip_packages, username=username, on_output=send_output
+    )
+    if "timings" in result:
+        timings = result["timings"]
+        await MessageSender.send_debug(
+            f"Code execution: queue {timings['queue']:.2f}s, container startup {timings['startup']:.2f}s, execution {timings['execution']:.2f}s",
+            2,
+            "gray",
+            username,
+        )
 
     return format_result(result)
 
@@ -0,0 +1,296 @@
+"""
+Shared on-disk cache for the web addons.
+
+The extracted text of visited pages and the results of web searches are stored
+zlib compressed in a sqlite database, keyed by url or query, and evicted least
+recently used once the cache is over WEB_CACHE_MAX_BYTES. Pages are fresh for the
+lifetime given by their Cache-Control / Expires headers, stale pages with an ETag
+or Last-Modified header are revalidated with a conditional request.
+
+The cache lookups of an addon call are collected with track_events(), so they can
+be shown in the function call debug messages.
+"""
+
+import asyncio
+import contextvars
+import email.utils
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+import logs
+from config import WEB_CACHE_DEFAULT_TTL, WEB_CACHE_MAX_BYTES, WEB_CACHE_PATH
+
+logger = logs.Log("web_cache", "web_cache.log").get_logger()
+
+# lifetime of pages without freshness headers, as a fraction of the time since Last-Modified
+HEURISTIC_FRACTION = 0.1
+HEURISTIC_MAX_TTL = 24 * 3600
+
+_events = contextvars.ContextVar("web_cache_events", default=None)
+
+
+def track_events():
+    """Collect the cache lookups of the current context in a list and return it."""
+    events = []
+    return events, _events.set(events)
+
+
+def stop_tracking(token):
+    _events.reset(token)
+
+
+def record_event(key, status):
+    """Record a cache lookup, status is "fresh", "revalidated" or "miss"."""
+    events = _events.get()
+    if events is not None:
+        events.append((key, status))
+
+
+def _parse_http_date(value):
+    if not value:
+        return None
+    try:
+        return email.utils.parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+def parse_cache_control(value):
+    directives = {}
+    for part in (value or "").split(","):
+        name, _, argument = part.strip().partition("=")
+        if name:
+            directives[name.lower()] = argument.strip('"') or None
+    return directives
+
+
+def freshness_lifetime(headers, default_ttl=WEB_CACHE_DEFAULT_TTL, now=None):
+    """Return how many seconds a response stays fresh, None if it may not be stored."""
+    headers = {key.lower(): value for key, value in (headers or {}).items()}
+    now = time.time() if now is None else now
+    cache_control = parse_cache_control(headers.get("cache-control"))
+    if "no-store" in cache_control:
+        return None
+    if "no-cache" in cache_control:
+        return 0
+
+    try:
+        age = max(0, int(headers.get("age", 0)))
+    except ValueError:
+        age = 0
+    for directive in ("s-maxage", "max-age"):
+        if cache_control.get(directive) is not None:
+            try:
+                return max(0, int(cache_control[directive]) - age)
+            except ValueError:
+                return 0
+
+    date = _parse_http_date(headers.get("date")) or now
+    if "expires" in headers:
+        expires = _parse_http_date(headers["expires"])
+        # an invalid Expires header means already expired
+        return max(0, expires - date - age) if expires else 0
+
+    last_modified = _parse_http_date(headers.get("last-modified"))
+    if last_modified is not None and last_modified < date:
+        return min(HEURISTIC_MAX_TTL, (date - last_modified) * HEURISTIC_FRACTION)
+    return default_ttl
+
+
+class CachedResponse:
+    __slots__ = ("key", "value", "etag", "last_modified", "expires_at")
+
+    def __init__(self, key, value, etag, last_modified, expires_at):
+        self.key = key
+        self.value = value
+        self.etag = etag
+        self.last_modified = last_modified
+        self.expires_at = expires_at
+
+    @property
+    def fresh(self):
+        return time.time() < self.expires_at
+
+    @property
+    def revalidatable(self):
+        return bool(self.etag or self.last_modified)
+
+    def conditional_headers(self):
+        """Return the headers for a conditional request for this response."""
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+
+class WebCache:
+    def __init__(
+        self,
+        path=WEB_CACHE_PATH,
+        max_bytes=WEB_CACHE_MAX_BYTES,
+        default_ttl=WEB_CACHE_DEFAULT_TTL,
+    ):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.default_ttl = default_ttl
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _get_connection(self):
+        if self._conn is None:
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS web_cache (
+                    key TEXT PRIMARY KEY,
+                    data BLOB NOT NULL,
+                    size INTEGER NOT NULL,
+                    etag TEXT,
+                    last_modified TEXT,
+                    expires_at REAL NOT NULL,
+                    accessed_at REAL NOT NULL
+                )
+                """
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS web_cache_accessed_at ON web_cache (accessed_at)"
+            )
+            self._conn.commit()
+        return self._conn
+
+    def get(self, key):
+        """Return the cached response for the key (fresh or stale) or None."""
+        try:
+            with self._lock:
+                conn = self._get_connection()
+                row = conn.execute(
+                    "SELECT data, etag, last_modified, expires_at FROM web_cache WHERE key = ?",
+                    (key,),
+                ).fetchone()
+                if row is None:
+                    return None
+                conn.execute(
+                    "UPDATE web_cache SET accessed_at = ? WHERE key = ?",
+                    (time.time(), key),
+                )
+                conn.commit()
+            data, etag, last_modified, expires_at = row
+            value = json.loads(zlib.decompress(data).decode("utf-8"))
+        except (sqlite3.Error, zlib.error, ValueError) as e:
+            logger.error(f"Error reading {key} from the web cache: {e}")
+            return None
+        return CachedResponse(key, value, etag, last_modified, expires_at)
+
+    def put(self, key, value, headers=None, ttl=None):
+        """Store a value, its lifetime comes from the response headers unless ttl is given.
+
+        Returns False if the headers don't allow storing the response.
+        """
+        headers = {k.lower(): v for k, v in (headers or {}).items()}
+        if ttl is None:
+            ttl = freshness_lifetime(headers, self.default_ttl)
+            if ttl is None:
+                return False
+        data = zlib.compress(json.dumps(value).encode("utf-8"))
+        now = time.time()
+        try:
+            with self._lock:
+                conn = self._get_connection()
+                conn.execute(
+                    "INSERT OR REPLACE INTO web_cache (key, data, size, etag, last_modified, expires_at, accessed_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (
+                        key,
+                        data,
+                        len(data),
+                        headers.get("etag"),
+                        headers.get("last-modified"),
+                        now + ttl,
+                        now,
+                    ),
+                )
+                self._evict(conn)
+                conn.commit()
+        except sqlite3.Error as e:
+            logger.error(f"Error writing {key} to the web cache: {e}")
+            return False
+        return True
+
+    def revalidated(self, key, headers=None):
+        """Extend the lifetime of a cached response after a 304 Not Modified."""
+        headers = {k.lower(): v for k, v in (headers or {}).items()}
+        ttl = freshness_lifetime(headers, self.default_ttl)
+        try:
+            with self._lock:
+                conn = self._get_connection()
+                if ttl is None:
+                    conn.execute("DELETE FROM web_cache WHERE key = ?", (key,))
+                else:
+                    conn.execute(
+                        "UPDATE web_cache SET expires_at = ?, etag = COALESCE(?, etag), last_modified = COALESCE(?, last_modified) WHERE key = ?",
+                        (
+                            time.time() + ttl,
+                            headers.get("etag"),
+                            headers.get("last-modified"),
+                            key,
+                        ),
+                    )
+                conn.commit()
+        except sqlite3.Error as e:
+            logger.error(f"Error revalidating {key} in the web cache: {e}")
+
+    # the sqlite I/O and the compression of the methods above on a worker
+    # thread, for the async addons
+
+    async def get_async(self, key):
+        return await asyncio.to_thread(self.get, key)
+
+    async def put_async(self, key, value, headers=None, ttl=None):
+        return await asyncio.to_thread(self.put, key, value, headers, ttl)
+
+    async def revalidated_async(self, key, headers=None):
+        return await asyncio.to_thread(self.revalidated, key, headers)
+
+    def _evict(self, conn):
+        """Drop the least recently used entries until the cache fits in max_bytes."""
+        (total,) = conn.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM web_cache"
+        ).fetchone()
+        if total <= self.max_bytes:
+            return
+        freed = 0
+        keys = []
+        for key, size in conn.execute(
+            "SELECT key, size FROM web_cache ORDER BY accessed_at"
+        ):
+            keys.append((key,))
+            freed += size
+            if total - freed <= self.max_bytes:
+                break
+        conn.executemany("DELETE FROM web_cache WHERE key = ?", keys)
+
+    def size(self):
+        with self._lock:
+            (total,) = (
+                self._get_connection()
+                .execute("SELECT COALESCE(SUM(size), 0) FROM web_cache")
+                .fetchone()
+            )
+        return total
+
+    def clear(self):
+        with self._lock:
+            conn = self._get_connection()
+            conn.execute("DELETE FROM web_cache")
+            conn.commit()
+
+
+web_cache = WebCache()
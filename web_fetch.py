@@ -0,0 +1,203 @@
+"""
+Fetch engine for the web addons.
+
+All fetches share one aiohttp client session (and so one connection pool) per
+event loop, with a limit on the connections per host. Bodies are streamed and
+cut off at WEB_FETCH_MAX_BYTES, the HTML is parsed with lxml on a worker thread
+and the extracted text is truncated incrementally against a token budget.
+"""
+
+import asyncio
+import threading
+
+import aiohttp
+import lxml.html
+from lxml import etree
+
+import logs
+import tokenizer
+from config import (
+    WEB_FETCH_MAX_BYTES,
+    WEB_FETCH_MAX_CONNECTIONS,
+    WEB_FETCH_PER_HOST,
+    WEB_FETCH_TIMEOUT,
+    WEB_FETCH_USER_AGENT,
+)
+
+logger = logs.Log("web_fetch", "web_fetch.log").get_logger()
+
+# size of the text chunks that are tokenized one by one while truncating
+TRUNCATE_CHUNK_CHARS = 2000
+
+
+class FetchResult:
+    """The (possibly truncated) body of a fetched url, or the error."""
+
+    __slots__ = ("url", "status", "headers", "body", "truncated", "encoding", "error")
+
+    def __init__(
+        self,
+        url,
+        status=None,
+        headers=None,
+        body=b"",
+        truncated=False,
+        encoding=None,
+        error=None,
+    ):
+        self.url = url
+        self.status = status
+        self.headers = headers or {}
+        self.body = body
+        self.truncated = truncated
+        self.encoding = encoding
+        self.error = error
+
+    @property
+    def ok(self):
+        return self.error is None
+
+
+class WebFetcher:
+    def __init__(
+        self,
+        max_bytes=WEB_FETCH_MAX_BYTES,
+        timeout=WEB_FETCH_TIMEOUT,
+        limit_per_host=WEB_FETCH_PER_HOST,
+        max_connections=WEB_FETCH_MAX_CONNECTIONS,
+        user_agent=WEB_FETCH_USER_AGENT,
+    ):
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self.limit_per_host = limit_per_host
+        self.max_connections = max_connections
+        self.user_agent = user_agent
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def get_session(self):
+        """Return the shared client session of the running event loop."""
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            session = self._sessions.get(loop)
+            if session is None or session.closed:
+                # drop the sessions of event loops that are gone
+                for other in [other for other in self._sessions if other.is_closed()]:
+                    del self._sessions[other]
+                session = aiohttp.ClientSession(
+                    connector=aiohttp.TCPConnector(
+                        limit=self.max_connections,
+                        limit_per_host=self.limit_per_host,
+                        ttl_dns_cache=300,
+                    ),
+                    timeout=aiohttp.ClientTimeout(total=self.timeout),
+                    headers={"User-Agent": self.user_agent},
+                )
+                self._sessions[loop] = session
+        return session
+
+    async def fetch(self, url, headers=None, max_bytes=None):
+        """Fetch a url, the body is read up to max_bytes. Errors are returned in the result."""
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        try:
+            async with self.get_session().get(url, headers=headers) as response:
+                result = FetchResult(
+                    str(response.url),
+                    status=response.status,
+                    headers=dict(response.headers),
+                    encoding=response.charset,
+                )
+                if response.status >= 400:
+                    result.error = f"{response.status} {response.reason} for url {url}"
+                    return result
+                chunks = []
+                size = 0
+                async for chunk in response.content.iter_chunked(64 * 1024):
+                    chunks.append(chunk)
+                    size += len(chunk)
+                    if size >= max_bytes:
+                        result.truncated = True
+                        break
+                result.body = b"".join(chunks)[:max_bytes]
+                return result
+        except asyncio.TimeoutError:
+            logger.warning(f"Fetching {url} timed out")
+            return FetchResult(url, error=f"Timed out after {self.timeout} seconds")
+        except aiohttp.ClientError as e:
+            logger.warning(f"Fetching {url} failed: {e}")
+            return FetchResult(url, error=str(e) or type(e).__name__)
+
+    async def fetch_all(self, urls, headers=None, max_bytes=None):
+        """Fetch the urls concurrently, the results are in the order of the urls."""
+        return await asyncio.gather(
+            *(self.fetch(url, headers=headers, max_bytes=max_bytes) for url in urls)
+        )
+
+    async def close(self):
+        with self._lock:
+            sessions = list(self._sessions.items())
+            self._sessions.clear()
+        loop = asyncio.get_running_loop()
+        for session_loop, session in sessions:
+            if session_loop is loop and not session.closed:
+                await session.close()
+
+
+def extract_page(body, encoding=None, include_links=True, include_images=False):
+    """Parse an HTML body and return its text, links and image sources.
+
+    Scripts and styles are dropped, the text is the stripped strings joined by spaces.
+    """
+    page = {"text": "", "links": [], "images": []}
+    if not body:
+        return page
+    try:
+        parser = lxml.html.HTMLParser(encoding=encoding) if encoding else None
+        document = lxml.html.document_fromstring(body, parser=parser)
+    except (etree.ParserError, LookupError, ValueError):
+        # unknown or wrong encoding, let lxml detect it
+        try:
+            document = lxml.html.document_fromstring(body)
+        except etree.ParserError:
+            return page
+    for element in document.xpath("//script|//style|//noscript"):
+        element.drop_tree()
+    page["text"] = " ".join(
+        text.strip() for text in document.itertext() if text and text.strip()
+    )
+    if include_links:
+        page["links"] = [href for href in document.xpath("//a/@href") if href]
+    if include_images:
+        page["images"] = [src for src in document.xpath("//img/@src") if src]
+    return page
+
+
+async def extract_page_async(
+    body, encoding=None, include_links=True, include_images=False
+):
+    """extract_page on a worker thread, so big pages don't block the event loop."""
+    return await asyncio.to_thread(
+        extract_page, body, encoding, include_links, include_images
+    )
+
+
+def truncate_to_tokens(text, budget, model="gpt-4"):
+    """Return the prefix of the text that fits in the token budget.
+
+    The text is tokenized chunk by chunk and the counting stops as soon as the
+    budget is used, so only the part of the page that is kept gets tokenized.
+    """
+    if budget <= 0:
+        return ""
+    packer = tokenizer.get_token_packer(model)
+    used = 0
+    for start in range(0, len(text), TRUNCATE_CHUNK_CHARS):
+        chunk = text[start : start + TRUNCATE_CHUNK_CHARS]
+        chunk_tokens = tokenizer.count_tokens(chunk, model)
+        if used + chunk_tokens > budget:
+            return text[:start] + packer.truncate(chunk, budget - used)
+        used += chunk_tokens
+    return text
+
+
+web_fetcher = WebFetcher()